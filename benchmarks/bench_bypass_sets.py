@@ -0,0 +1,133 @@
+# Copyright (c) 2025 whyDPI Contributors
+# SPDX-License-Identifier: MIT
+
+"""Per-connection netfilter cost of the TLS bypass list as it grows.
+
+Run as root from the repository root (needs ``unshare``, plus ``nft``
+and/or ``iptables-restore`` + ``ipset``)::
+
+    sudo python benchmarks/bench_bypass_sets.py [--sizes 10,100,1000,5000] [--connects 3000]
+
+The script re-executes itself in a private network namespace, so the
+host's ruleset is never touched.  For each list size it installs the
+real whyDPI rule set — the bypass list (random 10.0.0.0/8 /24s, none of
+which match) followed by the REDIRECT — and times loopback connects to
+port 443, each of which the REDIRECT sends to a local listener.  Every
+connect's first packet walks nat OUTPUT, so the rate falls with the cost
+of the bypass match.  Layouts compared:
+
+* ``rules``  — one ``-d <cidr>`` rule per entry (the fallback without ipset)
+* ``ipset``  — one rule matching an ipset ``hash:net``
+* ``nft``    — one rule matching an nftables interval set
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from whydpi.system.netfilter import Netfilter, compose_rules, render_restore  # noqa: E402
+
+
+_NETNS_FLAG = "WHYDPI_BENCH_NETNS"
+
+
+def _cidrs(count: int) -> list[str]:
+    rng = random.Random(count)
+    picked: set[str] = set()
+    while len(picked) < count:
+        picked.add(f"10.{rng.randrange(256)}.{rng.randrange(256)}.0/24")
+    return sorted(picked)
+
+
+def _listener() -> int:
+    server = socket.create_server(("127.0.0.1", 0), backlog=1024)
+
+    def accept() -> None:
+        while True:
+            conn, _ = server.accept()
+            conn.close()
+
+    threading.Thread(target=accept, daemon=True).start()
+    return server.getsockname()[1]
+
+
+def _connects_per_s(count: int) -> float:
+    start = time.perf_counter()
+    for _ in range(count):
+        with socket.create_connection(("127.0.0.1", 443), timeout=2):
+            pass
+    return count / (time.perf_counter() - start)
+
+
+def _install(layout: str, rules) -> Netfilter:
+    if layout == "rules":
+        subprocess.run(
+            ["iptables-restore", "--noflush"], check=True, text=True,
+            input=render_restore(rules, "v4", jumps=[("nat", "OUTPUT")], ipset=False),
+        )
+        return Netfilter(rules, backend="iptables")
+    nf = Netfilter(rules, backend="nft" if layout == "nft" else "iptables")
+    nf.apply()
+    return nf
+
+
+def _layouts() -> list[str]:
+    layouts = []
+    if shutil.which("iptables-restore"):
+        layouts.append("rules")
+        if shutil.which("ipset"):
+            layouts.append("ipset")
+    if shutil.which("nft"):
+        layouts.append("nft")
+    return layouts
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="10,100,1000,5000")
+    parser.add_argument("--connects", type=int, default=3000)
+    args = parser.parse_args()
+
+    if os.geteuid() != 0:
+        sys.exit("needs root (it creates a network namespace)")
+    if os.environ.get(_NETNS_FLAG) != "1":
+        os.environ[_NETNS_FLAG] = "1"
+        os.execvp("unshare", ["unshare", "--net", sys.executable, *sys.argv])
+    subprocess.run(["ip", "link", "set", "lo", "up"], check=True)
+
+    layouts = _layouts()
+    if not layouts:
+        sys.exit("neither nft nor iptables-restore is installed")
+    port = _listener()
+    _connects_per_s(200)  # warm the listener and the socket paths
+    print(f"{args.connects} connects per cell, connects/s (higher is better)")
+    print(f"{'entries':>8} " + " ".join(f"{layout:>10}" for layout in layouts))
+    for size in (int(s) for s in args.sizes.split(",")):
+        rules = compose_rules(
+            tls_port=port, tls_mark=1, ipv6_enabled=False, block_quic=False,
+            bypass_v4=_cidrs(size), bypass_v6=(),
+            dns_stub_address=None, dns_stub_port=53, dns_altport=None,
+        )
+        row = []
+        for layout in layouts:
+            nf = _install(layout, rules)
+            try:
+                row.append(_connects_per_s(args.connects))
+            finally:
+                nf.cleanup()
+        print(f"{size:>8} " + " ".join(f"{rate:>10.0f}" for rate in row))
+
+
+if __name__ == "__main__":
+    main()
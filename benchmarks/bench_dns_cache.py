@@ -0,0 +1,76 @@
+# Copyright (c) 2025 whyDPI Contributors
+# SPDX-License-Identifier: MIT
+
+"""Per-query cost of the :class:`~whydpi.net.dns_cache.DnsCache` hot path.
+
+Run from the repository root::
+
+    python benchmarks/bench_dns_cache.py
+
+Reports nanoseconds per operation for the question parse alone and for a
+full cache hit through :meth:`DnsCache.resolve`.  The ``legacy key`` row
+re-implements the pre-``parse_question`` string-decoding key so the two
+can be compared on the same machine; a hit used to pay for it up to
+three times per query.
+"""
+
+from __future__ import annotations
+
+import socket
+import struct
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from whydpi.net.dns import encode_dns_query  # noqa: E402
+from whydpi.net.dns_cache import DnsCache, parse_question  # noqa: E402
+
+
+def _legacy_key(wire: bytes) -> tuple[str, int, int] | None:
+    if len(wire) < 12 or struct.unpack_from("!H", wire, 4)[0] < 1:
+        return None
+    labels: list[str] = []
+    i = 12
+    while wire[i]:
+        length = wire[i]
+        labels.append(wire[i + 1:i + 1 + length].decode("ascii", errors="replace"))
+        i += 1 + length
+    qtype, qclass = struct.unpack_from("!HH", wire, i + 1)
+    return ".".join(labels).lower(), qtype, qclass
+
+
+def _response(query: bytes) -> bytes:
+    header = query[:2] + b"\x81\x80" + struct.pack("!HHHH", 1, 2, 0, 0)
+    answers = b"".join(
+        b"\xc0\x0c" + struct.pack("!HHIH", 1, 1, 300, 4) + socket.inet_aton(ip)
+        for ip in ("192.0.2.1", "192.0.2.2")
+    )
+    return header + query[12:] + answers
+
+
+def _bench(label: str, fn, arg, rounds: int) -> None:
+    start = time.perf_counter_ns()
+    for _ in range(rounds):
+        fn(arg)
+    per_op = (time.perf_counter_ns() - start) / rounds
+    print(f"{label:<28} {per_op:8.0f} ns/op")
+
+
+def main(rounds: int = 200_000) -> None:
+    query = encode_dns_query("static.cdn.Example-Content.com", 1, txid=0x1234)
+    cache = DnsCache()
+    cache.put(query, _response(query))
+
+    def never(_wire: bytes) -> bytes:
+        raise AssertionError("cache miss in hit benchmark")
+
+    _bench("legacy key", _legacy_key, query, rounds)
+    _bench("parse_question", parse_question, query, rounds)
+    _bench("DnsCache.get", cache.get, query, rounds)
+    _bench("DnsCache.resolve (hit)", lambda q: cache.resolve(q, never), query, rounds)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+# Copyright (c) 2025 whyDPI Contributors
+# SPDX-License-Identifier: MIT
+
+"""Throughput and latency of the DoH and DoT upstream transports.
+
+Run from the repository root (needs the ``openssl`` CLI for a throwaway
+self-signed certificate)::
+
+    python benchmarks/bench_dns_transport.py [--queries 4000] [--concurrency 16] [--delay-ms 0]
+
+Both transports talk to local stand-in servers on 127.0.0.1 that echo
+each query back as its answer after ``--delay-ms`` — a stand-in for the
+resolver's own processing time.  The DoH server speaks HTTP/1.1
+keep-alive like the public resolvers whyDPI targets; the DoT server
+answers pipelined queries concurrently, in completion order.  Reports
+queries per second and p50 / p95 / p99 latency per transport, with the
+client pools sized the way the engine sizes them.
+"""
+
+from __future__ import annotations
+
+import argparse
+import socket
+import ssl
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from whydpi.net.dns import DoHClient, DoHEndpoint, encode_dns_query  # noqa: E402
+from whydpi.net.dot import DoTClient, DoTEndpoint  # noqa: E402
+
+
+def _answer(query: bytes) -> bytes:
+    return query[:2] + b"\x81\x80" + query[4:]
+
+
+class _Server:
+    def __init__(self, ctx: ssl.SSLContext, delay_s: float) -> None:
+        self._ctx = ctx
+        self._delay = delay_s
+        self._listener = socket.create_server(("127.0.0.1", 0), backlog=128)
+        self.port = self._listener.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self) -> None:
+        while True:
+            try:
+                raw, _ = self._listener.accept()
+            except OSError:
+                return
+            raw.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self._serve_raw, args=(raw,), daemon=True).start()
+
+    def _serve_raw(self, raw: socket.socket) -> None:
+        try:
+            tls = self._ctx.wrap_socket(raw, server_side=True)
+        except (OSError, ssl.SSLError):
+            raw.close()
+            return
+        try:
+            self.serve(tls)
+        except (OSError, ssl.SSLError, ValueError, IndexError):
+            pass
+        finally:
+            tls.close()
+
+    def serve(self, tls: ssl.SSLSocket) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        self._listener.close()
+
+
+class _DoHServer(_Server):
+    """HTTP/1.1 keep-alive: one request at a time per connection."""
+
+    def serve(self, tls: ssl.SSLSocket) -> None:
+        buf = b""
+        while True:
+            while b"\r\n\r\n" not in buf:
+                chunk = tls.recv(4096)
+                if not chunk:
+                    return
+                buf += chunk
+            head, _, buf = buf.partition(b"\r\n\r\n")
+            length = int(head.lower().split(b"content-length:")[1].split(b"\r\n")[0])
+            while len(buf) < length:
+                buf += tls.recv(4096)
+            body, buf = buf[:length], buf[length:]
+            if self._delay:
+                time.sleep(self._delay)
+            reply = _answer(body)
+            tls.sendall(
+                b"HTTP/1.1 200 OK\r\nContent-Type: application/dns-message\r\n"
+                b"Content-Length: %d\r\n\r\n" % len(reply) + reply
+            )
+
+
+class _DoTServer(_Server):
+    """RFC 7858: pipelined queries answered as each completes."""
+
+    def serve(self, tls: ssl.SSLSocket) -> None:
+        lock = threading.Lock()
+        buf = b""
+        while True:
+            chunk = tls.recv(65536)
+            if not chunk:
+                return
+            buf += chunk
+            while len(buf) >= 2 and len(buf) >= 2 + struct.unpack_from("!H", buf)[0]:
+                length = struct.unpack_from("!H", buf)[0]
+                message, buf = buf[2:2 + length], buf[2 + length:]
+                if self._delay:
+                    threading.Thread(
+                        target=self._reply, args=(tls, lock, message), daemon=True,
+                    ).start()
+                else:
+                    self._send(tls, lock, message)
+
+    def _reply(self, tls: ssl.SSLSocket, lock: threading.Lock, message: bytes) -> None:
+        time.sleep(self._delay)
+        try:
+            self._send(tls, lock, message)
+        except (OSError, ssl.SSLError):
+            pass
+
+    @staticmethod
+    def _send(tls: ssl.SSLSocket, lock: threading.Lock, message: bytes) -> None:
+        reply = _answer(message)
+        with lock:
+            tls.sendall(struct.pack("!H", len(reply)) + reply)
+
+
+def _run(label: str, client, queries: int, concurrency: int) -> None:
+    client.warm_up()
+    wires = [encode_dns_query(f"host{i}.example", 1, txid=i & 0xFFFF) for i in range(queries)]
+    latencies: list[float] = []
+    lock = threading.Lock()
+    cursor = iter(range(queries))
+
+    def worker() -> None:
+        local: list[float] = []
+        while True:
+            with lock:
+                index = next(cursor, None)
+            if index is None:
+                break
+            start = time.perf_counter()
+            client.query(wires[index])
+            local.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(local)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+
+    def pct(p: float) -> float:
+        return 1000 * latencies[min(len(latencies) - 1, int(p * len(latencies)))]
+
+    print(
+        f"{label:<5} {queries / elapsed:9.0f} q/s   "
+        f"p50 {pct(0.50):6.2f} ms   p95 {pct(0.95):6.2f} ms   p99 {pct(0.99):6.2f} ms"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--queries", type=int, default=4000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--delay-ms", type=float, default=0.0,
+                        help="simulated resolver processing time per query")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cert, key = Path(tmp) / "cert.pem", Path(tmp) / "key.pem"
+        subprocess.run(
+            ["openssl", "req", "-x509", "-newkey", "ec",
+             "-pkeyopt", "ec_paramgen_curve:prime256v1", "-nodes",
+             "-subj", "/CN=localhost", "-days", "1",
+             "-keyout", str(key), "-out", str(cert)],
+            check=True, capture_output=True,
+        )
+        ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        ctx.load_cert_chain(cert, key)
+
+    delay = args.delay_ms / 1000
+    doh_server, dot_server = _DoHServer(ctx, delay), _DoTServer(ctx, delay)
+    doh = DoHClient(DoHEndpoint(ip="127.0.0.1", port=doh_server.port))
+    dot = DoTClient(DoTEndpoint(ip="127.0.0.1", port=dot_server.port))
+    print(f"{args.queries} queries, {args.concurrency} concurrent, "
+          f"{args.delay_ms:g} ms server delay")
+    try:
+        _run("DoH", doh, args.queries, args.concurrency)
+        _run("DoT", dot, args.queries, args.concurrency)
+    finally:
+        doh.close()
+        dot.close()
+        doh_server.close()
+        dot_server.close()
+
+
+if __name__ == "__main__":
+    main()
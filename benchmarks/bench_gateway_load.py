@@ -0,0 +1,284 @@
+# Copyright (c) 2025 whyDPI Contributors
+# SPDX-License-Identifier: MIT
+
+"""Many LAN clients through gateway mode, against plain forwarding.
+
+Run as root from the repository root (needs ``ip`` and ``nft``)::
+
+    sudo python benchmarks/bench_gateway_load.py [--clients 32] [--connections 200] [--concurrency 8] [--kb 64] [--client-limit 0]
+
+The script builds a small routed topology out of network namespaces::
+
+    wdgw-c0 .. wdgw-cN ──┐
+      10.77.x.y/16       ├─ br-lan 10.77.0.1 [wdgw-router] 198.18.0.1 ── 198.18.0.2:443 [wdgw-wan]
+                         ┘
+
+and runs every client at once, each opening ``--connections`` TLS
+connections (``--concurrency`` at a time) to the server, which answers
+each ClientHello with ``--kb`` KiB.  First with the router only
+forwarding, then with the real whyDPI gateway rules (nft backend) and
+proxy in the router namespace — relaying unshaped, as the SNI is
+user-passthrough — and reports per run:
+
+* connections/s and MiB/s over all clients;
+* p50 / p99 latency from connect to the last payload byte;
+* failed connections, and those refused by ``--client-limit`` (set it
+  below ``--concurrency`` to watch the per-client cap work).
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from whydpi.core.cache import StrategyCache  # noqa: E402
+from whydpi.core.strategy import Strategy  # noqa: E402
+from whydpi.net.proxy import TransparentTLSProxy  # noqa: E402
+from whydpi.net.tls_parser import build_minimal_client_hello  # noqa: E402
+from whydpi.system.netfilter import Gateway, Netfilter, compose_rules  # noqa: E402
+
+
+_PREFIX = "wdgw"
+_ROUTER = f"{_PREFIX}-router"
+_WAN = f"{_PREFIX}-wan"
+_LAN_IP = "10.77.0.1"
+_SERVER = "198.18.0.2"
+_PROXY_PORT = 18443
+_MARK = 0x2A
+_SNI = "bench.example"
+
+
+def _ip(*argv: str, ns: str | None = None) -> None:
+    prefix = ["ip", "netns", "exec", ns] if ns else []
+    subprocess.run([*prefix, "ip", *argv], check=True)
+
+
+def _client_ns(i: int) -> str:
+    return f"{_PREFIX}-c{i}"
+
+
+def _client_ip(i: int) -> str:
+    n = i + 2
+    return f"10.77.{n // 250}.{n % 250 + 2}"
+
+
+def _setup(clients: int) -> None:
+    for ns in (_ROUTER, _WAN):
+        _ip("netns", "add", ns)
+        _ip("link", "set", "lo", "up", ns=ns)
+    _ip("link", "add", "wdgw-wan0", "netns", _ROUTER, "type", "veth",
+        "peer", "name", "wdgw-wan1", "netns", _WAN)
+    _ip("addr", "add", "198.18.0.1/30", "dev", "wdgw-wan0", ns=_ROUTER)
+    _ip("link", "set", "wdgw-wan0", "up", ns=_ROUTER)
+    _ip("addr", "add", f"{_SERVER}/30", "dev", "wdgw-wan1", ns=_WAN)
+    _ip("link", "set", "wdgw-wan1", "up", ns=_WAN)
+    _ip("route", "add", "10.77.0.0/16", "via", "198.18.0.1", ns=_WAN)
+    _ip("link", "add", "br-lan", "type", "bridge", ns=_ROUTER)
+    _ip("addr", "add", f"{_LAN_IP}/16", "dev", "br-lan", ns=_ROUTER)
+    _ip("link", "set", "br-lan", "up", ns=_ROUTER)
+    subprocess.run(["ip", "netns", "exec", _ROUTER, "sysctl", "-qw",
+                    "net.ipv4.ip_forward=1"], check=True)
+    for i in range(clients):
+        ns = _client_ns(i)
+        _ip("netns", "add", ns)
+        _ip("link", "set", "lo", "up", ns=ns)
+        _ip("link", "add", "eth0", "netns", ns, "type", "veth",
+            "peer", "name", f"wdgw-p{i}", "netns", _ROUTER)
+        _ip("link", "set", f"wdgw-p{i}", "master", "br-lan", "up", ns=_ROUTER)
+        _ip("addr", "add", f"{_client_ip(i)}/16", "dev", "eth0", ns=ns)
+        _ip("link", "set", "eth0", "up", ns=ns)
+        _ip("route", "add", "default", "via", _LAN_IP, ns=ns)
+
+
+def _teardown(clients: int) -> None:
+    for ns in (_ROUTER, _WAN, *(_client_ns(i) for i in range(clients))):
+        subprocess.run(["ip", "netns", "del", ns], check=False, capture_output=True)
+
+
+def _role(ns: str, *argv: str) -> subprocess.Popen:
+    return subprocess.Popen(
+        ["ip", "netns", "exec", ns, sys.executable, __file__, *argv],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True,
+    )
+
+
+# -- roles (each runs inside its own namespace) ------------------------------
+
+def _serve(size: int) -> None:
+    payload = os.urandom(size)
+    listener = socket.create_server(("0.0.0.0", 443), backlog=4096)
+
+    def serve(conn: socket.socket) -> None:
+        with conn:
+            try:
+                if conn.recv(65536):
+                    conn.sendall(payload)
+                    conn.recv(1)  # hold until the client closes
+            except OSError:
+                pass
+
+    def accept() -> None:
+        while True:
+            conn, _ = listener.accept()
+            threading.Thread(target=serve, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=accept, daemon=True).start()
+    print("ready", flush=True)
+    sys.stdin.read()
+
+
+def _route(client_limit: int) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        proxy = TransparentTLSProxy(
+            port=_PROXY_PORT, proxy_mark=_MARK,
+            default_strategy=Strategy.parse("passthrough"), fallbacks=(),
+            cache=StrategyCache.load(Path(tmp) / "cache.json"),
+            timeout_s=3.0, success_min_bytes=1, passthrough_sni=(_SNI,),
+            probe_passthrough_first=True, ipv6_enabled=False,
+            listen_addresses=(_LAN_IP,), client_limit=client_limit,
+        )
+        proxy.start()
+        nf = Netfilter(compose_rules(
+            tls_port=_PROXY_PORT, tls_mark=_MARK, ipv6_enabled=False,
+            block_quic=False, bypass_v4=(), bypass_v6=(),
+            dns_stub_address=None, dns_stub_port=53, dns_altport=None,
+            gateway=Gateway(interfaces=("br-lan",), addresses=(_LAN_IP,), dns=False),
+        ), backend="nft")
+        nf.apply()
+        try:
+            print("ready", flush=True)
+            sys.stdin.read()
+        finally:
+            nf.cleanup()
+            proxy.stop()
+        print(json.dumps({"rejected": proxy.rejected}), flush=True)
+
+
+def _drive(size: int, connections: int, concurrency: int) -> None:
+    hello = build_minimal_client_hello(_SNI)
+    lock = threading.Lock()
+    cursor = iter(range(connections))
+    latencies: list[float] = []
+    failed = 0
+
+    def one() -> None:
+        nonlocal failed
+        start = time.perf_counter()
+        try:
+            with socket.create_connection((_SERVER, 443), timeout=10) as sock:
+                sock.sendall(hello)
+                got = 0
+                while got < size:
+                    chunk = sock.recv(65536)
+                    if not chunk:
+                        raise OSError("closed early")
+                    got += len(chunk)
+        except OSError:
+            with lock:
+                failed += 1
+            return
+        with lock:
+            latencies.append(time.perf_counter() - start)
+
+    def worker() -> None:
+        while True:
+            with lock:
+                if next(cursor, None) is None:
+                    return
+            one()
+
+    print("ready", flush=True)
+    sys.stdin.readline()  # start together
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    print(json.dumps({"latencies": latencies, "failed": failed}), flush=True)
+
+
+# -- driver -------------------------------------------------------------------
+
+def _run(args: argparse.Namespace, gateway: bool) -> str:
+    router = _role(_ROUTER, "--role", "router", "--client-limit", str(args.client_limit)) \
+        if gateway else None
+    if router is not None:
+        router.stdout.readline()
+    clients = [
+        _role(_client_ns(i), "--role", "client", "--kb", str(args.kb),
+              "--connections", str(args.connections), "--concurrency", str(args.concurrency))
+        for i in range(args.clients)
+    ]
+    for proc in clients:
+        proc.stdout.readline()
+    start = time.perf_counter()
+    for proc in clients:
+        proc.stdin.write("go\n")
+        proc.stdin.flush()
+    results = [json.loads(proc.communicate()[0].splitlines()[-1]) for proc in clients]
+    elapsed = time.perf_counter() - start
+    rejected = 0
+    if router is not None:
+        rejected = json.loads(router.communicate()[0].splitlines()[-1])["rejected"]
+
+    latencies = sorted(x for r in results for x in r["latencies"])
+    failed = sum(r["failed"] for r in results)
+    done = len(latencies)
+    p50 = latencies[done // 2] * 1000 if done else 0.0
+    p99 = latencies[min(done - 1, done * 99 // 100)] * 1000 if done else 0.0
+    mib = done * args.kb / 1024
+    label = "gateway" if gateway else "forwarded"
+    return (f"{label:<10} {done / elapsed:>8.0f} {mib / elapsed:>8.1f} "
+            f"{p50:>8.1f} {p99:>8.1f} {failed:>7} {rejected:>8}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--connections", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--kb", type=int, default=64)
+    parser.add_argument("--client-limit", type=int, default=0)
+    parser.add_argument("--role", choices=("server", "router", "client"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.role == "server":
+        return _serve(args.kb * 1024)
+    if args.role == "router":
+        return _route(args.client_limit)
+    if args.role == "client":
+        return _drive(args.kb * 1024, args.connections, args.concurrency)
+
+    if os.geteuid() != 0:
+        sys.exit("needs root (it creates network namespaces)")
+    _teardown(args.clients)
+    try:
+        _setup(args.clients)
+        server = _role(_WAN, "--role", "server", "--kb", str(args.kb))
+        server.stdout.readline()
+        print(f"{args.clients} clients x {args.connections} connections x {args.kb} KiB, "
+              f"{args.concurrency} concurrent each; client limit {args.client_limit or 'none'}")
+        print(f"{'path':<10} {'conn/s':>8} {'MiB/s':>8} {'p50 ms':>8} {'p99 ms':>8} "
+              f"{'failed':>7} {'rejected':>8}")
+        try:
+            for gateway in (False, True):
+                print(_run(args, gateway), flush=True)
+        finally:
+            server.stdin.close()
+            server.wait()
+    finally:
+        _teardown(args.clients)
+
+
+if __name__ == "__main__":
+    main()
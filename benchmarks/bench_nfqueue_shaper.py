@@ -0,0 +1,196 @@
+# Copyright (c) 2025 whyDPI Contributors
+# SPDX-License-Identifier: MIT
+
+"""Shaped connections through the proxy, against the NFQUEUE shaper.
+
+Run as root from the repository root (needs ``unshare``, ``nft`` and
+libnetfilter_queue)::
+
+    sudo python benchmarks/bench_nfqueue_shaper.py [--connections 2000] [--concurrency 32] [--kb 256] [--strategy record:sni-mid]
+
+The script re-executes itself in a private network namespace and runs
+a local server on 127.0.0.1:443 that reads each ClientHello record by
+record, then answers with ``--kb`` KiB.  Connections to it are shaped
+with ``--strategy`` twice: relayed by the transparent proxy (REDIRECT),
+then split in place by the NFQUEUE shaper.  Per run it reports:
+
+* connections/s and MiB/s;
+* how many TLS records the server saw per hello (2 when the split
+  reached it intact; 1 means the hello went out unshaped);
+* user + system CPU time per MiB, from ``os.times()`` — the process
+  hosts client, server and proxy or shaper, so this is the whole path;
+* for the shaper, hellos shaped and left alone.
+"""
+
+from __future__ import annotations
+
+import argparse
+import collections
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from whydpi.core.cache import StrategyCache  # noqa: E402
+from whydpi.core.strategy import Strategy  # noqa: E402
+from whydpi.net.proxy import TransparentTLSProxy  # noqa: E402
+from whydpi.net.tls_parser import build_minimal_client_hello  # noqa: E402
+from whydpi.system.netfilter import Netfilter, compose_rules  # noqa: E402
+from whydpi.system.nfq_shaper import NfqShaper  # noqa: E402
+
+
+_NETNS_FLAG = "WHYDPI_BENCH_NETNS"
+_PROXY_PORT = 18443
+_MARK = 0x2A
+_SHAPER_MARK = 0x2C
+_QUEUE = 4242
+_SNI = "bench.example"
+
+
+def _recv_exact(conn: socket.socket, n: int) -> bytes:
+    data = b""
+    while len(data) < n:
+        chunk = conn.recv(n - len(data))
+        if not chunk:
+            raise OSError("closed mid-record")
+        data += chunk
+    return data
+
+
+def _read_hello(conn: socket.socket) -> int:
+    """Read one handshake message record by record; the record count."""
+    body = b""
+    records = 0
+    while len(body) < 4 or len(body) < 4 + int.from_bytes(body[1:4], "big"):
+        header = _recv_exact(conn, 5)
+        body += _recv_exact(conn, int.from_bytes(header[3:5], "big"))
+        records += 1
+    return records
+
+
+def _server(payload: bytes, records: collections.Counter) -> socket.socket:
+    listener = socket.create_server(("127.0.0.1", 443), backlog=1024)
+    lock = threading.Lock()
+
+    def serve(conn: socket.socket) -> None:
+        with conn:
+            try:
+                count = _read_hello(conn)
+                with lock:
+                    records[count] += 1
+                conn.sendall(payload)
+                conn.recv(1)  # hold until the client closes
+            except OSError:
+                pass
+
+    def accept() -> None:
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=serve, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=accept, daemon=True).start()
+    return listener
+
+
+def _load(hello: bytes, size: int, connections: int, concurrency: int) -> tuple[float, float, float]:
+    lock = threading.Lock()
+    cursor = iter(range(connections))
+
+    def one() -> None:
+        with socket.create_connection(("127.0.0.1", 443), timeout=5) as sock:
+            sock.sendall(hello)
+            got = 0
+            while got < size:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    raise OSError("closed early")
+                got += len(chunk)
+
+    def worker() -> None:
+        while True:
+            with lock:
+                if next(cursor, None) is None:
+                    return
+            one()
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    cpu0, start = os.times(), time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed, cpu1 = time.perf_counter() - start, os.times()
+    mib = connections * size / (1 << 20)
+    cpu = (cpu1.user - cpu0.user) + (cpu1.system - cpu0.system)
+    return connections / elapsed, mib / elapsed, 1000 * cpu / mib
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--connections", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--kb", type=int, default=256)
+    parser.add_argument("--strategy", default="record:sni-mid")
+    args = parser.parse_args()
+
+    if os.geteuid() != 0:
+        sys.exit("needs root (it creates a network namespace)")
+    if os.environ.get(_NETNS_FLAG) != "1":
+        os.environ[_NETNS_FLAG] = "1"
+        os.execvp("unshare", ["unshare", "--net", sys.executable, *sys.argv])
+    subprocess.run(["ip", "link", "set", "lo", "up"], check=True)
+
+    size = args.kb * 1024
+    records: collections.Counter = collections.Counter()
+    _server(os.urandom(size), records)
+    hello = build_minimal_client_hello(_SNI)
+    strategy = Strategy.parse(args.strategy)
+    print(f"{args.connections} connections x {args.kb} KiB, {args.concurrency} concurrent, "
+          f"strategy {strategy.label()}")
+    print(f"{'path':<8} {'conn/s':>8} {'MiB/s':>8} {'cpu ms/MiB':>11}  records/hello  shaped/passed")
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode in ("proxy", "nfqueue"):
+            cache = StrategyCache.load(Path(tmp) / f"{mode}.json")
+            engine: TransparentTLSProxy | NfqShaper
+            if mode == "proxy":
+                engine = TransparentTLSProxy(
+                    port=_PROXY_PORT, proxy_mark=_MARK, default_strategy=strategy,
+                    fallbacks=(), cache=cache, timeout_s=3.0, success_min_bytes=1,
+                    passthrough_sni=(), probe_passthrough_first=False, ipv6_enabled=False,
+                )
+            else:
+                engine = NfqShaper(
+                    queue_num=_QUEUE, shaper_mark=_SHAPER_MARK, proxy_mark=_MARK,
+                    default_strategy=strategy, fallbacks=(), cache=cache,
+                    success_min_bytes=1,
+                )
+            engine.start()
+            nf = Netfilter(compose_rules(
+                tls_port=_PROXY_PORT, tls_mark=_MARK, ipv6_enabled=False,
+                block_quic=False, bypass_v4=(), bypass_v6=(),
+                dns_stub_address=None, dns_stub_port=53, dns_altport=None,
+                shaper_mark=_SHAPER_MARK if mode == "nfqueue" else 0, nfqueue_num=_QUEUE,
+            ), backend="nft")
+            nf.apply()
+            records.clear()
+            try:
+                rate, mib_s, cpu_ms = _load(hello, size, args.connections, args.concurrency)
+            finally:
+                nf.cleanup()
+                engine.stop()
+            seen = " ".join(f"{n}:{records[n]}" for n in sorted(records))
+            counts = f"{engine.shaped}/{engine.passed}" if isinstance(engine, NfqShaper) else "-"
+            print(f"{mode:<8} {rate:>8.0f} {mib_s:>8.1f} {cpu_ms:>11.2f}  {seen:<13}  {counts}")
+
+
+if __name__ == "__main__":
+    main()
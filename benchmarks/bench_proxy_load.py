@@ -0,0 +1,175 @@
+# Copyright (c) 2025 whyDPI Contributors
+# SPDX-License-Identifier: MIT
+
+"""Relay load through the transparent proxy, and what it costs the kernel.
+
+Run as root from the repository root (needs ``unshare`` and ``nft``)::
+
+    sudo python benchmarks/bench_proxy_load.py [--connections 2000] [--concurrency 32] [--kb 64] [--held 200]
+
+The script re-executes itself in a private network namespace, installs
+the real whyDPI rules (nft backend) and proxy there, and drives
+connections to 127.0.0.1:443 — REDIRECTed to the proxy, which relays
+them unshaped (the SNI is user-passthrough) to a local server on
+:443 that answers each ClientHello with ``--kb`` KiB.  Each run is
+repeated with and without ``notrack_upstream`` and reports:
+
+* connections/s and relayed MiB/s;
+* conntrack entries per relayed connection, from
+  ``nf_conntrack_count`` while ``--held`` connections are open at once;
+* system (kernel) CPU time per relayed MiB, from ``os.times()`` — the
+  process hosts client, proxy and server, so this is the whole path.
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from whydpi.core.cache import StrategyCache  # noqa: E402
+from whydpi.core.strategy import Strategy  # noqa: E402
+from whydpi.net.proxy import TransparentTLSProxy  # noqa: E402
+from whydpi.net.tls_parser import build_minimal_client_hello  # noqa: E402
+from whydpi.system.netfilter import Netfilter, compose_rules  # noqa: E402
+
+
+_NETNS_FLAG = "WHYDPI_BENCH_NETNS"
+_PROXY_PORT = 18443
+_MARK = 0x2A
+_SNI = "bench.example"
+_CONNTRACK_COUNT = Path("/proc/sys/net/netfilter/nf_conntrack_count")
+
+
+def _server(payload: bytes) -> socket.socket:
+    listener = socket.create_server(("127.0.0.1", 443), backlog=1024)
+
+    def serve(conn: socket.socket) -> None:
+        with conn:
+            try:
+                if conn.recv(65536):
+                    conn.sendall(payload)
+                    conn.recv(1)  # hold until the client closes
+            except OSError:
+                pass
+
+    def accept() -> None:
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=serve, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=accept, daemon=True).start()
+    return listener
+
+
+def _open(hello: bytes, size: int) -> socket.socket:
+    sock = socket.create_connection(("127.0.0.1", 443), timeout=5)
+    sock.sendall(hello)
+    got = 0
+    while got < size:
+        chunk = sock.recv(65536)
+        if not chunk:
+            raise OSError("relay closed early")
+        got += len(chunk)
+    return sock
+
+
+def _conntrack() -> int:
+    return int(_CONNTRACK_COUNT.read_text())
+
+
+def _entries_per_conn(hello: bytes, size: int, held: int) -> float:
+    time.sleep(0.5)
+    before = _conntrack()
+    socks = [_open(hello, size) for _ in range(held)]
+    during = _conntrack()
+    for sock in socks:
+        sock.close()
+    return (during - before) / held
+
+
+def _load(hello: bytes, size: int, connections: int, concurrency: int) -> tuple[float, float, float]:
+    lock = threading.Lock()
+    cursor = iter(range(connections))
+
+    def worker() -> None:
+        while True:
+            with lock:
+                if next(cursor, None) is None:
+                    return
+            _open(hello, size).close()
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    cpu0, start = os.times(), time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed, cpu1 = time.perf_counter() - start, os.times()
+    mib = connections * size / (1 << 20)
+    return connections / elapsed, mib / elapsed, 1000 * (cpu1.system - cpu0.system) / mib
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--connections", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--kb", type=int, default=64)
+    parser.add_argument("--held", type=int, default=200)
+    args = parser.parse_args()
+
+    if os.geteuid() != 0:
+        sys.exit("needs root (it creates a network namespace)")
+    if os.environ.get(_NETNS_FLAG) != "1":
+        os.environ[_NETNS_FLAG] = "1"
+        os.execvp("unshare", ["unshare", "--net", sys.executable, *sys.argv])
+    subprocess.run(["ip", "link", "set", "lo", "up"], check=True)
+
+    size = args.kb * 1024
+    _server(os.urandom(size))
+    hello = build_minimal_client_hello(_SNI)
+    with tempfile.TemporaryDirectory() as tmp:
+        proxy = TransparentTLSProxy(
+            port=_PROXY_PORT, proxy_mark=_MARK,
+            default_strategy=Strategy.parse("passthrough"), fallbacks=(),
+            cache=StrategyCache.load(Path(tmp) / "cache.json"),
+            timeout_s=3.0, success_min_bytes=1, passthrough_sni=(_SNI,),
+            probe_passthrough_first=True, ipv6_enabled=False,
+        )
+        proxy.start()
+        print(f"{args.connections} connections x {args.kb} KiB, "
+              f"{args.concurrency} concurrent; {args.held} held for conntrack")
+        print(f"{'upstream':<10} {'conn/s':>8} {'MiB/s':>8} {'ct/conn':>8} {'sys ms/MiB':>11}")
+        try:
+            for notrack in (False, True):
+                nf = Netfilter(compose_rules(
+                    tls_port=_PROXY_PORT, tls_mark=_MARK, ipv6_enabled=False,
+                    block_quic=False, bypass_v4=(), bypass_v6=(),
+                    dns_stub_address=None, dns_stub_port=53, dns_altport=None,
+                    notrack_mark=_MARK if notrack else 0,
+                ), backend="nft")
+                nf.apply()
+                try:
+                    per_conn = _entries_per_conn(hello, size, args.held)
+                    rate, mib_s, sys_ms = _load(hello, size, args.connections, args.concurrency)
+                finally:
+                    nf.cleanup()
+                label = "notrack" if notrack else "tracked"
+                print(f"{label:<10} {rate:>8.0f} {mib_s:>8.1f} {per_conn:>8.2f} {sys_ms:>11.2f}")
+        finally:
+            proxy.stop()
+
+
+if __name__ == "__main__":
+    main()
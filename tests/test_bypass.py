@@ -0,0 +1,76 @@
+# Copyright (c) 2025 whyDPI Contributors
+# SPDX-License-Identifier: MIT
+
+"""Unit tests for :class:`whydpi.core.bypass.LearnedBypass`."""
+
+from __future__ import annotations
+
+from pathlib import Path
+
+from whydpi.core.bypass import LearnedBypass
+from whydpi.core.cache import StrategyCache
+from whydpi.system.netfilter import compose_rules, render_ipset, render_nft
+
+
+class _Sets:
+    def __init__(self) -> None:
+        self.calls: list[tuple[str, tuple[str, ...], tuple[str, ...]]] = []
+
+    def __call__(self, name: str, *, add=(), remove=()) -> None:
+        self.calls.append((name, tuple(add), tuple(remove)))
+
+
+def _learned(tmp_path: Path, names: dict[str, list[str]] | None = None):
+    cache = StrategyCache.load(tmp_path / "s.json")
+    sets = _Sets()
+    learned = LearnedBypass(
+        cache=cache, update_set=sets, timeout_s=600, min_hits=2,
+        names_for=lambda ip: (names or {}).get(ip, []),
+    )
+    return learned, cache, sets
+
+
+def test_promotes_after_clean_hits_and_evicts_on_unvetted_answer(tmp_path: Path) -> None:
+    learned, cache, sets = _learned(tmp_path)
+    cache.record_success("cdn.example", "passthrough")
+    learned.observe("192.0.2.10", "cdn.example", True)
+    assert sets.calls == []
+    learned.observe("192.0.2.10", "cdn.example", True)
+    assert sets.calls == [("learned_v4", ("192.0.2.10",), ())]
+    assert learned.active() == ["192.0.2.10"]
+
+    # Another passthrough name on the same address keeps it in the set...
+    cache.record_success("static.example", "passthrough")
+    learned.on_answer("static.example", ["192.0.2.10"])
+    assert len(sets.calls) == 1
+    # ...a name that might need shaping takes it out before the answer.
+    learned.on_answer("blocked.example", ["192.0.2.10", "198.51.100.1"])
+    assert sets.calls[-1] == ("learned_v4", (), ("192.0.2.10",))
+    assert learned.active() == []
+
+
+def test_shared_or_tainted_addresses_are_never_promoted(tmp_path: Path) -> None:
+    learned, cache, sets = _learned(
+        tmp_path, names={"192.0.2.20": ["cdn.example", "blocked.example"]},
+    )
+    cache.record_success("cdn.example", "passthrough")
+    cache.record_success("blocked.example", "record:2")
+    for _ in range(3):
+        learned.observe("192.0.2.20", "cdn.example", True)
+    # A shaped connection taints the address even if later ones are clean.
+    learned.observe("192.0.2.30", "cdn.example", False)
+    for _ in range(3):
+        learned.observe("192.0.2.30", "cdn.example", True)
+    assert sets.calls == []
+
+
+def test_timed_sets_render_for_both_backends() -> None:
+    rules = compose_rules(
+        tls_port=4443, tls_mark=200, ipv6_enabled=False, block_quic=False,
+        bypass_v4=(), bypass_v6=(), dns_stub_address=None, dns_stub_port=53,
+        dns_altport=None, learned_bypass_s=600,
+    )
+    script = render_nft(rules)
+    assert "type ipv4_addr; flags timeout; timeout 600s;" in script
+    assert script.index("@learned_v4") < script.index("redirect to :4443")
+    assert "create whydpi-learned_v4 hash:net family inet timeout 600 -exist" in render_ipset(rules)
@@ -3,6 +3,7 @@
 
 from __future__ import annotations
 
+import socket
 import sys
 
 from whydpi.core import discovery as discovery_mod
@@ -12,6 +13,7 @@ from whydpi.core.discovery import (
     fragmentation_candidates,
     order_candidates,
     platform_fallbacks,
+    socket_strategy,
 )
 from whydpi.core.failure import FailureKind
 from whydpi.core.resolve import UpstreamTarget
@@ -46,6 +48,81 @@ def test_fragmentation_candidates_exclude_passthrough() -> None:
     assert all(s.layer != "passthrough" for s in frag)
 
 
+def test_fragmentation_candidates_try_mss_fallbacks_last() -> None:
+    frag = fragmentation_candidates(
+        None, Strategy.parse("record:2"), parse_fallback(["mss:100", "tcp:sni-mid"]),
+    )
+    assert [s.label() for s in frag] == ["record:2", "tcp:sni-mid", "mss:100"]
+    # A configured default keeps its place.
+    frag = fragmentation_candidates(
+        None, Strategy.parse("mss:100"), parse_fallback(["record:2", "tcp:sni-mid"]),
+    )
+    assert [s.label() for s in frag] == ["mss:100", "record:2", "tcp:sni-mid"]
+
+
+def test_socket_strategy_skips_layers_a_socket_cannot_apply() -> None:
+    fallbacks = parse_fallback(("decoy:5", "record:2"))
+    # decoy needs the packet shaper: the first fragmenting fallback instead.
+    assert socket_strategy(None, Strategy.parse("decoy:5"), fallbacks).label() == "record:2"
+    assert socket_strategy(
+        Strategy.parse("tcp:sni-mid"), Strategy.parse("decoy:5"), fallbacks,
+    ).label() == "tcp:sni-mid"
+    # An mss clamp would outlive the handshake on a keep-alive socket.
+    assert socket_strategy(
+        None, Strategy.parse("mss:100"), parse_fallback(["tcp:sni-mid"]),
+    ).label() == "tcp:sni-mid"
+    assert socket_strategy(None, Strategy.parse("mss:100"), ()) is None
+    # A name known to need nothing is left alone.
+    assert socket_strategy(Strategy.parse("passthrough"), Strategy.parse("record:2"), ()) is None
+    assert socket_strategy(None, Strategy.parse("decoy:5"), ()) is None
+
+
+def test_mss_plan_is_one_send_on_a_clamped_socket() -> None:
+    hello, view = _hello()
+    plan = discovery_mod.build_plan(hello, view, Strategy.parse("mss:100"))
+    with socket.create_server(("127.0.0.1", 0)) as listener:
+        port = listener.getsockname()[1]
+        upstream = discovery_mod.connect_upstream("127.0.0.1", port, 0, 2.0, mss=plan.mss)
+        conn, _ = listener.accept()
+        with upstream, conn:
+            # The segments carry exactly mss:N bytes, like a shaper's.
+            assert upstream.getsockopt(socket.IPPROTO_TCP, socket.TCP_MAXSEG) == 100
+            assert discovery_mod.socket_plan(upstream, plan) == plan
+            discovery_mod.send_plan(upstream, plan)
+            got = b""
+            while len(got) < len(hello):
+                got += conn.recv(65536)
+            assert got == hello
+
+    class Settled:
+        def __init__(self, mss: int) -> None:
+            self.mss = mss
+            self.sent: list[bytes] = []
+
+        def getsockopt(self, *_args) -> int:
+            return self.mss
+
+        def setsockopt(self, *_args) -> None:
+            pass
+
+        def send(self, data: bytes) -> int:
+            self.sent.append(data)
+            return len(data)
+
+        def sendall(self, data: bytes) -> None:
+            self.sent.append(data)
+
+    # The server advertised less: the kernel cuts 88-byte segments.
+    settled = discovery_mod.socket_plan(Settled(88), plan)
+    assert settled.mss == 88
+    assert [len(f) for f in settled.fragments[:-1]] == [88] * (len(settled.fragments) - 1)
+    # The clamp did not hold: one send per 100-byte fragment.
+    sock = Settled(1460)
+    assert discovery_mod.socket_plan(sock, plan).mss == 0
+    discovery_mod.send_plan(sock, plan)
+    assert sock.sent == list(plan.fragments)
+
+
 # --- upstream-IP rotation on a uniformly blocked address -------------------
 
 def _hello():
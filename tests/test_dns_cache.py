@@ -0,0 +1,224 @@
+# Copyright (c) 2025 whyDPI Contributors
+# SPDX-License-Identifier: MIT
+
+"""Unit tests for :class:`whydpi.net.dns_cache.DnsCache`."""
+
+from __future__ import annotations
+
+import socket
+import struct
+import threading
+
+from whydpi.net.dns import encode_dns_query
+from whydpi.net.dns_cache import DnsCache, parse_question
+
+
+def _a_response(query: bytes, ips: list[str], ttl: int = 300) -> bytes:
+    header = query[:2] + b"\x81\x80" + struct.pack("!HHHH", 1, len(ips), 0, 0)
+    answers = b"".join(
+        b"\xc0\x0c" + struct.pack("!HHIH", 1, 1, ttl, 4) + socket.inet_aton(ip)
+        for ip in ips
+    )
+    return header + query[12:] + answers
+
+
+def _ttls(response: bytes) -> list[int]:
+    ancount = struct.unpack_from("!H", response, 6)[0]
+    pos = response.index(b"\xc0\x0c")
+    out = []
+    for _ in range(ancount):
+        out.append(struct.unpack_from("!I", response, pos + 6)[0])
+        pos += 12 + struct.unpack_from("!H", response, pos + 10)[0]
+    return out
+
+
+def _age(cache: DnsCache, seconds: float) -> None:
+    for entry in cache._entries.values():
+        entry.expires_at -= seconds
+        entry.stored_at -= seconds
+
+
+def _nxdomain(query: bytes, soa_ttl: int, minimum: int) -> bytes:
+    header = query[:2] + b"\x81\x83" + struct.pack("!HHHH", 1, 0, 1, 0)
+    rdata = (
+        b"\x02ns\xc0\x14" + b"\x0ahostmaster\xc0\x14"
+        + struct.pack("!IIIII", 2025010101, 7200, 3600, 1209600, minimum)
+    )
+    soa = b"\xc0\x14" + struct.pack("!HHIH", 6, 1, soa_ttl, len(rdata)) + rdata
+    return header + query[12:] + soa
+
+
+def test_hit_overlays_caller_txid() -> None:
+    cache = DnsCache()
+    q1 = encode_dns_query("example.com", 1, txid=0x1111)
+    cache.put(q1, _a_response(q1, ["192.0.2.1"]))
+    q2 = encode_dns_query("EXAMPLE.com", 1, txid=0x2222)
+    hit = cache.get(q2)
+    assert hit is not None and hit[:2] == b"\x22\x22"
+
+
+def test_question_key_is_case_folded_wire() -> None:
+    q = parse_question(encode_dns_query("WwW.Example.COM", 28))
+    assert q is not None
+    assert q.key == b"\x03www\x07example\x03com\x00\x00\x1c\x00\x01"
+    assert q.qtype == 28
+    assert q.end == 12 + len(q.key)
+
+
+def test_question_rejects_malformed() -> None:
+    assert parse_question(b"") is None
+    assert parse_question(b"\x00" * 12 + b"\x03www") is None
+    # Compression pointer in the question: uncacheable, never a wrong hit.
+    assert parse_question(b"\x00" * 4 + b"\x00\x01" + b"\x00" * 6
+                          + b"\xc0\x0c\x00\x01\x00\x01") is None
+
+
+def test_refresh_ahead_for_hot_entry() -> None:
+    cache = DnsCache(prefetch_fraction=0.5, prefetch_min_hits=2)
+    query = encode_dns_query("example.com", 1)
+    cache.put(query, _a_response(query, ["192.0.2.1"]))
+    _age(cache, 200)  # 100 s of 300 s left: inside the refresh window
+
+    refreshed = threading.Event()
+
+    def compute(wire: bytes) -> bytes:
+        refreshed.set()
+        return _a_response(wire, ["192.0.2.2"])
+
+    # First hit is below the popularity floor: no refresh yet.
+    cache.resolve(query, compute)
+    assert not refreshed.is_set()
+    # Second hit still answers from RAM but kicks off a background refresh.
+    served = cache.resolve(query, compute)
+    assert socket.inet_aton("192.0.2.1") in served
+    assert refreshed.wait(2.0)
+    for _ in range(50):
+        if socket.inet_aton("192.0.2.2") in (cache.get(query) or b""):
+            break
+        threading.Event().wait(0.02)
+    assert socket.inet_aton("192.0.2.2") in cache.get(query)
+
+
+def test_serve_stale_when_upstream_fails() -> None:
+    cache = DnsCache()
+    query = encode_dns_query("example.com", 1, txid=0x4242)
+    cache.put(query, _a_response(query, ["192.0.2.1"]))
+    _age(cache, 400)
+    assert cache.get(query) is None
+
+    def failing(_wire: bytes) -> bytes:
+        raise OSError("upstream down")
+
+    served = cache.resolve(query, failing)
+    assert served[:2] == b"\x42\x42"
+    assert socket.inet_aton("192.0.2.1") in served
+    assert _ttls(served) == [30]
+
+
+def test_serve_stale_disabled() -> None:
+    cache = DnsCache(serve_stale_s=0)
+    query = encode_dns_query("example.com", 1)
+    cache.put(query, _a_response(query, ["192.0.2.1"]))
+    _age(cache, 400)
+    assert cache.resolve(query, lambda _w: b"") == b""
+    assert len(cache) == 0
+
+
+def test_eviction_drops_least_recently_used() -> None:
+    cache = DnsCache(max_entries=3)
+    queries = [encode_dns_query(f"h{i}.example", 1) for i in range(3)]
+    for q in queries:
+        cache.put(q, _a_response(q, ["192.0.2.1"]))
+    # Touch h0 so h1 becomes the least recently used entry.
+    assert cache.get(queries[0]) is not None
+    extra = encode_dns_query("h3.example", 1)
+    cache.put(extra, _a_response(extra, ["192.0.2.1"]))
+    assert len(cache) == 3
+    assert cache.get(queries[1]) is None
+    assert cache.get(queries[0]) is not None
+    assert cache.get(extra) is not None
+
+
+def test_eviction_prefers_dead_entries() -> None:
+    cache = DnsCache(max_entries=2, serve_stale_s=0)
+    old = encode_dns_query("old.example", 1)
+    cache.put(old, _a_response(old, ["192.0.2.1"], ttl=30))
+    live = encode_dns_query("live.example", 1)
+    cache.put(live, _a_response(live, ["192.0.2.2"]))
+    # ``old`` is most recently used but has expired: it must go first.
+    old_key = parse_question(old).key
+    cache._entries[old_key].expires_at -= 60
+    cache._expiry = [(e.expires_at, k) for k, e in cache._entries.items()]
+    cache._entries.move_to_end(old_key)
+    new = encode_dns_query("new.example", 1)
+    cache.put(new, _a_response(new, ["192.0.2.3"]))
+    assert cache.get(live) is not None
+    assert cache.get(new) is not None
+    assert old_key not in cache._entries
+
+
+def test_expiry_heap_stays_bounded() -> None:
+    cache = DnsCache(max_entries=4)
+    query = encode_dns_query("example.com", 1)
+    for _ in range(100):
+        cache.put(query, _a_response(query, ["192.0.2.1"]))
+    assert len(cache) == 1
+    assert len(cache._expiry) <= 8
+
+
+def test_hit_decrements_ttls() -> None:
+    cache = DnsCache()
+    query = encode_dns_query("example.com", 1)
+    cache.put(query, _a_response(query, ["192.0.2.1", "192.0.2.2"], ttl=300))
+    assert _ttls(cache.get(query)) == [300, 300]
+    _age(cache, 42)
+    assert _ttls(cache.get(query)) == [258, 258]
+    # The stored template itself is never modified.
+    assert _ttls(next(iter(cache._entries.values())).wire_template) == [300, 300]
+
+
+def test_negative_ttl_from_soa_minimum() -> None:
+    cache = DnsCache()
+    query = encode_dns_query("missing.example.com", 1)
+    cache.put(query, _nxdomain(query, soa_ttl=900, minimum=120))
+    entry = next(iter(cache._entries.values()))
+    assert entry.ttl == 120
+    # The SOA TTL is aged on hits like any other RR.
+    _age(cache, 20)
+    resp = cache.get(query)
+    assert resp is not None and resp[3] & 0x0F == 3
+    assert struct.unpack_from("!I", resp, len(query) + 6)[0] == 880
+
+
+def test_negative_without_soa_uses_floor() -> None:
+    cache = DnsCache()
+    query = encode_dns_query("missing.example.com", 1)
+    cache.put(query, query[:2] + b"\x81\x83" + query[4:])
+    assert next(iter(cache._entries.values())).ttl == 10
+
+
+def test_address_index_merges_and_expires() -> None:
+    cache = DnsCache()
+    q = encode_dns_query("www.example.com", 1)
+    cache.put(q, _a_response(q, ["192.0.2.1", "192.0.2.2"], ttl=60))
+    cache.put(q, _a_response(q, ["192.0.2.3"], ttl=1))
+    assert cache.addresses_for("WWW.Example.com.") == ["192.0.2.1", "192.0.2.2", "192.0.2.3"]
+    assert cache.hostname_for("192.0.2.1") == "www.example.com"
+    for known in cache._by_name.values():
+        known["192.0.2.3"] -= 5
+    assert cache.addresses_for("www.example.com") == ["192.0.2.1", "192.0.2.2"]
+    cache.wipe()
+    assert cache.addresses_for("www.example.com") == []
+
+
+def test_shared_address_has_no_single_hostname() -> None:
+    cache = DnsCache(max_entries=2)
+    for name in ("a.example", "b.example"):
+        q = encode_dns_query(name, 1)
+        cache.put(q, _a_response(q, ["192.0.2.9"]))
+    assert sorted(cache.names_for("192.0.2.9")) == ["a.example", "b.example"]
+    assert cache.hostname_for("192.0.2.9") is None
+    # The index is bounded like the cache: the oldest name goes first.
+    q = encode_dns_query("c.example", 1)
+    cache.put(q, _a_response(q, ["192.0.2.9"]))
+    assert sorted(cache.names_for("192.0.2.9")) == ["b.example", "c.example"]
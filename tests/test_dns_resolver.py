@@ -5,6 +5,8 @@ from __future__ import annotations
 
 import socket
 import struct
+import threading
+import time
 
 from whydpi.net.dns import (
     DNSStubServer,
@@ -12,6 +14,8 @@ from whydpi.net.dns import (
     decode_addresses,
     encode_dns_query,
 )
+from whydpi.net.dns_cache import DnsCache
+from whydpi.net.dns_policy import LocalAnswerPolicy
 
 
 def _qname(name: str) -> bytes:
@@ -84,6 +88,71 @@ def test_doh_resolver_empty_without_clients() -> None:
     assert DoHResolver([]).addresses("host.example") == []
 
 
+class _SlowClient(_FakeClient):
+    def __init__(self, ips_by_qtype: dict[int, list[str]], delay_s: float):
+        super().__init__(ips_by_qtype)
+        self._delay = delay_s
+        self.calls = 0
+
+    def query(self, wire: bytes) -> bytes:
+        self.calls += 1
+        time.sleep(self._delay)
+        return super().query(wire)
+
+
+def test_doh_resolver_fans_out_concurrently() -> None:
+    # Two clients x two qtypes at 0.3 s each: a sequential walk would
+    # take 1.2 s, the fan-out pays roughly one round-trip.
+    a = _SlowClient({1: ["192.0.2.1"], 28: ["2001:db8::1"]}, 0.3)
+    b = _SlowClient({1: ["198.51.100.1"]}, 0.3)
+    resolver = DoHResolver([a, b])
+    t0 = time.monotonic()
+    ips = resolver.addresses("host.example")
+    assert time.monotonic() - t0 < 0.9
+    assert ips[0] == "192.0.2.1"
+    assert set(ips) >= {"192.0.2.1", "198.51.100.1"}
+
+
+def test_doh_resolver_returns_at_quorum() -> None:
+    fast = _FakeClient({1: ["192.0.2.1"]})
+    stuck = _SlowClient({1: ["198.51.100.1"]}, 2.0)
+    resolver = DoHResolver([fast, stuck], quorum=1)
+    t0 = time.monotonic()
+    assert resolver.addresses("host.example", ipv6_enabled=False) == ["192.0.2.1"]
+    assert time.monotonic() - t0 < 1.0
+
+
+def test_doh_resolver_memoises_through_cache() -> None:
+    client = _SlowClient({1: ["192.0.2.1"]}, 0.05)
+    cache = DnsCache()
+    resolver = DoHResolver([client], cache=cache)
+    threads = [
+        threading.Thread(target=resolver.addresses, args=("host.example",),
+                         kwargs={"ipv6_enabled": False})
+        for _ in range(5)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert resolver.addresses("host.example", ipv6_enabled=False) == ["192.0.2.1"]
+    # One upstream query served every caller; the stub's own key space
+    # for the same question stays empty.
+    assert client.calls == 1
+    assert cache.get(encode_dns_query("host.example", 1)) is None
+
+
+def test_doh_resolver_answers_cached_names_without_threads(monkeypatch) -> None:
+    clients = [_FakeClient({1: ["192.0.2.1"]}), _FakeClient({1: ["198.51.100.1"]})]
+    resolver = DoHResolver(clients, cache=DnsCache())
+    expected = ["192.0.2.1", "198.51.100.1"]
+    assert resolver.addresses("host.example", ipv6_enabled=False) == expected
+    started: list[threading.Thread] = []
+    monkeypatch.setattr(threading.Thread, "start", lambda self: started.append(self))
+    assert resolver.addresses("host.example", ipv6_enabled=False) == expected
+    assert started == []
+
+
 def _parse_counts(msg: bytes) -> tuple[int, int, int, int, int, int]:
     return struct.unpack_from("!HHHHHH", msg, 0)
 
@@ -122,3 +191,104 @@ def test_stub_passes_through_a_query_when_neutralising() -> None:
     query = encode_dns_query("goonbox.cr", 1)
     resp = stub._resolve(query)
     assert decode_addresses(resp) == ["1.2.3.4"]
+
+
+class _TxidEchoClient:
+    """Answers with the query's txid; names starting ``slow`` stall."""
+
+    def query(self, wire: bytes) -> bytes:
+        if b"\x04slow" in wire:
+            time.sleep(0.3)
+        return wire[:2] + _a_response("host.example", ["192.0.2.1"])[2:]
+
+
+def _read_tcp_reply(sock: socket.socket) -> bytes:
+    length = struct.unpack("!H", sock.recv(2, socket.MSG_WAITALL))[0]
+    return sock.recv(length, socket.MSG_WAITALL)
+
+
+def test_stub_tcp_is_persistent_and_pipelined() -> None:
+    stub = DNSStubServer(
+        bind_address="127.0.0.53", bind_port=53, primary=_TxidEchoClient(),
+    )
+    stub._running = True
+    client, server = socket.socketpair()
+    handler = threading.Thread(target=stub._handle_tcp, args=(server,), daemon=True)
+    handler.start()
+    client.settimeout(3)
+
+    slow = encode_dns_query("slow.example", 1, txid=0x0001)
+    fast = encode_dns_query("fast.example", 1, txid=0x0002)
+    client.sendall(
+        struct.pack("!H", len(slow)) + slow + struct.pack("!H", len(fast)) + fast
+    )
+    # The fast answer overtakes the slow one on the same connection.
+    assert _read_tcp_reply(client)[:2] == b"\x00\x02"
+    assert _read_tcp_reply(client)[:2] == b"\x00\x01"
+
+    # The connection stays open for further queries.
+    again = encode_dns_query("fast.example", 1, txid=0x0003)
+    client.sendall(struct.pack("!H", len(again)) + again)
+    assert _read_tcp_reply(client)[:2] == b"\x00\x03"
+
+    # A half-close still delivers the reply in flight, then the stub hangs up.
+    client.sendall(struct.pack("!H", len(slow)) + slow)
+    client.shutdown(socket.SHUT_WR)
+    assert _read_tcp_reply(client)[:2] == b"\x00\x01"
+    handler.join(timeout=3)
+    assert not handler.is_alive()
+    client.close()
+
+
+def test_stub_answer_hook_sees_name_and_addresses() -> None:
+    seen: list[tuple[str, list[str]]] = []
+    stub = DNSStubServer(
+        bind_address="127.0.0.53", bind_port=53,
+        primary=_FakeClient({1: ["192.0.2.7"]}),
+        on_answer=lambda name, ips: seen.append((name, ips)),
+    )
+    stub._resolve(encode_dns_query("Host.Example", 1))
+    stub._resolve(encode_dns_query("host.example", 16))  # TXT: not reported
+    assert seen == [("host.example", ["192.0.2.7"])]
+
+
+def test_stub_prefetches_sibling_qtypes() -> None:
+    asked: list[int] = []
+
+    class _Client:
+        def query(self, wire: bytes) -> bytes:
+            asked.append(struct.unpack("!H", wire[-4:-2])[0])
+            return wire[:2] + b"\x81\x80" + wire[4:]  # NOERROR, no records
+
+    cache = DnsCache()
+    stub = DNSStubServer(
+        bind_address="127.0.0.53", bind_port=53, primary=_Client(),
+        cache=cache, sibling_qtypes=(1, 28),
+    )
+    stub._resolve(encode_dns_query("host.example", 1))
+    for _ in range(100):
+        if cache.get(encode_dns_query("host.example", 28)) is not None:
+            break
+        time.sleep(0.01)
+    stub._resolve(encode_dns_query("host.example", 28, txid=0x4242))
+    stub._resolve(encode_dns_query("host.example", 16))  # TXT: no siblings
+    assert sorted(asked) == [1, 16, 28]
+
+
+def test_stub_local_policy_answers_without_upstream() -> None:
+    upstream = _FakeClient({})
+    stub = DNSStubServer(
+        bind_address="127.0.0.53", bind_port=53, primary=upstream,
+        policy=LocalAnswerPolicy(ipv6_enabled=False, minimal_any=True),
+    )
+    upstream.query = None  # any forward would raise
+
+    aaaa = stub._resolve(encode_dns_query("host.example", 28, txid=0x0101))
+    assert aaaa[:2] == b"\x01\x01"
+    assert _parse_counts(aaaa)[2:] == (1, 0, 0, 0)
+
+    any_reply = stub._resolve(encode_dns_query("host.example", 255))
+    assert _parse_counts(any_reply)[2:] == (1, 1, 0, 0)
+    assert any_reply.endswith(struct.pack("!HHIH", 13, 1, 86400, 9) + b"\x07RFC8482\x00")
+    # HTTPS is forwarded unless ECH neutralisation is on.
+    assert 65 not in stub._policy.qtypes
@@ -0,0 +1,165 @@
+# Copyright (c) 2025 whyDPI Contributors
+# SPDX-License-Identifier: MIT
+
+"""Keep-alive DoH pool against a local TLS stand-in server."""
+
+from __future__ import annotations
+
+import shutil
+import socket
+import ssl
+import subprocess
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+from whydpi.core.strategy import Strategy
+from whydpi.net.dns import DoHConnectionPool, DoHEndpoint, encode_dns_query
+
+
+def _self_signed(tmp_path: Path) -> tuple[Path, Path]:
+    if shutil.which("openssl") is None:
+        pytest.skip("openssl CLI not available")
+    cert, key = tmp_path / "cert.pem", tmp_path / "key.pem"
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "ec",
+         "-pkeyopt", "ec_paramgen_curve:prime256v1", "-nodes",
+         "-subj", "/CN=localhost", "-days", "1",
+         "-keyout", str(key), "-out", str(cert)],
+        check=True, capture_output=True,
+    )
+    return cert, key
+
+
+class _EchoDoHServer:
+    """Answers every POST with its own body until the client hangs up."""
+
+    def __init__(self, cert: Path, key: Path, *, idle_timeout_s: float | None = None) -> None:
+        self._idle_timeout = idle_timeout_s
+        self.first_record_lengths: list[int] = []
+        self._ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self._ctx.load_cert_chain(cert, key)
+        self._listener = socket.create_server(("127.0.0.1", 0))
+        self.port = self._listener.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self) -> None:
+        while True:
+            try:
+                raw, _ = self._listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(raw,), daemon=True).start()
+
+    def _serve(self, raw: socket.socket) -> None:
+        tls = None
+        try:
+            header = raw.recv(5, socket.MSG_PEEK | socket.MSG_WAITALL)
+            self.first_record_lengths.append(int.from_bytes(header[3:5], "big"))
+            tls = self._ctx.wrap_socket(raw, server_side=True)
+            tls.settimeout(self._idle_timeout)
+            buf = b""
+            while True:
+                while b"\r\n\r\n" not in buf:
+                    chunk = tls.recv(4096)
+                    if not chunk:
+                        return
+                    buf += chunk
+                head, _, buf = buf.partition(b"\r\n\r\n")
+                length = int(head.lower().split(b"content-length:")[1].split(b"\r\n")[0])
+                while len(buf) < length:
+                    buf += tls.recv(4096)
+                body, buf = buf[:length], buf[length:]
+                tls.sendall(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: application/dns-message\r\n"
+                    b"Content-Length: %d\r\n\r\n" % len(body) + body
+                )
+        except (OSError, ssl.SSLError, IndexError, ValueError):
+            pass
+        finally:
+            (tls or raw).close()
+
+    def close(self) -> None:
+        self._listener.close()
+
+
+def test_new_connections_resume_tls_session(tmp_path: Path) -> None:
+    server = _EchoDoHServer(*_self_signed(tmp_path))
+    pool = DoHConnectionPool(DoHEndpoint(ip="127.0.0.1", port=server.port))
+    try:
+        wire = encode_dns_query("example.com", 1)
+        assert pool.query(wire) == wire
+        stats = pool.stats()
+        assert (stats["session_hits"], stats["session_misses"]) == (0, 1)
+        # A connection opened after the first response resumes its ticket.
+        fresh = pool._acquire(force_new=True)
+        assert fresh.session_reused
+        fresh.close()
+        stats = pool.stats()
+        assert (stats["session_hits"], stats["session_misses"]) == (1, 1)
+    finally:
+        pool.close()
+        server.close()
+    assert pool._session is None
+
+
+def test_pool_shrinks_to_observed_concurrency(tmp_path: Path) -> None:
+    server = _EchoDoHServer(*_self_signed(tmp_path))
+    pool = DoHConnectionPool(DoHEndpoint(ip="127.0.0.1", port=server.port))
+    try:
+        assert pool.warm_up(4) == 4
+        pool.query(encode_dns_query("example.com", 1))
+        # One window of single-query load halves the target.
+        pool._tick(now=time.monotonic() + pool._WINDOW_S + 1)
+        stats = pool.stats()
+        assert stats["target"] == 2
+        assert stats["idle"] == 2
+        assert stats["trimmed"] == 2
+    finally:
+        pool.close()
+        server.close()
+
+
+def test_pool_learns_idle_timeout_and_refreshes(tmp_path: Path) -> None:
+    server = _EchoDoHServer(*_self_signed(tmp_path), idle_timeout_s=0.3)
+    pool = DoHConnectionPool(DoHEndpoint(ip="127.0.0.1", port=server.port))
+    pool._MIN_LEARN_IDLE_S = 0.1
+    try:
+        wire = encode_dns_query("example.com", 1)
+        pool.query(wire)
+        time.sleep(0.6)
+        pool._tick()
+        stats = pool.stats()
+        assert stats["broken"] == 1 and stats["idle"] == 0
+        assert 0.3 <= stats["idle_timeout_s"] < 1.0
+        # With a learned limit, idle sockets are replaced before it.
+        pool.query(wire)
+        pool._tick()
+        stats = pool.stats()
+        assert stats["refreshed"] == 1 and stats["idle"] == 1
+        assert pool.query(wire) == wire
+    finally:
+        pool.close()
+        server.close()
+
+
+def test_client_hello_fragmented_in_process(tmp_path: Path) -> None:
+    server = _EchoDoHServer(*_self_signed(tmp_path))
+    pool = DoHConnectionPool(
+        DoHEndpoint(ip="127.0.0.1", port=server.port),
+        strategy=Strategy.parse("record:2"),
+    )
+    try:
+        wire = encode_dns_query("example.com", 1)
+        assert pool.query(wire) == wire
+        # The hello reached the server re-framed: a 2-byte first record.
+        assert server.first_record_lengths == [2]
+        fresh = pool._acquire(force_new=True)
+        assert fresh.session_reused
+        fresh.close()
+        assert pool.query(wire) == wire
+    finally:
+        pool.close()
+        server.close()
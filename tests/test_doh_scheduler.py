@@ -0,0 +1,143 @@
+# Copyright (c) 2025 whyDPI Contributors
+# SPDX-License-Identifier: MIT
+
+"""Unit tests for :class:`whydpi.net.doh_scheduler.DoHScheduler`."""
+
+from __future__ import annotations
+
+import threading
+import time
+
+import pytest
+
+from whydpi.net.dns import encode_dns_query
+from whydpi.net.doh_scheduler import DoHScheduler
+
+
+class _Client:
+    def __init__(self, name: str, *, delay_s: float = 0.0, fail: bool = False):
+        self.name = name
+        self.delay_s = delay_s
+        self.fail = fail
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def query(self, wire: bytes) -> bytes:
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.delay_s)
+        if self.fail:
+            raise OSError(f"{self.name} down")
+        return self.name.encode() + wire
+
+    def close(self) -> None:  # pragma: no cover - parity with DoHClient
+        pass
+
+    def __repr__(self) -> str:
+        return self.name
+
+
+_QUERY = encode_dns_query("example.com", 1)
+
+
+def test_hedges_to_runner_up_when_primary_stalls() -> None:
+    slow = _Client("slow", delay_s=1.0)
+    fast = _Client("fast")
+    scheduler = DoHScheduler([slow, fast])
+    start = time.monotonic()
+    assert scheduler.query(_QUERY).startswith(b"fast")
+    # Default hedge delay, not the stalled endpoint's full latency.
+    assert time.monotonic() - start < 0.8
+
+
+def test_no_hedge_when_disabled() -> None:
+    slow = _Client("slow", delay_s=0.4)
+    fast = _Client("fast")
+    scheduler = DoHScheduler([slow, fast], hedge=False)
+    assert scheduler.query(_QUERY).startswith(b"slow")
+    assert fast.calls == 0
+
+
+def test_error_fails_over_immediately() -> None:
+    broken = _Client("broken", fail=True)
+    good = _Client("good")
+    scheduler = DoHScheduler([broken, good])
+    start = time.monotonic()
+    assert scheduler.query(_QUERY).startswith(b"good")
+    assert time.monotonic() - start < 0.2
+
+
+def test_ranking_follows_measured_latency() -> None:
+    slower = _Client("slower", delay_s=0.03)
+    quicker = _Client("quicker", delay_s=0.001)
+    scheduler = DoHScheduler([slower, quicker], hedge=False)
+    scheduler.query(_QUERY)
+    # Warm both so each has a latency sample.
+    scheduler._record_success(scheduler._endpoints[1], 0.001)
+    for _ in range(5):
+        scheduler.query(_QUERY)
+    assert quicker.calls >= 5
+
+
+def test_ejection_and_health_check() -> None:
+    flaky = _Client("flaky", fail=True)
+    good = _Client("good")
+    scheduler = DoHScheduler([flaky, good], hedge=False)
+    scheduler._endpoints[0].backoff_s = 0.05
+    for _ in range(3):
+        scheduler._record_failure(scheduler._endpoints[0])
+    assert scheduler.stats()[0]["ejected"]
+    calls = flaky.calls
+    scheduler.query(_QUERY)
+    assert flaky.calls == calls  # out of rotation: no live traffic
+
+    flaky.fail = False
+    time.sleep(0.1)
+    calls = flaky.calls
+    scheduler.query(_QUERY)  # back-off over: triggers the health check
+    for _ in range(50):
+        if not scheduler.stats()[0]["ejected"]:
+            break
+        time.sleep(0.02)
+    assert not scheduler.stats()[0]["ejected"]
+    assert flaky.calls == calls + 1  # only the health-check probe
+
+
+def test_all_endpoints_failing_raises() -> None:
+    scheduler = DoHScheduler([_Client("a", fail=True), _Client("b", fail=True)])
+    with pytest.raises(OSError):
+        scheduler.query(_QUERY)
+
+
+def test_unhedged_queries_run_in_the_callers_thread() -> None:
+    seen: list[threading.Thread] = []
+
+    class Recording(_Client):
+        def query(self, wire: bytes) -> bytes:
+            seen.append(threading.current_thread())
+            return super().query(wire)
+
+    broken = Recording("broken", fail=True)
+    good = Recording("good")
+    scheduler = DoHScheduler([broken, good], hedge=False)
+    assert scheduler.query(_QUERY).startswith(b"good")
+    assert seen == [threading.current_thread()] * 2
+    # A single endpoint has nothing to hedge to either.
+    seen.clear()
+    DoHScheduler([good]).query(_QUERY)
+    assert seen == [threading.current_thread()]
+
+
+def test_close_stops_queries_and_health_checks() -> None:
+    flaky = _Client("flaky", fail=True)
+    scheduler = DoHScheduler([flaky, _Client("good")])
+    scheduler._endpoints[0].backoff_s = 0.0
+    for _ in range(3):
+        scheduler._record_failure(scheduler._endpoints[0])
+    scheduler.close()
+    calls = flaky.calls
+    with pytest.raises(OSError):
+        scheduler.query(_QUERY)
+    scheduler._ranked()   # a due health check is not started either
+    time.sleep(0.05)
+    assert flaky.calls == calls
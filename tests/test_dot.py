@@ -0,0 +1,156 @@
+# Copyright (c) 2025 whyDPI Contributors
+# SPDX-License-Identifier: MIT
+
+"""Pipelined DoT client against a local TLS stand-in server."""
+
+from __future__ import annotations
+
+import shutil
+import socket
+import ssl
+import struct
+import subprocess
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+from whydpi.net.dns import encode_dns_query
+from whydpi.net.dot import DoTClient, DoTEndpoint
+
+
+def _self_signed(tmp_path: Path) -> tuple[Path, Path]:
+    if shutil.which("openssl") is None:
+        pytest.skip("openssl CLI not available")
+    cert, key = tmp_path / "cert.pem", tmp_path / "key.pem"
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "ec",
+         "-pkeyopt", "ec_paramgen_curve:prime256v1", "-nodes",
+         "-subj", "/CN=localhost", "-days", "1",
+         "-keyout", str(key), "-out", str(cert)],
+        check=True, capture_output=True,
+    )
+    return cert, key
+
+
+class _EchoDoTServer:
+    """Echoes each framed query; names starting ``slow`` answer late."""
+
+    def __init__(self, cert: Path, key: Path) -> None:
+        self.connections = 0
+        self.txids: list[int] = []
+        self._ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self._ctx.load_cert_chain(cert, key)
+        self._listener = socket.create_server(("127.0.0.1", 0))
+        self.port = self._listener.getsockname()[1]
+        self._live: list[ssl.SSLSocket] = []
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self) -> None:
+        while True:
+            try:
+                raw, _ = self._listener.accept()
+            except OSError:
+                return
+            self.connections += 1
+            threading.Thread(target=self._serve, args=(raw,), daemon=True).start()
+
+    def _serve(self, raw: socket.socket) -> None:
+        try:
+            tls = self._ctx.wrap_socket(raw, server_side=True)
+        except (OSError, ssl.SSLError):
+            raw.close()
+            return
+        self._live.append(tls)
+        lock = threading.Lock()
+        try:
+            while True:
+                header = tls.recv(2)
+                if len(header) < 2:
+                    return
+                length = struct.unpack("!H", header)[0]
+                message = b""
+                while len(message) < length:
+                    chunk = tls.recv(length - len(message))
+                    if not chunk:
+                        return
+                    message += chunk
+                self.txids.append(struct.unpack_from("!H", message, 0)[0])
+                delay = 0.3 if b"\x04slow" in message else 0.0
+                threading.Thread(
+                    target=self._reply, args=(tls, lock, message, delay), daemon=True,
+                ).start()
+        except (OSError, ssl.SSLError):
+            pass
+        finally:
+            tls.close()
+
+    @staticmethod
+    def _reply(tls: ssl.SSLSocket, lock: threading.Lock, message: bytes, delay: float) -> None:
+        time.sleep(delay)
+        reply = message[:2] + b"\x81\x80" + message[4:]
+        try:
+            with lock:
+                tls.sendall(struct.pack("!H", len(reply)) + reply)
+        except (OSError, ssl.SSLError):
+            pass
+
+    def drop_connections(self) -> None:
+        for tls in self._live:
+            try:
+                tls.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self._live.clear()
+
+    def close(self) -> None:
+        self._listener.close()
+        self.drop_connections()
+
+
+def test_pipelined_replies_match_out_of_order(tmp_path: Path) -> None:
+    server = _EchoDoTServer(*_self_signed(tmp_path))
+    client = DoTClient(DoTEndpoint(ip="127.0.0.1", port=server.port), connections=1)
+    try:
+        results: dict[str, bytes] = {}
+        finished: list[str] = []
+
+        def ask(name: str, txid: int) -> None:
+            results[name] = client.query(encode_dns_query(name, 1, txid=txid))
+            finished.append(name)
+
+        slow = threading.Thread(target=ask, args=("slow.example", 0x1111))
+        slow.start()
+        time.sleep(0.05)
+        ask("fast.example", 0x2222)
+        slow.join(timeout=3)
+        # Both went over one connection; the fast reply overtook the slow one.
+        assert server.connections == 1
+        assert finished == ["fast.example", "slow.example"]
+        assert results["slow.example"][:2] == b"\x11\x11"
+        assert results["fast.example"][:2] == b"\x22\x22"
+        assert b"\x04fast\x07example\x00" in results["fast.example"]
+        # Each query went out under its own connection-unique ID.
+        assert len(set(server.txids)) == 2
+    finally:
+        client.close()
+        server.close()
+
+
+def test_reconnects_and_resumes_after_server_close(tmp_path: Path) -> None:
+    server = _EchoDoTServer(*_self_signed(tmp_path))
+    client = DoTClient(DoTEndpoint(ip="127.0.0.1", port=server.port), connections=1)
+    try:
+        wire = encode_dns_query("example.com", 1, txid=0x0102)
+        assert client.query(wire)[2:4] == b"\x81\x80"
+        server.drop_connections()
+        time.sleep(0.1)
+        assert client.query(wire)[:2] == b"\x01\x02"
+        stats = client.stats()
+        assert server.connections == 2
+        assert stats["session_hits"] == 1 and stats["session_misses"] == 1
+    finally:
+        client.close()
+        server.close()
+    assert client.stats()["connections"] == 0
@@ -0,0 +1,386 @@
+# Copyright (c) 2025 whyDPI Contributors
+# SPDX-License-Identifier: MIT
+
+"""Rendering and backend selection of :mod:`whydpi.system.netfilter`."""
+
+from __future__ import annotations
+
+import subprocess
+
+import pytest
+
+from whydpi.system import netfilter, policy_route
+from whydpi.system.netfilter import (
+    Netfilter,
+    compose_rules,
+    render_ipset,
+    render_nft,
+    render_restore,
+)
+
+
+def _rules(**overrides) -> list[netfilter.Rule]:
+    kwargs = dict(
+        tls_port=4443, tls_mark=200, ipv6_enabled=True, block_quic=True,
+        bypass_v4=("192.0.2.0/24", "198.51.100.0/24"), bypass_v6=("2001:db8::/32",),
+        dns_stub_address="127.0.0.53", dns_stub_port=53, dns_altport=None,
+    )
+    kwargs.update(overrides)
+    return compose_rules(**kwargs)
+
+
+@pytest.fixture
+def calls(monkeypatch: pytest.MonkeyPatch) -> list[tuple[list[str], str | None]]:
+    recorded: list[tuple[list[str], str | None]] = []
+
+    def fake_run(argv, *, must_succeed=False, stdin=None):
+        recorded.append((list(argv), stdin))
+        return True
+
+    monkeypatch.setattr(netfilter, "_run", fake_run)
+    return recorded
+
+
+def _tools(monkeypatch: pytest.MonkeyPatch, *present: str) -> None:
+    monkeypatch.setattr(
+        netfilter.shutil, "which",
+        lambda name: f"/usr/sbin/{name}" if name in present else None,
+    )
+
+
+def test_nft_script_uses_one_set_rule_per_family() -> None:
+    script = render_nft(_rules())
+    assert script.startswith("table inet whydpi\ndelete table inet whydpi\n")
+    assert "elements = { 192.0.2.0/24, 198.51.100.0/24 }" in script
+    assert script.count("@bypass_v4") == 1 and script.count("@bypass_v6") == 1
+    # Bypass returns precede the redirect in the same chain.
+    assert script.index("@bypass_v4") < script.index("redirect to :4443")
+    assert "dnat ip to 127.0.0.53:53" in script
+
+
+def test_restore_batch_fills_dedicated_chains() -> None:
+    batch = render_restore(_rules(), "v4", jumps=[("nat", "OUTPUT")])
+    assert ":WHYDPI_OUTPUT - [0:0]" in batch
+    assert (
+        "-A WHYDPI_OUTPUT -p tcp -m set --match-set whydpi-bypass_v4 dst "
+        "--dport 443 -j RETURN"
+    ) in batch
+    assert batch.count("-I OUTPUT 1 -j WHYDPI_OUTPUT") == 1
+    assert "2001:db8::/32" not in batch
+    # Without ipset the set is expanded to one rule per CIDR.
+    plain = render_restore(_rules(), "v4", ipset=False)
+    assert "-A WHYDPI_OUTPUT -p tcp -d 192.0.2.0/24 --dport 443 -j RETURN" in plain
+    assert "--match-set" not in plain
+
+
+def test_ipset_batch_and_collapsed_nft_elements() -> None:
+    rules = _rules(bypass_v4=("192.0.2.0/25", "192.0.2.128/25", "bogus"))
+    batch = render_ipset(rules)
+    assert "create whydpi-bypass_v4 hash:net family inet -exist" in batch
+    assert "create whydpi-bypass_v6 hash:net family inet6 -exist" in batch
+    assert "add whydpi-bypass_v6 2001:db8::/32 -exist" in batch
+    # ipset restore aborts on one bad line: the halves merge and the
+    # invalid entry is dropped, as in the nft set.
+    assert "add whydpi-bypass_v4 192.0.2.0/24 -exist" in batch
+    assert "bogus" not in batch and "add whydpi-bypass_v4 2001:db8" not in batch
+    # Adjacent halves merge; invalid entries are dropped from the nft set.
+    assert "elements = { 192.0.2.0/24 }" in render_nft(rules)
+    empty = render_nft(_rules(bypass_v4=()))
+    assert "set bypass_v4 {" in empty and "@bypass_v4" in empty
+
+
+def test_apply_and_cleanup_are_one_nft_call_each(monkeypatch, calls) -> None:
+    _tools(monkeypatch, "nft", "iptables", "ip6tables", "iptables-restore", "ip6tables-restore")
+    nf = Netfilter(_rules())
+    nf.apply()
+    assert [argv for argv, _ in calls] == [["nft", "-f", "-"]]
+    assert nf.applied_via == "nft"
+    calls.clear()
+    nf.cleanup()
+    assert [argv for argv, _ in calls] == [["nft", "delete", "table", "inet", "whydpi"]]
+
+
+def test_falls_back_to_iptables_restore(monkeypatch) -> None:
+    _tools(monkeypatch, "nft", "iptables", "iptables-restore")
+    seen: list[list[str]] = []
+
+    def fake_run(argv, *, must_succeed=False, stdin=None):
+        seen.append(list(argv))
+        if argv[0] == "nft":
+            raise subprocess.CalledProcessError(1, argv, b"", b"No such file or directory")
+        return "-C" not in argv  # no jump installed yet
+
+    monkeypatch.setattr(netfilter, "_run", fake_run)
+    nf = Netfilter(_rules(ipv6_enabled=False))
+    nf.apply()
+    assert nf.applied_via == "iptables"
+    restores = [argv for argv in seen if argv[0].endswith("iptables-restore")]
+    assert restores == [["/usr/sbin/iptables-restore", "--noflush"]]
+
+
+def test_update_set_is_one_call_per_backend(monkeypatch, calls) -> None:
+    _tools(monkeypatch, "nft")
+    nf = Netfilter(_rules(ipv6_enabled=False))
+    nf.apply()
+    calls.clear()
+    nf.update_set("bypass_v4", add=["203.0.113.0/24", "192.0.2.0/24"])
+    assert calls == [(
+        ["nft", "-f", "-"],
+        "add element inet whydpi bypass_v4 { 203.0.113.0/24 }\n",
+    )]
+    calls.clear()
+    nf.update_set("bypass_v4", remove=["192.0.2.0/24"])
+    assert len(calls) == 1
+    assert calls[0][1].startswith("flush set inet whydpi bypass_v4\n")
+    assert "{ 198.51.100.0/24, 203.0.113.0/24 }" in calls[0][1]
+    assert nf.set_members("bypass_v4") == ("198.51.100.0/24", "203.0.113.0/24")
+
+    _tools(monkeypatch, "iptables", "iptables-restore", "ipset")
+    nf = Netfilter(_rules(ipv6_enabled=False))
+    nf.apply()
+    order = [argv[0] for argv, _ in calls]
+    # The sets must exist before the rules that match them.
+    assert order.index("ipset") < order.index("/usr/sbin/iptables-restore")
+    calls.clear()
+    nf.update_set("bypass_v4", add=["203.0.113.0/24"], remove=["192.0.2.0/24"])
+    assert calls == [(
+        ["ipset", "restore"],
+        "del whydpi-bypass_v4 192.0.2.0/24 -exist\n"
+        "add whydpi-bypass_v4 203.0.113.0/24 -exist\n",
+    )]
+    calls.clear()
+    nf.update_set("bypass_v4", add=["bogus", "2001:db8::/32", "198.18.0.0/15"])
+    assert calls == [(["ipset", "restore"], "add whydpi-bypass_v4 198.18.0.0/15 -exist\n")]
+    with pytest.raises(KeyError):
+        nf.update_set("bypass_v6", add=["2001:db8::/32"])
+
+
+def test_timed_set_members_expire_with_the_kernel(monkeypatch, calls) -> None:
+    _tools(monkeypatch, "nft")
+    nf = Netfilter(_rules(ipv6_enabled=False, learned_bypass_s=60))
+    nf.apply()
+    calls.clear()
+    nf.update_set("learned_v4", add=["192.0.2.7"])
+    assert calls[-1][1] == "add element inet whydpi learned_v4 { 192.0.2.7 }\n"
+    assert nf.set_members("learned_v4") == ("192.0.2.7",)
+    clock = netfilter.time.monotonic() + 61
+    monkeypatch.setattr(netfilter.time, "monotonic", lambda: clock)
+    assert nf.set_members("learned_v4") == ()
+    # Expired in the kernel too, so re-adding is a fresh add.
+    nf.update_set("learned_v4", add=["192.0.2.7"])
+    assert calls[-1][1].startswith("add element")
+
+    _tools(monkeypatch, "iptables", "iptables-restore")
+    nf = Netfilter(_rules(ipv6_enabled=False, learned_bypass_s=60))
+    nf.apply()
+    with pytest.raises(RuntimeError):
+        nf.update_set("learned_v4", add=["192.0.2.7"])
+
+
+def test_timed_set_adds_survive_a_stale_delete(monkeypatch) -> None:
+    _tools(monkeypatch, "nft")
+    scripts: list[tuple[str, bool]] = []
+    refuse = {"delete": True, "add": False}
+
+    def fake_run(argv, *, must_succeed=False, stdin=None):
+        if stdin is not None:
+            scripts.append((stdin, must_succeed))
+            verb = stdin.split()[0]
+            if refuse.get(verb):
+                if must_succeed:
+                    raise subprocess.CalledProcessError(1, argv, b"", b"No such file")
+                return False
+        return True
+
+    monkeypatch.setattr(netfilter, "_run", fake_run)
+    nf = Netfilter(_rules(ipv6_enabled=False, learned_bypass_s=60))
+    nf.apply()
+    nf.update_set("learned_v4", add=["192.0.2.7", "192.0.2.8"])
+    scripts.clear()
+    # Both already expired in the kernel: the batch and each retry fail.
+    nf.update_set("learned_v4", add=["192.0.2.9"], remove=["192.0.2.7", "192.0.2.8"])
+    assert scripts == [
+        ("delete element inet whydpi learned_v4 { 192.0.2.7, 192.0.2.8 }\n", False),
+        ("delete element inet whydpi learned_v4 { 192.0.2.7 }\n", False),
+        ("delete element inet whydpi learned_v4 { 192.0.2.8 }\n", False),
+        ("add element inet whydpi learned_v4 { 192.0.2.9 }\n", True),
+    ]
+    assert nf.set_members("learned_v4") == ("192.0.2.9",)
+    # A refused add is not recorded, so the next add retries it.
+    refuse["add"] = True
+    with pytest.raises(subprocess.CalledProcessError):
+        nf.update_set("learned_v4", add=["192.0.2.10"])
+    assert nf.set_members("learned_v4") == ("192.0.2.9",)
+
+
+def test_notrack_rules_are_nft_only() -> None:
+    rules = _rules(ipv6_enabled=False, notrack_mark=200)
+    script = render_nft(rules)
+    assert "type filter hook output priority -300" in script
+    assert "meta nfproto ipv4 meta mark 200 notrack" in script
+    assert "socket mark 200 notrack" in script
+    batch = render_restore(rules, "v4")
+    assert "*raw" not in batch and "notrack" not in batch.lower()
+
+
+def test_tproxy_mode_marks_in_mangle_and_never_nats_tls(monkeypatch) -> None:
+    rules = _rules(tproxy_mark=201, dns_stub_address=None)
+    assert not [r for r in rules if r.table == "nat"]
+    script = render_nft(rules)
+    assert "type route hook output priority -150" in script
+    assert "tcp dport 443 meta mark != 200 meta mark set 201" in script
+    assert 'iifname "lo" tcp dport 443 meta mark 201 tproxy ip to 127.0.0.1:4443' in script
+    assert "tproxy ip6 to [::1]:4443" in script
+    # Exemptions move to the intercepting table, ahead of the mark.
+    assert script.index("@bypass_v4") < script.index("meta mark set 201")
+    batch = render_restore(rules, "v4")
+    assert "-j TPROXY --on-ip 127.0.0.1 --on-port 4443 --tproxy-mark 201" in batch
+
+    issued: list[list[str]] = []
+    monkeypatch.setattr(
+        policy_route, "_ip",
+        lambda argv, must_succeed=False: issued.append(list(argv)) or must_succeed,
+    )
+    policy_route.PolicyRoute(mark=201, table=201, ipv6_enabled=False).apply()
+    assert ["-4", "rule", "add", "fwmark", "201", "lookup", "201"] in issued
+    assert ["-4", "route", "add", "local", "default", "dev", "lo", "table", "201"] in issued
+
+
+def test_policy_route_rolls_back_a_half_applied_family(monkeypatch) -> None:
+    issued: list[list[str]] = []
+
+    def fake_ip(argv, must_succeed=False):
+        issued.append(list(argv))
+        if must_succeed and argv[1] == "route":
+            raise subprocess.CalledProcessError(2, ["ip", *argv], b"", b"RTNETLINK answers")
+        return must_succeed
+
+    monkeypatch.setattr(policy_route, "_ip", fake_ip)
+    route = policy_route.PolicyRoute(mark=201, table=201, ipv6_enabled=False)
+    with pytest.raises(subprocess.CalledProcessError):
+        route.apply()
+    added = issued.index(["-4", "rule", "add", "fwmark", "201", "lookup", "201"])
+    # The rule that did go in is deleted again; nothing is left marked applied.
+    assert ["-4", "rule", "del", "fwmark", "201", "lookup", "201"] in issued[added:]
+    assert not route._applied
+
+
+def test_gateway_intercepts_forwarded_lan_traffic(calls, monkeypatch) -> None:
+    lan = netfilter.Gateway(
+        interfaces=("br-lan",), addresses=("192.168.1.1",), subnets_v6=("fd00::/64",),
+    )
+    rules = _rules(gateway=lan)
+    script = render_nft(rules)
+    assert "type nat hook prerouting priority -100" in script
+    assert (
+        'iifname "br-lan" meta nfproto ipv4 tcp dport 443 fib daddr type != local '
+        "redirect to :4443"
+    ) in script
+    assert 'iifname "br-lan" ip6 saddr fd00::/64 tcp dport 443' in script
+    # DNS only for the family the stub listens on a LAN address for.
+    assert 'iifname "br-lan" meta nfproto ipv4 udp dport 53 redirect to :53' in script
+    assert "ip6 saddr fd00::/64 udp dport 53" not in script
+    assert 'iifname "br-lan" meta nfproto ipv4 udp dport 443 reject' in script
+    # One set, matched from both the local and the forwarded path.
+    assert script.count("set bypass_v4 {") == 1
+    prerouting = script[script.index("chain nat_prerouting"):]
+    assert prerouting.index("@bypass_v4") < prerouting.index("redirect to :4443")
+    assert render_ipset(rules).count("create whydpi-bypass_v4") == 1
+    batch = render_restore(rules, "v4", jumps=[("nat", "PREROUTING")])
+    assert (
+        "-A WHYDPI_PREROUTING -i br-lan -p tcp --dport 443 -m addrtype ! --dst-type LOCAL "
+        "-j REDIRECT --to-port 4443"
+    ) in batch
+    assert "-I PREROUTING 1 -j WHYDPI_PREROUTING" in batch
+
+    # Without ipset a runtime update reaches both chains' expanded rules.
+    _tools(monkeypatch, "iptables", "iptables-restore")
+    nf = Netfilter(_rules(ipv6_enabled=False, gateway=lan))
+    nf.apply()
+    calls.clear()
+    nf.update_set("bypass_v4", add=["203.0.113.0/24"])
+    chains = {argv[argv.index("-I") + 1] for argv, _ in calls}
+    assert chains == {"WHYDPI_OUTPUT", "WHYDPI_PREROUTING"}
+
+
+def test_gateway_tproxy_marks_lan_traffic_itself() -> None:
+    lan = netfilter.Gateway(interfaces=("br-lan",), port=4444)
+    script = render_nft(_rules(ipv6_enabled=False, tproxy_mark=201, gateway=lan))
+    # Forwarded connections reach a listener of their own.
+    assert (
+        'iifname "br-lan" meta nfproto ipv4 tcp dport 443 fib daddr type != local '
+        "tproxy ip to 127.0.0.1:4444 meta mark set 201 accept"
+    ) in script
+    assert "tproxy ip to 127.0.0.1:4443" in script
+    # No gateway address: the stub cannot take LAN DNS.
+    assert "dport 53 redirect" not in script
+
+
+def test_owner_policy_rules_and_counters(monkeypatch) -> None:
+    owners = netfilter.OwnerPolicy(uids=("1000",), cgroups=("/system.slice/backup.service",))
+    rules = _rules(ipv6_enabled=False, owners=owners)
+    script = render_nft(rules)
+    assert "counter uid_1000 { }" in script
+    # Counted in mangle OUTPUT, where every packet passes before NAT ...
+    chains = {c.split(" ", 1)[0]: c for c in script.split("chain ")[1:]}
+    mangle, nat = chains["mangle_output"], chains["nat_output"]
+    assert (
+        'socket cgroupv2 level 2 "system.slice/backup.service" meta nfproto ipv4 '
+        "tcp dport 443 meta mark != { 200 } counter name cgroup_system_slice_backup_service\n"
+    ) in mangle
+    # ... and excluded owners return before the redirect.
+    assert nat.index("meta skuid 1000 meta nfproto ipv4 tcp dport 443 return") < nat.index(
+        "redirect to :4443")
+    assert "counter name" not in nat
+    batch = render_restore(rules, "v4")
+    assert (
+        "-A WHYDPI_OUTPUT -m owner --uid-owner 1000 -p tcp --dport 443 "
+        "-m mark ! --mark 200 -m comment --comment whydpi:uid_1000\n"
+    ) in batch
+    assert "-A WHYDPI_OUTPUT -m owner --uid-owner 1000 -p tcp --dport 443 -j RETURN" in batch
+
+    include = netfilter.OwnerPolicy(mode="include", gids=("users",), uids=("backup",))
+    script = render_nft(_rules(ipv6_enabled=False, owners=include, tproxy_mark=201))
+    assert (
+        'meta skgid "users" meta nfproto ipv4 tcp dport 443 meta mark != 200 meta mark set 201'
+    ) in script
+    assert (
+        'meta skuid != "backup" meta skgid != "users" meta nfproto ipv4 tcp dport 443 '
+        "meta mark != { 200 } counter name owner_other"
+    ) in script
+    batch = render_restore(_rules(ipv6_enabled=False, owners=include, tproxy_mark=201), "v4")
+    assert (
+        "-m owner ! --uid-owner backup -m owner ! --gid-owner users -p tcp --dport 443"
+    ) in batch
+    shaped = render_nft(_rules(ipv6_enabled=False, owners=include, shaper_mark=202))
+    assert "meta mark != { 200, 202, 203 } counter name gid_users" in shaped
+
+    _tools(monkeypatch, "iptables", "iptables-save")
+    saved = (
+        "[7:9120] -A WHYDPI_OUTPUT -m owner --uid-owner 1000 -p tcp --dport 443 "
+        '-m mark ! --mark 200 -m comment --comment "whydpi:uid_1000"\n'
+        "[9:540] -A WHYDPI_OUTPUT -p tcp --dport 443 -j REDIRECT --to-ports 4443\n"
+    )
+    monkeypatch.setattr(netfilter, "_output", lambda argv: saved)
+    assert Netfilter(rules).counters() == {
+        "uid_1000": (7, 9120), "cgroup_system_slice_backup_service": (0, 0),
+    }
+
+
+def test_nfqueue_mode_queues_hellos_and_tagged_flows() -> None:
+    rules = _rules(shaper_mark=202, nfqueue_num=7, dns_stub_address=None)
+    assert not [r for r in rules if r.table == "nat"]
+    script = render_nft(rules)
+    assert (
+        "tcp dport 443 tcp flags & (syn | rst) == 0 ct original packets 2-8 "
+        "meta length >= 100 meta mark != { 200, 202, 203 } ct mark != 203 queue num 7 bypass"
+    ) in script
+    assert "tcp dport 443 meta mark 203 ct mark set 203" in script
+    assert "tcp sport 443 ct mark 203 queue num 7 bypass" in script
+    assert "tcp sport 443 ct mark 202 ct reply packets 1-8 queue num 7 bypass" in script
+    # Exemptions come before the queue.
+    assert script.index("@bypass_v4") < script.index("queue num 7")
+    batch = render_restore(rules, "v4")
+    assert "--connbytes 2:8 --connbytes-dir original --connbytes-mode packets" in batch
+    assert "-j NFQUEUE --queue-num 7 --queue-bypass" in batch
+    assert "-m mark --mark 202 -j CONNMARK --set-mark 202" in batch
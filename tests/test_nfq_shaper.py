@@ -0,0 +1,181 @@
+# Copyright (c) 2025 whyDPI Contributors
+# SPDX-License-Identifier: MIT
+
+"""The NFQUEUE shaper (:mod:`whydpi.system.nfq_shaper`) and its packet codec."""
+
+from __future__ import annotations
+
+import struct
+from pathlib import Path
+
+from whydpi.core.cache import StrategyCache
+from whydpi.core.strategy import Strategy
+from whydpi.net.tls_parser import build_minimal_client_hello
+from whydpi.system import tcp_packet
+from whydpi.system.nfq_shaper import NfqShaper
+from whydpi.system.tcp_packet import ACK, FIN, PSH, RST, _checksum
+
+
+CLIENT, SERVER = "192.0.2.10", "198.51.100.7"
+HELLO = build_minimal_client_hello("shaped.example")
+SEQ = 0xFFFFFF00  # wraps while the hello is in flight
+
+
+def _packet(
+    payload: bytes = b"", *, seq: int = SEQ, ack: int = 1000, flags: int = ACK | PSH,
+    src: str = CLIENT, dst: str = SERVER, sport: int = 40000, dport: int = 443,
+) -> bytes:
+    if ":" in src:
+        ip = struct.pack("!IHBB", 6 << 28, 0, 6, 64)
+        ip += bytes.fromhex(_v6(src)) + bytes.fromhex(_v6(dst))
+    else:
+        ip = struct.pack("!BBHHHBBH", 0x45, 0, 0, 1, 0x4000, 64, 6, 0)
+        ip += bytes(map(int, src.split("."))) + bytes(map(int, dst.split(".")))
+    tcp = struct.pack("!HHIIBBHHH", sport, dport, 0, 0, 5 << 4, 0, 65535, 0, 0)
+    template = tcp_packet.parse(ip + tcp)
+    assert template is not None
+    return template.rebuild(payload=payload, seq=seq, ack=ack, flags=flags)
+
+
+def _v6(address: str) -> str:
+    import ipaddress
+    return ipaddress.IPv6Address(address).packed.hex()
+
+
+def _valid(raw: bytes) -> bool:
+    packet = tcp_packet.parse(raw)
+    assert packet is not None
+    segment = raw[packet.ip_len:]
+    if packet.version == 4:
+        if _checksum(raw[:packet.ip_len]) != 0:
+            return False
+        pseudo = raw[12:20] + struct.pack("!BBH", 0, 6, len(segment))
+    else:
+        pseudo = raw[8:40] + struct.pack("!I3xB", len(segment), 6)
+    return _checksum(pseudo + segment) == 0
+
+
+def _shaper(tmp_path: Path, strategy: str, **kwargs) -> tuple[NfqShaper, list, StrategyCache]:
+    sent: list[tuple[bytes, int]] = []
+    cache = StrategyCache.load(tmp_path / "cache.json")
+    shaper = NfqShaper(
+        queue_num=200, shaper_mark=202, proxy_mark=200,
+        default_strategy=Strategy.parse(strategy), fallbacks=(), cache=cache,
+        send=lambda raw, _packet, mark: sent.append((raw, mark)), **kwargs,
+    )
+    return shaper, sent, cache
+
+
+def test_codec_round_trips_and_fixes_checksums() -> None:
+    for src, dst in ((CLIENT, SERVER), ("2001:db8::1", "2001:db8::2")):
+        raw = _packet(b"hello", src=src, dst=dst)
+        packet = tcp_packet.parse(raw)
+        assert packet is not None and _valid(raw)
+        assert (packet.src, packet.dst, packet.src_port, packet.dst_port) == (src, dst, 40000, 443)
+        assert packet.payload == b"hello" and packet.flags == ACK | PSH
+
+        out = packet.rebuild(payload=b"longer payload", seq=5, ack=7, ttl=3)
+        again = tcp_packet.parse(out)
+        assert _valid(out)
+        assert (again.seq, again.ack, again.payload) == (5, 7, b"longer payload")
+        assert out[8 if packet.version == 4 else 7] == 3
+    assert tcp_packet.parse(b"\x45" + bytes(30)) is None  # not TCP
+
+
+def test_record_split_rewrites_the_rest_of_the_flow(tmp_path: Path) -> None:
+    shaper, sent, cache = _shaper(tmp_path, "record:sni-mid")
+    verdict = shaper.handle(_packet(HELLO))
+    assert not verdict.accept
+    fragments = [tcp_packet.parse(raw) for raw, _ in sent]
+    assert {mark for _, mark in sent} == {203}
+    assert all(_valid(raw) for raw, _ in sent)
+    assert sum(len(f.payload) for f in fragments) == len(HELLO) + 5
+    assert fragments[1].seq == (SEQ + len(fragments[0].payload)) & 0xFFFFFFFF
+    assert [f.flags & PSH for f in fragments] == [0, PSH]
+
+    # A retransmitted hello repeats what actually went out.
+    assert not shaper.handle(_packet(HELLO)).accept
+    assert [raw for raw, _ in sent[2:]] == [raw for raw, _ in sent[:2]]
+
+    after = (SEQ + len(HELLO)) & 0xFFFFFFFF
+    out = shaper.handle(_packet(b"GET", seq=after)).payload
+    assert tcp_packet.parse(out).seq == (after + 5) & 0xFFFFFFFF and _valid(out)
+
+    reply = _packet(b"\x16\x03\x03\x00\x10", src=SERVER, dst=CLIENT, sport=443, dport=40000,
+                    seq=1000, ack=after + 5 + 3)
+    out = shaper.handle(reply).payload
+    assert tcp_packet.parse(out).ack == (after + 3) & 0xFFFFFFFF and _valid(out)
+    assert cache.get("shaped.example").strategy == "record:sni-mid"
+
+    fin = _packet(seq=after + 3, flags=ACK | FIN)
+    assert tcp_packet.parse(shaper.handle(fin).payload).seq == (after + 8) & 0xFFFFFFFF
+    assert shaper.handle(_packet(b"late", seq=after + 4)).payload is None
+
+
+def test_tcp_split_leaves_the_flow_alone(tmp_path: Path) -> None:
+    relayed: list[tuple[str, str, bool]] = []
+    shaper, sent, cache = _shaper(
+        tmp_path, "tcp:sni-mid", passthrough_sni=("plain.example",),
+        on_relayed=lambda *args: relayed.append(args),
+    )
+    assert not shaper.handle(_packet(HELLO)).accept
+    assert len(sent) == 2 and {mark for _, mark in sent} == {202}
+    assert b"".join(tcp_packet.parse(raw).payload for raw, _ in sent) == HELLO
+    assert shaper.handle(_packet(b"GET", seq=SEQ + len(HELLO))).payload is None
+
+    rst = _packet(src=SERVER, dst=CLIENT, sport=443, dport=40000, flags=RST)
+    assert shaper.handle(rst).accept
+    assert relayed == [(SERVER, "shaped.example", False)]
+    assert cache.get("shaped.example") is None
+
+    plain = _packet(build_minimal_client_hello("plain.example"), sport=40001)
+    assert shaper.handle(plain).accept and len(sent) == 2
+
+
+def test_passthrough_hello_is_only_tagged(tmp_path: Path) -> None:
+    relayed: list[tuple[str, str, bool]] = []
+    shaper, sent, _cache = _shaper(
+        tmp_path, "passthrough", on_relayed=lambda *args: relayed.append(args),
+    )
+    verdict = shaper.handle(_packet(HELLO))
+    assert verdict.accept and verdict.payload is None and verdict.mark == 202 and not sent
+    reply = _packet(b"\x16\x03\x03\x00\x10", src=SERVER, dst=CLIENT, sport=443, dport=40000)
+    assert shaper.handle(reply).payload is None
+    assert relayed == [(SERVER, "shaped.example", True)]
+
+
+def test_multi_segment_hello_is_reassembled_then_shaped(tmp_path: Path) -> None:
+    shaper, sent, _cache = _shaper(tmp_path, "record:sni-mid")
+    # The SNI only arrives with the second segment.
+    head, tail = HELLO[:60], HELLO[60:]
+    assert not shaper.handle(_packet(head, flags=ACK)).accept and not sent
+    assert not shaper.handle(_packet(tail, seq=SEQ + len(head))).accept
+    fragments = [tcp_packet.parse(raw) for raw, _ in sent]
+    assert fragments[0].seq == SEQ and all(_valid(raw) for raw, _ in sent)
+    assert b"".join(f.payload for f in fragments).count(b"shaped.example") == 0
+    assert sum(len(f.payload) for f in fragments) == len(HELLO) + 5
+    assert max(len(f.payload) for f in fragments) <= len(tail)
+    assert (shaper.shaped, shaper.reassembled, shaper.passed) == (1, 1, 0)
+
+    # Retransmitting either segment repeats the shaped flight.
+    count = len(sent)
+    assert not shaper.handle(_packet(tail, seq=SEQ + len(head))).accept
+    assert [raw for raw, _ in sent[count:]] == [raw for raw, _ in sent[:count]]
+
+
+def test_multi_segment_hello_for_passthrough_name_is_untouched(tmp_path: Path) -> None:
+    shaper, sent, _cache = _shaper(
+        tmp_path, "record:sni-mid", passthrough_sni=("shaped.example",),
+    )
+    head = HELLO[:-20]  # the SNI is complete in the first segment
+    assert shaper.handle(_packet(head, flags=ACK)).accept and not sent
+
+
+def test_multi_segment_hello_gap_releases_what_was_held(tmp_path: Path) -> None:
+    shaper, sent, _cache = _shaper(tmp_path, "record:sni-mid")
+    head = _packet(HELLO[:60], flags=ACK)
+    assert not shaper.handle(head).accept
+    verdict = shaper.handle(_packet(HELLO[:80], flags=ACK))  # retransmitted, coalesced
+    assert verdict.accept and verdict.mark == 202
+    assert sent == [(head, 202)]
+    assert (shaper.shaped, shaper.abandoned) == (0, 1)
@@ -0,0 +1,100 @@
+# Copyright (c) 2025 whyDPI Contributors
+# SPDX-License-Identifier: MIT
+
+"""Unit tests for :class:`whydpi.core.predictive.PredictiveDiscovery`."""
+
+from __future__ import annotations
+
+import time
+from pathlib import Path
+
+import pytest
+
+from whydpi.core import predictive
+from whydpi.core.cache import StrategyCache
+from whydpi.core.discovery import DiscoveryResult
+from whydpi.core.predictive import PredictiveDiscovery
+from whydpi.core.strategy import Strategy
+
+
+@pytest.fixture
+def probes(monkeypatch: pytest.MonkeyPatch) -> list[tuple[str, str]]:
+    calls: list[tuple[str, str]] = []
+
+    def fake_discover(**kwargs) -> DiscoveryResult:
+        calls.append((kwargs["sni"], kwargs["client_dest_ip"]))
+        return DiscoveryResult(
+            strategy=Strategy.parse("record:1"), upstream=None,
+            server_preview=b"", attempts=[],
+        )
+
+    monkeypatch.setattr(predictive, "discover_upstream", fake_discover)
+    return calls
+
+
+def _predictor(tmp_path: Path, **kwargs) -> tuple[PredictiveDiscovery, StrategyCache]:
+    cache = StrategyCache.load(tmp_path / "s.json")
+    predictor = PredictiveDiscovery(
+        cache=cache,
+        default=Strategy.parse("record:2"),
+        fallbacks=(),
+        proxy_mark=0,
+        timeout_s=1.0,
+        success_min_bytes=6,
+        **kwargs,
+    )
+    return predictor, cache
+
+
+def _settle(predictor: PredictiveDiscovery) -> None:
+    for _ in range(100):
+        if predictor._inflight == 0:
+            return
+        time.sleep(0.01)
+
+
+def test_popular_name_seeds_cache(
+    tmp_path: Path, probes: list, monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    # Back-to-back calls stand for lookups further apart than a pair.
+    monkeypatch.setattr(predictive, "_REPEAT_S", 0.0)
+    predictor, cache = _predictor(tmp_path, min_queries=2)
+    predictor.observe("WWW.Example.com.", ["192.0.2.10"])
+    _settle(predictor)
+    assert probes == []  # below the popularity threshold
+    predictor.observe("www.example.com", ["192.0.2.10"])
+    _settle(predictor)
+    assert probes == [("www.example.com", "192.0.2.10")]
+    assert cache.get("www.example.com").strategy == "record:1"
+    # A cached name is never probed again.
+    predictor.observe("www.example.com", ["192.0.2.10"])
+    _settle(predictor)
+    assert len(probes) == 1
+
+
+def test_rate_limit_and_passthrough(tmp_path: Path, probes: list) -> None:
+    predictor, _ = _predictor(
+        tmp_path, min_queries=1, max_per_minute=1,
+        passthrough_sni=("bank.example",),
+    )
+    predictor.observe("login.bank.example", ["192.0.2.1"])
+    predictor.observe("a.example", ["192.0.2.2"])
+    _settle(predictor)
+    predictor.observe("b.example", ["192.0.2.3"])
+    _settle(predictor)
+    assert [sni for sni, _ in probes] == ["a.example"]
+
+
+def test_ipv6_targets_skipped_when_disabled(tmp_path: Path, probes: list) -> None:
+    predictor, _ = _predictor(tmp_path, min_queries=1, ipv6_enabled=False)
+    predictor.observe("v6.example", ["2001:db8::1"])
+    _settle(predictor)
+    assert probes == []
+
+
+def test_a_and_aaaa_of_one_lookup_count_once(tmp_path: Path, probes: list) -> None:
+    predictor, _ = _predictor(tmp_path, min_queries=2)
+    predictor.observe("tracker.example", ["192.0.2.20"])
+    predictor.observe("tracker.example", ["2001:db8::20"])
+    _settle(predictor)
+    assert probes == []
@@ -0,0 +1,73 @@
+# Copyright (c) 2025 whyDPI Contributors
+# SPDX-License-Identifier: MIT
+
+"""Admission in the transparent TLS proxy (:mod:`whydpi.net.proxy`)."""
+
+from __future__ import annotations
+
+import socket
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+from whydpi.core.cache import StrategyCache
+from whydpi.core.strategy import Strategy
+from whydpi.net import proxy as proxy_mod
+from whydpi.net.proxy import TransparentTLSProxy
+
+
+def _free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def _closed(conn: socket.socket) -> bool:
+    conn.settimeout(0.3)
+    try:
+        return conn.recv(1) == b""
+    except socket.timeout:
+        return False
+    except OSError:
+        return True
+
+
+def test_client_limit_caps_the_gateway_listener_only(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    release = threading.Event()
+
+    def hold(client: socket.socket, _family: int, _ctx) -> None:
+        release.wait(10.0)
+        client.close()
+
+    monkeypatch.setattr(proxy_mod, "_handle", hold)
+    port, gateway_port = _free_port(), _free_port()
+    proxy = TransparentTLSProxy(
+        port=port, proxy_mark=200, default_strategy=Strategy.parse("record:2"), fallbacks=(),
+        cache=StrategyCache.load(tmp_path / "cache.json"), timeout_s=1.0,
+        success_min_bytes=1, passthrough_sni=(), probe_passthrough_first=False,
+        ipv6_enabled=False, gateway_port=gateway_port, client_limit=1,
+    )
+    proxy.start()
+    try:
+        # The host's own connections reach the local listener uncapped ...
+        own = [socket.create_connection(("127.0.0.1", port)) for _ in range(3)]
+        # ... while forwarded ones, whatever their source, get their share.
+        lan = [socket.create_connection(("127.0.0.1", gateway_port)) for _ in range(2)]
+        assert _closed(lan[1])
+        assert not any(_closed(c) for c in own)
+        assert proxy.rejected == 1
+        assert proxy._clients == {"127.0.0.1": 1}
+        release.set()
+        for conn in (*own, *lan):
+            conn.close()
+        # The count is released with the connection.
+        deadline = time.monotonic() + 3.0
+        while proxy._clients and time.monotonic() < deadline:
+            time.sleep(0.02)
+        assert proxy._clients == {}
+    finally:
+        proxy.stop()
@@ -0,0 +1,113 @@
+# Copyright (c) 2025 whyDPI Contributors
+# SPDX-License-Identifier: MIT
+
+"""Unit tests for :class:`whydpi.core.quic.QuicPolicy` and its rules."""
+
+from __future__ import annotations
+
+import threading
+import time
+from pathlib import Path
+
+from whydpi.core.cache import StrategyCache
+from whydpi.core.quic import QuicPolicy
+from whydpi.system.netfilter import compose_rules, render_nft, render_restore
+
+
+_NAMES = {
+    "192.0.2.1": ["cdn.example"],
+    "192.0.2.2": ["cdn.example", "blocked.example"],
+    "192.0.2.3": ["cdn.example"],
+}
+
+
+def _policy(tmp_path: Path, **kwargs) -> tuple[QuicPolicy, StrategyCache]:
+    cache = StrategyCache.load(tmp_path / "s.json")
+    cache.record_success("cdn.example", "passthrough")
+    cache.record_success("blocked.example", "record:2")
+    policy = QuicPolicy(cache=cache, names_for=lambda ip: _NAMES.get(ip, []), **kwargs)
+    return policy, cache
+
+
+def test_only_known_clean_destinations_keep_quic(tmp_path: Path) -> None:
+    policy, _ = _policy(tmp_path)
+    assert policy.allows("192.0.2.1")
+    assert not policy.allows("192.0.2.2")      # shared with a shaped name
+    assert not policy.allows("198.51.100.9")   # unknown
+
+
+def _wait_for(predicate) -> None:
+    deadline = time.monotonic() + 2.0
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_kernel_allow_set_follows_dns_and_relays(tmp_path: Path) -> None:
+    calls: list[tuple[str, tuple, tuple]] = []
+
+    def update_set(name, *, add=(), remove=()):
+        calls.append((name, tuple(add), tuple(remove)))
+
+    policy, _ = _policy(tmp_path, update_set=update_set)
+    policy.on_answer("cdn.example", ["192.0.2.1", "192.0.2.2"])
+    policy.on_answer("cdn.example", ["192.0.2.1"])
+    _wait_for(lambda: calls)
+    assert calls == [("quic_allow_v4", ("192.0.2.1",), ())]
+    policy.observe("192.0.2.1", "cdn.example", False)
+    assert calls[-1] == ("quic_allow_v4", (), ("192.0.2.1",))
+    policy.stop()
+
+
+def test_allow_additions_stay_off_the_answer_path(tmp_path: Path) -> None:
+    release = threading.Event()
+    calls: list[tuple[str, tuple, tuple]] = []
+
+    def update_set(name, *, add=(), remove=()):
+        if add:
+            release.wait(2.0)
+        calls.append((name, tuple(add), tuple(remove)))
+
+    policy, _ = _policy(tmp_path, update_set=update_set)
+    started = time.monotonic()
+    policy.on_answer("cdn.example", ["192.0.2.1"])
+    assert time.monotonic() - started < 1.0 and not calls
+    release.set()
+    _wait_for(lambda: calls)
+    assert calls == [("quic_allow_v4", ("192.0.2.1",), ())]
+    policy.stop()
+
+
+def test_block_before_the_worker_runs_never_reaches_the_kernel(tmp_path: Path) -> None:
+    entered, release = threading.Event(), threading.Event()
+    calls: list[tuple[str, tuple, tuple]] = []
+
+    def update_set(name, *, add=(), remove=()):
+        entered.set()
+        release.wait(2.0)
+        calls.append((name, tuple(add), tuple(remove)))
+
+    policy, _ = _policy(tmp_path, update_set=update_set)
+    policy.on_answer("cdn.example", ["192.0.2.3"])
+    entered.wait(2.0)      # the worker is busy pushing 192.0.2.3
+    policy.on_answer("cdn.example", ["192.0.2.1"])
+    policy.observe("192.0.2.1", "cdn.example", False)
+    release.set()
+    _wait_for(lambda: calls)
+    time.sleep(0.05)
+    assert calls == [("quic_allow_v4", ("192.0.2.3",), ())]
+    policy.stop()
+
+
+def test_allow_rule_precedes_reject_in_every_backend() -> None:
+    rules = compose_rules(
+        tls_port=4443, tls_mark=200, ipv6_enabled=False, block_quic=True,
+        bypass_v4=(), bypass_v6=(), dns_stub_address=None, dns_stub_port=53,
+        dns_altport=None, quic_allow_s=600,
+    )
+    script = render_nft(rules)
+    assert script.index("@quic_allow_v4 udp dport 443 return") < script.index("reject")
+    batch = render_restore(rules, "v4")
+    assert batch.index("--match-set whydpi-quic_allow_v4") < batch.index("REJECT")
+    # Without ipset there is no allow set: QUIC stays blocked outright.
+    assert "quic_allow" not in render_restore(rules, "v4", ipset=False)
@@ -83,3 +83,19 @@ def test_dns_alternates_resolver_failure_is_safe(monkeypatch) -> None:
         extra_resolver=boom,
     )
     assert [a.ip for a in alts] == ["203.0.113.50"]
+
+
+def test_known_addresses_skip_resolution(monkeypatch) -> None:
+    def no_lookup(*args, **kwargs):
+        raise AssertionError("resolved again")
+
+    monkeypatch.setattr(socket, "getaddrinfo", no_lookup)
+    alts = dns_alternate_targets(
+        "example.com",
+        client_port=443,
+        exclude_ips={"203.0.113.10"},
+        ipv6_enabled=False,
+        known_resolver=lambda name, v6: ["203.0.113.10", "2001:db8::1", "198.51.100.7"],
+        extra_resolver=no_lookup,
+    )
+    assert [a.ip for a in alts] == ["198.51.100.7"]
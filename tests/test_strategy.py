@@ -6,7 +6,8 @@
 from __future__ import annotations
 
 from whydpi.core.discovery import order_candidates
-from whydpi.core.strategy import Strategy
+from whydpi.core.strategy import Strategy, build_plan
+from whydpi.net.tls_parser import build_minimal_client_hello, parse_client_hello
 
 
 def test_parse_tcp_sni_mid() -> None:
@@ -23,3 +24,19 @@ def test_order_candidates_dedup() -> None:
     assert len(ordered) == 4
     assert ordered[0].layer == "record"
     assert ordered[-1].layer == "passthrough"
+
+
+def test_parse_mss_and_plan_kernel_segments() -> None:
+    s = Strategy.parse("mss:100")
+    assert (s.layer, s.offset_value, s.label()) == ("mss", 100, "mss:100")
+    for bad in ("mss:40", "mss:9000", "mss:x"):
+        try:
+            Strategy.parse(bad)
+        except ValueError:
+            continue
+        raise AssertionError(bad)
+    hello = build_minimal_client_hello("shaped.example")
+    plan = build_plan(hello, parse_client_hello(hello), s)
+    assert plan.mss == 100
+    assert b"".join(plan.fragments) == hello
+    assert [len(f) for f in plan.fragments[:-1]] == [100] * (len(plan.fragments) - 1)
@@ -12,10 +12,11 @@ import sys
 
 from .core.cache import StrategyCache
 from .core.discovery import discover_upstream
-from .core.engine import run, stop_only
+from .core.engine import counters, run, stop_only
 from .core.failure import format_summary
 from .core.strategy import Strategy, parse_fallback
 from .net.dns import DoHClient, DoHEndpoint, DoHResolver
+from .net.dot import DoTClient, DoTEndpoint
 from .net.tls_parser import build_minimal_client_hello, parse_client_hello
 from .settings import Settings, apply_cli_overrides, cache_path, load_settings
 from .system import resolver as resolver_system
@@ -61,6 +62,19 @@ def cmd_stop(args: argparse.Namespace) -> int:
     return stop_only(settings)
 
 
+def cmd_counters(args: argparse.Namespace) -> int:
+    _require_root()
+    settings = load_settings(args.config)
+    _configure_logging(args.verbose)
+    totals = counters(settings)
+    if not totals:
+        print("(no owner policy configured)")
+        return 0
+    for name, (packets, nbytes) in sorted(totals.items()):
+        print(f"{name}\tpackets={packets}\tbytes={nbytes}")
+    return 0
+
+
 def cmd_dns_configure(args: argparse.Namespace) -> int:
     _require_root()
     settings = load_settings(args.config)
@@ -122,7 +136,9 @@ def cmd_cache(args: argparse.Namespace) -> int:
     return 1
 
 
-def _build_probe_resolver(settings: Settings) -> tuple[DoHResolver | None, tuple[DoHClient, ...]]:
+def _build_probe_resolver(
+    settings: Settings,
+) -> tuple[DoHResolver | None, tuple[DoHClient | DoTClient, ...]]:
     """A standalone DoH resolver for the probe diagnostic.
 
     The running engine shares the stub's DoH clients with the proxy; the
@@ -133,7 +149,7 @@ def _build_probe_resolver(settings: Settings) -> tuple[DoHResolver | None, tuple
     """
     if settings.dns.mode == "off":
         return None, ()
-    clients: list[DoHClient] = []
+    clients: list[DoHClient | DoTClient] = []
     for ip, hostname in (
         (settings.dns.doh_endpoint_ip, settings.dns.doh_endpoint_hostname),
         (settings.dns.doh_fallback_ip, settings.dns.doh_fallback_hostname),
@@ -141,6 +157,11 @@ def _build_probe_resolver(settings: Settings) -> tuple[DoHResolver | None, tuple
         if not ip:
             continue
         try:
+            if ip in settings.dns.dot_endpoints:
+                clients.append(
+                    DoTClient(DoTEndpoint(ip=ip, hostname=hostname or None), timeout_s=5.0)
+                )
+                continue
             clients.append(
                 DoHClient(
                     DoHEndpoint(ip=ip, hostname=hostname or None,
@@ -152,7 +173,11 @@ def _build_probe_resolver(settings: Settings) -> tuple[DoHResolver | None, tuple
             logger.debug("probe DoH client %s skipped: %s", ip, exc)
     if not clients:
         return None, ()
-    return DoHResolver(clients), tuple(clients)
+    resolver = DoHResolver(
+        clients, quorum=settings.dns.resolver_quorum,
+        deadline_s=settings.dns.resolver_deadline_s,
+    )
+    return resolver, tuple(clients)
 
 
 def _preflight_probe(settings, targets: list[str]) -> int:
@@ -252,6 +277,12 @@ def build_parser() -> argparse.ArgumentParser:
     _add_common(p)
     p.set_defaults(func=cmd_stop)
 
+    p = sub.add_parser(
+        "counters", help="show TCP/443 packets and bytes sent per policy owner (Linux)",
+    )
+    _add_common(p)
+    p.set_defaults(func=cmd_counters)
+
     p = sub.add_parser("dns-configure", help="pin /etc/resolv.conf to stub resolver")
     _add_common(p)
     p.set_defaults(func=cmd_dns_configure)
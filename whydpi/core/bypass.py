@@ -0,0 +1,198 @@
+# Copyright (c) 2025 whyDPI Contributors
+# SPDX-License-Identifier: MIT
+
+"""Learned kernel bypass for destinations that never need shaping.
+
+Once discovery has settled on ``passthrough`` for a name, every later
+connection to it still pays the REDIRECT, a proxy thread, the
+ClientHello read and a Python relay only to forward bytes unchanged —
+for bulk CDNs most of the relayed traffic.  :class:`LearnedBypass`
+watches those connections and promotes a destination IP into a timed
+kernel set (``learned_v4`` / ``learned_v6``, see
+:func:`whydpi.system.netfilter.learned_bypass`) matched before the
+REDIRECT; its flows then stay in the kernel until the element expires,
+after which the next connection is seen, and re-verified, again.
+
+An IP can host blocked names next to clean ones, and a bypassed flow
+can no longer be shaped, so promotion is conservative:
+
+* ``min_hits`` passthrough connections to the IP that each got at
+  least ``success_min_bytes`` back, with a real SNI;
+* every name seen on the IP *and* every name the DNS stub answered with
+  it must be passthrough — cached, or user-configured;
+* any shaped, failed or short connection taints the IP for
+  ``_TAINT_S``; it is not promoted again until then;
+* when the stub answers an IP in the set for a name not known to be
+  passthrough, the IP is removed before the answer goes out, so the
+  client's connection reaches the proxy.
+
+A client that reuses a DNS answer it cached itself skips that last
+check; the element timeout bounds how long it can be wrongly bypassed.
+State is RAM-only, bounded by ``max_entries``, and dropped by
+:meth:`LearnedBypass.stop`.
+"""
+
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Callable, Iterable, Sequence
+
+from ..settings import passthrough_contains
+from .cache import StrategyCache
+
+
+logger = logging.getLogger(__name__)
+
+_TAINT_S = 3600.0
+
+UpdateSet = Callable[..., None]
+
+
+@dataclass
+class _Seen:
+    hits: int = 0
+    names: set[str] = field(default_factory=set)
+    tainted_until: float = 0.0
+
+
+class LearnedBypass:
+    """Promote passthrough-clean destination IPs into a timed kernel set."""
+
+    def __init__(
+        self,
+        *,
+        cache: StrategyCache,
+        update_set: UpdateSet,
+        timeout_s: float,
+        names_for: "Callable[[str], Sequence[str]] | None" = None,
+        passthrough_sni: Sequence[str] = (),
+        min_hits: int = 3,
+        max_entries: int = 4096,
+    ) -> None:
+        self._cache = cache
+        self._update_set = update_set
+        self._timeout = float(timeout_s)
+        self._names_for = names_for
+        self._passthrough = tuple(passthrough_sni)
+        self._min_hits = max(1, int(min_hits))
+        self._max = max(1, int(max_entries))
+        self._lock = threading.Lock()
+        self._seen: OrderedDict[str, _Seen] = OrderedDict()
+        self._active: dict[str, float] = {}
+        self._disabled = False
+        self.promoted = 0
+        self.demoted = 0
+
+    def observe(self, ip: str, sni: str, clean: bool) -> None:
+        """Proxy hook: a connection to *ip* for *sni* ended.
+
+        *clean* means it was relayed unshaped to the client-chosen IP
+        and got a real answer back.
+        """
+        if self._disabled or not ip or not sni:
+            return
+        now = time.monotonic()
+        with self._lock:
+            seen = self._seen.pop(ip, None) or _Seen()
+            self._seen[ip] = seen
+            while len(self._seen) > self._max:
+                self._seen.popitem(last=False)
+            if not clean:
+                seen.hits = 0
+                seen.tainted_until = now + _TAINT_S
+                if self._active.pop(ip, None) is None:
+                    return
+                demote = True
+            else:
+                demote = False
+                seen.names.add(sni.lower())
+                seen.hits += 1
+                if len(self._active) >= self._max:
+                    self._active = {k: v for k, v in self._active.items() if v > now}
+                if (
+                    seen.hits < self._min_hits
+                    or seen.tainted_until > now
+                    or self._active.get(ip, 0.0) > now
+                    or len(self._active) >= self._max
+                    or not self._all_passthrough(ip, seen.names)
+                ):
+                    return
+                self._active[ip] = now + self._timeout
+                seen.hits = 0
+        if demote:
+            self._remove(ip, "shaped or failed connection")
+        else:
+            self._add(ip, sni)
+
+    def on_answer(self, name: str, addresses: Iterable[str]) -> None:
+        """Stub hook: evict answered IPs *name* is not cleared for."""
+        if self._disabled or not self._active:
+            return
+        name = name.lower().rstrip(".")
+        if self._is_passthrough(name):
+            return
+        now = time.monotonic()
+        with self._lock:
+            evict = [ip for ip in addresses if self._active.pop(ip, 0.0) > now]
+        for ip in evict:
+            self._remove(ip, f"answered for {name}")
+
+    def active(self) -> list[str]:
+        now = time.monotonic()
+        with self._lock:
+            return [ip for ip, until in self._active.items() if until > now]
+
+    def stop(self) -> None:
+        """Stop learning and forget every address seen."""
+        self._disabled = True
+        with self._lock:
+            self._seen.clear()
+            self._active.clear()
+
+    # Internal -----------------------------------------------------------
+
+    def _all_passthrough(self, ip: str, names: Iterable[str]) -> bool:
+        answered = self._names_for(ip) if self._names_for is not None else ()
+        return all(self._is_passthrough(n) for n in (*names, *answered))
+
+    def _is_passthrough(self, name: str) -> bool:
+        return known_passthrough(self._cache, name, self._passthrough)
+
+    def _add(self, ip: str, sni: str) -> None:
+        try:
+            self._update_set(_set_name(ip), add=[ip])
+        except Exception as exc:  # noqa: BLE001
+            # No kernel sets with timeouts here (iptables without
+            # ipset): nothing to learn into, so stop trying.
+            logger.info("learned bypass disabled: %s", exc)
+            self.stop()
+            return
+        self.promoted += 1
+        logger.debug("learned bypass + %s (sni=%s) for %.0fs", ip, sni, self._timeout)
+
+    def _remove(self, ip: str, why: str) -> None:
+        try:
+            self._update_set(_set_name(ip), remove=[ip])
+        except Exception as exc:  # noqa: BLE001
+            logger.debug("learned bypass remove %s failed: %s", ip, exc)
+            return
+        self.demoted += 1
+        logger.debug("learned bypass - %s (%s)", ip, why)
+
+
+def known_passthrough(
+    cache: StrategyCache, name: str, user_passthrough: Sequence[str] = (),
+) -> bool:
+    """Whether *name* is known to work unshaped: configured, or cached."""
+    if passthrough_contains(user_passthrough, name):
+        return True
+    entry = cache.get(name)
+    return entry is not None and entry.strategy == "passthrough"
+
+
+def _set_name(ip: str) -> str:
+    return "learned_v6" if ":" in ip else "learned_v4"
@@ -9,13 +9,13 @@ import logging
 import socket
 import sys
 import time
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
 from typing import Iterable, Sequence
 
 from ..net.tls_parser import ClientHelloView
 from .failure import FailureKind, classify_reason, dominant_failure
 from .resolve import AltResolver, UpstreamTarget, client_target, dns_alternate_targets
-from .strategy import FragmentPlan, Strategy, build_plan
+from .strategy import FragmentPlan, Strategy, build_plan, with_mss
 
 
 logger = logging.getLogger(__name__)
@@ -23,6 +23,10 @@ logger = logging.getLogger(__name__)
 _USE_CORK = sys.platform.startswith("linux")
 _PASSTHROUGH = Strategy.parse("passthrough")
 _DEFAULT_CONNECT_TIMEOUT_S = 1.5
+_TCP_MAXSEG = getattr(socket, "TCP_MAXSEG", 2)
+# NOP, NOP, timestamp: the option bytes Linux takes out of a clamped MSS
+# on every segment once timestamps are negotiated.
+_TIMESTAMP_OPTION_LEN = 12
 
 # Failure classes that justify trying a *different* upstream IP for the same
 # SNI.  TRANSPORT = the TCP layer never came up.  DPI_BLOCK = the TCP layer
@@ -42,7 +46,13 @@ class DiscoveryResult:
     failure_kind: FailureKind = FailureKind.UNKNOWN
 
 
-def _send_plan(sock: socket.socket, plan: FragmentPlan) -> None:
+def send_plan(sock: socket.socket, plan: FragmentPlan) -> None:
+    if plan.mss:
+        plan = socket_plan(sock, plan)
+    if plan.mss:
+        # The kernel cuts the segments itself: one send, no cork dance.
+        sock.sendall(b"".join(plan.fragments))
+        return
     cork = getattr(socket, "TCP_CORK", 3)
     for idx, fragment in enumerate(plan.fragments):
         if not fragment:
@@ -59,6 +69,40 @@ def _send_plan(sock: socket.socket, plan: FragmentPlan) -> None:
             time.sleep(plan.delay_ms / 1000.0)
 
 
+def socket_plan(sock: socket.socket, plan: FragmentPlan) -> FragmentPlan:
+    """An ``mss`` *plan* as connected *sock* puts it on the wire.
+
+    The handshake settles the MSS (the clamp less the TCP options, or
+    whatever smaller size the server advertised); that is the segment
+    size the kernel cuts, so the plan is re-cut to it.  A clamp that
+    did not hold — refused, or the server skipped timestamps and the
+    segments came out larger — yields ``mss=0``: one send per fragment.
+    """
+    try:
+        effective = sock.getsockopt(socket.IPPROTO_TCP, _TCP_MAXSEG)
+    except OSError:
+        effective = 0
+    if 0 < effective <= plan.mss:
+        return plan if effective == plan.mss else with_mss(plan, effective)
+    return replace(plan, mss=0)
+
+
+_OPTION_OVERHEAD: int | None = None
+
+
+def _option_overhead() -> int:
+    """Option bytes to add to ``mss:N`` so segments carry N bytes of payload."""
+    global _OPTION_OVERHEAD
+    if _OPTION_OVERHEAD is None:
+        try:
+            with open("/proc/sys/net/ipv4/tcp_timestamps", encoding="ascii") as fh:
+                enabled = fh.read().strip() != "0"
+        except OSError:
+            enabled = False
+        _OPTION_OVERHEAD = _TIMESTAMP_OPTION_LEN if enabled else 0
+    return _OPTION_OVERHEAD
+
+
 def _peek(sock: socket.socket, min_bytes: int, timeout_s: float) -> bytes:
     sock.settimeout(timeout_s)
     buf = b""
@@ -120,7 +164,17 @@ def connect_upstream(
     dest_port: int,
     mark: int,
     timeout_s: float,
+    *,
+    mss: int = 0,
 ) -> socket.socket:
+    """A connected upstream socket; *mss* clamps its segment payload.
+
+    The clamp only works before connect and holds for the whole
+    connection: Linux fixes it (and the MSS advertised to the server)
+    during the handshake, and a later ``TCP_MAXSEG`` does not lift it.
+    Linux takes the timestamp option out of the clamp, so it is set
+    that much higher; :func:`socket_plan` reads back what held.
+    """
     family = socket.AF_INET6 if ":" in dest_ip else socket.AF_INET
     sock = socket.socket(family, socket.SOCK_STREAM)
     if mark and _has_net_admin():
@@ -129,6 +183,11 @@ def connect_upstream(
         except OSError:
             pass
     sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if mss:
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, _TCP_MAXSEG, mss + _option_overhead())
+        except OSError as exc:
+            logger.debug("TCP_MAXSEG %d refused: %s", mss, exc)
     sock.settimeout(timeout_s)
     try:
         if family == socket.AF_INET6:
@@ -192,11 +251,39 @@ def fragmentation_candidates(
     default: Strategy,
     fallbacks: Iterable[Strategy],
 ) -> tuple[Strategy, ...]:
-    """Strategies that reshape ClientHello — excludes passthrough."""
-    return tuple(
+    """Strategies that reshape ClientHello — excludes passthrough.
+
+    ``mss:*`` fallbacks go last: their clamp outlives the handshake and
+    slows the relay, so a userspace split that works is worth more.  A
+    cached or configured default ``mss:*`` keeps its place.
+    """
+    pinned = {s.label() for s in (cached, default) if s is not None}
+    ordered = [
         s for s in order_candidates(cached, default, fallbacks, include_passthrough=False)
         if s.layer != "passthrough"
-    )
+    ]
+    return tuple(sorted(ordered, key=lambda s: s.layer == "mss" and s.label() not in pinned))
+
+
+def socket_strategy(
+    cached: Strategy | None,
+    default: Strategy,
+    fallbacks: Iterable[Strategy],
+) -> Strategy | None:
+    """The strategy for a first flight on one of our keep-alive sockets.
+
+    Only ``record`` and ``tcp`` apply: ``decoy`` needs a packet shaper,
+    and an ``mss`` clamp would hold (and shrink every answer) for the
+    socket's whole life.  A cached ``passthrough`` means the name needs
+    nothing (``None``); otherwise the first candidate that applies, in
+    discovery's order.
+    """
+    if cached is not None and cached.layer == "passthrough":
+        return None
+    for strategy in fragmentation_candidates(cached, default, fallbacks):
+        if strategy.layer in ("record", "tcp"):
+            return strategy
+    return None
 
 
 def platform_fallbacks(fallbacks: Iterable[Strategy]) -> tuple[Strategy, ...]:
@@ -219,11 +306,11 @@ def _probe_one(
 ) -> tuple[Strategy, socket.socket | None, bytes, str]:
     plan = build_plan(hello_bytes, hello_view, strategy)
     try:
-        upstream = connect_upstream(dest_ip, dest_port, proxy_mark, timeout_s)
+        upstream = connect_upstream(dest_ip, dest_port, proxy_mark, timeout_s, mss=plan.mss)
     except OSError as exc:
         return strategy, None, b"", f"connect-failed:{exc.errno}"
     try:
-        _send_plan(upstream, plan)
+        send_plan(upstream, plan)
     except OSError as exc:
         try:
             upstream.close()
@@ -486,6 +573,7 @@ def discover_upstream(
     max_dns_alternates: int = 3,
     connect_timeout_s: float = _DEFAULT_CONNECT_TIMEOUT_S,
     alt_resolver: "AltResolver | None" = None,
+    known_resolver: "AltResolver | None" = None,
 ) -> DiscoveryResult:
     """Pick a working strategy for one client connection."""
     primary = client_target(client_dest_ip, client_dest_port)
@@ -530,6 +618,7 @@ def discover_upstream(
         ipv6_enabled=ipv6_enabled,
         max_alternates=max_dns_alternates,
         extra_resolver=alt_resolver,
+        known_resolver=known_resolver,
     ):
         alt_result = _discover_at_target(
             alt,
@@ -47,6 +47,14 @@ def stop_only(settings: Settings) -> int:
     return _backend().stop_only(settings)
 
 
+def counters(settings: Settings) -> dict[str, tuple[int, int]]:
+    """Named netfilter rule counters (owner policy); Linux only."""
+    backend = _backend()
+    if not hasattr(backend, "counters"):
+        raise RuntimeError("rule counters are Linux-specific")
+    return backend.counters(settings)
+
+
 def build_runtime(settings: Settings, *, configure_resolver: bool):
     """Linux-only helper; kept for backwards compatibility with callers.
 
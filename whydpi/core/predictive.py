@@ -0,0 +1,209 @@
+# Copyright (c) 2025 whyDPI Contributors
+# SPDX-License-Identifier: MIT
+
+"""DNS-driven predictive strategy discovery.
+
+The DNS stub sees a hostname a few hundred milliseconds before the
+browser's ClientHello reaches the proxy.  For a name with no
+:class:`~whydpi.core.cache.StrategyCache` entry that head start is
+otherwise wasted: the first real connection pays the whole discovery
+race.  :class:`PredictiveDiscovery` is the stub's answer hook — once a
+name has been answered ``min_queries`` times without a cache entry it
+runs discovery in the background against the answered addresses with a
+synthetic :func:`~whydpi.net.tls_parser.build_minimal_client_hello`
+and seeds the cache, so the real connection starts on a hit.
+
+Guard rails, because the stub also sees every tracker and telemetry
+name a page pulls in:
+
+* a popularity threshold (queries per ``_WINDOW_S``) before any probe;
+  answers for the same name within ``_REPEAT_S`` — the A and AAAA of
+  one lookup — count once;
+* a token bucket of ``max_per_minute`` probes and at most
+  ``max_concurrent`` in flight — over budget, the name simply waits
+  for its next query;
+* one attempt per name per ``_RETRY_S``, user passthrough names never;
+* probes go only to the answered IPs (no alternate resolution), and a
+  failed probe records nothing — the real connection still decides.
+
+Names are held in RAM only, bounded by ``_MAX_TRACKED``, and dropped by
+:meth:`PredictiveDiscovery.stop`.
+"""
+
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Sequence
+
+from ..net.tls_parser import build_minimal_client_hello, parse_client_hello
+from ..settings import passthrough_contains
+from .cache import StrategyCache
+from .discovery import discover_upstream
+from .strategy import Strategy
+
+
+logger = logging.getLogger(__name__)
+
+_WINDOW_S = 600.0
+_RETRY_S = 1800.0
+_MAX_TRACKED = 4096
+# One lookup is usually an A + AAAA pair answered back to back.
+_REPEAT_S = 1.0
+# Answered addresses probed per name; the first usually suffices.
+_MAX_TARGETS = 2
+
+
+class PredictiveDiscovery:
+    """Seed the strategy cache from DNS answers ahead of the first connection."""
+
+    def __init__(
+        self,
+        *,
+        cache: StrategyCache,
+        default: Strategy,
+        fallbacks: Sequence[Strategy],
+        proxy_mark: int,
+        timeout_s: float,
+        success_min_bytes: int,
+        ipv6_enabled: bool = True,
+        probe_passthrough_first: bool = True,
+        passthrough_sni: Sequence[str] = (),
+        min_queries: int = 2,
+        max_per_minute: int = 12,
+        max_concurrent: int = 2,
+        port: int = 443,
+    ) -> None:
+        self._cache = cache
+        self._default = default
+        self._fallbacks = tuple(fallbacks)
+        self._proxy_mark = proxy_mark
+        self._timeout = timeout_s
+        self._success_min_bytes = success_min_bytes
+        self._ipv6_enabled = ipv6_enabled
+        self._probe_passthrough_first = probe_passthrough_first
+        self._passthrough = tuple(passthrough_sni)
+        self._min_queries = max(1, int(min_queries))
+        self._rate = max(0, int(max_per_minute)) / 60.0
+        self._burst = float(max(1, int(max_per_minute)))
+        self._max_concurrent = max(1, int(max_concurrent))
+        self._port = port
+        self._lock = threading.Lock()
+        # name -> (queries counted, window start, last counted query)
+        self._seen: OrderedDict[str, tuple[int, float, float]] = OrderedDict()
+        self._attempted: OrderedDict[str, float] = OrderedDict()
+        self._tokens = self._burst
+        self._refilled = time.monotonic()
+        self._inflight = 0
+        self._stopped = False
+        self.probes = 0
+        self.seeded = 0
+
+    def observe(self, name: str, addresses: Sequence[str]) -> None:
+        """Stub hook: *name* was just answered with *addresses*.
+
+        Cheap and non-blocking; any probe runs on a daemon thread.
+        """
+        if self._stopped or not name or not addresses:
+            return
+        name = name.lower().rstrip(".")
+        if self._cache.get(name) is not None:
+            return
+        if passthrough_contains(self._passthrough, name):
+            return
+        targets = [ip for ip in addresses if self._ipv6_enabled or ":" not in ip]
+        if not targets:
+            return
+        now = time.monotonic()
+        with self._lock:
+            last = self._attempted.get(name)
+            if last is not None and now - last < _RETRY_S:
+                return
+            count, since, previous = self._seen.get(name, (0, now, -_REPEAT_S))
+            if now - previous < _REPEAT_S:
+                return
+            if now - since > _WINDOW_S:
+                count, since = 0, now
+            count += 1
+            self._seen[name] = (count, since, now)
+            self._seen.move_to_end(name)
+            while len(self._seen) > _MAX_TRACKED:
+                self._seen.popitem(last=False)
+            if count < self._min_queries:
+                return
+            if self._inflight >= self._max_concurrent or not self._take_token_locked(now):
+                return
+            self._inflight += 1
+            self.probes += 1
+            self._seen.pop(name, None)
+            self._attempted[name] = now
+            while len(self._attempted) > _MAX_TRACKED:
+                self._attempted.popitem(last=False)
+        threading.Thread(
+            target=self._probe, args=(name, tuple(targets[:_MAX_TARGETS])),
+            name="whydpi-predict", daemon=True,
+        ).start()
+
+    def stop(self) -> None:
+        """Stop probing and forget every name seen."""
+        self._stopped = True
+        with self._lock:
+            self._seen.clear()
+            self._attempted.clear()
+
+    # Internal -----------------------------------------------------------
+
+    def _take_token_locked(self, now: float) -> bool:
+        self._tokens = min(self._burst, self._tokens + (now - self._refilled) * self._rate)
+        self._refilled = now
+        if self._tokens < 1.0:
+            return False
+        self._tokens -= 1.0
+        return True
+
+    def _probe(self, name: str, targets: tuple[str, ...]) -> None:
+        try:
+            hello = build_minimal_client_hello(name)
+            view = parse_client_hello(hello)
+            for ip in targets:
+                # The real connection may have finished discovery while
+                # we waited for a slot; its verdict wins.
+                if self._stopped or self._cache.get(name) is not None:
+                    return
+                result = discover_upstream(
+                    sni=name,
+                    client_dest_ip=ip,
+                    client_dest_port=self._port,
+                    hello_bytes=hello,
+                    hello_view=view,
+                    cached=None,
+                    default=self._default,
+                    fallbacks=self._fallbacks,
+                    proxy_mark=self._proxy_mark,
+                    timeout_s=self._timeout,
+                    success_min_bytes=self._success_min_bytes,
+                    ipv6_enabled=self._ipv6_enabled,
+                    probe_passthrough_first=self._probe_passthrough_first,
+                    accept_alert=True,
+                    max_dns_alternates=0,
+                )
+                if result.upstream is not None:
+                    try:
+                        result.upstream.close()
+                    except OSError:
+                        pass
+                if result.strategy is not None:
+                    if not self._stopped and self._cache.get(name) is None:
+                        self._cache.record_success(name, result.strategy.label())
+                        self.seeded += 1
+                        logger.debug("predictive discovery sni=%s -> %s via %s",
+                                     name, result.strategy.label(), ip)
+                    return
+            logger.debug("predictive discovery sni=%s: no strategy", name)
+        except Exception as exc:  # noqa: BLE001
+            logger.debug("predictive discovery sni=%s failed: %s", name, exc)
+        finally:
+            with self._lock:
+                self._inflight -= 1
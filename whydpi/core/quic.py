@@ -0,0 +1,196 @@
+# Copyright (c) 2025 whyDPI Contributors
+# SPDX-License-Identifier: MIT
+
+"""Selective QUIC blocking: keep HTTP/3 where no shaping is needed.
+
+Blocking UDP/443 outright pushes every site onto TCP+TLS so the
+ClientHello can be shaped — including the many that work unshaped and
+would be faster over HTTP/3.  :class:`QuicPolicy` allows QUIC to a
+destination only when it is known clean: the DNS reverse map
+(:meth:`whydpi.net.dns_cache.DnsCache.names_for`) has names for it,
+and every one of them is passthrough in the
+:class:`~whydpi.core.cache.StrategyCache` or user-configured.  Unknown
+destinations, and any address shared with a name that needs shaping,
+stay blocked.
+
+The two engines consume the same decision differently:
+
+* Linux — :meth:`QuicPolicy.on_answer` (stub hook) and
+  :meth:`QuicPolicy.observe` (proxy relay hook) push allowed addresses
+  into the timed ``quic_allow`` kernel sets that precede the REJECT
+  (:func:`whydpi.system.netfilter.quic_allow`), and pull them out again
+  when a shaped or failed connection is seen.  Additions are batched
+  on a worker thread, off the DNS answer's path; removals stay
+  synchronous so they land before the client connects;
+* Windows — the QUIC loop asks :meth:`QuicPolicy.allows` per datagram
+  and re-injects allowed ones instead of answering port-unreachable.
+  Verdicts are memoised for ``_DECISION_S`` to keep that per-packet.
+"""
+
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from typing import Callable, Iterable, Sequence
+
+from .bypass import UpdateSet, known_passthrough
+from .cache import StrategyCache
+
+
+logger = logging.getLogger(__name__)
+
+_DECISION_S = 30.0
+
+
+class QuicPolicy:
+    """Decide which destination IPs may keep QUIC (UDP/443)."""
+
+    def __init__(
+        self,
+        *,
+        cache: StrategyCache,
+        names_for: Callable[[str], Sequence[str]],
+        passthrough_sni: Sequence[str] = (),
+        update_set: UpdateSet | None = None,
+        timeout_s: float = 600.0,
+        max_entries: int = 4096,
+    ) -> None:
+        self._cache = cache
+        self._names_for = names_for
+        self._passthrough = tuple(passthrough_sni)
+        self._update_set = update_set
+        self._timeout = float(timeout_s)
+        self._max = max(1, int(max_entries))
+        self._lock = threading.Lock()
+        self._decisions: dict[str, tuple[bool, float]] = {}
+        # Addresses currently in the kernel allow set, with expiry.
+        self._allowed: dict[str, float] = {}
+        # Allowed addresses the worker has yet to push; ``_io`` orders
+        # its additions against the synchronous removals.
+        self._pending: set[str] = set()
+        self._wake = threading.Event()
+        self._io = threading.Lock()
+        self._worker: threading.Thread | None = None
+        self._disabled = False
+        self.allowed = 0
+        self.blocked = 0
+
+    def allows(self, ip: str) -> bool:
+        """Whether QUIC to *ip* may pass (memoised per ``_DECISION_S``)."""
+        now = time.monotonic()
+        with self._lock:
+            cached = self._decisions.get(ip)
+            if cached is not None and cached[1] > now:
+                verdict = cached[0]
+            else:
+                verdict = None
+        if verdict is None:
+            verdict = self._clean(ip)
+            with self._lock:
+                if len(self._decisions) >= self._max:
+                    self._decisions.clear()
+                self._decisions[ip] = (verdict, now + _DECISION_S)
+        if verdict:
+            self.allowed += 1
+        else:
+            self.blocked += 1
+        return verdict
+
+    def on_answer(self, name: str, addresses: Iterable[str]) -> None:
+        """Stub hook: (re)evaluate the addresses just answered for *name*."""
+        for ip in addresses:
+            self._sync(ip)
+
+    def observe(self, ip: str, sni: str, clean: bool) -> None:
+        """Proxy hook: a TCP connection to *ip* ended (see ``on_relayed``)."""
+        if not clean:
+            with self._lock:
+                self._decisions.pop(ip, None)
+        self._sync(ip, force_block=not clean)
+
+    def stop(self) -> None:
+        self._disabled = True
+        with self._lock:
+            self._decisions.clear()
+            self._allowed.clear()
+            self._pending.clear()
+        self._wake.set()
+
+    # Internal -----------------------------------------------------------
+
+    def _clean(self, ip: str) -> bool:
+        names = self._names_for(ip)
+        return bool(names) and all(
+            known_passthrough(self._cache, n, self._passthrough) for n in names
+        )
+
+    def _sync(self, ip: str, *, force_block: bool = False) -> None:
+        if self._update_set is None or self._disabled:
+            return
+        allow = not force_block and self._clean(ip)
+        now = time.monotonic()
+        with self._lock:
+            present = self._allowed.get(ip, 0.0) > now
+            if allow == present:
+                return
+            if allow:
+                if len(self._allowed) >= self._max:
+                    self._allowed = {k: v for k, v in self._allowed.items() if v > now}
+                    if len(self._allowed) >= self._max:
+                        return
+                self._allowed[ip] = now + self._timeout
+                self._pending.add(ip)
+                if self._worker is None:
+                    self._worker = threading.Thread(
+                        target=self._drain, name="whydpi-quic", daemon=True,
+                    )
+                    self._worker.start()
+            else:
+                self._allowed.pop(ip, None)
+                if ip in self._pending:
+                    # Never reached the kernel: nothing to take out.
+                    self._pending.discard(ip)
+                    return
+        if allow:
+            self._wake.set()
+            return
+        with self._io:
+            try:
+                self._update_set(_set_name(ip), remove=[ip])
+            except Exception as exc:  # noqa: BLE001
+                logger.debug("QUIC block %s failed: %s", ip, exc)
+                return
+        logger.debug("QUIC blocked for %s", ip)
+
+    def _drain(self) -> None:
+        while not self._disabled:
+            self._wake.wait()
+            self._wake.clear()
+            with self._lock:
+                batch, self._pending = self._pending, set()
+            if batch:
+                self._push(batch)
+
+    def _push(self, batch: Iterable[str]) -> None:
+        by_set: dict[str, list[str]] = {}
+        with self._io:
+            # A removal may have overtaken the batch; skip what it took out.
+            now = time.monotonic()
+            with self._lock:
+                for ip in batch:
+                    if self._allowed.get(ip, 0.0) > now:
+                        by_set.setdefault(_set_name(ip), []).append(ip)
+            for name, ips in by_set.items():
+                try:
+                    self._update_set(name, add=ips)
+                except Exception as exc:  # noqa: BLE001
+                    # No timed kernel sets: QUIC simply stays blocked everywhere.
+                    logger.info("selective QUIC disabled: %s", exc)
+                    self.stop()
+                    return
+                logger.debug("QUIC allowed for %s", ", ".join(ips))
+
+
+def _set_name(ip: str) -> str:
+    return "quic_allow_v6" if ":" in ip else "quic_allow_v4"
@@ -42,6 +42,7 @@ def dns_alternate_targets(
     ipv6_enabled: bool,
     max_alternates: int = 3,
     extra_resolver: "AltResolver | None" = None,
+    known_resolver: "AltResolver | None" = None,
 ) -> tuple[UpstreamTarget, ...]:
     """Alternate A/AAAA targets, tried when the client-chosen IP is unusable.
 
@@ -49,7 +50,11 @@ def dns_alternate_targets(
     seconds (each dead edge pays a full discovery window), so alternates are
     capped and only consulted on a failing connection.
 
-    Two address sources are merged, in priority order:
+    *known_resolver* (optional) is asked first: addresses the name was
+    already answered with, typically read from the stub's DNS cache.  If it
+    yields any usable candidate nothing is resolved at all — the common
+    case, since the browser resolved the name through the stub moments ago.
+    Otherwise two address sources are merged, in priority order:
 
     1. *extra_resolver* (optional) — a diversified resolver, typically DoH
        across several upstreams.  It can surface CDN anycast ranges the local
@@ -77,14 +82,23 @@ def dns_alternate_targets(
         seen.add(ip)
         candidates.append(ip)
 
-    if extra_resolver is not None:
+    if known_resolver is not None:
+        try:
+            for ip in known_resolver(sni, ipv6_enabled):
+                _add(ip)
+        except Exception:  # noqa: BLE001 — same as extra_resolver below
+            pass
+    already_known = bool(candidates)
+
+    if not already_known and extra_resolver is not None:
         try:
             for ip in extra_resolver(sni, ipv6_enabled):
                 _add(ip)
         except Exception:  # noqa: BLE001 — a resolver hiccup must not break discovery
             pass
 
-    for family in ([socket.AF_INET, socket.AF_INET6] if ipv6_enabled else [socket.AF_INET]):
+    families = [socket.AF_INET, socket.AF_INET6] if ipv6_enabled else [socket.AF_INET]
+    for family in [] if already_known else families:
         try:
             infos = socket.getaddrinfo(
                 sni,
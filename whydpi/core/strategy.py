@@ -8,12 +8,15 @@ modes (``record``, ``header``, ``sni``, ``half``, ``random``, ``chunked``)
 collapse into specific values of these three axes:
 
 * layer    — ``record`` (re-frame as two TLS records), ``tcp``
-  (single TLS record split across two TCP sends), or ``decoy`` (emit a
+  (single TLS record split across two TCP sends), ``decoy`` (emit a
   short-lived spoofed ClientHello before the real one; the decoy dies
   en route so only stateful DPI middleboxes on the first few hops
-  observe it — they lock on the decoy's SNI instead of ours).
+  observe it — they lock on the decoy's SNI instead of ours), or
+  ``mss`` (clamp the upstream socket's MSS before connect so the kernel
+  itself cuts the ClientHello, handed over in one send, into segments).
 * offset   — integer, ``sni-mid``, ``half``, ``random`` or ``chunked``;
-  interpreted as the IP TTL / hop-limit for the ``decoy`` layer.
+  interpreted as the IP TTL / hop-limit for the ``decoy`` layer and as
+  the payload bytes per segment for the ``mss`` layer.
 * chunk_sz — only for chunked; chunk size in bytes.
 
 Grammar (used by :func:`Strategy.parse`):
@@ -24,6 +27,7 @@ Grammar (used by :func:`Strategy.parse`):
     tcp:sni-mid       TCP-level split at sni midpoint, single TLS record
     chunked:40        TCP-level split every 40 bytes
     decoy:5           spoof a ClientHello at IP TTL 5 before the real one
+    mss:100           100-byte TCP segments, cut by the kernel, one send
     passthrough       no transformation; send as-is
 """
 
@@ -31,13 +35,13 @@ from __future__ import annotations
 
 import random
 import struct
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, replace
 from typing import Iterable, Literal
 
 from ..net.tls_parser import ClientHelloView
 
 
-Layer = Literal["record", "tcp", "passthrough", "decoy"]
+Layer = Literal["record", "tcp", "passthrough", "decoy", "mss"]
 OffsetKind = Literal["fixed", "sni-mid", "half", "random", "chunked"]
 
 
@@ -51,8 +55,8 @@ class Strategy:
     def label(self) -> str:
         if self.layer == "passthrough":
             return "passthrough"
-        if self.layer == "decoy":
-            return f"decoy:{self.offset_value}"
+        if self.layer in ("decoy", "mss"):
+            return f"{self.layer}:{self.offset_value}"
         if self.offset_kind == "chunked":
             return f"chunked:{self.offset_value}"
         if self.offset_kind == "fixed":
@@ -89,6 +93,17 @@ class Strategy:
                 raise ValueError(f"decoy TTL out of range (1-16): {ttl}")
             return cls(layer="decoy", offset_kind="fixed", offset_value=ttl)
 
+        if left == "mss":
+            # Linux refuses a TCP_MAXSEG below TCP_MIN_MSS (88); above
+            # an Ethernet MSS the clamp no longer splits anything.
+            try:
+                mss = int(right)
+            except ValueError as exc:
+                raise ValueError(f"mss must be an integer: {right!r}") from exc
+            if mss < 88 or mss > 1460:
+                raise ValueError(f"mss out of range (88-1460): {mss}")
+            return cls(layer="mss", offset_kind="fixed", offset_value=mss)
+
         if left not in ("record", "tcp"):
             raise ValueError(f"unknown strategy layer: {left!r}")
 
@@ -105,6 +120,11 @@ class FragmentPlan:
     strategy: Strategy
     fragments: tuple[bytes, ...] = field(default_factory=tuple)
     delay_ms: int = 0
+    # ``mss`` layer: payload bytes per segment, and ``fragments`` cut
+    # to that size — what a packet shaper sends.  A clamped socket
+    # re-cuts the plan to the MSS its handshake settled on
+    # (:func:`~whydpi.core.discovery.socket_plan`).
+    mss: int = 0
 
     @property
     def label(self) -> str:
@@ -183,6 +203,13 @@ def build_plan(data: bytes, hello: ClientHelloView, strategy: Strategy) -> Fragm
     if strategy.layer == "decoy":
         return FragmentPlan(strategy=strategy, fragments=(data,), delay_ms=0)
 
+    if strategy.layer == "mss":
+        return FragmentPlan(
+            strategy=strategy,
+            fragments=_chunked(data, strategy.offset_value),
+            mss=strategy.offset_value,
+        )
+
     payload_len = max(0, len(data) - 5)
     if strategy.offset_kind == "chunked":
         return FragmentPlan(
@@ -207,6 +234,11 @@ def build_plan(data: bytes, hello: ClientHelloView, strategy: Strategy) -> Fragm
     )
 
 
+def with_mss(plan: FragmentPlan, mss: int) -> FragmentPlan:
+    """An ``mss`` *plan* re-cut into *mss*-byte segments."""
+    return replace(plan, fragments=_chunked(b"".join(plan.fragments), mss), mss=mss)
+
+
 def _delay(range_ms: tuple[int, int]) -> int:
     low, high = sorted((max(0, range_ms[0]), max(0, range_ms[1])))
     if high == 0:
@@ -8,21 +8,26 @@ Design notes
 This module is the resolver side of whyDPI: every DNS query we serve
 (directly via the Linux stub, or via the Windows packet-layer
 hijacker) is forwarded as a wire-format DNS-over-HTTPS POST to a
-public resolver.  Because the DoH request is a regular outbound HTTPS
-connection, it is transparently intercepted by our TLS proxy and gets
-the same record-split treatment as ordinary web traffic — no domain
-name ever leaves the host in the clear.
+public resolver.  The DoH ClientHello gets the same fragmentation as
+ordinary web traffic, but in-process: the socket carries ``proxy_mark``
+so the REDIRECT rule lets it past our TLS proxy, and the handshake runs
+over an ``ssl.MemoryBIO`` whose first flight is sent through
+:func:`~whydpi.core.strategy.build_plan`.  That saves every DoH
+connection a relay hop and two proxy threads, and no domain name ever
+leaves the host in the clear.
 
 Historically :class:`DoHClient` opened a fresh TCP+TLS connection per
 query and sent ``Connection: close``.  On a page load that resolves
 40+ distinct hostnames this multiplies into 40 TLS handshakes, each
 costing 50-200 ms round-trip, and the hijacker looks like a DoS
 attack on its own upstream.  :class:`DoHConnectionPool` fixes this by
-running HTTP/1.1 keep-alive: a small pool (default 8) of long-lived
-TLS sockets serve queries back-to-back, and only break-and-reopen on
-a genuine wire failure.  Against ``cloudflare-dns.com`` this reduces
-per-query cost from one TLS handshake down to one request/response
-on an existing stream — typically <5 ms RTT.
+running HTTP/1.1 keep-alive: a small pool (at most 8, sized to the
+observed concurrency) of long-lived TLS sockets serve queries
+back-to-back, are refreshed just ahead of the server's idle timeout,
+and only break-and-reopen on a genuine wire failure.  Against
+``cloudflare-dns.com`` this reduces per-query cost from one TLS
+handshake down to one request/response on an existing stream —
+typically <5 ms RTT.
 
 All state is RAM-only.  Pool connections close on :meth:`DoHClient.close`,
 which is called from the engine's shutdown path alongside the strategy
@@ -33,15 +38,24 @@ from __future__ import annotations
 
 import logging
 import queue
+import select
 import socket
 import ssl
 import struct
 import threading
+import time
 from dataclasses import dataclass
-from typing import TYPE_CHECKING, Iterable
+from typing import TYPE_CHECKING, Callable, Iterable
+
+from ..core.discovery import connect_upstream, send_plan
+from ..core.strategy import Strategy, build_plan
+from .dns_cache import DnsQuestion, parse_question
+from .dns_policy import LocalAnswerPolicy
+from .tls_parser import parse_client_hello
 
 if TYPE_CHECKING:
     from .dns_cache import DnsCache
+    from .doh_scheduler import DoHScheduler
 
 
 logger = logging.getLogger(__name__)
@@ -50,8 +64,13 @@ DOH_CONTENT_TYPE = "application/dns-message"
 
 _QTYPE_A = 1
 _QTYPE_AAAA = 28
-_QTYPE_SVCB = 64
-_QTYPE_HTTPS = 65
+
+# Stub TCP (RFC 7766): idle timeout between queries on a persistent
+# connection, per-connection cap on concurrently resolving queries, and
+# how long replies still in flight may delay closing the socket.
+_TCP_IDLE_S = 10.0
+_TCP_MAX_INFLIGHT = 16
+_TCP_DRAIN_S = 6.0
 
 
 @dataclass(frozen=True)
@@ -74,6 +93,130 @@ class DoHEndpoint:
 # Keep-alive connection + pool
 # ---------------------------------------------------------------------------
 
+def shaped_handshake(
+    sock: socket.socket,
+    obj: ssl.SSLObject,
+    incoming: ssl.MemoryBIO,
+    outgoing: ssl.MemoryBIO,
+    strategy: Strategy | None,
+) -> None:
+    """Complete *obj*'s client handshake over *sock*, BIO by BIO.
+
+    The first flight is cut by *strategy* (see
+    :func:`~whydpi.core.discovery.socket_strategy`) before it touches
+    the socket; everything after it is passed through as is.
+    """
+    first_flight = True
+    while True:
+        try:
+            obj.do_handshake()
+            break
+        except ssl.SSLWantReadError:
+            pending = outgoing.read()
+            # Only a single-record hello can be re-framed; a
+            # multi-record one goes out unchanged.
+            if (
+                first_flight
+                and strategy is not None
+                and len(pending) >= 5
+                and len(pending) == 5 + struct.unpack_from("!H", pending, 3)[0]
+            ):
+                plan = build_plan(pending, parse_client_hello(pending), strategy)
+                send_plan(sock, plan)
+            elif pending:
+                sock.sendall(pending)
+            first_flight = False
+            chunk = sock.recv(65536)
+            if not chunk:
+                raise OSError("server closed during TLS handshake")
+            incoming.write(chunk)
+    pending = outgoing.read()
+    if pending:
+        sock.sendall(pending)
+
+
+class _ShapedTLS:
+    """Client TLS over an ``ssl.SSLObject`` with a fragmented ClientHello.
+
+    Exposes the slice of the ``ssl.SSLSocket`` API that
+    :class:`_DoHConnection` uses.  The handshake is driven through a pair
+    of memory BIOs by :func:`shaped_handshake`.
+    """
+
+    __slots__ = ("_sock", "_in", "_out", "_obj")
+
+    def __init__(
+        self,
+        sock: socket.socket,
+        ctx: ssl.SSLContext,
+        *,
+        server_hostname: str | None,
+        session: ssl.SSLSession | None,
+        strategy: Strategy,
+    ) -> None:
+        self._sock = sock
+        self._in = ssl.MemoryBIO()
+        self._out = ssl.MemoryBIO()
+        self._obj = ctx.wrap_bio(
+            self._in, self._out, server_hostname=server_hostname, session=session,
+        )
+        shaped_handshake(sock, self._obj, self._in, self._out, strategy)
+
+    @property
+    def session(self) -> ssl.SSLSession | None:
+        return self._obj.session
+
+    @property
+    def session_reused(self) -> bool:
+        return self._obj.session_reused
+
+    def fileno(self) -> int:
+        return self._sock.fileno()
+
+    def settimeout(self, timeout: float | None) -> None:
+        self._sock.settimeout(timeout)
+
+    def setblocking(self, flag: bool) -> None:
+        self._sock.setblocking(flag)
+
+    def sendall(self, data: bytes) -> None:
+        self._obj.write(data)
+        self._flush()
+
+    def recv(self, size: int) -> bytes:
+        while True:
+            try:
+                data = self._obj.read(size)
+            except ssl.SSLWantReadError:
+                self._flush()
+                try:
+                    if not self._fill():
+                        return b""
+                except BlockingIOError:
+                    raise ssl.SSLWantReadError("no TLS record pending") from None
+                continue
+            except ssl.SSLZeroReturnError:
+                return b""
+            self._flush()
+            return data
+
+    def close(self) -> None:
+        self._sock.close()
+
+    def _flush(self) -> None:
+        pending = self._out.read()
+        if pending:
+            self._sock.sendall(pending)
+
+    def _fill(self) -> bool:
+        chunk = self._sock.recv(65536)
+        if not chunk:
+            self._in.write_eof()
+            return False
+        self._in.write(chunk)
+        return True
+
+
 class _DoHConnection:
     """Single persistent HTTP/1.1 keep-alive DoH connection.
 
@@ -82,27 +225,26 @@ class _DoHConnection:
     replies don't get re-read from the kernel for every new query.
     """
 
-    __slots__ = ("_sock", "_tls", "_buf", "_endpoint", "_timeout", "_closed")
+    __slots__ = (
+        "_sock", "_tls", "_buf", "_endpoint", "_timeout", "_closed",
+        "last_used", "served",
+    )
 
     def __init__(
         self,
         endpoint: DoHEndpoint,
         timeout_s: float,
         ctx: ssl.SSLContext,
+        *,
+        session: ssl.SSLSession | None = None,
+        mark: int = 0,
+        strategy: Strategy | None = None,
     ) -> None:
-        family = socket.AF_INET6 if ":" in endpoint.ip else socket.AF_INET
-        sock = socket.socket(family, socket.SOCK_STREAM)
+        # ``connect_upstream`` sets TCP_NODELAY (DoH queries are small
+        # and latency-sensitive) and, with *mark*, SO_MARK so the
+        # REDIRECT rule does not loop this socket through our own proxy.
+        sock = connect_upstream(endpoint.ip, endpoint.port, mark, timeout_s)
         sock.settimeout(timeout_s)
-        try:
-            # DoH queries are small (≤ 512 B) and latency-sensitive;
-            # Nagle would only ever hurt us here.
-            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-        except OSError:
-            pass
-        if family == socket.AF_INET6:
-            sock.connect((endpoint.ip, endpoint.port, 0, 0))
-        else:
-            sock.connect((endpoint.ip, endpoint.port))
         self._sock = sock
         # ``endpoint.hostname`` drives both the TLS SNI we put on the
         # wire and the name we match against the peer's certificate.
@@ -112,15 +254,68 @@ class _DoHConnection:
         # itself) fails the handshake instead of silently feeding us
         # the attacker's DNS answers.
         server_hostname = endpoint.hostname or None
-        self._tls = ctx.wrap_socket(sock, server_hostname=server_hostname)
+        # ``session`` is the pool's most recent ticket for this endpoint;
+        # when the server accepts it the handshake is an abbreviated
+        # resumption (no certificate chain, no signature verification).
+        try:
+            if strategy is not None:
+                self._tls = _ShapedTLS(
+                    sock, ctx, server_hostname=server_hostname,
+                    session=session, strategy=strategy,
+                )
+            else:
+                self._tls = ctx.wrap_socket(
+                    sock, server_hostname=server_hostname, session=session,
+                )
+        except BaseException:
+            sock.close()
+            raise
         self._buf = bytearray()
         self._endpoint = endpoint
         self._timeout = timeout_s
         self._closed = False
+        self.last_used = time.monotonic()
+        self.served = 0
 
     def is_open(self) -> bool:
         return not self._closed
 
+    @property
+    def session(self) -> ssl.SSLSession | None:
+        return self._tls.session
+
+    @property
+    def session_reused(self) -> bool:
+        return self._tls.session_reused
+
+    def peer_closed(self) -> bool:
+        """True when an idle connection is no longer usable.
+
+        Readable-while-idle means the server sent a FIN, a TLS alert or
+        a late session ticket.  A non-blocking read tells them apart: a
+        ticket is consumed by OpenSSL and surfaces as ``SSLWantReadError``.
+        """
+        if self._closed:
+            return True
+        try:
+            readable, _, _ = select.select([self._tls], [], [], 0)
+        except (OSError, ValueError):
+            return True
+        if not readable:
+            return False
+        try:
+            self._tls.setblocking(False)
+            try:
+                self._tls.recv(1)
+            finally:
+                self._tls.settimeout(self._timeout)
+        except ssl.SSLWantReadError:
+            return False
+        except (OSError, ssl.SSLError):
+            pass
+        # EOF or unsolicited bytes: either way the stream is unusable.
+        return True
+
     def close(self) -> None:
         if self._closed:
             return
@@ -150,7 +345,10 @@ class _DoHConnection:
             f"Connection: keep-alive\r\n\r\n"
         ).encode("ascii") + wire
         self._tls.sendall(request)
-        return self._read_one_response()
+        response = self._read_one_response()
+        self.last_used = time.monotonic()
+        self.served += 1
+        return response
 
     # -- Response parsing ------------------------------------------------
 
@@ -254,24 +452,54 @@ class _DoHConnection:
 
 
 class DoHConnectionPool:
-    """Bounded pool of keep-alive DoH connections to one endpoint.
+    """Adaptive pool of keep-alive DoH connections to one endpoint.
 
     The pool is LIFO so the most-recently-released (and therefore most
     likely still healthy) connection is reused first.  When the caller
     releases a connection that the server has marked ``Connection:
     close``, the pool discards it instead of reusing it.
+
+    The newest TLS session ticket seen on a released connection is kept
+    and offered to every connection the pool opens afterwards, so
+    warm-up, keep-alive breakage and burst growth pay a resumed
+    handshake instead of a full one.  The ticket lives in RAM only and
+    is dropped by :meth:`close`.
+
+    Sizing and upkeep.  ``max_size`` is a ceiling, not a target: the
+    number of idle sockets kept follows the peak concurrency seen per
+    ``_WINDOW_S`` window (plus one spare when queries had to wait on a
+    handshake), shrinking by halves toward ``min_size`` once load
+    drops.  A maintenance thread wakes every ``_TICK_S`` to drop idle
+    sockets the server has already hung up on, learns the server's
+    idle timeout from the age at which those closes happen, and
+    replaces connections shortly before reaching it — but only while
+    queries have been seen in the last ``_REFRESH_ACTIVE_S``, so an
+    idle host stops talking to the resolver.
     """
 
+    _TICK_S = 1.0
+    _WINDOW_S = 10.0
+    _REFRESH_ACTIVE_S = 600.0
+    # Closes on sockets younger than this are network trouble, not the
+    # server's idle policy, and do not teach us a timeout.
+    _MIN_LEARN_IDLE_S = 2.0
+
     def __init__(
         self,
         endpoint: DoHEndpoint,
         *,
         timeout_s: float = 5.0,
         max_size: int = 8,
+        min_size: int = 1,
+        mark: int = 0,
+        strategy: Strategy | None = None,
     ) -> None:
         self._endpoint = endpoint
+        self._mark = mark
+        self._strategy = strategy
         self._timeout = timeout_s
         self._max = max(1, int(max_size))
+        self._min = max(0, min(int(min_size), self._max))
         self._ctx = ssl.create_default_context()
         # Cryptographic identity on DoH is not optional: a transparent
         # man-in-the-middle on UDP-53 (the exact class of adversary we
@@ -299,43 +527,74 @@ class DoHConnectionPool:
                 "`hostname = \"...\"` field in settings or use a shipped "
                 "default.", endpoint.ip,
             )
-        self._idle: queue.LifoQueue[_DoHConnection] = queue.LifoQueue()
+        # Idle connections, oldest first; acquire pops from the end.
+        self._idle: list[_DoHConnection] = []
+        self._lock = threading.Lock()
         self._closed = False
+        self._stop = threading.Event()
+        self._maintainer: threading.Thread | None = None
+        self._session: ssl.SSLSession | None = None
+        # Sizing state.
+        self._target = max(self._min, 1)
+        self._active = 0
+        self._window_start = time.monotonic()
+        self._window_peak = 0
+        self._window_waits = 0
+        self._last_query = 0.0
+        # Learned server idle timeout; ``None`` until a close is seen.
+        self._idle_limit: float | None = None
+        # Counters for :meth:`stats`.
+        self._resumed = 0
+        self._full_handshakes = 0
+        self._waits = 0
+        self._wait_total_s = 0.0
+        self._broken = 0
+        self._refreshed = 0
+        self._trimmed = 0
 
     @property
     def endpoint(self) -> DoHEndpoint:
         return self._endpoint
 
+    def stats(self) -> dict:
+        """Sizing, upkeep and TLS resumption counters for diagnostics."""
+        with self._lock:
+            return {
+                "idle": len(self._idle),
+                "active": self._active,
+                "target": self._target,
+                "max": self._max,
+                "idle_timeout_s": self._idle_limit,
+                "waits": self._waits,
+                "wait_ms_avg": round(1000 * self._wait_total_s / self._waits, 1)
+                if self._waits else 0.0,
+                "broken": self._broken,
+                "refreshed": self._refreshed,
+                "trimmed": self._trimmed,
+                "session_hits": self._resumed,
+                "session_misses": self._full_handshakes,
+            }
+
     def query(self, wire: bytes) -> bytes:
         """Forward one query.  Retries exactly once on a broken keep-alive."""
-        for attempt in (0, 1):
-            conn = self._acquire(force_new=(attempt == 1))
-            try:
-                response = conn.query(wire)
-            except (OSError, ssl.SSLError) as exc:
-                conn.close()
-                if attempt == 1:
-                    raise
-                logger.debug(
-                    "DoH keep-alive broke on attempt %d (%s); retrying fresh",
-                    attempt, exc,
-                )
-                continue
-            if conn.is_open():
-                self._release(conn)
-            else:
-                conn.close()
-            return response
-        raise OSError("DoH pool: unreachable retry state")
+        with self._lock:
+            self._active += 1
+            self._window_peak = max(self._window_peak, self._active)
+            self._last_query = time.monotonic()
+        try:
+            return self._query(wire)
+        finally:
+            with self._lock:
+                self._active -= 1
 
     def close(self) -> None:
         """Drain every idle connection.  Safe to call multiple times."""
-        self._closed = True
-        while True:
-            try:
-                conn = self._idle.get_nowait()
-            except queue.Empty:
-                break
+        self._stop.set()
+        with self._lock:
+            self._closed = True
+            self._session = None
+            idle, self._idle = self._idle, []
+        for conn in idle:
             conn.close()
 
     def warm_up(self, count: int | None = None) -> int:
@@ -346,54 +605,192 @@ class DoHConnectionPool:
         Returns the number of connections that actually came up.  Fewer
         than requested is not fatal — the pool lazily opens missing
         sockets on demand, and the primary benefit of warming is just
-        shortening the cold-start window.
+        shortening the cold-start window.  Warming also seeds the
+        adaptive target so the connections are not trimmed straight
+        away.
         """
         if self._closed:
             return 0
         target = self._max if count is None else max(0, min(int(count), self._max))
+        with self._lock:
+            self._target = max(self._target, target)
         opened = 0
         for _ in range(target):
             try:
-                conn = _DoHConnection(self._endpoint, self._timeout, self._ctx)
+                conn = self._open()
             except (OSError, ssl.SSLError) as exc:
                 logger.debug(
                     "DoH warm-up failed after %d/%d connections: %s",
                     opened, target, exc,
                 )
                 break
-            self._idle.put(conn)
+            self._park(conn)
             opened += 1
         return opened
 
     # Internal -----------------------------------------------------------
 
+    def _query(self, wire: bytes) -> bytes:
+        for attempt in (0, 1):
+            conn = self._acquire(force_new=(attempt == 1))
+            idle_s = time.monotonic() - conn.last_used
+            try:
+                response = conn.query(wire)
+            except (OSError, ssl.SSLError) as exc:
+                conn.close()
+                if attempt == 1:
+                    raise
+                if conn.served:
+                    with self._lock:
+                        self._broken += 1
+                        self._learn_close_locked(idle_s)
+                logger.debug(
+                    "DoH keep-alive broke on attempt %d (%s); retrying fresh",
+                    attempt, exc,
+                )
+                continue
+            if conn.served > 1:
+                with self._lock:
+                    # The server kept a socket alive this long: any
+                    # learned limit below it was a network blip.
+                    if self._idle_limit is not None and idle_s > self._idle_limit:
+                        self._idle_limit = idle_s
+            if conn.is_open():
+                self._release(conn)
+            else:
+                conn.close()
+            return response
+        raise OSError("DoH pool: unreachable retry state")
+
     def _acquire(self, *, force_new: bool) -> _DoHConnection:
         if not force_new:
-            while True:
-                try:
-                    conn = self._idle.get_nowait()
-                except queue.Empty:
-                    break
-                if conn.is_open():
-                    return conn
-                conn.close()
-        return _DoHConnection(self._endpoint, self._timeout, self._ctx)
+            with self._lock:
+                while self._idle:
+                    conn = self._idle.pop()
+                    if conn.is_open():
+                        return conn
+                    conn.close()
+        # No idle socket: this query waits on a handshake.  Counted so
+        # the next window keeps a spare ready.
+        t0 = time.monotonic()
+        conn = self._open()
+        with self._lock:
+            self._waits += 1
+            self._window_waits += 1
+            self._wait_total_s += time.monotonic() - t0
+            self._target = min(self._max, max(self._target, self._active))
+        return conn
+
+    def _open(self) -> _DoHConnection:
+        conn = _DoHConnection(
+            self._endpoint, self._timeout, self._ctx, session=self._session,
+            mark=self._mark, strategy=self._strategy,
+        )
+        with self._lock:
+            if conn.session_reused:
+                self._resumed += 1
+            else:
+                self._full_handshakes += 1
+        return conn
 
     def _release(self, conn: _DoHConnection) -> None:
-        if self._closed:
+        # TLS 1.3 tickets arrive after the handshake, so the session is
+        # only worth keeping once a response has been read on it.
+        session = conn.session
+        if session is not None and session.has_ticket and not self._closed:
+            self._session = session
+        self._park(conn)
+
+    def _park(self, conn: _DoHConnection) -> None:
+        victims: list[_DoHConnection] = []
+        with self._lock:
+            if self._closed:
+                victims.append(conn)
+            else:
+                self._idle.append(conn)
+                # Trim to the adaptive target on release rather than on
+                # acquire so a short burst can exceed it without
+                # serialising; the oldest sockets go first.
+                while len(self._idle) > self._target:
+                    victims.append(self._idle.pop(0))
+                    self._trimmed += 1
+                self._ensure_maintainer_locked()
+        for victim in victims:
+            victim.close()
+
+    def _ensure_maintainer_locked(self) -> None:
+        if self._maintainer is None:
+            self._maintainer = threading.Thread(
+                target=self._maintain, name="whydpi-doh-keepalive", daemon=True,
+            )
+            self._maintainer.start()
+
+    def _maintain(self) -> None:
+        while not self._stop.wait(self._TICK_S):
+            try:
+                self._tick()
+            except Exception as exc:  # noqa: BLE001
+                logger.debug("DoH pool maintenance failed: %s", exc)
+
+    def _tick(self, now: float | None = None) -> None:
+        now = time.monotonic() if now is None else now
+        victims: list[_DoHConnection] = []
+        refresh = 0
+        with self._lock:
+            if self._closed:
+                return
+            self._roll_window_locked(now)
+            keep: list[_DoHConnection] = []
+            for conn in self._idle:
+                if conn.peer_closed():
+                    self._broken += 1
+                    self._learn_close_locked(now - conn.last_used)
+                    victims.append(conn)
+                else:
+                    keep.append(conn)
+            while len(keep) > self._target:
+                victims.append(keep.pop(0))
+                self._trimmed += 1
+            limit = self._idle_limit
+            if limit is not None and now - self._last_query < self._REFRESH_ACTIVE_S:
+                due = limit - max(2 * self._TICK_S, 0.2 * limit)
+                stale = [c for c in keep if now - c.last_used >= due]
+                if stale:
+                    keep = [c for c in keep if c not in stale]
+                    victims.extend(stale)
+                    refresh = len(stale)
+            self._idle = keep
+        for conn in victims:
             conn.close()
-            return
-        self._idle.put(conn)
-        # Trim overflow.  ``LifoQueue`` is unbounded; we enforce the
-        # cap on release rather than on acquire so a short burst of
-        # concurrent queries can temporarily exceed ``_max`` without
-        # serialising.
-        while self._idle.qsize() > self._max:
+        for _ in range(refresh):
             try:
-                victim = self._idle.get_nowait()
-            except queue.Empty:
+                conn = self._open()
+            except (OSError, ssl.SSLError) as exc:
+                logger.debug("DoH keep-alive refresh failed: %s", exc)
                 break
-            victim.close()
+            with self._lock:
+                self._refreshed += 1
+            self._park(conn)
+
+    def _roll_window_locked(self, now: float) -> None:
+        if now - self._window_start < self._WINDOW_S:
+            return
+        want = self._window_peak + (1 if self._window_waits else 0)
+        if want >= self._target:
+            self._target = min(self._max, want)
+        else:
+            self._target = max(self._min, 1, (self._target + want) // 2)
+        self._window_start = now
+        self._window_peak = self._active
+        self._window_waits = 0
+
+    def _learn_close_locked(self, idle_s: float) -> None:
+        if idle_s < self._MIN_LEARN_IDLE_S:
+            return
+        if self._idle_limit is None or idle_s < self._idle_limit:
+            self._idle_limit = idle_s
+            logger.debug("DoH %s: server idle timeout ~%.0fs",
+                         self._endpoint.ip, idle_s)
 
 
 # ---------------------------------------------------------------------------
@@ -413,6 +810,11 @@ class DoHClient:
     endpoint is configured without a ``hostname`` (explicit local
     override) the underlying :class:`DoHConnectionPool` downgrades to
     unverified TLS and logs a warning.
+
+    With ``mark`` and ``strategy`` (the Linux engine passes
+    ``proxy_mark`` and the default strategy) connections bypass the TLS
+    proxy and fragment their own ClientHello; without them the DoH
+    socket is an ordinary outbound HTTPS connection.
     """
 
     def __init__(
@@ -421,13 +823,20 @@ class DoHClient:
         timeout_s: float = 5.0,
         *,
         pool_size: int = 8,
+        mark: int = 0,
+        strategy: Strategy | None = None,
     ):
         self._endpoint = endpoint
         self._timeout = timeout_s
         self._pool = DoHConnectionPool(
             endpoint, timeout_s=timeout_s, max_size=pool_size,
+            mark=mark, strategy=strategy,
         )
 
+    @property
+    def endpoint(self) -> DoHEndpoint:
+        return self._endpoint
+
     def query(self, wire: bytes) -> bytes:
         return self._pool.query(wire)
 
@@ -437,6 +846,9 @@ class DoHClient:
         """
         return self._pool.warm_up(count)
 
+    def stats(self) -> dict:
+        return self._pool.stats()
+
     def close(self) -> None:
         """Release all pooled sockets.  Called from engine shutdown."""
         self._pool.close()
@@ -459,6 +871,25 @@ class DNSStubServer:
     logged and skipped so a missing IPv6 stack does not prevent the
     IPv4 stub from starting.
 
+    ``primary`` is normally a :class:`~whydpi.net.doh_scheduler.DoHScheduler`
+    spreading queries over every configured endpoint; a bare
+    :class:`DoHClient` plus ``fallback`` still works for tests and
+    embedders.
+
+    ``on_answer`` is called with the question name and the answered
+    addresses after every A/AAAA response; the Linux engine hooks
+    :class:`~whydpi.core.predictive.PredictiveDiscovery` in here.
+
+    ``policy`` picks the questions answered locally without DoH (see
+    :mod:`whydpi.net.dns_policy`); when omitted, ``neutralize_ech``
+    alone decides, as it always has.
+
+    ``sibling_qtypes`` lists record types that browsers ask for together
+    (A, AAAA, HTTPS).  When a query for one of them misses the cache,
+    the others are fetched for the same name in the background, through
+    the same pooled DoH connections, so the follow-up question a few
+    milliseconds later is a cache hit instead of a second round-trip.
+
     A small in-front :class:`DnsCache` (injected via ``cache``) is
     consulted before DoH forwarding so a burst of identical queries
     from parallel connections does not hit the upstream resolver more
@@ -471,10 +902,13 @@ class DNSStubServer:
         bind_address: str | None = None,
         bind_addresses: "Iterable[str] | None" = None,
         bind_port: int,
-        primary: DoHClient,
+        primary: "DoHClient | DoHScheduler",
         fallback: DoHClient | None = None,
         cache: "DnsCache | None" = None,
         neutralize_ech: bool = False,
+        policy: LocalAnswerPolicy | None = None,
+        on_answer: "Callable[[str, list[str]], None] | None" = None,
+        sibling_qtypes: Iterable[int] = (),
     ):
         if bind_addresses is None:
             if bind_address is None:
@@ -489,7 +923,9 @@ class DNSStubServer:
         self._primary = primary
         self._fallback = fallback
         self._cache = cache
-        self._neutralize_ech = neutralize_ech
+        self._policy = policy or LocalAnswerPolicy(neutralize_ech=neutralize_ech)
+        self._on_answer = on_answer
+        self._siblings = tuple(sibling_qtypes)
         self._udp_socks: list[socket.socket] = []
         self._tcp_socks: list[socket.socket] = []
         self._running = False
@@ -593,47 +1029,121 @@ class DNSStubServer:
             ).start()
 
     def _handle_tcp(self, client: socket.socket) -> None:
+        """Serve one persistent TCP connection (RFC 7766).
+
+        Queries are read back-to-back and each is resolved on its own
+        thread, so a slow upstream answer does not hold up the ones
+        behind it; replies go out as they complete, in any order, and
+        the client matches them by transaction id.  At most
+        ``_TCP_MAX_INFLIGHT`` queries per connection are in progress at
+        once (reading pauses beyond that), and a connection idle for
+        ``_TCP_IDLE_S`` between queries is closed.  Replies still in
+        flight when the client half-closes are delivered before the
+        socket goes away.
+        """
+        write_lock = threading.Lock()
+        slots = threading.BoundedSemaphore(_TCP_MAX_INFLIGHT)
         try:
-            client.settimeout(5)
-            header = client.recv(2)
-            if len(header) < 2:
-                return
-            length = struct.unpack("!H", header)[0]
-            payload = b""
-            while len(payload) < length:
-                chunk = client.recv(length - len(payload))
-                if not chunk:
-                    return
-                payload += chunk
-
-            response = self._resolve(payload)
-            if response:
-                client.sendall(struct.pack("!H", len(response)) + response)
+            client.settimeout(_TCP_IDLE_S)
+            while self._running:
+                header = _recv_exact(client, 2)
+                if header is None:
+                    break
+                length = struct.unpack("!H", header)[0]
+                payload = _recv_exact(client, length) if length else None
+                if payload is None:
+                    break
+                slots.acquire()
+                threading.Thread(
+                    target=self._answer_tcp,
+                    args=(client, payload, write_lock, slots),
+                    daemon=True,
+                ).start()
         except OSError:
             pass
         finally:
+            deadline = time.monotonic() + _TCP_DRAIN_S
+            for _ in range(_TCP_MAX_INFLIGHT):
+                if not slots.acquire(timeout=max(0.0, deadline - time.monotonic())):
+                    break
             try:
                 client.close()
             except OSError:
                 pass
 
+    def _answer_tcp(
+        self,
+        client: socket.socket,
+        payload: bytes,
+        write_lock: threading.Lock,
+        slots: threading.BoundedSemaphore,
+    ) -> None:
+        try:
+            response = self._resolve(payload)
+            if response:
+                with write_lock:
+                    client.sendall(struct.pack("!H", len(response)) + response)
+        except OSError:
+            pass
+        finally:
+            slots.release()
+
     def _resolve(self, wire: bytes) -> bytes:
-        if self._neutralize_ech:
-            qtype = _question_qtype(wire)
-            if qtype in (_QTYPE_HTTPS, _QTYPE_SVCB):
-                # Withhold HTTPS/SVCB records so no client obtains the
-                # advertised ECHConfig.  The client then falls back to
-                # A/AAAA and emits a cleartext SNI, which is exactly what
-                # the proxy needs to see in order to fragment and rotate.
-                logger.debug("ECH neutralise: NODATA for qtype=%d", qtype)
-                return _nodata_response(wire)
-        if self._cache is not None:
+        # One parse of the question section per query: the result feeds
+        # the local-answer policy and every cache / single-flight step
+        # below.
+        question = parse_question(wire)
+        if question is not None:
+            # HTTPS/SVCB under ECH neutralisation, AAAA without IPv6,
+            # ANY: answered here, never forwarded (see ``dns_policy``).
+            local = self._policy.answer(wire, question)
+            if local is not None:
+                return local
+        if self._cache is not None and question is not None:
             # Dedup + TTL cache in one call: parallel duplicate queries
             # (common during a page load's DNS burst) collapse onto the
             # leader's DoH round-trip instead of each racing the upstream
             # resolver independently.
-            return self._cache.resolve(wire, self._resolve_direct)
-        return self._resolve_direct(wire)
+            on_miss = (
+                (lambda: self._prefetch_siblings(wire, question))
+                if question.qtype in self._siblings else None
+            )
+            response = self._cache.resolve(
+                wire, self._resolve_direct, question=question, on_miss=on_miss,
+            )
+        else:
+            response = self._resolve_direct(wire)
+        if (
+            self._on_answer is not None
+            and question is not None
+            and question.qtype in (_QTYPE_A, _QTYPE_AAAA)
+            and response
+        ):
+            self._notify_answer(question, response)
+        return response
+
+    def _notify_answer(self, question: DnsQuestion, response: bytes) -> None:
+        # The hook (predictive discovery) must never cost a DNS answer.
+        try:
+            addresses = decode_addresses(response)
+            if addresses:
+                self._on_answer(question.name, addresses)
+        except Exception as exc:  # noqa: BLE001
+            logger.debug("DNS answer hook failed: %s", exc)
+
+    def _prefetch_siblings(self, wire: bytes, question: DnsQuestion) -> None:
+        # Same QNAME and QCLASS, other QTYPE; EDNS options are dropped,
+        # which the question-keyed cache does not distinguish anyway.
+        qname = wire[12:question.end - 4]
+        qclass = wire[question.end - 2:question.end]
+        for qtype in self._siblings:
+            if qtype == question.qtype:
+                continue
+            sibling = (
+                struct.pack("!HHHHHH", 0, 0x0100, 1, 0, 0, 0)
+                + qname + struct.pack("!H", qtype) + qclass
+            )
+            self._cache.prefetch(sibling, self._resolve_direct)
 
     def _resolve_direct(self, wire: bytes) -> bytes:
         for client in (self._primary, self._fallback):
@@ -652,6 +1162,17 @@ class DNSStubServer:
 # Wire-format helpers + DoH-backed address resolver
 # ---------------------------------------------------------------------------
 
+def _recv_exact(sock: socket.socket, size: int) -> bytes | None:
+    """Read exactly *size* bytes, or ``None`` if the peer closes first."""
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = sock.recv(size - len(buf))
+        if not chunk:
+            return None
+        buf.extend(chunk)
+    return bytes(buf)
+
+
 def encode_dns_query(name: str, qtype: int, *, txid: int = 0) -> bytes:
     """Build a minimal DNS query (one question, RD=1) for *name*/*qtype*."""
     qname = b""
@@ -668,43 +1189,6 @@ def encode_dns_query(name: str, qtype: int, *, txid: int = 0) -> bytes:
     return header + qname + struct.pack("!HH", qtype, 1)
 
 
-def _question_qtype(wire: bytes) -> int | None:
-    """Return the QTYPE of the first question, or ``None`` if unparseable."""
-    if len(wire) < 12:
-        return None
-    try:
-        qdcount = struct.unpack_from("!H", wire, 4)[0]
-        if qdcount < 1:
-            return None
-        pos = _skip_dns_name(wire, 12)
-        return struct.unpack_from("!H", wire, pos)[0]
-    except (struct.error, ValueError, IndexError):
-        return None
-
-
-def _nodata_response(query: bytes) -> bytes:
-    """Synthesise a NOERROR/NODATA reply that echoes *query*'s question.
-
-    Keeps the question section intact, sets QR+RD+RA with RCODE=0, and
-    zeroes every record count so the client sees "this type does not
-    exist" and falls back to A/AAAA.  Any EDNS OPT in the additional
-    section is intentionally dropped — clients do not require it echoed.
-    """
-    if len(query) < 12:
-        return b""
-    try:
-        end = _skip_dns_name(query, 12) + 4  # qtype + qclass
-    except (ValueError, IndexError):
-        return b""
-    header = bytearray(query[:12])
-    struct.pack_into("!H", header, 2, 0x8180)  # QR=1, RD=1, RA=1, RCODE=0
-    struct.pack_into("!H", header, 4, 1)        # QDCOUNT
-    struct.pack_into("!H", header, 6, 0)        # ANCOUNT
-    struct.pack_into("!H", header, 8, 0)        # NSCOUNT
-    struct.pack_into("!H", header, 10, 0)       # ARCOUNT
-    return bytes(header) + query[12:end]
-
-
 def _skip_dns_name(wire: bytes, offset: int) -> int:
     """Advance past a (possibly-compressed) DNS name; return new offset."""
     end = len(wire)
@@ -763,31 +1247,141 @@ class DoHResolver:
     in here: the client list is whatever the operator configured, and the
     answers come from those resolvers at runtime.  This keeps the tool
     site-free and list-free while still defeating range blocks.
+
+    Answers already in the cache are taken synchronously; only the
+    remaining qtype × client queries are issued, concurrently.  The call
+    returns once ``quorum`` answers are in (``0`` = all of them) or
+    ``deadline_s`` has passed, whichever comes first.  Queries still in
+    flight at that point keep running and land in the cache for the next
+    caller.  Addresses are merged in configured priority order (qtype,
+    then client), so the primary resolver's answers always lead.
+
+    With a shared :class:`DnsCache` each per-client answer is memoised
+    for its TTL and deduplicated through the cache's single-flight, so
+    a burst of failing connections for one SNI costs one DoH round-trip
+    per client instead of one per connection.  The cache key is tagged
+    with the client's endpoint, keeping per-resolver answers distinct
+    from each other and from the stub's own entries.
     """
 
-    def __init__(self, clients: Iterable["DoHClient"]):
+    def __init__(
+        self,
+        clients: Iterable["DoHClient"],
+        *,
+        cache: "DnsCache | None" = None,
+        quorum: int = 0,
+        deadline_s: float = 2.0,
+    ):
         self._clients = tuple(c for c in clients if c is not None)
+        self._cache = cache
+        self._quorum = max(0, int(quorum))
+        self._deadline = max(0.0, float(deadline_s))
+        self._tags = tuple(_client_tag(c) for c in self._clients)
 
     def addresses(self, name: str, *, ipv6_enabled: bool = True) -> list[str]:
         if not name or not self._clients:
             return []
         qtypes = [_QTYPE_A] + ([_QTYPE_AAAA] if ipv6_enabled else [])
+        jobs = [
+            (qtype, index)
+            for qtype in qtypes
+            for index in range(len(self._clients))
+        ]
+        results: dict[tuple[int, int], bytes] = {}
+        # Cached answers are read here; only the misses go upstream,
+        # one thread each.
+        misses: list[tuple[int, int, bytes, DnsQuestion | None]] = []
+        for qtype, index in jobs:
+            wire, question = self._question(name, qtype, index)
+            cached = (
+                self._cache.get(wire, question)
+                if self._cache is not None and question is not None else None
+            )
+            if cached is not None:
+                results[qtype, index] = cached
+            else:
+                misses.append((qtype, index, wire, question))
+
+        need = min(self._quorum or len(jobs), len(jobs))
+        answered = sum(1 for response in results.values() if response)
+        done: "queue.Queue[tuple[int, int, bytes]]" = queue.Queue()
+        for miss in misses:
+            threading.Thread(
+                target=self._lookup_one,
+                args=(name, *miss, done),
+                name="whydpi-doh-fanout",
+                daemon=True,
+            ).start()
+
+        deadline = time.monotonic() + self._deadline
+        for _ in misses:
+            if answered >= need:
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                qtype, index, response = done.get(timeout=remaining)
+            except queue.Empty:
+                break
+            results[qtype, index] = response
+            if response:
+                answered += 1
+
         out: list[str] = []
         seen: set[str] = set()
-        for qtype in qtypes:
-            wire = encode_dns_query(name, qtype)
-            for client in self._clients:
-                try:
-                    response = client.query(wire)
-                except (OSError, ssl.SSLError) as exc:
-                    logger.debug("DoH resolve %s/%d via %s failed: %s",
-                                 name, qtype, client, exc)
-                    continue
-                for ip in decode_addresses(response):
-                    if ip and ip not in seen:
-                        seen.add(ip)
-                        out.append(ip)
+        for job in jobs:
+            for ip in decode_addresses(results.get(job, b"")):
+                if ip and ip not in seen:
+                    seen.add(ip)
+                    out.append(ip)
         return out
 
     def __call__(self, name: str, ipv6_enabled: bool = True) -> list[str]:
         return self.addresses(name, ipv6_enabled=ipv6_enabled)
+
+    def _question(
+        self, name: str, qtype: int, index: int,
+    ) -> tuple[bytes, DnsQuestion | None]:
+        """The query for *name* and its cache key, tagged with client *index*."""
+        wire = encode_dns_query(name, qtype)
+        question = parse_question(wire)
+        if question is None:
+            return wire, None
+        tagged = DnsQuestion(self._tags[index] + question.key, question.qtype, question.end)
+        return wire, tagged
+
+    def _lookup_one(
+        self,
+        name: str,
+        qtype: int,
+        index: int,
+        wire: bytes,
+        question: DnsQuestion | None,
+        done: "queue.Queue[tuple[int, int, bytes]]",
+    ) -> None:
+        client = self._clients[index]
+        response = b""
+        try:
+            if self._cache is not None and question is not None:
+                response = self._cache.resolve(wire, client.query, question=question)
+            else:
+                response = client.query(wire)
+        except (OSError, ssl.SSLError) as exc:
+            logger.debug("DoH resolve %s/%d via %s failed: %s",
+                         name, qtype, client, exc)
+        done.put((qtype, index, response))
+
+
+def _client_tag(client: "DoHClient") -> bytes:
+    """Cache-key prefix naming *client*.
+
+    Starts with ``0xFF``, a byte that can never begin a question-section
+    key (label lengths stop at 63), so tagged keys cannot collide with
+    the stub's own cache entries.
+    """
+    endpoint = getattr(client, "endpoint", None)
+    ident = (
+        f"{endpoint.ip}:{endpoint.port}" if endpoint is not None else repr(client)
+    )
+    return b"\xff" + ident.encode("ascii", "replace") + b"\x00"
@@ -24,17 +24,52 @@ bottleneck when the OS cache can't help.
 This module is a minimalist, standards-respectful answer cache sitting
 in front of the DoH forwarder:
 
-* **Key** — ``(lower-case qname, qtype, qclass)`` extracted from the
-  DNS question section.  Case-insensitive per RFC 1035 §2.3.3.
-* **Value** — the full on-wire DNS response as stored; on hit the
-  caller's transaction id is stamped into the first two bytes so
-  clients still see a response matching the query they just sent.
+* **Key** — the raw question section (QNAME + QTYPE + QCLASS) with
+  ASCII letters folded to lower case, case-insensitive per RFC 1035
+  §2.3.3.  :func:`parse_question` builds it in one pass without
+  decoding labels, and callers that already parsed the question pass
+  the :class:`DnsQuestion` through so each query is walked only once.
+* **Value** — the full on-wire DNS response as stored, plus the offset
+  and original value of every RR's TTL field, recorded by a single walk
+  at :meth:`DnsCache.put` time.  On hit the template is copied, the
+  caller's transaction id is stamped into the first two bytes, and each
+  TTL is decremented by the time the answer has spent in the cache —
+  so downstream OS and browser caches hold it exactly as long as the
+  authoritative TTL allows, no longer.
 * **TTL** — minimum TTL across all RRs in the response, clamped to
-  ``[_MIN_TTL_S, _MAX_TTL_S]``.  Empty-answer / error responses are
-  cached briefly (``_NEG_TTL_S``) to dampen retry storms without
-  contradicting short-TTL records.
-* **Eviction** — soft cap at ``_MAX_ENTRIES``; on overflow we drop
-  already-expired entries first, then the oldest-by-deadline entries.
+  ``[_MIN_TTL_S, _MAX_TTL_S]``.  NXDOMAIN / NODATA answers are cached
+  for ``min(SOA TTL, SOA MINIMUM)`` from the authority section, as
+  RFC 2308 §5 prescribes, clamped to ``[_NEG_TTL_S, _MAX_TTL_S]``.
+  Error responses and negative answers without an SOA are cached
+  briefly (``_NEG_TTL_S``) to dampen retry storms.
+* **Eviction** — cap at ``max_entries`` (default ``_MAX_ENTRIES``).
+  Entries live in an LRU-ordered dict and their deadlines in a min-heap;
+  on overflow we pop expired heads off the heap first, then the least
+  recently used entry.  Both are amortised O(log n) per insert, so the
+  cap can be raised to 100 k+ names on a gateway without turning every
+  insert into a full scan under ``_lock``.
+* **Refresh-ahead** — every hit bumps a per-entry counter.  Once an
+  entry has been asked for ``prefetch_min_hits`` times and has less
+  than ``prefetch_fraction`` of its TTL left, :meth:`DnsCache.resolve`
+  refreshes it in the background while still answering from RAM, so a
+  hot name never falls off the cache onto the cold DoH path.
+* **Serve-stale** (RFC 8767) — expired entries are retained for up to
+  ``serve_stale_s``.  When one is asked for, a refresh is started and
+  the caller waits at most ``_STALE_WAIT_S`` (the RFC's client
+  response timer); if upstream is slow or failing, the expired answer
+  is returned with every TTL rewritten to ``_STALE_TTL_S``.
+
+Both the prefetch and the stale refresh run through the same in-flight
+single-flight registry as a cold miss, so a refresh and a concurrent
+cold query for the same question never issue two DoH requests.
+
+* **Address index** — the same walk at ``put`` time collects the A and
+  AAAA records of positive answers into a bounded two-way index: name
+  → every address it was answered with, and address → every name that
+  resolved to it, each with its record's own expiry.  The proxy reads
+  it for rotation alternates (:meth:`DnsCache.addresses_for`) and for a
+  hostname behind an SNI-less connection (:meth:`DnsCache.hostname_for`)
+  without resolving anything again.
 
 Privacy
 -------
@@ -46,13 +81,20 @@ gone".  No domain name is ever logged.
 
 from __future__ import annotations
 
+import heapq
+import logging
+import socket
 import struct
 import threading
 import time
+from collections import OrderedDict
 from dataclasses import dataclass
 from typing import Callable
 
 
+logger = logging.getLogger(__name__)
+
+
 # Clamp bounds for positive answers.  A 0-TTL record exists (mail exchangers
 # with DNS-based load balancing, some CDNs) but caching it for 0 seconds is
 # equivalent to not caching at all and re-introduces the slow cold path we
@@ -65,62 +107,167 @@ _MIN_TTL_S = 30.0
 _MAX_TTL_S = 600.0
 # Short negative-cache window: enough to collapse a browser retry burst on a
 # NXDOMAIN or SERVFAIL without trapping a real transient upstream hiccup.
+# Used as-is when upstream sends no SOA, and as the floor for SOA-derived
+# negative TTLs.
 _NEG_TTL_S = 10.0
 # 4 k entries * ~512 B avg response * 2 overhead ≈ 4 MB peak — well within
 # the footprint budget for a tray application.
 _MAX_ENTRIES = 4096
+# The expiry heap is lazily pruned (replaced entries leave their old
+# deadline behind); once it holds this many times more items than the
+# cache has entries it is rebuilt from scratch.
+_HEAP_SLACK = 2
+# Refresh-ahead trigger: refresh an entry in the background once less than
+# this fraction of its TTL remains *and* it has been hit at least
+# ``_PREFETCH_MIN_HITS`` times since it was stored.  The hit floor keeps us
+# from re-resolving one-shot tracker names that nobody will ask for again.
+_PREFETCH_FRACTION = 0.1
+_PREFETCH_MIN_HITS = 3
+# RFC 8767 §5 recommends a 30 s TTL on stale answers, a 1.8 s client
+# response timer before falling back to stale data, and a maximum stale
+# window of 1-3 days.  The window is only ever used when upstream cannot
+# answer, and the whole cache is still wiped on shutdown.
+_STALE_TTL_S = 30
+_STALE_WAIT_S = 1.8
+_STALE_MAX_S = 86400.0
+
+# :meth:`DnsCache._lookup` outcomes.
+_MISS = "miss"
+_FRESH = "fresh"
+_PREFETCH = "prefetch"
+_STALE = "stale"
+
+_QTYPE_A = 1
+_QTYPE_SOA = 6
+_QTYPE_AAAA = 28
+_QTYPE_OPT = 41
+_RCODE_NOERROR = 0
+_RCODE_SERVFAIL = 2
+_RCODE_NXDOMAIN = 3
+_RCODE_REFUSED = 5
+# First byte of a per-client tagged key (``whydpi.net.dns._client_tag``).
+_TAG_MARK = b"\xff"
 
 
 @dataclass
 class _Entry:
-    """One cached DNS response with absolute expiry deadline."""
+    """One cached DNS response with absolute expiry deadline.
+
+    ``ttl_offsets[i]`` is the byte offset of an RR's 32-bit TTL field in
+    ``wire_template`` and ``ttl_values[i]`` its value as received.
+    """
     wire_template: bytes
     expires_at: float
+    ttl: float
+    stored_at: float
+    ttl_offsets: tuple[int, ...] = ()
+    ttl_values: tuple[int, ...] = ()
+    hits: int = 0
+
+    def render(self, txid: bytes, now: float) -> bytes:
+        """Copy of the template for a client asking with *txid*, TTLs
+        decremented by the time spent in the cache."""
+        out = bytearray(self.wire_template)
+        out[0:2] = txid
+        elapsed = int(now - self.stored_at)
+        if elapsed > 0:
+            for offset, ttl in zip(self.ttl_offsets, self.ttl_values):
+                struct.pack_into("!I", out, offset, ttl - elapsed if ttl > elapsed else 0)
+        return bytes(out)
+
+    def render_stale(self, txid: bytes) -> bytes:
+        """Copy of the template with every TTL set to ``_STALE_TTL_S``."""
+        out = bytearray(self.wire_template)
+        out[0:2] = txid
+        for offset in self.ttl_offsets:
+            struct.pack_into("!I", out, offset, _STALE_TTL_S)
+        return bytes(out)
 
 
-def _parse_qname(wire: bytes, offset: int) -> tuple[str, int]:
-    """Decode a DNS name starting at ``offset``.
+@dataclass
+class _Scan:
+    """What :func:`_scan_response` learned from one pass over an answer."""
+    ttl_offsets: tuple[int, ...]
+    ttl_values: tuple[int, ...]
+    # Cache lifetime before clamping, or ``None`` when the response
+    # gives no basis for one (no RRs, no SOA, malformed).
+    lifetime: float | None
+    negative: bool
+    # ``(address, ttl)`` of every A / AAAA record in the answer section.
+    addresses: tuple[tuple[str, int], ...] = ()
+
+
+# ``bytes.translate`` table folding ASCII A-Z onto a-z and leaving every
+# other byte (length octets included) untouched — RFC 4343 case folding
+# straight on the wire, no label decoding.
+_ASCII_LOWER = bytes(
+    c + 32 if 0x41 <= c <= 0x5A else c for c in range(256)
+)
+
+
+@dataclass(slots=True)
+class DnsQuestion:
+    """The first question of a DNS message, parsed exactly once.
+
+    ``key`` is the question section (QNAME labels + QTYPE + QCLASS) as
+    raw wire bytes, ASCII-lowercased; it is the cache and single-flight
+    key.  ``end`` is the offset just past the question, which lets
+    callers synthesise replies without walking the name again.
+
+    Treat instances as read-only.  They are not ``frozen`` because a
+    frozen dataclass triples the construction cost on a path that runs
+    once per DNS query.
+    """
+    key: bytes
+    qtype: int
+    end: int
 
-    Returns ``(lower-case dotted name, offset_after_name)``.  Questions
-    don't use pointer compression in practice; if we encounter one we
-    treat it as a terminator — losing potential cache hits but never
-    producing a wrong hit.
+    @property
+    def name(self) -> str:
+        """QNAME as dotted lower-case text, without the trailing dot.
+
+        Decoded on demand: the hot path only ever needs :attr:`key`.
+        """
+        key = self.key
+        if key[:1] == _TAG_MARK:
+            # Per-client tagged key (see ``DoHResolver``): the real
+            # question starts after the NUL-terminated tag.
+            key = key[key.index(0) + 1:]
+        labels: list[str] = []
+        pos = 0
+        while pos < len(key) and key[pos]:
+            length = key[pos]
+            labels.append(key[pos + 1:pos + 1 + length].decode("ascii", errors="replace"))
+            pos += 1 + length
+        return ".".join(labels).lower()
+
+
+def parse_question(wire: bytes) -> DnsQuestion | None:
+    """Parse the first question of *wire*, or ``None`` if malformed.
+
+    A compression pointer inside a question is legal but never seen in
+    practice; such queries are treated as uncacheable rather than risk
+    two different names sharing a key.
     """
-    labels: list[str] = []
-    i = offset
     end = len(wire)
+    if end < 17 or wire[4] == 0 and wire[5] == 0:
+        return None
+    i = 12
     while i < end:
         length = wire[i]
         if length == 0:
-            return ".".join(labels).lower(), i + 1
+            after = i + 5
+            if after > end:
+                return None
+            return DnsQuestion(
+                wire[12:after].translate(_ASCII_LOWER),
+                (wire[i + 1] << 8) | wire[i + 2],
+                after,
+            )
         if length & 0xC0:
-            return ".".join(labels).lower(), i + 2
-        i += 1
-        if i + length > end:
-            raise ValueError("truncated qname label")
-        labels.append(wire[i:i + length].decode("ascii", errors="replace"))
-        i += length
-    raise ValueError("unterminated qname")
-
-
-def _question_key(wire: bytes) -> tuple[str, int, int] | None:
-    """Extract ``(qname, qtype, qclass)`` from a DNS query or response.
-
-    Returns ``None`` if the message is malformed or carries no question.
-    """
-    if len(wire) < 12:
-        return None
-    qdcount = struct.unpack_from("!H", wire, 4)[0]
-    if qdcount < 1:
-        return None
-    try:
-        qname, after = _parse_qname(wire, 12)
-        if after + 4 > len(wire):
             return None
-        qtype, qclass = struct.unpack_from("!HH", wire, after)
-        return qname, int(qtype), int(qclass)
-    except (ValueError, struct.error, IndexError):
-        return None
+        i += 1 + length
+    return None
 
 
 def _skip_name(wire: bytes, offset: int) -> int:
@@ -137,31 +284,68 @@ def _skip_name(wire: bytes, offset: int) -> int:
     raise ValueError("unterminated name in response")
 
 
-def _min_ttl(response: bytes) -> float | None:
-    """Minimum TTL across all RRs in *response*, or ``None`` if the
-    response parses but carries no RRs (SOA-only negative answers fall
-    into this branch and get short negative caching)."""
+def _scan_response(response: bytes) -> _Scan | None:
+    """Walk *response* once, recording every RR's TTL field.
+
+    EDNS OPT pseudo-records are skipped: their TTL field carries the
+    extended RCODE and flags, not a lifetime.  For NXDOMAIN and NODATA
+    the lifetime is ``min(SOA TTL, SOA MINIMUM)`` of the first SOA in
+    the authority section (RFC 2308 §5); for positive answers it is the
+    minimum TTL over all RRs.  Returns ``None`` if the message does not
+    parse.
+    """
     if len(response) < 12:
         return None
     _, _, qdcount, ancount, nscount, arcount = struct.unpack_from("!HHHHHH", response, 0)
+    rcode = response[3] & 0x0F
+    negative = rcode == _RCODE_NXDOMAIN or (rcode == _RCODE_NOERROR and ancount == 0)
+    offsets: list[int] = []
+    ttls: list[int] = []
+    addresses: list[tuple[str, int]] = []
+    soa_ttl: int | None = None
     pos = 12
     try:
         for _ in range(qdcount):
-            _, pos = _parse_qname(response, pos)
-            pos += 4  # qtype + qclass
-        ttls: list[int] = []
-        for _ in range(ancount + nscount + arcount):
+            pos = _skip_name(response, pos) + 4  # qtype + qclass
+        for index in range(ancount + nscount + arcount):
             pos = _skip_name(response, pos)
             if pos + 10 > len(response):
                 return None
-            _, _, ttl, rdlen = struct.unpack_from("!HHIH", response, pos)
-            ttls.append(int(ttl))
-            pos += 10 + int(rdlen)
-        if not ttls:
-            return None
-        return float(min(ttls))
+            rtype, _, ttl, rdlen = struct.unpack_from("!HHIH", response, pos)
+            rdata = pos + 10
+            if rdata + rdlen > len(response):
+                return None
+            if rtype != _QTYPE_OPT:
+                offsets.append(pos + 4)
+                ttls.append(int(ttl))
+            if index < ancount:
+                if rtype == _QTYPE_A and rdlen == 4:
+                    addresses.append((socket.inet_ntoa(response[rdata:rdata + 4]), int(ttl)))
+                elif rtype == _QTYPE_AAAA and rdlen == 16:
+                    addresses.append((
+                        socket.inet_ntop(socket.AF_INET6, response[rdata:rdata + 16]),
+                        int(ttl),
+                    ))
+            if (
+                negative and soa_ttl is None and rtype == _QTYPE_SOA
+                and ancount <= index < ancount + nscount
+            ):
+                # MNAME, RNAME, then SERIAL REFRESH RETRY EXPIRE MINIMUM.
+                tail = _skip_name(response, _skip_name(response, rdata)) + 16
+                minimum = struct.unpack_from("!I", response, tail)[0]
+                soa_ttl = min(int(ttl), int(minimum))
+            pos = rdata + int(rdlen)
     except (struct.error, ValueError, IndexError):
         return None
+    if negative:
+        lifetime = float(soa_ttl) if soa_ttl is not None else None
+    else:
+        lifetime = float(min(ttls)) if ttls else None
+    return _Scan(tuple(offsets), tuple(ttls), lifetime, negative, tuple(addresses))
+
+
+def _rcode(response: bytes) -> int:
+    return response[3] & 0x0F if len(response) >= 4 else 0
 
 
 class DnsCache:
@@ -170,64 +354,145 @@ class DnsCache:
     Only the answer bytes are stored; the caller's transaction id is
     overlaid onto the template at lookup time so clients never see a
     stale id.
+
+    ``prefetch_fraction`` / ``prefetch_min_hits`` tune refresh-ahead
+    (``prefetch_fraction=0`` disables it) and ``serve_stale_s`` bounds
+    how long an expired answer may still be served while upstream is
+    unreachable (``0`` disables serve-stale).
     """
 
-    def __init__(self, *, max_entries: int = _MAX_ENTRIES) -> None:
-        self._entries: dict[tuple[str, int, int], _Entry] = {}
+    def __init__(
+        self,
+        *,
+        max_entries: int = _MAX_ENTRIES,
+        prefetch_fraction: float = _PREFETCH_FRACTION,
+        prefetch_min_hits: int = _PREFETCH_MIN_HITS,
+        serve_stale_s: float = _STALE_MAX_S,
+    ) -> None:
+        # LRU order: a hit moves the key to the end, eviction pops from
+        # the front.  ``_expiry`` is a min-heap of ``(expires_at, key)``
+        # used to find dead entries without scanning the dict.
+        self._entries: OrderedDict[bytes, _Entry] = OrderedDict()
+        self._expiry: list[tuple[float, bytes]] = []
         self._lock = threading.Lock()
         self._max = max(1, int(max_entries))
+        self._prefetch_fraction = min(1.0, max(0.0, float(prefetch_fraction)))
+        self._prefetch_min_hits = max(1, int(prefetch_min_hits))
+        self._stale_s = max(0.0, float(serve_stale_s))
+        # Bumped by :meth:`wipe` so a refresh that was already in flight
+        # at shutdown cannot repopulate the cache afterwards.
+        self._generation = 0
         # In-flight deduplication: when a cold query arrives we register
         # its key in ``_inflight`` before issuing the DoH request; any
-        # subsequent caller for the same ``(qname, qtype, qclass)`` waits
+        # subsequent caller for the same question key waits
         # on the attached :class:`threading.Event` instead of issuing a
         # duplicate upstream query.  Parallel page-load bursts routinely
         # ask for the same A + AAAA records from dozens of connections
         # at once; without this guard each of them races to the DoH
         # resolver, defeats the connection pool, and adds hundreds of
         # milliseconds of latency to every worker.
-        self._inflight: dict[tuple[str, int, int], threading.Event] = {}
+        self._inflight: dict[bytes, threading.Event] = {}
         self._inflight_lock = threading.Lock()
-
-    def get(self, query_wire: bytes) -> bytes | None:
-        """Return a response matching *query_wire* or ``None``."""
-        key = _question_key(query_wire)
-        if key is None or len(query_wire) < 2:
-            return None
-        now = time.monotonic()
-        with self._lock:
-            entry = self._entries.get(key)
-            if entry is None:
-                return None
-            if entry.expires_at <= now:
-                self._entries.pop(key, None)
+        # Address index: name -> {address: expires_at} in LRU order and
+        # address -> {name: expires_at}.  Bounded to ``max_entries`` names.
+        self._by_name: OrderedDict[str, dict[str, float]] = OrderedDict()
+        self._by_addr: dict[str, dict[str, float]] = {}
+
+    def get(
+        self, query_wire: bytes, question: DnsQuestion | None = None,
+    ) -> bytes | None:
+        """Return a fresh response matching *query_wire* or ``None``.
+
+        *question* is the already-parsed question of *query_wire*, if
+        the caller has it; otherwise it is parsed here.
+        """
+        if question is None:
+            question = parse_question(query_wire)
+            if question is None:
                 return None
-            template = entry.wire_template
-        if len(template) < 2:
+        entry, state = self._lookup(question.key)
+        if entry is None or state == _STALE:
             return None
-        # Overlay the caller's transaction id.
-        return query_wire[:2] + template[2:]
+        # Overlay the caller's transaction id and age the TTLs.
+        return entry.render(query_wire[:2], time.monotonic())
 
-    def put(self, query_wire: bytes, response_wire: bytes) -> None:
+    def put(
+        self,
+        query_wire: bytes,
+        response_wire: bytes,
+        question: DnsQuestion | None = None,
+    ) -> None:
         """Cache *response_wire* as the answer to *query_wire*.
 
         Silently ignored on malformed inputs.
         """
-        key = _question_key(query_wire)
-        if key is None or len(response_wire) < 12:
+        if question is None:
+            question = parse_question(query_wire)
+            if question is None:
+                return
+        if len(response_wire) < 12:
             return
-        ttl = _min_ttl(response_wire)
-        if ttl is None:
+        key = question.key
+        scan = _scan_response(response_wire)
+        if scan is None or scan.lifetime is None:
             ttl = _NEG_TTL_S
+        elif scan.negative:
+            ttl = max(_NEG_TTL_S, min(scan.lifetime, _MAX_TTL_S))
         else:
-            ttl = max(_MIN_TTL_S, min(ttl, _MAX_TTL_S))
-        deadline = time.monotonic() + ttl
+            ttl = max(_MIN_TTL_S, min(scan.lifetime, _MAX_TTL_S))
+        now = time.monotonic()
+        deadline = now + ttl
         with self._lock:
-            if len(self._entries) >= self._max:
+            if key not in self._entries and len(self._entries) >= self._max:
                 self._evict_locked()
             self._entries[key] = _Entry(
                 wire_template=bytes(response_wire),
                 expires_at=deadline,
+                ttl=ttl,
+                stored_at=now,
+                ttl_offsets=scan.ttl_offsets if scan is not None else (),
+                ttl_values=scan.ttl_values if scan is not None else (),
             )
+            self._entries.move_to_end(key)
+            heapq.heappush(self._expiry, (deadline, key))
+            if len(self._expiry) > _HEAP_SLACK * self._max:
+                self._rebuild_heap_locked()
+        if scan is not None and scan.addresses:
+            self._index_addresses(question.name, scan.addresses, now)
+
+    def addresses_for(self, name: str, ipv6_enabled: bool = True) -> list[str]:
+        """Unexpired addresses *name* has been answered with, oldest first.
+
+        Matches the ``AltResolver`` signature, so the proxy can consult
+        it before resolving anything externally.
+        """
+        now = time.monotonic()
+        with self._lock:
+            known = self._by_name.get(name.lower().rstrip("."))
+            if not known:
+                return []
+            return [
+                addr for addr, expires in known.items()
+                if expires > now and (ipv6_enabled or ":" not in addr)
+            ]
+
+    def names_for(self, address: str) -> list[str]:
+        """Unexpired names that resolved to *address*."""
+        now = time.monotonic()
+        with self._lock:
+            known = self._by_addr.get(address)
+            if not known:
+                return []
+            return [name for name, expires in known.items() if expires > now]
+
+    def hostname_for(self, address: str) -> str | None:
+        """The one name behind *address*, or ``None`` if unknown or shared.
+
+        A CDN address answered for several names gives no basis to pick
+        one, so ambiguity is reported as a miss.
+        """
+        names = self.names_for(address)
+        return names[0] if len(names) == 1 else None
 
     def resolve(
         self,
@@ -235,10 +500,20 @@ class DnsCache:
         compute: Callable[[bytes], bytes],
         *,
         wait_timeout_s: float = 5.0,
+        question: DnsQuestion | None = None,
+        on_miss: Callable[[], None] | None = None,
     ) -> bytes:
         """Cache-and-dedup resolver wrapper.
 
         Fast-path: cached hit → return synthesised response immediately.
+        A hot entry near the end of its TTL is additionally refreshed in
+        the background (refresh-ahead).
+
+        Stale path: the entry has expired but is inside the serve-stale
+        window.  A refresh is started (or joined) and awaited for at most
+        ``_STALE_WAIT_S``; if it has not produced a usable answer by then
+        the expired answer is returned with a short TTL and the refresh
+        carries on in the background.
 
         Cold path: if no other thread is already resolving this key,
         *this* thread becomes the leader — it calls ``compute(query_wire)``,
@@ -249,14 +524,31 @@ class DnsCache:
         call so a slow leader never pins the whole pool.
 
         Returns an empty byte string only if *both* the leader and the
-        fallback compute calls fail.
+        fallback compute calls fail.  *question* is reused for every
+        cache and single-flight step; it is parsed here when omitted.
+        *on_miss* is called by the cold-path leader just before it goes
+        upstream (the stub uses it to prefetch sibling record types).
         """
-        cached = self.get(query_wire)
-        if cached is not None:
-            return cached
-        key = _question_key(query_wire)
-        if key is None:
-            return compute(query_wire)
+        if question is None:
+            question = parse_question(query_wire)
+            if question is None:
+                return compute(query_wire)
+        key = question.key
+
+        entry, state = self._lookup(key)
+        if state == _FRESH:
+            return entry.render(query_wire[:2], time.monotonic())
+        if state == _PREFETCH:
+            self._refresh_async(question, query_wire, compute)
+            return entry.render(query_wire[:2], time.monotonic())
+        if state == _STALE:
+            event = self._refresh_async(question, query_wire, compute)
+            event.wait(timeout=_STALE_WAIT_S)
+            fresh = self.get(query_wire, question)
+            if fresh is not None:
+                return fresh
+            logger.debug("DNS cache: upstream slow/failing, serving stale answer")
+            return entry.render_stale(query_wire[:2])
 
         leader_event: threading.Event | None = None
         follower_event: threading.Event | None = None
@@ -274,7 +566,7 @@ class DnsCache:
             # through to a direct compute so a stuck leader doesn't
             # stall every peer forever.
             follower_event.wait(timeout=wait_timeout_s)
-            cached = self.get(query_wire)
+            cached = self.get(query_wire, question)
             if cached is not None:
                 return cached
             # Leader gave up or failed; resolve ourselves.
@@ -285,21 +577,36 @@ class DnsCache:
 
         # Leader path: produce the answer, populate the cache, signal.
         assert leader_event is not None
-        try:
-            response = compute(query_wire)
-        except Exception:  # noqa: BLE001
-            response = b""
-        if response:
-            self.put(query_wire, response)
+        if on_miss is not None:
+            try:
+                on_miss()
+            except Exception as exc:  # noqa: BLE001
+                logger.debug("DNS cache: miss hook failed: %s", exc)
+        return self._lead(question, query_wire, compute, leader_event)
+
+    def prefetch(self, query_wire: bytes, compute: Callable[[bytes], bytes]) -> bool:
+        """Resolve *query_wire* in the background unless already known.
+
+        Skipped when an entry exists (in any state) or a resolution is
+        already in flight.  Returns whether a fetch was started.
+        """
+        question = parse_question(query_wire)
+        if question is None or self._has_entry(question.key):
+            return False
         with self._inflight_lock:
-            self._inflight.pop(key, None)
-        leader_event.set()
-        return response
+            if question.key in self._inflight:
+                return False
+        self._refresh_async(question, query_wire, compute)
+        return True
 
     def wipe(self) -> None:
         """Drop every cached entry.  Called on engine shutdown."""
         with self._lock:
             self._entries.clear()
+            self._expiry.clear()
+            self._by_name.clear()
+            self._by_addr.clear()
+            self._generation += 1
         with self._inflight_lock:
             # Wake any lingering waiters so shutdown doesn't strand them.
             for evt in self._inflight.values():
@@ -312,16 +619,148 @@ class DnsCache:
 
     # Internal -------------------------------------------------------
 
-    def _evict_locked(self) -> None:
-        """Make room for a new entry.  Caller holds ``self._lock``."""
+    def _lookup(self, key: bytes) -> tuple[_Entry | None, str]:
+        """Classify the entry for *key* and count the hit.
+
+        Returns ``(entry, state)`` where *state* is one of ``_MISS``
+        (*entry* is ``None``), ``_FRESH``, ``_PREFETCH`` (fresh but due
+        for refresh-ahead) or ``_STALE`` (expired but still inside the
+        serve-stale window).  Entries are replaced, never mutated, so
+        the caller may render *entry* after the lock is released.
+        """
         now = time.monotonic()
-        expired = [k for k, e in self._entries.items() if e.expires_at <= now]
-        for k in expired:
-            self._entries.pop(k, None)
-        if len(self._entries) < self._max:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or len(entry.wire_template) < 12:
+                return None, _MISS
+            remaining = entry.expires_at - now
+            if remaining <= 0:
+                if -remaining >= self._stale_s:
+                    self._entries.pop(key, None)
+                    return None, _MISS
+                return entry, _STALE
+            self._entries.move_to_end(key)
+            entry.hits += 1
+            if (
+                entry.hits >= self._prefetch_min_hits
+                and remaining < entry.ttl * self._prefetch_fraction
+            ):
+                return entry, _PREFETCH
+            return entry, _FRESH
+
+    def _refresh_async(
+        self,
+        question: DnsQuestion,
+        query_wire: bytes,
+        compute: Callable[[bytes], bytes],
+    ) -> threading.Event:
+        """Start a background refresh for *question* unless one is in
+        flight.
+
+        Returns the in-flight event either way, so the stale path can
+        wait on whichever refresh ends up answering.
+        """
+        with self._inflight_lock:
+            existing = self._inflight.get(question.key)
+            if existing is not None:
+                return existing
+            event = threading.Event()
+            self._inflight[question.key] = event
+        threading.Thread(
+            target=self._lead,
+            args=(question, bytes(query_wire), compute, event),
+            name="whydpi-dns-refresh",
+            daemon=True,
+        ).start()
+        return event
+
+    def _lead(
+        self,
+        question: DnsQuestion,
+        query_wire: bytes,
+        compute: Callable[[bytes], bytes],
+        event: threading.Event,
+    ) -> bytes:
+        """Single-flight leader: compute, store, release the followers."""
+        key = question.key
+        generation = self._generation
+        try:
+            response = compute(query_wire)
+        except Exception:  # noqa: BLE001
+            response = b""
+        # RFC 8767 §4: a SERVFAIL/REFUSED from upstream must not replace
+        # an answer we could still serve stale.
+        usable = bool(response) and not (
+            _rcode(response) in (_RCODE_SERVFAIL, _RCODE_REFUSED)
+            and self._has_entry(key)
+        )
+        if usable and generation == self._generation:
+            self.put(query_wire, response, question)
+        with self._inflight_lock:
+            if self._inflight.get(key) is event:
+                self._inflight.pop(key, None)
+        event.set()
+        return response
+
+    def _has_entry(self, key: bytes) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def _evict_locked(self) -> None:
+        """Make room for one new entry.  Caller holds ``self._lock``.
+
+        Entries past their serve-stale window are popped off the expiry
+        heap first — they are dead weight.  Entries still inside the
+        window are kept: they are the ones that rescue a page load when
+        upstream goes away.  If that frees nothing, the least recently
+        used entry goes.
+        """
+        cutoff = time.monotonic() - self._stale_s
+        heap = self._expiry
+        while heap and heap[0][0] <= cutoff:
+            deadline, key = heapq.heappop(heap)
+            entry = self._entries.get(key)
+            # A replaced entry leaves its old deadline behind; only drop
+            # the key if the heap item still describes the live entry.
+            if entry is not None and entry.expires_at == deadline:
+                del self._entries[key]
+        while len(self._entries) >= self._max:
+            self._entries.popitem(last=False)
+
+    def _index_addresses(
+        self, name: str, addresses: tuple[tuple[str, int], ...], now: float,
+    ) -> None:
+        """Merge one answer's A / AAAA records into the address index.
+
+        Merged rather than replaced: resolvers rotate through a CDN's
+        pool, and every address seen is a valid alternate until its own
+        TTL runs out.
+        """
+        if not name:
             return
-        # Still full: drop the 5 % nearest to expiry.
-        ordered = sorted(self._entries.items(), key=lambda kv: kv[1].expires_at)
-        drop_count = max(1, len(ordered) // 20)
-        for k, _ in ordered[:drop_count]:
-            self._entries.pop(k, None)
+        with self._lock:
+            known = self._by_name.pop(name, None) or {}
+            for addr in [a for a, expires in known.items() if expires <= now]:
+                del known[addr]
+                self._unlink_locked(addr, name)
+            for addr, ttl in addresses:
+                expires = now + ttl
+                known[addr] = max(expires, known.get(addr, 0.0))
+                self._by_addr.setdefault(addr, {})[name] = known[addr]
+            self._by_name[name] = known
+            while len(self._by_name) > self._max:
+                old_name, old = self._by_name.popitem(last=False)
+                for addr in old:
+                    self._unlink_locked(addr, old_name)
+
+    def _unlink_locked(self, addr: str, name: str) -> None:
+        names = self._by_addr.get(addr)
+        if names is not None:
+            names.pop(name, None)
+            if not names:
+                del self._by_addr[addr]
+
+    def _rebuild_heap_locked(self) -> None:
+        """Drop superseded heap items.  Caller holds ``self._lock``."""
+        self._expiry = [(e.expires_at, k) for k, e in self._entries.items()]
+        heapq.heapify(self._expiry)
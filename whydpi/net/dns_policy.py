@@ -0,0 +1,114 @@
+# Copyright (c) 2025 whyDPI Contributors
+# SPDX-License-Identifier: MIT
+
+"""Questions the DNS stub answers itself instead of forwarding to DoH.
+
+Some answers follow from the deployment alone, whatever the name:
+
+* **HTTPS / SVCB** (with ``neutralize_ech``) — NODATA, so no client
+  obtains an ECHConfig and every ClientHello keeps a cleartext SNI the
+  proxy can fragment and rotate on.
+* **AAAA** (with IPv6 disabled) — NODATA.  Only IPv4 is intercepted
+  then, so an IPv6 address is at best unused and at worst routes the
+  connection around the proxy; clients fall back to A straight away.
+* **ANY** — the RFC 8482 minimal response: a single synthesised HINFO
+  record (CPU ``"RFC8482"``), which tells the client to ask for the
+  types it actually wants.
+
+:class:`LocalAnswerPolicy` maps a QTYPE to the synthesiser for it.  The
+replies are pure functions of the question, so building one is cheaper
+than a cache lookup; they are served ahead of :class:`DnsCache` and
+never take a slot in it or a DoH round-trip.
+"""
+
+from __future__ import annotations
+
+import logging
+import struct
+from typing import Callable
+
+from .dns_cache import DnsQuestion
+
+
+logger = logging.getLogger(__name__)
+
+_QTYPE_HINFO = 13
+_QTYPE_AAAA = 28
+_QTYPE_SVCB = 64
+_QTYPE_HTTPS = 65
+_QTYPE_ANY = 255
+# RFC 8482 §4.2 leaves the TTL to the responder; a long one keeps
+# clients from repeating ANY queries that will never say more.
+_HINFO_TTL = 86400
+
+Synthesiser = Callable[[bytes, DnsQuestion], bytes]
+
+
+def nodata_response(query: bytes, question: DnsQuestion) -> bytes:
+    """NOERROR/NODATA reply that echoes *query*'s question.
+
+    Keeps the question section intact, sets QR+RD+RA with RCODE=0, and
+    zeroes every record count so the client sees "this type does not
+    exist".  Any EDNS OPT in the additional section is intentionally
+    dropped — clients do not require it echoed.
+    """
+    return _header(query, ancount=0) + query[12:question.end]
+
+
+def minimal_any_response(query: bytes, question: DnsQuestion) -> bytes:
+    """RFC 8482 §4.2 reply to an ANY query: one HINFO ``"RFC8482" ""``."""
+    rdata = b"\x07RFC8482\x00"
+    answer = b"\xc0\x0c" + struct.pack(
+        "!HHIH", _QTYPE_HINFO, _qclass(query, question), _HINFO_TTL, len(rdata),
+    ) + rdata
+    return _header(query, ancount=1) + query[12:question.end] + answer
+
+
+class LocalAnswerPolicy:
+    """QTYPE → synthesiser for the questions the stub answers locally."""
+
+    def __init__(
+        self,
+        *,
+        neutralize_ech: bool = False,
+        ipv6_enabled: bool = True,
+        minimal_any: bool = False,
+    ) -> None:
+        rules: dict[int, Synthesiser] = {}
+        if neutralize_ech:
+            rules[_QTYPE_HTTPS] = nodata_response
+            rules[_QTYPE_SVCB] = nodata_response
+        if not ipv6_enabled:
+            rules[_QTYPE_AAAA] = nodata_response
+        if minimal_any:
+            rules[_QTYPE_ANY] = minimal_any_response
+        self._rules = rules
+        self.answered = 0
+
+    @property
+    def qtypes(self) -> frozenset[int]:
+        """Every QTYPE this policy answers."""
+        return frozenset(self._rules)
+
+    def answer(self, query: bytes, question: DnsQuestion) -> bytes | None:
+        """The local reply to *query*, or ``None`` to forward it."""
+        synthesise = self._rules.get(question.qtype)
+        if synthesise is None:
+            return None
+        self.answered += 1
+        logger.debug("DNS local answer for qtype=%d", question.qtype)
+        return synthesise(query, question)
+
+    def __repr__(self) -> str:
+        return f"LocalAnswerPolicy(qtypes={sorted(self._rules)})"
+
+
+def _header(query: bytes, *, ancount: int) -> bytes:
+    header = bytearray(query[:12])
+    struct.pack_into("!H", header, 2, 0x8180)   # QR=1, RD=1, RA=1, RCODE=0
+    struct.pack_into("!HHHH", header, 4, 1, ancount, 0, 0)
+    return bytes(header)
+
+
+def _qclass(query: bytes, question: DnsQuestion) -> int:
+    return struct.unpack_from("!H", query, question.end - 2)[0]
@@ -0,0 +1,350 @@
+# Copyright (c) 2025 whyDPI Contributors
+# SPDX-License-Identifier: MIT
+
+"""Latency-aware scheduling of DNS queries across several DoH endpoints.
+
+Design notes
+============
+The stub and the Windows hijacker used to try the primary
+:class:`~whydpi.net.dns.DoHClient` and move to the fallback only after
+an exception.  A primary that silently stalls (an ISP that black-holes
+the resolver's range, a half-dead keep-alive socket) therefore costs
+the full ``timeout_s`` — five seconds — on every query until it fails
+outright.
+
+:class:`DoHScheduler` sits in front of *N* clients and duck-types as
+one (``query`` / ``warm_up`` / ``close``):
+
+* **Ranking** — every endpoint keeps an EWMA of its answer latency, an
+  EWMA error rate and a ring buffer of recent latencies.  Each query
+  goes to the endpoint with the lowest ``latency × (1 + 4 × errors)``;
+  configuration order breaks ties and ranks endpoints with no samples
+  yet.
+* **Hedging** — if the chosen endpoint has not answered by its own p95
+  latency, a duplicate goes to the runner-up and the first answer
+  wins.  The loser finishes in the background and still feeds the
+  statistics.  By construction only ~5 % of queries are hedged.
+* **Fail fast** — an error (or an empty body) moves the query straight
+  to the next endpoint instead of waiting out the timeout.
+* **Ejection** — ``_EJECT_AFTER`` consecutive errors take an endpoint
+  out of rotation for an exponentially growing back-off.  When the
+  back-off ends a background health check (a root ``NS`` query) must
+  succeed before live traffic is routed there again.  If every
+  endpoint is ejected, all of them are used anyway — degraded DNS
+  beats no DNS.
+
+Concurrent attempts and health checks run on one bounded worker pool
+owned by the scheduler; :meth:`DoHScheduler.close` shuts it down.
+Without hedging nothing overlaps, so attempts run in the caller's
+thread, one endpoint after the other.
+
+All state is in RAM and per-process; nothing about which names were
+queried is kept here.
+"""
+
+from __future__ import annotations
+
+import logging
+import queue
+import ssl
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Callable, Iterable
+
+from .dns import encode_dns_query
+
+if TYPE_CHECKING:
+    from .dns import DoHClient
+
+
+logger = logging.getLogger(__name__)
+
+# EWMA smoothing for latency and error rate.
+_ALPHA = 0.2
+# Latency assumed for an endpoint that has not answered yet.  Slower than
+# any healthy DoH round-trip, so a measured endpoint is preferred.
+_PRIOR_LATENCY_S = 0.2
+# Hedge delay bounds.  Below the floor a hedge is pure duplicate load;
+# the default applies until an endpoint has enough samples for a p95.
+_MIN_HEDGE_S = 0.02
+_DEFAULT_HEDGE_S = 0.3
+_P95_MIN_SAMPLES = 8
+_SAMPLE_WINDOW = 64
+# Ejection: consecutive errors before leaving rotation, then back-off
+# doubling from the base up to the cap between health checks.
+_EJECT_AFTER = 3
+_EJECT_BASE_S = 5.0
+_EJECT_MAX_S = 120.0
+_QTYPE_NS = 2
+# Worker threads shared by every query's concurrent attempts.
+_MAX_WORKERS = 16
+
+
+@dataclass
+class _Endpoint:
+    client: "DoHClient"
+    order: int
+    ewma_s: float | None = None
+    error_rate: float = 0.0
+    consecutive_errors: int = 0
+    ejected_until: float = 0.0
+    backoff_s: float = _EJECT_BASE_S
+    probing: bool = False
+    samples: deque = field(default_factory=lambda: deque(maxlen=_SAMPLE_WINDOW))
+
+    def score(self) -> float:
+        latency = self.ewma_s if self.ewma_s is not None else _PRIOR_LATENCY_S
+        return latency * (1.0 + 4.0 * self.error_rate)
+
+    def p95(self) -> float | None:
+        if len(self.samples) < _P95_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[int(0.95 * (len(ordered) - 1))]
+
+
+class DoHScheduler:
+    """Route each DoH query to the best endpoint, hedging slow ones.
+
+    Accepts the same calls as :class:`~whydpi.net.dns.DoHClient`, so the
+    stub and the hijacker take it wherever they took a client.
+    """
+
+    def __init__(
+        self,
+        clients: Iterable["DoHClient"],
+        *,
+        hedge: bool = True,
+        timeout_s: float = 5.0,
+    ) -> None:
+        self._endpoints = [
+            _Endpoint(client=c, order=i)
+            for i, c in enumerate(c for c in clients if c is not None)
+        ]
+        self._hedge = hedge
+        self._timeout = timeout_s
+        self._lock = threading.Lock()
+        self._closed = False
+        self._pool = ThreadPoolExecutor(
+            max_workers=_MAX_WORKERS, thread_name_prefix="whydpi-doh-query",
+        )
+
+    @property
+    def clients(self) -> tuple["DoHClient", ...]:
+        return tuple(e.client for e in self._endpoints)
+
+    def query(self, wire: bytes) -> bytes:
+        """Resolve *wire* on the best endpoint; raises ``OSError`` if no
+        endpoint produced an answer within ``timeout_s``."""
+        if self._closed:
+            raise OSError("DoH scheduler: closed")
+        ranked = self._ranked()
+        if not ranked:
+            raise OSError("DoH scheduler: no endpoint configured")
+        if not self._hedge or len(ranked) == 1:
+            return self._query_in_turn(ranked, wire)
+        done: "queue.Queue[tuple[_Endpoint, bytes, BaseException | None]]" = queue.Queue()
+        deadline = time.monotonic() + self._timeout
+        launched = 1
+        self._launch(ranked[0], wire, done)
+        next_idx = 1
+        hedge_at = time.monotonic() + self._hedge_delay(ranked[0])
+        hedged = not self._hedge
+        failures = 0
+        last_exc: BaseException | None = None
+
+        while True:
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            can_hedge = not hedged and next_idx < len(ranked)
+            wake = min(deadline, hedge_at) if can_hedge else deadline
+            try:
+                endpoint, response, exc = done.get(timeout=max(0.0, wake - now))
+            except queue.Empty:
+                if can_hedge and time.monotonic() >= hedge_at:
+                    logger.debug("DoH hedge: %s slow, duplicating to %s",
+                                 ranked[0].client, ranked[next_idx].client)
+                    self._launch(ranked[next_idx], wire, done)
+                    next_idx += 1
+                    launched += 1
+                    hedged = True
+                    continue
+                break
+            if exc is None and response:
+                return response
+            failures += 1
+            last_exc = exc
+            if next_idx < len(ranked):
+                # Fail fast: the next endpoint starts now rather than
+                # after the failed one's timeout would have elapsed.
+                self._launch(ranked[next_idx], wire, done)
+                next_idx += 1
+                launched += 1
+                continue
+            if failures >= launched:
+                break
+        raise OSError(f"DoH scheduler: every endpoint failed ({last_exc})")
+
+    def warm_up(self, count: int | None = None) -> int:
+        opened = 0
+        for endpoint in self._endpoints:
+            try:
+                opened += endpoint.client.warm_up(count)
+            except (OSError, ssl.SSLError) as exc:
+                logger.debug("DoH warm-up skipped (%s): %s", endpoint.client, exc)
+        return opened
+
+    def close(self) -> None:
+        """Stop the workers and close every endpoint's client.  Safe to
+        call multiple times."""
+        self._closed = True
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        for endpoint in self._endpoints:
+            endpoint.client.close()
+
+    def stats(self) -> list[dict]:
+        """Per-endpoint health snapshot for diagnostics."""
+        now = time.monotonic()
+        with self._lock:
+            return [
+                {
+                    "endpoint": repr(e.client),
+                    "ewma_ms": None if e.ewma_s is None else round(e.ewma_s * 1000, 1),
+                    "p95_ms": None if e.p95() is None else round(e.p95() * 1000, 1),
+                    "error_rate": round(e.error_rate, 3),
+                    "ejected": e.ejected_until > now or e.probing,
+                }
+                for e in self._endpoints
+            ]
+
+    def __repr__(self) -> str:
+        return f"DoHScheduler({', '.join(repr(e.client) for e in self._endpoints)})"
+
+    # Internal -----------------------------------------------------------
+
+    def _ranked(self) -> list[_Endpoint]:
+        now = time.monotonic()
+        healthy: list[_Endpoint] = []
+        due: list[_Endpoint] = []
+        with self._lock:
+            for endpoint in self._endpoints:
+                if endpoint.probing:
+                    continue
+                if endpoint.ejected_until > now:
+                    continue
+                if endpoint.ejected_until:
+                    endpoint.probing = True
+                    due.append(endpoint)
+                    continue
+                healthy.append(endpoint)
+            if not healthy:
+                healthy = list(self._endpoints)
+            healthy.sort(key=lambda e: (e.score(), e.order))
+        for endpoint in due:
+            if not self._submit(self._health_check, endpoint):
+                with self._lock:
+                    endpoint.probing = False
+        return healthy
+
+    def _hedge_delay(self, endpoint: _Endpoint) -> float:
+        with self._lock:
+            p95 = endpoint.p95()
+        if p95 is None:
+            return _DEFAULT_HEDGE_S
+        return min(max(p95, _MIN_HEDGE_S), self._timeout)
+
+    def _query_in_turn(self, ranked: list[_Endpoint], wire: bytes) -> bytes:
+        # Each attempt is bounded by its client's own timeout; the next
+        # endpoint is only tried while the scheduler's has not run out.
+        deadline = time.monotonic() + self._timeout
+        last_exc: BaseException | None = None
+        for endpoint in ranked:
+            if time.monotonic() >= deadline:
+                break
+            response, exc = self._attempt(endpoint, wire)
+            if exc is None and response:
+                return response
+            last_exc = exc
+        raise OSError(f"DoH scheduler: every endpoint failed ({last_exc})")
+
+    def _submit(self, fn: Callable[..., object], *args: object) -> bool:
+        try:
+            self._pool.submit(fn, *args)
+        except RuntimeError:
+            # Shut down by ``close``.
+            return False
+        return True
+
+    def _launch(
+        self,
+        endpoint: _Endpoint,
+        wire: bytes,
+        done: "queue.Queue[tuple[_Endpoint, bytes, BaseException | None]]",
+    ) -> None:
+        if not self._submit(lambda: done.put((endpoint, *self._attempt(endpoint, wire)))):
+            done.put((endpoint, b"", OSError("DoH scheduler: closed")))
+
+    def _attempt(
+        self, endpoint: _Endpoint, wire: bytes,
+    ) -> tuple[bytes, BaseException | None]:
+        t0 = time.monotonic()
+        response = b""
+        error: BaseException | None = None
+        try:
+            response = endpoint.client.query(wire)
+        except (OSError, ssl.SSLError) as exc:
+            error = exc
+            logger.debug("DoH query via %s failed: %s", endpoint.client, exc)
+        if error is None and response:
+            self._record_success(endpoint, time.monotonic() - t0)
+        else:
+            self._record_failure(endpoint)
+        return response, error
+
+    def _record_success(self, endpoint: _Endpoint, latency_s: float) -> None:
+        with self._lock:
+            if endpoint.ewma_s is None:
+                endpoint.ewma_s = latency_s
+            else:
+                endpoint.ewma_s += _ALPHA * (latency_s - endpoint.ewma_s)
+            endpoint.samples.append(latency_s)
+            endpoint.error_rate *= 1.0 - _ALPHA
+            endpoint.consecutive_errors = 0
+            endpoint.backoff_s = _EJECT_BASE_S
+
+    def _record_failure(self, endpoint: _Endpoint) -> None:
+        with self._lock:
+            endpoint.error_rate += _ALPHA * (1.0 - endpoint.error_rate)
+            endpoint.consecutive_errors += 1
+            if endpoint.consecutive_errors >= _EJECT_AFTER and not endpoint.ejected_until:
+                self._eject_locked(endpoint)
+
+    def _eject_locked(self, endpoint: _Endpoint) -> None:
+        endpoint.ejected_until = time.monotonic() + endpoint.backoff_s
+        logger.info("DoH endpoint %s out of rotation for %.0fs",
+                    endpoint.client, endpoint.backoff_s)
+        endpoint.backoff_s = min(endpoint.backoff_s * 2, _EJECT_MAX_S)
+
+    def _health_check(self, endpoint: _Endpoint) -> None:
+        if self._closed:
+            return
+        t0 = time.monotonic()
+        try:
+            ok = bool(endpoint.client.query(encode_dns_query(".", _QTYPE_NS)))
+        except (OSError, ssl.SSLError):
+            ok = False
+        with self._lock:
+            endpoint.probing = False
+            if ok:
+                endpoint.ejected_until = 0.0
+                endpoint.consecutive_errors = 0
+                endpoint.error_rate = 0.0
+                logger.info("DoH endpoint %s back in rotation", endpoint.client)
+            else:
+                self._eject_locked(endpoint)
+        if ok:
+            self._record_success(endpoint, time.monotonic() - t0)
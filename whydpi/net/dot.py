@@ -0,0 +1,390 @@
+# Copyright (c) 2025 whyDPI Contributors
+# SPDX-License-Identifier: MIT
+
+"""DNS-over-TLS (RFC 7858) upstream transport.
+
+:class:`DoTClient` answers the same calls as
+:class:`~whydpi.net.dns.DoHClient` (``query`` / ``warm_up`` / ``stats``
+/ ``close``), so the stub, :class:`~whydpi.net.doh_scheduler.DoHScheduler`
+and :class:`~whydpi.net.dns.DoHResolver` take either.  Per query it
+skips everything HTTP adds: a two-byte length prefix replaces request
+and response headers, and there is no chunked decoding.
+
+One connection carries many queries at once (RFC 7858 §3.3, RFC 7766
+§6.2.1.1).  Each query is written under a fresh transaction ID unique
+on its connection, and a reader thread matches replies back by that ID
+in whatever order the server sends them — a slow name never holds up
+the ones behind it.  The original ID is restored before the reply is
+returned.
+
+TLS runs over a pair of memory BIOs: the socket is only ever read by the
+reader thread and written by one caller at a time under ``_io``, which
+also guards the ``ssl.SSLObject``.  That keeps concurrent reads and
+writes safe without a second TLS library, and lets the DoH pool's
+:func:`~whydpi.net.dns.shaped_handshake` cut the first flight.
+
+The certificate is verified against the endpoint's ``hostname`` (RFC
+7858 §4.2 strict privacy profile); an endpoint without one downgrades
+to unverified TLS with a warning, as for DoH.
+"""
+
+from __future__ import annotations
+
+import logging
+import random
+import socket
+import ssl
+import struct
+import threading
+import time
+from dataclasses import dataclass
+
+from ..core.discovery import connect_upstream
+from ..core.strategy import Strategy
+from .dns import shaped_handshake
+
+
+logger = logging.getLogger(__name__)
+
+# Queries in flight on one connection before another is opened.
+_PIPELINE_DEPTH = 32
+
+
+@dataclass(frozen=True)
+class DoTEndpoint:
+    ip: str
+    port: int = 853
+    # Certificate name and SNI; see ``DoHEndpoint.hostname``.
+    hostname: str | None = None
+
+
+class _Waiter:
+    __slots__ = ("event", "reply")
+
+    def __init__(self) -> None:
+        self.event = threading.Event()
+        self.reply: bytes | None = None
+
+
+class _DoTConnection:
+    """One TLS stream to the resolver carrying pipelined queries."""
+
+    def __init__(
+        self,
+        endpoint: DoTEndpoint,
+        timeout_s: float,
+        ctx: ssl.SSLContext,
+        *,
+        session: ssl.SSLSession | None = None,
+        mark: int = 0,
+        strategy: Strategy | None = None,
+    ) -> None:
+        sock = connect_upstream(endpoint.ip, endpoint.port, mark, timeout_s)
+        sock.settimeout(timeout_s)
+        self._sock = sock
+        self._in = ssl.MemoryBIO()
+        self._out = ssl.MemoryBIO()
+        try:
+            self._obj = ctx.wrap_bio(
+                self._in, self._out,
+                server_hostname=endpoint.hostname or None, session=session,
+            )
+            shaped_handshake(sock, self._obj, self._in, self._out, strategy)
+        except BaseException:
+            sock.close()
+            raise
+        self._io = threading.Lock()
+        self._pending: dict[int, _Waiter] = {}
+        self._next_id = random.getrandbits(16)
+        self._closed = False
+        self.last_used = time.monotonic()
+        self.served = 0
+        threading.Thread(
+            target=self._read_loop, name="whydpi-dot-reader", daemon=True,
+        ).start()
+
+    @property
+    def session(self) -> ssl.SSLSession | None:
+        with self._io:
+            return self._obj.session
+
+    @property
+    def session_reused(self) -> bool:
+        return self._obj.session_reused
+
+    @property
+    def inflight(self) -> int:
+        return len(self._pending)
+
+    def is_open(self) -> bool:
+        return not self._closed
+
+    def query(self, wire: bytes, timeout_s: float) -> bytes:
+        """Send *wire* on this stream and wait for its reply.
+
+        Raises ``OSError`` when the stream fails or the reply does not
+        arrive within *timeout_s*.
+        """
+        if len(wire) < 12:
+            raise OSError("DNS query too short")
+        waiter = _Waiter()
+        with self._io:
+            if self._closed:
+                raise OSError("DoT connection closed")
+            txid = self._allocate_locked()
+            self._pending[txid] = waiter
+            frame = struct.pack("!HH", len(wire), txid) + wire[2:]
+            try:
+                self._obj.write(frame)
+                self._flush_locked()
+            except (OSError, ssl.SSLError) as exc:
+                self._pending.pop(txid, None)
+                self._closed = True
+                raise OSError(f"DoT write failed: {exc}") from exc
+        if not waiter.event.wait(timeout_s):
+            with self._io:
+                self._pending.pop(txid, None)
+            raise OSError("DoT query timed out")
+        if waiter.reply is None:
+            raise OSError("DoT connection closed")
+        self.last_used = time.monotonic()
+        self.served += 1
+        return wire[:2] + waiter.reply[2:]
+
+    def close(self) -> None:
+        with self._io:
+            self._closed = True
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._sock.close()
+
+    # Internal -----------------------------------------------------------
+
+    def _allocate_locked(self) -> int:
+        # IDs only need to be unique among the queries still in flight.
+        while True:
+            self._next_id = (self._next_id + 1) & 0xFFFF
+            if self._next_id not in self._pending:
+                return self._next_id
+
+    def _flush_locked(self) -> None:
+        pending = self._out.read()
+        if pending:
+            self._sock.sendall(pending)
+
+    def _read_loop(self) -> None:
+        buf = bytearray()
+        try:
+            while not self._closed:
+                try:
+                    chunk = self._sock.recv(65536)
+                except (socket.timeout, TimeoutError):
+                    continue
+                if not chunk:
+                    return
+                with self._io:
+                    self._in.write(chunk)
+                    while True:
+                        try:
+                            data = self._obj.read(65536)
+                        except ssl.SSLWantReadError:
+                            break
+                        except ssl.SSLZeroReturnError:
+                            return
+                        if not data:
+                            return
+                        buf.extend(data)
+                    # Post-handshake messages (key updates) may need a reply.
+                    self._flush_locked()
+                    self._dispatch_locked(buf)
+        except (OSError, ssl.SSLError) as exc:
+            if not self._closed:
+                logger.debug("DoT reader stopped: %s", exc)
+        finally:
+            with self._io:
+                self._closed = True
+                waiters = list(self._pending.values())
+                self._pending.clear()
+            for waiter in waiters:
+                waiter.event.set()
+
+    def _dispatch_locked(self, buf: bytearray) -> None:
+        while len(buf) >= 2:
+            length = struct.unpack_from("!H", buf, 0)[0]
+            if len(buf) < 2 + length:
+                return
+            message = bytes(buf[2:2 + length])
+            del buf[:2 + length]
+            if length < 12:
+                continue
+            waiter = self._pending.pop(struct.unpack_from("!H", message, 0)[0], None)
+            if waiter is not None:
+                waiter.reply = message
+                waiter.event.set()
+
+
+class DoTClient:
+    """DNS-over-TLS client: a few pipelined connections to one resolver.
+
+    Queries go to the open connection with the fewest in flight; another
+    is opened (up to ``connections``) once every open one already carries
+    ``_PIPELINE_DEPTH``.  A failed connection is dropped and the query
+    retried once on a fresh one.  As with the DoH pool, the newest TLS
+    session ticket is offered to every new connection, and ``mark`` /
+    ``strategy`` let the socket skip the TLS proxy and fragment its own
+    ClientHello.
+    """
+
+    def __init__(
+        self,
+        endpoint: DoTEndpoint,
+        timeout_s: float = 5.0,
+        *,
+        connections: int = 2,
+        mark: int = 0,
+        strategy: Strategy | None = None,
+    ) -> None:
+        self._endpoint = endpoint
+        self._timeout = timeout_s
+        self._max = max(1, int(connections))
+        self._mark = mark
+        self._strategy = strategy
+        self._ctx = ssl.create_default_context()
+        if not endpoint.hostname:
+            self._ctx.check_hostname = False
+            self._ctx.verify_mode = ssl.CERT_NONE
+            logger.warning(
+                "DoT endpoint %s has no hostname set; certificate "
+                "verification is DISABLED.", endpoint.ip,
+            )
+        self._conns: list[_DoTConnection] = []
+        self._lock = threading.Lock()
+        self._open_lock = threading.Lock()
+        self._session: ssl.SSLSession | None = None
+        self._closed = False
+        self._queries = 0
+        self._broken = 0
+        self._resumed = 0
+        self._full_handshakes = 0
+
+    @property
+    def endpoint(self) -> DoTEndpoint:
+        return self._endpoint
+
+    def query(self, wire: bytes) -> bytes:
+        """Forward one query.  Retries once on a failed connection."""
+        with self._lock:
+            self._queries += 1
+        conn = self._pick()
+        try:
+            reply = conn.query(wire, self._timeout)
+        except OSError as exc:
+            if conn.is_open():
+                # A timeout on a live stream: the resolver is slow, not
+                # the connection broken.  Retrying would only double it.
+                raise
+            logger.debug("DoT %s: connection lost (%s); retrying", self, exc)
+            self._drop(conn)
+            conn = self._pick(force_new=True)
+            reply = conn.query(wire, self._timeout)
+        if conn.served == 1:
+            # TLS 1.3 tickets follow the handshake, so by the first
+            # answer the connection holds a resumable session.
+            session = conn.session
+            if session is not None and session.has_ticket:
+                with self._lock:
+                    self._session = session
+        return reply
+
+    def warm_up(self, count: int | None = None) -> int:
+        """Open up to *count* (default ``connections``) connections."""
+        want = self._max if count is None else max(0, min(int(count), self._max))
+        opened = 0
+        while self._open_count() < want:
+            try:
+                self._pick(force_new=True)
+            except OSError as exc:
+                logger.debug("DoT warm-up %s: %s", self, exc)
+                break
+            opened += 1
+        return opened
+
+    def stats(self) -> dict:
+        with self._lock:
+            live = [c for c in self._conns if c.is_open()]
+            return {
+                "connections": len(live),
+                "max": self._max,
+                "inflight": sum(c.inflight for c in live),
+                "queries": self._queries,
+                "broken": self._broken,
+                "session_hits": self._resumed,
+                "session_misses": self._full_handshakes,
+            }
+
+    def close(self) -> None:
+        """Close every connection and forget the session ticket."""
+        with self._lock:
+            self._closed = True
+            conns, self._conns = self._conns, []
+            self._session = None
+        for conn in conns:
+            conn.close()
+
+    def __repr__(self) -> str:
+        return f"DoTClient({self._endpoint.ip}:{self._endpoint.port})"
+
+    # Internal -----------------------------------------------------------
+
+    def _open_count(self) -> int:
+        with self._lock:
+            return sum(1 for c in self._conns if c.is_open())
+
+    def _pick(self, *, force_new: bool = False) -> _DoTConnection:
+        if self._closed:
+            raise OSError("DoT client closed")
+        if not force_new:
+            with self._lock:
+                best = self._best_locked()
+            if best is not None:
+                return best
+        with self._open_lock:
+            with self._lock:
+                # Another caller may have opened one while we waited.
+                best = None if force_new else self._best_locked()
+                session = self._session
+            if best is not None:
+                return best
+            conn = _DoTConnection(
+                self._endpoint, self._timeout, self._ctx,
+                session=session, mark=self._mark, strategy=self._strategy,
+            )
+            with self._lock:
+                if conn.session_reused:
+                    self._resumed += 1
+                else:
+                    self._full_handshakes += 1
+                if self._closed:
+                    conn.close()
+                    raise OSError("DoT client closed")
+                self._conns.append(conn)
+            return conn
+
+    def _best_locked(self) -> _DoTConnection | None:
+        """Least busy open connection, unless a new one is due."""
+        self._conns = [c for c in self._conns if c.is_open()]
+        best = min(self._conns, key=lambda c: c.inflight, default=None)
+        if best is None:
+            return None
+        if best.inflight < _PIPELINE_DEPTH or len(self._conns) >= self._max:
+            return best
+        return None
+
+    def _drop(self, conn: _DoTConnection) -> None:
+        with self._lock:
+            if conn in self._conns:
+                self._conns.remove(conn)
+                self._broken += 1
+        conn.close()
@@ -13,7 +13,7 @@ import struct
 import threading
 import time
 from dataclasses import dataclass
-from typing import Iterable
+from typing import Callable, Iterable
 
 from ..core.cache import StrategyCache
 from ..core.discovery import connect_upstream, discover_upstream
@@ -27,6 +27,8 @@ from .tls_parser import looks_like_client_hello, parse_client_hello, read_client
 logger = logging.getLogger(__name__)
 
 _SO_ORIGINAL_DST = 80
+_IP_TRANSPARENT = 19
+_IPV6_TRANSPARENT = 75
 
 # Per-connection id so a single browser's many parallel streams can be told
 # apart in the log when diagnosing a failure.
@@ -109,6 +111,24 @@ class ProxyContext:
     ipv6_enabled: bool
     cache: StrategyCache
     alt_resolver: "AltResolver | None" = None
+    known_resolver: "AltResolver | None" = None
+    # Destination IP -> hostname, for ClientHellos that carry no SNI.
+    host_hint: "Callable[[str], str | None] | None" = None
+    # TPROXY mode: the accepted socket's own address is the original
+    # destination (no NAT, no SO_ORIGINAL_DST lookup).
+    transparent: bool = False
+    # ``(dest_ip, sni, clean)`` after each relay under a real SNI; clean
+    # means unshaped, to the client-chosen IP, with an answer back.
+    on_relayed: "Callable[[str, str, bool], None] | None" = None
+
+
+def _report(ctx: ProxyContext, dest_ip: str, sni: str, clean: bool) -> None:
+    if ctx.on_relayed is None or not sni:
+        return
+    try:
+        ctx.on_relayed(dest_ip, sni, clean)
+    except Exception as exc:  # noqa: BLE001
+        logger.debug("relay hook failed for %s: %s", dest_ip, exc)
 
 
 def _relay_passthrough(
@@ -121,6 +141,7 @@ def _relay_passthrough(
     sni: str,
     cid: int,
     path: str,
+    learn: bool = False,
 ) -> socket.socket | None:
     try:
         upstream = connect_upstream(dest_ip, dest_port, ctx.proxy_mark, ctx.timeout_s)
@@ -136,6 +157,8 @@ def _relay_passthrough(
         "conn#%d %s sni=%s dest=%s hello=%dB relay c->u=%dB u->c=%dB end=%s",
         cid, path, sni or "?", dest_ip, len(hello_bytes), a2b, b2a, reason,
     )
+    if learn:
+        _report(ctx, dest_ip, sni, b2a >= ctx.success_min_bytes)
     return upstream
 
 
@@ -145,7 +168,9 @@ def _handle(client: socket.socket, family: int, ctx: ProxyContext) -> None:
     fam = "v6" if family == socket.AF_INET6 else "v4"
     t0 = time.monotonic()
     try:
-        if family == socket.AF_INET6:
+        if ctx.transparent:
+            dest_ip, dest_port = client.getsockname()[:2]
+        elif family == socket.AF_INET6:
             dest_ip, dest_port = _get_original_dst_v6(client)
         else:
             dest_ip, dest_port = _get_original_dst_v4(client)
@@ -179,11 +204,20 @@ def _handle(client: socket.socket, family: int, ctx: ProxyContext) -> None:
             "conn#%d %s dest=[%s]:%d sni=%s hello=%dB",
             cid, fam, dest_ip, dest_port, sni or "(none)", len(hello_bytes),
         )
-
-        if sni and passthrough_contains(ctx.passthrough_sni, sni):
+        # Without an SNI (ECH-only or bare-IP hellos) the name the stub
+        # answered with this address still selects the cached strategy,
+        # passthrough and rotation.  Verdicts are only ever recorded
+        # under a real SNI.
+        name = sni
+        if not name and ctx.host_hint is not None:
+            name = ctx.host_hint(dest_ip) or ""
+            if name:
+                logger.debug("conn#%d no SNI; dest %s answered for %s", cid, dest_ip, name)
+
+        if name and passthrough_contains(ctx.passthrough_sni, name):
             upstream = _relay_passthrough(
                 client, dest_ip, dest_port, hello_bytes, ctx,
-                sni=sni, cid=cid, path="user-passthrough",
+                sni=name, cid=cid, path="user-passthrough", learn=name == sni,
             )
             if upstream is not None:
                 return
@@ -194,7 +228,7 @@ def _handle(client: socket.socket, family: int, ctx: ProxyContext) -> None:
             upstream = None
 
         cached = None
-        entry = ctx.cache.get(sni) if sni else None
+        entry = ctx.cache.get(name) if name else None
         if entry is not None:
             try:
                 cached = Strategy.parse(entry.strategy)
@@ -204,7 +238,7 @@ def _handle(client: socket.socket, family: int, ctx: ProxyContext) -> None:
         if cached is not None and cached.layer == "passthrough":
             upstream = _relay_passthrough(
                 client, dest_ip, dest_port, hello_bytes, ctx,
-                sni=sni, cid=cid, path="cached-passthrough",
+                sni=name, cid=cid, path="cached-passthrough", learn=name == sni,
             )
             if upstream is not None:
                 return
@@ -220,7 +254,7 @@ def _handle(client: socket.socket, family: int, ctx: ProxyContext) -> None:
             upstream = None
 
         result = discover_upstream(
-            sni=sni or None,
+            sni=name or None,
             client_dest_ip=dest_ip,
             client_dest_port=dest_port,
             hello_bytes=hello_bytes,
@@ -234,6 +268,7 @@ def _handle(client: socket.socket, family: int, ctx: ProxyContext) -> None:
             ipv6_enabled=ctx.ipv6_enabled,
             probe_passthrough_first=ctx.probe_passthrough_first,
             alt_resolver=ctx.alt_resolver,
+            known_resolver=ctx.known_resolver,
         )
 
         attempts_str = ",".join(f"{lbl}:{reason}" for lbl, reason in result.attempts)
@@ -245,6 +280,7 @@ def _handle(client: socket.socket, family: int, ctx: ProxyContext) -> None:
             )
             if sni:
                 ctx.cache.record_failure_kind(sni, result.failure_kind.value)
+            _report(ctx, dest_ip, sni, False)
             return
 
         upstream = result.upstream
@@ -265,6 +301,12 @@ def _handle(client: socket.socket, family: int, ctx: ProxyContext) -> None:
             len(result.server_preview or b""), attempts_str,
             a2b, b2a, reason, time.monotonic() - t0,
         )
+        _report(
+            ctx, dest_ip, sni,
+            result.strategy.layer == "passthrough"
+            and (result.target is None or result.target.ip == dest_ip)
+            and b2a >= ctx.success_min_bytes,
+        )
 
     except OSError as exc:
         logger.debug("conn#%d %s handler OSError: %s", cid, fam, exc)
@@ -292,6 +334,13 @@ class TransparentTLSProxy:
         probe_passthrough_first: bool,
         ipv6_enabled: bool,
         alt_resolver: "AltResolver | None" = None,
+        known_resolver: "AltResolver | None" = None,
+        host_hint: "Callable[[str], str | None] | None" = None,
+        on_relayed: "Callable[[str, str, bool], None] | None" = None,
+        transparent: bool = False,
+        listen_addresses: Iterable[str] = (),
+        gateway_port: int = 0,
+        client_limit: int = 0,
     ):
         self._port = port
         self._ctx = ProxyContext(
@@ -305,66 +354,124 @@ class TransparentTLSProxy:
             ipv6_enabled=ipv6_enabled,
             cache=cache,
             alt_resolver=alt_resolver,
+            known_resolver=known_resolver,
+            host_hint=host_hint,
+            on_relayed=on_relayed,
+            transparent=transparent,
         )
         self._ipv6 = ipv6_enabled
+        # Gateway mode: forwarded connections arrive on their own port,
+        # apart from the host's — on the router's LAN addresses with
+        # REDIRECT, on loopback with TPROXY (no *listen_addresses*).
+        self._gateway_port = gateway_port
+        self._extra = tuple(listen_addresses)
+        # Concurrent connections per forwarded client address; 0 is
+        # unlimited.  The host's own connections are never capped.
+        self._client_limit = max(0, int(client_limit))
+        self._clients: dict[str, int] = {}
+        self._clients_lock = threading.Lock()
+        self.rejected = 0
         self._sockets: list[socket.socket] = []
         self._threads: list[threading.Thread] = []
         self._running = False
 
     def start(self) -> None:
         self._running = True
-        v4 = self._listen(socket.AF_INET, "127.0.0.1")
-        if v4 is not None:
-            self._sockets.append(v4)
-            self._threads.append(self._spawn(v4, socket.AF_INET, "tls-proxy-v4"))
-
-        if self._ipv6:
-            v6 = self._listen(socket.AF_INET6, "::1")
-            if v6 is not None:
-                self._sockets.append(v6)
-                self._threads.append(self._spawn(v6, socket.AF_INET6, "tls-proxy-v6"))
+        loopback = ["127.0.0.1", "::1"] if self._ipv6 else ["127.0.0.1"]
+        listeners = [(addr, self._port, False) for addr in loopback]
+        if self._gateway_port:
+            lan = [a for a in self._extra if self._ipv6 or ":" not in a] or loopback
+            listeners += [(addr, self._gateway_port, True) for addr in lan]
+        for addr, port, gateway in listeners:
+            family = socket.AF_INET6 if ":" in addr else socket.AF_INET
+            sock = self._listen(family, addr, port)
+            if sock is not None:
+                self._sockets.append(sock)
+                role = "gateway" if gateway else "proxy"
+                name = f"tls-{role}-v6" if family == socket.AF_INET6 else f"tls-{role}-v4"
+                self._threads.append(self._spawn(sock, family, name, gateway))
 
         logger.info(
-            "transparent TLS proxy listening on :%s (%s) default=%s passthrough_probe=%s",
+            "transparent TLS proxy listening on :%s (%s%s) default=%s passthrough_probe=%s",
             self._port,
             "v4+v6" if self._ipv6 else "v4",
+            ", tproxy" if self._ctx.transparent else "",
             self._ctx.default_strategy.label(),
             self._ctx.probe_passthrough_first,
         )
 
-    def _listen(self, family: int, addr: str) -> socket.socket | None:
+    def _listen(self, family: int, addr: str, port: int) -> socket.socket | None:
         try:
             sock = socket.socket(family, socket.SOCK_STREAM)
             sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self._ctx.transparent:
+                # TPROXY hands us connections addressed to remote IPs.
+                if family == socket.AF_INET6:
+                    sock.setsockopt(socket.IPPROTO_IPV6, _IPV6_TRANSPARENT, 1)
+                else:
+                    sock.setsockopt(socket.SOL_IP, _IP_TRANSPARENT, 1)
             if family == socket.AF_INET6:
                 sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
-                sock.bind((addr, self._port, 0, 0))
+                sock.bind((addr, port, 0, 0))
             else:
-                sock.bind((addr, self._port))
+                sock.bind((addr, port))
             sock.listen(512)
             return sock
         except OSError as exc:
             logger.warning("listen %s failed: %s", addr, exc)
             return None
 
-    def _spawn(self, sock: socket.socket, family: int, name: str) -> threading.Thread:
-        t = threading.Thread(target=self._serve, args=(sock, family), name=name, daemon=True)
+    def _spawn(
+        self, sock: socket.socket, family: int, name: str, gateway: bool,
+    ) -> threading.Thread:
+        t = threading.Thread(
+            target=self._serve, args=(sock, family, gateway), name=name, daemon=True,
+        )
         t.start()
         return t
 
-    def _serve(self, sock: socket.socket, family: int) -> None:
+    def _serve(self, sock: socket.socket, family: int, gateway: bool) -> None:
+        # Only the gateway listener carries forwarded clients.
+        limited = gateway and bool(self._client_limit)
         while self._running:
             try:
                 sock.settimeout(1.0)
-                client, _addr = sock.accept()
+                client, addr = sock.accept()
             except socket.timeout:
                 continue
             except OSError:
                 break
+            if limited and not self._admit(addr[0]):
+                self.rejected += 1
+                logger.debug("client %s over its %d-connection limit", addr[0], self._client_limit)
+                client.close()
+                continue
             threading.Thread(
-                target=_handle, args=(client, family, self._ctx), daemon=True
+                target=self._handle_counted,
+                args=(client, family, addr[0] if limited else None),
+                daemon=True,
             ).start()
 
+    def _admit(self, client_ip: str) -> bool:
+        with self._clients_lock:
+            count = self._clients.get(client_ip, 0)
+            if count >= self._client_limit:
+                return False
+            self._clients[client_ip] = count + 1
+        return True
+
+    def _handle_counted(
+        self, client: socket.socket, family: int, client_ip: str | None,
+    ) -> None:
+        try:
+            _handle(client, family, self._ctx)
+        finally:
+            if client_ip is not None:
+                with self._clients_lock:
+                    left = self._clients.pop(client_ip, 1) - 1
+                    if left:
+                        self._clients[client_ip] = left
+
     def stop(self) -> None:
         self._running = False
         for s in self._sockets:
@@ -1,7 +1,8 @@
 # Copyright (c) 2025 whyDPI Contributors
 # SPDX-License-Identifier: MIT
 
-"""Linux engine — iptables REDIRECT + transparent TLS proxy + DoH stub.
+"""Linux engine — netfilter REDIRECT/TPROXY + transparent TLS proxy + DoH stub,
+or an NFQUEUE packet shaper in place of the proxy.
 
 This is the historical (and currently only fully working) engine; the
 body was lifted verbatim from ``whydpi.core.engine`` during the Windows
@@ -18,101 +19,158 @@ from typing import Callable
 
 from ..net.dns import DNSStubServer, DoHClient, DoHEndpoint, DoHResolver
 from ..net.dns_cache import DnsCache
+from ..net.dns_policy import LocalAnswerPolicy
+from ..net.doh_scheduler import DoHScheduler
+from ..net.dot import DoTClient, DoTEndpoint
 from ..net.proxy import TransparentTLSProxy
-from ..settings import Settings, cache_path
+from ..settings import (
+    Settings, cache_path, dns_cache_options, doh_endpoints, sibling_qtypes,
+)
 from ..system import resolver as resolver_system
-from ..system.netfilter import Netfilter, compose_rules
+from ..system.netfilter import Gateway, Netfilter, OwnerPolicy, compose_rules
+from ..system.nfq_shaper import NfqShaper
+from ..system.policy_route import PolicyRoute
+from ..core.bypass import LearnedBypass
 from ..core.cache import StrategyCache
+from ..core.discovery import socket_strategy
+from ..core.predictive import PredictiveDiscovery
+from ..core.quic import QuicPolicy
 from ..core.strategy import Strategy, parse_fallback
 
 
 logger = logging.getLogger(__name__)
 
+# Lifetime of an address in the QUIC allow set; a fresh DNS answer or
+# passthrough connection re-adds it once expired.
+_QUIC_ALLOW_S = 600
+
 
 @dataclass
 class Runtime:
-    proxy: TransparentTLSProxy
+    proxy: TransparentTLSProxy | NfqShaper
     dns_stub: DNSStubServer | None
     netfilter: Netfilter
     cache: StrategyCache
     dns_cache: DnsCache
-    doh_clients: tuple[DoHClient, ...]
+    doh_clients: tuple[DoHClient | DoTClient, ...]
+    scheduler: DoHScheduler | None
     configure_resolver: bool
     resolver_servers: list[str]
-
-
-def _build_doh_client(ip: str, hostname: str, path: str, timeout: float) -> DoHClient:
+    predictor: PredictiveDiscovery | None = None
+    learned: LearnedBypass | None = None
+    quic: QuicPolicy | None = None
+    policy_route: PolicyRoute | None = None
+
+
+def _build_doh_client(
+    ip: str,
+    hostname: str,
+    path: str,
+    timeout: float,
+    *,
+    mark: int,
+    strategy: Strategy | None,
+    dot: bool = False,
+) -> DoHClient | DoTClient:
+    # DoH sockets carry ``proxy_mark`` so they skip the REDIRECT rule and
+    # fragment their own ClientHello instead of relaying through the proxy.
+    if dot:
+        return DoTClient(
+            DoTEndpoint(ip=ip, hostname=hostname or None),
+            timeout_s=timeout,
+            mark=mark,
+            strategy=strategy,
+        )
     return DoHClient(
         DoHEndpoint(ip=ip, hostname=hostname or None, path=path),
         timeout_s=timeout,
+        mark=mark,
+        strategy=strategy,
     )
 
 
+def _resolver_strategy(
+    hostname: str,
+    cache: StrategyCache,
+    default: Strategy,
+    fallbacks: tuple[Strategy, ...],
+) -> Strategy | None:
+    """What the resolver's own first flight is cut with (see ``socket_strategy``)."""
+    cached = None
+    entry = cache.get(hostname)
+    if entry is not None:
+        try:
+            cached = Strategy.parse(entry.strategy)
+        except ValueError:
+            cached = None
+    return socket_strategy(cached, default, fallbacks)
+
+
 def _dns_stub(
     settings: Settings,
     dns_cache: DnsCache,
-) -> tuple[DNSStubServer | None, tuple[DoHClient, ...]]:
-    """Build the DoH-forwarding stub + the list of DoH clients to close
-    on shutdown.  Returns ``(None, ())`` when DNS mode isn't ``doh``."""
+    cache: StrategyCache,
+    on_answer: Callable[[str, list[str]], None] | None = None,
+) -> tuple[DNSStubServer | None, DoHScheduler | None]:
+    """Build the DoH-forwarding stub + the scheduler over its DoH clients,
+    to close on shutdown.  Returns ``(None, None)`` when DNS mode isn't
+    ``doh``."""
     if settings.dns.mode != "doh":
-        return None, ()
-    primary = _build_doh_client(
-        settings.dns.doh_endpoint_ip,
-        settings.dns.doh_endpoint_hostname,
-        settings.dns.doh_endpoint_path,
-        5.0,
-    )
-    fallback = None
-    clients: list[DoHClient] = [primary]
-    if settings.dns.doh_fallback_ip:
-        fallback = _build_doh_client(
-            settings.dns.doh_fallback_ip,
-            settings.dns.doh_fallback_hostname,
-            settings.dns.doh_endpoint_path,
-            5.0,
+        return None, None
+    default = Strategy.parse(settings.tls.default_strategy)
+    fallbacks = parse_fallback(settings.tls.fallback_strategies)
+    clients = tuple(
+        _build_doh_client(
+            ip, hostname, settings.dns.doh_endpoint_path, 5.0,
+            mark=settings.tls.proxy_mark,
+            strategy=_resolver_strategy(hostname, cache, default, fallbacks),
+            dot=ip in settings.dns.dot_endpoints,
         )
-        clients.append(fallback)
+        for ip, hostname in doh_endpoints(settings)
+    )
+    addresses = [settings.dns.stub_address]
+    if settings.net.gateway_interfaces and settings.net.gateway_dns:
+        # Gateway mode: LAN clients' DNS is REDIRECTed to these.
+        addresses += settings.net.gateway_addresses
+    scheduler = DoHScheduler(clients, hedge=settings.dns.doh_hedge)
     stub = DNSStubServer(
-        bind_address=settings.dns.stub_address,
+        bind_addresses=addresses,
         bind_port=settings.dns.stub_port,
-        primary=primary,
-        fallback=fallback,
+        primary=scheduler,
         cache=dns_cache,
-        neutralize_ech=settings.dns.neutralize_ech,
+        policy=LocalAnswerPolicy(
+            neutralize_ech=settings.dns.neutralize_ech,
+            ipv6_enabled=settings.net.ipv6_enabled,
+            minimal_any=settings.dns.minimal_any,
+        ),
+        on_answer=on_answer,
+        sibling_qtypes=sibling_qtypes(settings),
     )
-    return stub, tuple(clients)
+    return stub, scheduler
 
 
 def build_runtime(settings: Settings, *, configure_resolver: bool) -> Runtime:
     cache = StrategyCache.load(cache_path(settings))
-    dns_cache = DnsCache()
+    dns_cache = DnsCache(**dns_cache_options(settings))
 
     default_strategy = Strategy.parse(settings.tls.default_strategy)
     fallbacks = parse_fallback(settings.tls.fallback_strategies)
 
-    stub, doh_clients = _dns_stub(settings, dns_cache)
-
-    # The proxy reuses the very same DoH clients as a diversified address
-    # source for upstream IP rotation.  Querying several resolvers surfaces
-    # CDN anycast ranges the local resolver hides, so when an ISP drops one
-    # range the discovery layer can rotate onto an address on another.  The
-    # client-chosen IP is always tried first; this only fires on a fully
-    # failing connection.
-    alt_resolver = DoHResolver(doh_clients) if doh_clients else None
-
-    proxy = TransparentTLSProxy(
-        port=settings.tls.proxy_port,
-        proxy_mark=settings.tls.proxy_mark,
-        default_strategy=default_strategy,
-        fallbacks=fallbacks,
-        cache=cache,
-        timeout_s=settings.tls.probe_timeout_s,
-        success_min_bytes=settings.tls.success_min_bytes,
-        passthrough_sni=settings.tls.user_passthrough_sni,
-        probe_passthrough_first=settings.tls.probe_passthrough_first,
-        ipv6_enabled=settings.net.ipv6_enabled,
-        alt_resolver=alt_resolver,
-    )
+    predictor: PredictiveDiscovery | None = None
+    if settings.tls.predictive_discovery:
+        predictor = PredictiveDiscovery(
+            cache=cache,
+            default=default_strategy,
+            fallbacks=fallbacks,
+            proxy_mark=settings.tls.proxy_mark,
+            timeout_s=settings.tls.probe_timeout_s,
+            success_min_bytes=settings.tls.success_min_bytes,
+            ipv6_enabled=settings.net.ipv6_enabled,
+            probe_passthrough_first=settings.tls.probe_passthrough_first,
+            passthrough_sni=settings.tls.user_passthrough_sni,
+            min_queries=settings.tls.predictive_min_queries,
+            max_per_minute=settings.tls.predictive_max_per_minute,
+        )
 
     dns_stub_address: str | None = None
     dns_stub_port: int = 53
@@ -135,6 +193,32 @@ def build_runtime(settings: Settings, *, configure_resolver: bool) -> Runtime:
         )
         resolver_servers = [settings.dns.altport_server]
 
+    tproxy = settings.net.interception == "tproxy"
+    nfqueue = settings.net.interception == "nfqueue"
+    gateway: Gateway | None = None
+    if settings.net.gateway_interfaces:
+        if nfqueue:
+            raise ValueError(
+                "net.gateway_interfaces needs interception='redirect' or 'tproxy'"
+            )
+        if not tproxy and not settings.net.gateway_addresses:
+            raise ValueError(
+                "net.gateway_interfaces with interception='redirect' requires "
+                "net.gateway_addresses"
+            )
+        if settings.net.gateway_proxy_port == settings.tls.proxy_port:
+            raise ValueError("net.gateway_proxy_port must differ from tls.proxy_port")
+        gateway = Gateway(
+            interfaces=settings.net.gateway_interfaces,
+            addresses=settings.net.gateway_addresses,
+            subnets_v4=settings.net.gateway_subnets_v4,
+            subnets_v6=settings.net.gateway_subnets_v6,
+            dns=settings.net.gateway_dns,
+            port=settings.net.gateway_proxy_port,
+        )
+    selective_quic = (
+        settings.net.block_quic and settings.net.selective_quic and settings.dns.mode == "doh"
+    )
     rules = compose_rules(
         tls_port=settings.tls.proxy_port,
         tls_mark=settings.tls.proxy_mark,
@@ -145,17 +229,149 @@ def build_runtime(settings: Settings, *, configure_resolver: bool) -> Runtime:
         dns_stub_address=dns_stub_address,
         dns_stub_port=dns_stub_port,
         dns_altport=dns_altport,
+        learned_bypass_s=settings.net.learned_bypass_s,
+        quic_allow_s=_QUIC_ALLOW_S if selective_quic else 0,
+        notrack_mark=settings.tls.proxy_mark if settings.net.notrack_upstream else 0,
+        tproxy_mark=settings.net.tproxy_mark if tproxy else 0,
+        shaper_mark=settings.net.shaper_mark if nfqueue else 0,
+        nfqueue_num=settings.net.nfqueue_num,
+        gateway=gateway,
+        owners=OwnerPolicy(
+            mode=settings.net.owner_policy,
+            uids=settings.net.owner_uids,
+            gids=settings.net.owner_gids,
+            cgroups=settings.net.owner_cgroups,
+        ),
     )
 
+    netfilter = Netfilter(rules, backend=settings.net.firewall_backend)
+
+    # Passthrough-clean destinations graduate to a timed kernel set and
+    # skip the proxy.  Only with the stub: it is what sees every name an
+    # address is shared with, and evicts the address as soon as it
+    # answers it for a name that might need shaping.
+    learned: LearnedBypass | None = None
+    if settings.net.learned_bypass_s > 0 and settings.dns.mode == "doh":
+        learned = LearnedBypass(
+            cache=cache,
+            update_set=netfilter.update_set,
+            timeout_s=settings.net.learned_bypass_s,
+            names_for=dns_cache.names_for,
+            passthrough_sni=settings.tls.user_passthrough_sni,
+            min_hits=settings.net.learned_bypass_min_hits,
+        )
+    quic: QuicPolicy | None = None
+    if selective_quic:
+        quic = QuicPolicy(
+            cache=cache,
+            names_for=dns_cache.names_for,
+            passthrough_sni=settings.tls.user_passthrough_sni,
+            update_set=netfilter.update_set,
+            timeout_s=_QUIC_ALLOW_S,
+        )
+    answer_hooks = [
+        hook for hook in (
+            learned.on_answer if learned is not None else None,
+            quic.on_answer if quic is not None else None,
+            predictor.observe if predictor is not None else None,
+        ) if hook is not None
+    ]
+    relay_hooks = [
+        hook for hook in (
+            learned.observe if learned is not None else None,
+            quic.observe if quic is not None else None,
+        ) if hook is not None
+    ]
+
+    def on_answer(name: str, addresses: list[str]) -> None:
+        for hook in answer_hooks:
+            hook(name, addresses)
+
+    def on_relayed(ip: str, sni: str, clean: bool) -> None:
+        for hook in relay_hooks:
+            hook(ip, sni, clean)
+
+    stub, scheduler = _dns_stub(
+        settings, dns_cache, cache, on_answer if answer_hooks else None,
+    )
+    doh_clients = scheduler.clients if scheduler is not None else ()
+
+    # The proxy reuses the very same DoH clients as a diversified address
+    # source for upstream IP rotation.  Querying several resolvers surfaces
+    # CDN anycast ranges the local resolver hides, so when an ISP drops one
+    # range the discovery layer can rotate onto an address on another.  The
+    # client-chosen IP is always tried first; this only fires on a fully
+    # failing connection.  Answers are memoised in the stub's DNS cache so
+    # repeated failures for the same SNI do not re-query upstream.
+    alt_resolver = DoHResolver(
+        doh_clients, cache=dns_cache,
+        quorum=settings.dns.resolver_quorum, deadline_s=settings.dns.resolver_deadline_s,
+    ) if doh_clients else None
+    # Before any of that, the addresses the stub already answered the
+    # browser with are alternates for free, and map an SNI-less
+    # connection's destination back to its hostname.
+    answered = dns_cache if stub is not None else None
+
+    # NFQUEUE mode shapes ClientHellos in place; nothing is relayed.
+    proxy: TransparentTLSProxy | NfqShaper
+    if nfqueue:
+        proxy = NfqShaper(
+            queue_num=settings.net.nfqueue_num,
+            shaper_mark=settings.net.shaper_mark,
+            proxy_mark=settings.tls.proxy_mark,
+            default_strategy=default_strategy,
+            fallbacks=fallbacks,
+            cache=cache,
+            probe_timeout_s=settings.tls.probe_timeout_s,
+            success_min_bytes=settings.tls.success_min_bytes,
+            passthrough_sni=settings.tls.user_passthrough_sni,
+            decoy_sni=settings.tls.decoy_sni,
+            on_relayed=on_relayed if relay_hooks else None,
+        )
+    else:
+        proxy = TransparentTLSProxy(
+            port=settings.tls.proxy_port,
+            proxy_mark=settings.tls.proxy_mark,
+            default_strategy=default_strategy,
+            fallbacks=fallbacks,
+            cache=cache,
+            timeout_s=settings.tls.probe_timeout_s,
+            success_min_bytes=settings.tls.success_min_bytes,
+            passthrough_sni=settings.tls.user_passthrough_sni,
+            probe_passthrough_first=settings.tls.probe_passthrough_first,
+            ipv6_enabled=settings.net.ipv6_enabled,
+            alt_resolver=alt_resolver,
+            known_resolver=answered.addresses_for if answered is not None else None,
+            host_hint=answered.hostname_for if answered is not None else None,
+            on_relayed=on_relayed if relay_hooks else None,
+            transparent=tproxy,
+            # REDIRECT delivers forwarded connections to the LAN address;
+            # TPROXY hands them to a loopback listener as they are.
+            listen_addresses=(
+                settings.net.gateway_addresses if gateway is not None and not tproxy else ()
+            ),
+            gateway_port=gateway.port if gateway is not None else 0,
+            client_limit=settings.net.gateway_client_limit,
+        )
+
     return Runtime(
         proxy=proxy,
         dns_stub=stub,
-        netfilter=Netfilter(rules),
+        netfilter=netfilter,
         cache=cache,
         dns_cache=dns_cache,
         doh_clients=doh_clients,
+        scheduler=scheduler,
         configure_resolver=configure_resolver and bool(resolver_servers),
         resolver_servers=resolver_servers,
+        predictor=predictor,
+        learned=learned,
+        quic=quic,
+        policy_route=PolicyRoute(
+            mark=settings.net.tproxy_mark,
+            table=settings.net.tproxy_table,
+            ipv6_enabled=settings.net.ipv6_enabled,
+        ) if tproxy else None,
     )
 
 
@@ -174,6 +390,8 @@ def run(settings: Settings, *, configure_resolver: bool,
         runtime.proxy.start()
 
         runtime.netfilter.apply()
+        if runtime.policy_route is not None:
+            runtime.policy_route.apply()
 
         if runtime.configure_resolver:
             if not resolver_system.is_configured(runtime.resolver_servers):
@@ -206,10 +424,21 @@ def run(settings: Settings, *, configure_resolver: bool,
 
     finally:
         logger.info("shutting down...")
+        try:
+            for name, (packets, nbytes) in sorted(runtime.netfilter.counters().items()):
+                logger.info("owner policy %s: sent %d packet(s), %d byte(s) to TCP/443",
+                            name, packets, nbytes)
+        except Exception as exc:  # noqa: BLE001
+            logger.debug("netfilter counters: %s", exc)
         try:
             runtime.netfilter.cleanup()
         except Exception as exc:
             logger.warning("netfilter cleanup: %s", exc)
+        if runtime.policy_route is not None:
+            try:
+                runtime.policy_route.cleanup()
+            except Exception as exc:
+                logger.warning("policy routing cleanup: %s", exc)
         try:
             runtime.proxy.stop()
         except Exception as exc:
@@ -219,6 +448,12 @@ def run(settings: Settings, *, configure_resolver: bool,
                 runtime.dns_stub.stop()
             except Exception as exc:
                 logger.warning("dns stub stop: %s", exc)
+        if runtime.predictor is not None:
+            runtime.predictor.stop()
+        if runtime.learned is not None:
+            runtime.learned.stop()
+        if runtime.quic is not None:
+            runtime.quic.stop()
         # Privacy by default: on any graceful exit we erase the browsing
         # fingerprint we built up at runtime.  The cache file on tmpfs
         # (/run/whydpi/) is removed; in-memory state is cleared.  Combined
@@ -236,6 +471,12 @@ def run(settings: Settings, *, configure_resolver: bool,
             runtime.dns_cache.wipe()
         except Exception as exc:
             logger.warning("dns cache wipe: %s", exc)
+        if runtime.scheduler is not None:
+            # No more attempts or health checks once the clients go.
+            try:
+                runtime.scheduler.close()
+            except Exception as exc:
+                logger.warning("doh scheduler close: %s", exc)
         for client in runtime.doh_clients:
             try:
                 client.close()
@@ -257,8 +498,15 @@ def _wait_for_signal() -> None:
         time.sleep(1)
 
 
+def counters(settings: Settings) -> dict[str, tuple[int, int]]:
+    """The running instance's rule counters (see ``Netfilter.counters``)."""
+    return build_runtime(settings, configure_resolver=False).netfilter.counters()
+
+
 def stop_only(settings: Settings) -> int:
     """Idempotent cleanup — remove any rules matching current settings."""
     runtime = build_runtime(settings, configure_resolver=False)
     runtime.netfilter.cleanup()
+    if runtime.policy_route is not None:
+        runtime.policy_route.cleanup()
     return 0
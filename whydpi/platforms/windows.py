@@ -39,10 +39,13 @@ from dataclasses import dataclass
 from typing import Callable
 
 from ..core.cache import StrategyCache
+from ..core.quic import QuicPolicy
 from ..core.strategy import Strategy, parse_fallback
 from ..net.dns import DoHClient, DoHEndpoint
+from ..net.dot import DoTClient, DoTEndpoint
 from ..net.dns_cache import DnsCache
-from ..settings import Settings, cache_path
+from ..net.doh_scheduler import DoHScheduler
+from ..settings import Settings, cache_path, dns_cache_options, doh_endpoints
 from ..system.dns_redirect_windows import PacketDnsHijacker
 from ..system.windivert import PacketShaper
 
@@ -55,7 +58,8 @@ class _Runtime:
     dns: PacketDnsHijacker | None
     cache: StrategyCache
     dns_cache: DnsCache
-    doh_clients: tuple[DoHClient, ...]
+    doh_clients: tuple[DoHClient | DoTClient, ...]
+    scheduler: DoHScheduler | None
 
 
 def _flush_dns_cache() -> None:
@@ -80,7 +84,11 @@ def _flush_dns_cache() -> None:
         logger.debug("DnsFlushResolverCache skipped: %s", exc)
 
 
-def _build_doh_client(ip: str, hostname: str, path: str, timeout: float) -> DoHClient:
+def _build_doh_client(
+    ip: str, hostname: str, path: str, timeout: float, *, dot: bool = False,
+) -> DoHClient | DoTClient:
+    if dot:
+        return DoTClient(DoTEndpoint(ip=ip, hostname=hostname or None), timeout_s=timeout)
     return DoHClient(
         DoHEndpoint(ip=ip, hostname=hostname or None, path=path),
         timeout_s=timeout,
@@ -90,7 +98,7 @@ def _build_doh_client(ip: str, hostname: str, path: str, timeout: float) -> DoHC
 def _build_dns_hijacker(
     settings: Settings,
     dns_cache: DnsCache,
-) -> tuple[PacketDnsHijacker | None, tuple[DoHClient, ...]]:
+) -> tuple[PacketDnsHijacker | None, DoHScheduler | None]:
     """Build the packet-layer DNS hijacker, if enabled.
 
     Honours ``settings.dns.mode``:
@@ -100,59 +108,60 @@ def _build_dns_hijacker(
                   the adapter is configured for (ISP DNS, typically).
                   Use this for isolated debugging of the shaper alone.
 
-    Returns the hijacker (or ``None``) plus the sequence of DoH clients
-    the caller must close on shutdown — the hijacker owns none of them
-    itself, so the engine keeps an explicit handle for cleanup.
+    Returns the hijacker (or ``None``) plus the scheduler over the DoH
+    clients, which the caller must close on shutdown — the hijacker owns
+    neither, so the engine keeps an explicit handle for cleanup.
     """
     if settings.dns.mode != "doh":
-        return None, ()
-    primary = _build_doh_client(
-        settings.dns.doh_endpoint_ip,
-        settings.dns.doh_endpoint_hostname,
-        settings.dns.doh_endpoint_path,
-        5.0,
-    )
-    fallback = None
-    clients: list[DoHClient] = [primary]
-    if settings.dns.doh_fallback_ip:
-        fallback = _build_doh_client(
-            settings.dns.doh_fallback_ip,
-            settings.dns.doh_fallback_hostname,
-            settings.dns.doh_endpoint_path,
-            5.0,
+        return None, None
+    clients = tuple(
+        _build_doh_client(
+            ip, hostname, settings.dns.doh_endpoint_path, 5.0,
+            dot=ip in settings.dns.dot_endpoints,
         )
-        clients.append(fallback)
-    return (
-        PacketDnsHijacker(primary=primary, fallback=fallback, cache=dns_cache),
-        tuple(clients),
+        for ip, hostname in doh_endpoints(settings)
     )
+    scheduler = DoHScheduler(clients, hedge=settings.dns.doh_hedge)
+    return PacketDnsHijacker(primary=scheduler, cache=dns_cache), scheduler
 
 
 def _build_runtime(settings: Settings) -> _Runtime:
     cache = StrategyCache.load(cache_path(settings))
-    dns_cache = DnsCache()
+    dns_cache = DnsCache(**dns_cache_options(settings))
 
     default_strategy = Strategy.parse(settings.tls.default_strategy)
     fallbacks = parse_fallback(settings.tls.fallback_strategies)
 
+    # The hijacker fills the same DNS cache, whose reverse map tells the
+    # QUIC loop which names an address serves.
+    quic: QuicPolicy | None = None
+    if settings.net.block_quic and settings.net.selective_quic and settings.dns.mode == "doh":
+        quic = QuicPolicy(
+            cache=cache,
+            names_for=dns_cache.names_for,
+            passthrough_sni=settings.tls.user_passthrough_sni,
+        )
+
     shaper = PacketShaper(
         default_strategy=default_strategy,
         fallbacks=fallbacks,
         cache=cache,
         block_quic=settings.net.block_quic,
+        quic_policy=quic.allows if quic is not None else None,
         probe_timeout_s=settings.tls.probe_timeout_s,
         success_min_bytes=settings.tls.success_min_bytes,
         decoy_sni=settings.tls.decoy_sni,
     )
 
-    dns, doh_clients = _build_dns_hijacker(settings, dns_cache)
+    dns, scheduler = _build_dns_hijacker(settings, dns_cache)
 
     return _Runtime(
         shaper=shaper,
         dns=dns,
         cache=cache,
         dns_cache=dns_cache,
-        doh_clients=doh_clients,
+        doh_clients=scheduler.clients if scheduler is not None else (),
+        scheduler=scheduler,
     )
 
 
@@ -245,6 +254,12 @@ def run(settings: Settings, *, configure_resolver: bool,
             runtime.dns_cache.wipe()
         except Exception as exc:  # noqa: BLE001
             logger.warning("dns cache wipe: %s", exc)
+        if runtime.scheduler is not None:
+            # No more attempts or health checks once the clients go.
+            try:
+                runtime.scheduler.close()
+            except Exception as exc:  # noqa: BLE001
+                logger.warning("doh scheduler close: %s", exc)
         for client in runtime.doh_clients:
             try:
                 client.close()
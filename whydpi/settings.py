@@ -22,6 +22,9 @@ except ModuleNotFoundError:
 
 
 DNSMode = Literal["doh", "altport", "off"]
+FirewallBackend = Literal["auto", "nft", "iptables"]
+Interception = Literal["redirect", "tproxy", "nfqueue"]
+OwnerMode = Literal["exclude", "include"]
 
 
 @dataclass(frozen=True)
@@ -61,6 +64,19 @@ class DNSSettings:
     # Secondary is tried if primary fails health check.
     doh_fallback_ip: str = "1.1.1.1"
     doh_fallback_hostname: str = "cloudflare-dns.com"
+    # Further endpoints as ``"ip#hostname"`` (path shared with the
+    # primary).  All configured endpoints are scheduled by measured
+    # latency and error rate (see ``net/doh_scheduler.py``); with
+    # ``doh_hedge`` a query still unanswered after the chosen endpoint's
+    # p95 latency is duplicated to the runner-up.
+    doh_extra_endpoints: tuple[str, ...] = ()
+    doh_hedge: bool = True
+    # Endpoint IPs (from any of the fields above) reached over
+    # DNS-over-TLS on port 853 instead of DoH (see ``net/dot.py``).
+    # DoT skips the HTTP framing and pipelines queries on one stream;
+    # some networks pass 853 where they interfere with 443, others the
+    # reverse.  The endpoint's hostname is verified the same way.
+    dot_endpoints: tuple[str, ...] = ()
     # Local stub resolver address written into /etc/resolv.conf.
     stub_address: str = "127.0.0.53"
     stub_port: int = 53
@@ -79,6 +95,33 @@ class DNSSettings:
     # block uniformly.  This is fully site-free — it keys on record type,
     # never on a hostname or list.
     neutralize_ech: bool = True
+    # Answer ANY queries locally with the RFC 8482 minimal response
+    # instead of forwarding them.  (AAAA is likewise answered NODATA
+    # locally whenever ``net.ipv6_enabled`` is off.)
+    minimal_any: bool = True
+    # Record types browsers ask for together.  A cache miss on one of
+    # them prefetches the others for the same name in the background so
+    # the follow-up query is a hit.  AAAA is skipped without IPv6 and
+    # HTTPS while ``neutralize_ech`` answers it locally; ``()`` disables.
+    prefetch_siblings: tuple[str, ...] = ("A", "AAAA", "HTTPS")
+    # In-memory answer cache in front of DoH (see ``net/dns_cache.py``).
+    # ``cache_max_entries`` bounds the cache; the default suits a single
+    # host, gateways serving a LAN can raise it to 100 k+ names since
+    # eviction cost is logarithmic in the size.  Hot names (hit at least
+    # ``cache_prefetch_min_hits`` times) are refreshed in the background
+    # once less than ``cache_prefetch_fraction`` of their TTL remains;
+    # 0 disables refresh-ahead.  ``cache_serve_stale_s`` is how long an
+    # expired answer may still be served (RFC 8767) while upstream is
+    # slow or failing; 0 disables serve-stale.
+    cache_max_entries: int = 4096
+    cache_prefetch_fraction: float = 0.1
+    cache_prefetch_min_hits: int = 3
+    cache_serve_stale_s: float = 86400.0
+    # Alternate addresses for a failing connection (``DoHResolver``):
+    # wait for ``resolver_quorum`` answers across endpoints and record
+    # types (0 = all of them), at most ``resolver_deadline_s``.
+    resolver_quorum: int = 0
+    resolver_deadline_s: float = 2.0
 
 
 @dataclass(frozen=True)
@@ -136,15 +179,80 @@ class TLSSettings:
     # them.  Overridable through the config file or the
     # ``WHYDPI_DECOY_SNI`` environment variable.
     decoy_sni: str = "www.example.com"
+    # Predictive discovery (Linux stub only, off by default): once an
+    # uncached name has been answered ``predictive_min_queries`` times,
+    # probe its answered IPs in the background with a synthetic hello
+    # and seed the strategy cache before the browser connects.  At most
+    # ``predictive_max_per_minute`` probes run per minute.
+    predictive_discovery: bool = False
+    predictive_min_queries: int = 2
+    predictive_max_per_minute: int = 12
 
 
 @dataclass(frozen=True)
 class NetSettings:
     ipv6_enabled: bool = True
     block_quic: bool = True
+    # With block_quic: keep QUIC to addresses whose every DNS name is
+    # known to work unshaped (needs dns.mode "doh"; on Linux also nft
+    # or ipset).  Unknown and shaped destinations are still blocked.
+    selective_quic: bool = True
     # CIDRs for which port 443 bypasses the proxy entirely (rare).
     bypass_cidrs_v4: tuple[str, ...] = ()
     bypass_cidrs_v6: tuple[str, ...] = ()
+    # How rules reach the kernel (see ``system/netfilter.py``): "nft"
+    # loads one atomic ``inet whydpi`` table, "iptables" one
+    # ``iptables-restore`` batch per family; "auto" prefers nft.
+    firewall_backend: FirewallBackend = "auto"
+    # How TCP/443 reaches the proxy: "redirect" (nat REDIRECT +
+    # SO_ORIGINAL_DST) or "tproxy" (mangle TPROXY + policy routing via
+    # ``tproxy_mark`` / ``tproxy_table``: no NAT, destination untouched).
+    # "nfqueue" runs no proxy: only ClientHellos go through NFQUEUE
+    # ``nfqueue_num`` to the packet shaper, which marks what it sends
+    # with ``shaper_mark`` and ``shaper_mark + 1`` (needs
+    # libnetfilter_queue).
+    interception: Interception = "redirect"
+    tproxy_mark: int = 201
+    tproxy_table: int = 201
+    nfqueue_num: int = 200
+    shaper_mark: int = 202
+    # Learned kernel bypass (Linux, off at 0): a destination IP whose
+    # every name has been relayed as passthrough ``learned_bypass_min_hits``
+    # times skips the proxy for this many seconds.  Needs dns.mode
+    # "doh" (the stub vets shared addresses) and nft or ipset.
+    learned_bypass_s: int = 0
+    learned_bypass_min_hits: int = 3
+    # Exempt the proxy's own ``proxy_mark`` upstream flows from conntrack
+    # (raw-table NOTRACK, nft backend only): one entry per relayed
+    # connection instead of two.  Replies then arrive as ``ct state
+    # untracked``, which a strict host input firewall must accept.
+    notrack_upstream: bool = False
+    # Local TCP/443 by socket owner (Linux): "exclude" sends the listed
+    # users / groups / cgroup-v2 paths (e.g. "system.slice/docker.service")
+    # straight out — package managers, backup agents, image pulls never
+    # touch the proxy; "include" intercepts only theirs.  Names or ids.
+    # ``whydpi counters`` shows the connections each entry matched.
+    owner_policy: OwnerMode = "exclude"
+    owner_uids: tuple[str, ...] = ()
+    owner_gids: tuple[str, ...] = ()
+    owner_cgroups: tuple[str, ...] = ()
+    # Gateway mode (Linux, off while empty): also shape TCP/443 and
+    # answer DNS for clients forwarded from these LAN interfaces.
+    # ``gateway_addresses`` are the router's own addresses there — the
+    # proxy (redirect mode) and DNS stub listen on them.  Subnets narrow
+    # interception to those client ranges (empty: the whole interface).
+    # Forwarding itself (``net.ipv4.ip_forward``, NAT) is left to the host.
+    gateway_interfaces: tuple[str, ...] = ()
+    gateway_addresses: tuple[str, ...] = ()
+    gateway_subnets_v4: tuple[str, ...] = ()
+    gateway_subnets_v6: tuple[str, ...] = ()
+    gateway_dns: bool = True
+    # The proxy port forwarded connections are handed to; kept apart
+    # from ``proxy_port`` so only they count against the limit below.
+    gateway_proxy_port: int = 4444
+    # Concurrent proxied connections per client address (0: unlimited),
+    # so one busy LAN host cannot starve the others.
+    gateway_client_limit: int = 256
 
 
 @dataclass(frozen=True)
@@ -210,8 +318,20 @@ def _merge_dns(base: DNSSettings, data: dict) -> DNSSettings:
         changes["stub_port"] = int(data["stub_port"])
     if "altport_port" in data:
         changes["altport_port"] = int(data["altport_port"])
-    if "neutralize_ech" in data:
-        changes["neutralize_ech"] = bool(data["neutralize_ech"])
+    for key in ("neutralize_ech", "doh_hedge", "minimal_any"):
+        if key in data:
+            changes[key] = bool(data[key])
+    for key in ("doh_extra_endpoints", "dot_endpoints"):
+        if key in data:
+            changes[key] = tuple(data[key])
+    if "prefetch_siblings" in data:
+        changes["prefetch_siblings"] = tuple(str(t).upper() for t in data["prefetch_siblings"])
+    for key in ("cache_prefetch_fraction", "cache_serve_stale_s", "resolver_deadline_s"):
+        if key in data:
+            changes[key] = float(data[key])
+    for key in ("cache_max_entries", "cache_prefetch_min_hits", "resolver_quorum"):
+        if key in data:
+            changes[key] = int(data[key])
     return replace(base, **changes) if changes else base
 
 
@@ -220,9 +340,14 @@ def _merge_tls(base: TLSSettings, data: dict) -> TLSSettings:
     for key in ("default_strategy", "cache_path", "decoy_sni"):
         if key in data:
             changes[key] = data[key]
-    for key in ("proxy_port", "proxy_mark", "success_min_bytes"):
+    for key in (
+        "proxy_port", "proxy_mark", "success_min_bytes",
+        "predictive_min_queries", "predictive_max_per_minute",
+    ):
         if key in data:
             changes[key] = int(data[key])
+    if "predictive_discovery" in data:
+        changes["predictive_discovery"] = bool(data["predictive_discovery"])
     if "probe_timeout_s" in data:
         changes["probe_timeout_s"] = float(data["probe_timeout_s"])
     if "fallback_strategies" in data:
@@ -238,12 +363,23 @@ def _merge_tls(base: TLSSettings, data: dict) -> TLSSettings:
 
 def _merge_net(base: NetSettings, data: dict) -> NetSettings:
     changes: dict = {}
-    for key in ("ipv6_enabled", "block_quic"):
+    for key in ("ipv6_enabled", "block_quic", "selective_quic", "notrack_upstream",
+                "gateway_dns"):
         if key in data:
             changes[key] = bool(data[key])
-    for key in ("bypass_cidrs_v4", "bypass_cidrs_v6"):
+    for key in ("bypass_cidrs_v4", "bypass_cidrs_v6", "gateway_interfaces",
+                "gateway_addresses", "gateway_subnets_v4", "gateway_subnets_v6",
+                "owner_uids", "owner_gids", "owner_cgroups"):
         if key in data:
-            changes[key] = tuple(data[key])
+            # ids may come as TOML integers
+            changes[key] = tuple(str(x) for x in data[key])
+    for key in ("firewall_backend", "interception", "owner_policy"):
+        if key in data:
+            changes[key] = str(data[key])
+    for key in ("learned_bypass_s", "learned_bypass_min_hits", "tproxy_mark", "tproxy_table",
+                "nfqueue_num", "shaper_mark", "gateway_proxy_port", "gateway_client_limit"):
+        if key in data:
+            changes[key] = int(data[key])
     return replace(base, **changes) if changes else base
 
 
@@ -259,6 +395,18 @@ def _apply_env(s: Settings) -> Settings:
         altport_server=_env("ALTPORT_SERVER", s.dns.altport_server),
         altport_port=int(_env("ALTPORT_PORT", str(s.dns.altport_port)) or 0),
         neutralize_ech=_env_bool("NEUTRALIZE_ECH", s.dns.neutralize_ech),
+        minimal_any=_env_bool("MINIMAL_ANY", s.dns.minimal_any),
+        doh_extra_endpoints=_env_tuple("DOH_EXTRA") or s.dns.doh_extra_endpoints,
+        doh_hedge=_env_bool("DOH_HEDGE", s.dns.doh_hedge),
+        dot_endpoints=_env_tuple("DOT_ENDPOINTS") or s.dns.dot_endpoints,
+        prefetch_siblings=(
+            tuple(t.upper() for t in (_env_tuple("PREFETCH_SIBLINGS") or ()))
+            or s.dns.prefetch_siblings
+        ),
+        resolver_quorum=int(_env("RESOLVER_QUORUM", str(s.dns.resolver_quorum)) or 0),
+        resolver_deadline_s=float(
+            _env("RESOLVER_DEADLINE_S", str(s.dns.resolver_deadline_s)) or 0
+        ),
     )
 
     tls_strategies = _env_tuple("FALLBACK")
@@ -275,14 +423,26 @@ def _apply_env(s: Settings) -> Settings:
             or s.tls.user_passthrough_sni
         ),
         decoy_sni=_env("DECOY_SNI", s.tls.decoy_sni),
+        predictive_discovery=_env_bool("PREDICTIVE_DISCOVERY", s.tls.predictive_discovery),
     )
 
     net = replace(
         s.net,
         ipv6_enabled=_env_bool("IPV6", s.net.ipv6_enabled),
         block_quic=_env_bool("BLOCK_QUIC", s.net.block_quic),
+        selective_quic=_env_bool("SELECTIVE_QUIC", s.net.selective_quic),
+        notrack_upstream=_env_bool("NOTRACK_UPSTREAM", s.net.notrack_upstream),
         bypass_cidrs_v4=_env_tuple("BYPASS_V4") or s.net.bypass_cidrs_v4,
         bypass_cidrs_v6=_env_tuple("BYPASS_V6") or s.net.bypass_cidrs_v6,
+        firewall_backend=_env("FIREWALL_BACKEND", s.net.firewall_backend),  # type: ignore[arg-type]
+        interception=_env("INTERCEPTION", s.net.interception),  # type: ignore[arg-type]
+        learned_bypass_s=int(_env("LEARNED_BYPASS_S", str(s.net.learned_bypass_s)) or 0),
+        owner_policy=_env("OWNER_POLICY", s.net.owner_policy),  # type: ignore[arg-type]
+        owner_uids=_env_tuple("OWNER_UIDS") or s.net.owner_uids,
+        owner_gids=_env_tuple("OWNER_GIDS") or s.net.owner_gids,
+        owner_cgroups=_env_tuple("OWNER_CGROUPS") or s.net.owner_cgroups,
+        gateway_interfaces=_env_tuple("GATEWAY_INTERFACES") or s.net.gateway_interfaces,
+        gateway_addresses=_env_tuple("GATEWAY_ADDRESSES") or s.net.gateway_addresses,
     )
 
     probe = _env_tuple("PROBE_TARGETS")
@@ -322,6 +482,47 @@ def apply_cli_overrides(s: Settings, *, probe_targets: Sequence[str] | None = No
     return replace(s, **changes) if changes else s
 
 
+def dns_cache_options(s: Settings) -> dict:
+    """Keyword arguments for :class:`whydpi.net.dns_cache.DnsCache`."""
+    return {
+        "max_entries": s.dns.cache_max_entries,
+        "prefetch_fraction": s.dns.cache_prefetch_fraction,
+        "prefetch_min_hits": s.dns.cache_prefetch_min_hits,
+        "serve_stale_s": s.dns.cache_serve_stale_s,
+    }
+
+
+_SIBLING_QTYPES = {"A": 1, "AAAA": 28, "HTTPS": 65}
+
+
+def sibling_qtypes(s: Settings) -> tuple[int, ...]:
+    """Record types the DNS stub prefetches together (see ``prefetch_siblings``)."""
+    out = []
+    for name in s.dns.prefetch_siblings:
+        qtype = _SIBLING_QTYPES.get(name.upper())
+        if qtype is None:
+            continue
+        if name.upper() == "AAAA" and not s.net.ipv6_enabled:
+            continue
+        if name.upper() == "HTTPS" and s.dns.neutralize_ech:
+            continue
+        out.append(qtype)
+    # A lone type has no sibling to fetch.
+    return tuple(out) if len(out) > 1 else ()
+
+
+def doh_endpoints(s: Settings) -> tuple[tuple[str, str], ...]:
+    """``(ip, hostname)`` for every configured DoH endpoint, primary first."""
+    out = [(s.dns.doh_endpoint_ip, s.dns.doh_endpoint_hostname)]
+    if s.dns.doh_fallback_ip:
+        out.append((s.dns.doh_fallback_ip, s.dns.doh_fallback_hostname))
+    for spec in s.dns.doh_extra_endpoints:
+        ip, _, hostname = spec.partition("#")
+        if ip.strip():
+            out.append((ip.strip(), hostname.strip() or ip.strip()))
+    return tuple(out)
+
+
 def cache_path(s: Settings) -> Path:
     return Path(os.path.expanduser(s.tls.cache_path))
 
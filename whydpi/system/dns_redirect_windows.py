@@ -96,6 +96,7 @@ from typing import Optional
 
 from ..net.dns import DoHClient
 from ..net.dns_cache import DnsCache
+from ..net.doh_scheduler import DoHScheduler
 from ._trace import format_dns_question, trace, trace_enabled
 
 
@@ -123,7 +124,7 @@ class PacketDnsHijacker:
     def __init__(
         self,
         *,
-        primary: DoHClient,
+        primary: "DoHClient | DoHScheduler",
         fallback: Optional[DoHClient] = None,
         cache: Optional[DnsCache] = None,
         worker_threads: int = 32,
@@ -161,9 +162,9 @@ class PacketDnsHijacker:
         )
         self._thread.start()
         logger.info(
-            "DNS hijacker active (upstream primary=%s fallback=%s workers=%d)",
-            getattr(self._primary._endpoint, "ip", "?"),  # type: ignore[attr-defined]
-            getattr(self._fallback._endpoint, "ip", None) if self._fallback else "-",  # type: ignore[attr-defined]
+            "DNS hijacker active (upstream primary=%r fallback=%r workers=%d)",
+            self._primary,
+            self._fallback,
             self._pool._max_workers,
         )
         if trace_enabled():
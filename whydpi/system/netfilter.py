@@ -3,24 +3,205 @@
 
 """Unified netfilter rule manager.
 
-One declarative rule format, one runner, one apply/cleanup cycle.  Supports
-both ``iptables`` and ``ip6tables`` families.  Rules are kept as ordered
-lists; cleanup simply deletes the same rules in reverse, so the object is
-idempotent across restarts.
+One declarative rule format, one apply/cleanup cycle, three backends:
+
+* **nft** (preferred) — the whole rule set is rendered into a dedicated
+  ``inet whydpi`` table and loaded with a single ``nft -f -``, which the
+  kernel applies as one transaction: the ruleset is never half-applied.
+  Cleanup is one ``delete table``.
+* **iptables** — when ``nft`` is missing (or the kernel refuses the
+  table), one ``iptables-restore --noflush`` batch per family fills
+  dedicated ``WHYDPI_<CHAIN>`` chains, jumped to from the built-in ones.
+  Also atomic per family; cleanup drops the jumps and the chains.
+* **legacy** — one ``iptables`` fork per rule, only when
+  ``iptables-restore`` itself is unavailable.
+
+Every builder below returns a :class:`Rule` carrying both its iptables
+argument vector and its nftables statement, so the backends never have
+to translate one into the other.
+
+Address lists (the TLS bypass CIDRs) are an :class:`AddressSet` matched
+by a single rule per family — an nftables interval set, or an ipset
+``hash:net`` under iptables — so a SYN costs one hashed / tree lookup
+however long the list grows, instead of a linear walk over one rule per
+CIDR.  :meth:`Netfilter.update_set` adds and removes elements at
+runtime without touching the rules.  Without ``ipset`` the iptables
+backends fall back to one rule per element.
+
+A set with ``timeout_s`` holds single addresses that the kernel expires
+on its own (nft ``flags timeout``, ipset ``timeout``); it backs the
+learned bypass (:mod:`whydpi.core.bypass`) and needs nft or ipset.
+
+An :class:`OwnerPolicy` keeps local TCP/443 of chosen users, groups or
+cgroups away from the proxy (or intercepts only theirs).  Each owner
+gets a counting rule at the top of mangle OUTPUT, which every packet
+passes before any interception; its named counter — an nft ``counter``
+object, or an iptables comment read back from ``iptables-save -c`` —
+is what :meth:`Netfilter.counters` reports.
+
+Gateway mode (:class:`Gateway`) adds the same interception for traffic
+forwarded from LAN interfaces: TCP/443 and DNS in PREROUTING, QUIC in
+FORWARD, with the bypass sets matched there as well.
+
+NFQUEUE mode (:func:`nfqueue_hello`, :func:`nfqueue_flow`) intercepts
+no connection at all: it queues a flow's first data segments to the
+packet shaper, and afterwards only the flows the shaper tagged through
+their conntrack mark.
 """
 
 from __future__ import annotations
 
+import ipaddress
 import logging
+import re
 import shutil
 import subprocess
-from dataclasses import dataclass
+import threading
+import time
+from dataclasses import dataclass, replace
 from typing import Iterable, Literal, Sequence
 
 
 logger = logging.getLogger(__name__)
 
 Family = Literal["v4", "v6"]
+Backend = Literal["auto", "nft", "iptables"]
+
+NFT_TABLE = "whydpi"
+CHAIN_PREFIX = "WHYDPI_"
+
+# (iptables table, chain) -> (nft chain name, type, hook, priority).
+# Priorities are the iptables-equivalent ones, so our chains run beside
+# (not instead of) any iptables/iptables-nft rules on the host.
+_NFT_CHAINS: dict[tuple[str, str], tuple[str, str, str, int]] = {
+    ("nat", "OUTPUT"): ("nat_output", "nat", "output", -100),
+    ("nat", "PREROUTING"): ("nat_prerouting", "nat", "prerouting", -100),
+    ("filter", "OUTPUT"): ("filter_output", "filter", "output", 0),
+    ("filter", "FORWARD"): ("filter_forward", "filter", "forward", 0),
+    ("raw", "OUTPUT"): ("raw_output", "filter", "output", -300),
+    # ``route`` so a mark set here re-routes the packet (TPROXY mode).
+    ("mangle", "OUTPUT"): ("mangle_output", "route", "output", -150),
+    ("mangle", "PREROUTING"): ("mangle_prerouting", "filter", "prerouting", -150),
+    ("raw", "PREROUTING"): ("raw_prerouting", "filter", "prerouting", -300),
+}
+
+
+@dataclass(frozen=True)
+class AddressSet:
+    """A named list of CIDRs that one rule matches destinations against."""
+
+    name: str           # nft set name; the ipset is ``whydpi-<name>``
+    family: Family
+    elements: tuple[str, ...] = ()
+    # > 0: single addresses, each expiring this long after it was added.
+    timeout_s: int = 0
+
+    @property
+    def ipset_name(self) -> str:
+        return f"whydpi-{self.name}"
+
+
+@dataclass(frozen=True)
+class Owner:
+    """One socket owner named by an :class:`OwnerPolicy`."""
+
+    match: tuple[str, ...]  # iptables form
+    nft: str
+    counter: str
+    nft_not: str            # nft form of "any other owner"
+
+    @property
+    def not_match(self) -> tuple[str, ...]:
+        # ``-m owner ! --uid-owner X``, ``-m cgroup ! --path P``
+        return (*self.match[:2], "!", *self.match[2:])
+
+
+@dataclass(frozen=True)
+class OwnerPolicy:
+    """Whose locally generated TCP/443 the proxy sees.
+
+    ``"exclude"`` returns the listed owners' connections before the
+    interception rule; ``"include"`` intercepts only theirs.  Users and
+    groups are names or numeric ids; cgroups are cgroup-v2 paths such
+    as ``system.slice/docker.service``.
+    """
+
+    mode: Literal["exclude", "include"] = "exclude"
+    uids: tuple[str, ...] = ()
+    gids: tuple[str, ...] = ()
+    cgroups: tuple[str, ...] = ()
+
+    def owners(self) -> list[Owner]:
+        out = [
+            Owner(("-m", "owner", "--uid-owner", uid), f"meta skuid {_nft_id(uid)}",
+                  _counter_name("uid", uid), f"meta skuid != {_nft_id(uid)}")
+            for uid in self.uids
+        ]
+        out += [
+            Owner(("-m", "owner", "--gid-owner", gid), f"meta skgid {_nft_id(gid)}",
+                  _counter_name("gid", gid), f"meta skgid != {_nft_id(gid)}")
+            for gid in self.gids
+        ]
+        for path in self.cgroups:
+            path = path.strip("/")
+            level = f"socket cgroupv2 level {path.count('/') + 1}"
+            out.append(Owner(
+                ("-m", "cgroup", "--path", path),
+                f'{level} "{path}"',
+                _counter_name("cgroup", path),
+                f'{level} != "{path}"',
+            ))
+        return out
+
+
+def _nft_id(value: str) -> str:
+    return value if value.isdigit() else f'"{value}"'
+
+
+def _counter_name(kind: str, value: str) -> str:
+    return f"{kind}_" + re.sub(r"[^A-Za-z0-9]+", "_", value).strip("_")
+
+
+def _comment(counter: str) -> tuple[str, ...]:
+    return ("-m", "comment", "--comment", f"whydpi:{counter}")
+
+
+@dataclass(frozen=True)
+class Gateway:
+    """The LAN side of gateway mode: whose forwarded traffic to intercept."""
+
+    interfaces: tuple[str, ...]
+    # The router's own LAN addresses; DNS is intercepted per family only
+    # where the stub listens on one of them.
+    addresses: tuple[str, ...] = ()
+    # Client source ranges; empty intercepts the whole interface.
+    subnets_v4: tuple[str, ...] = ()
+    subnets_v6: tuple[str, ...] = ()
+    dns: bool = True
+    # Proxy port forwarded connections are handed to, apart from the
+    # host's own (0: the same port).
+    port: int = 0
+
+    def matches(self, family: Family) -> list[tuple[tuple[str, ...], str]]:
+        """``(iptables match, nft match)`` prefixes, one per LAN source.
+
+        The nft prefix always pins the family, as the ``inet`` table
+        sees both.
+        """
+        subnets = self.subnets_v4 if family == "v4" else self.subnets_v6
+        saddr = "ip saddr" if family == "v4" else "ip6 saddr"
+        out: list[tuple[tuple[str, ...], str]] = []
+        for iface in self.interfaces:
+            if not subnets:
+                out.append((("-i", iface), f'iifname "{iface}" {_nfproto(family)}'))
+            out += [
+                (("-i", iface, "-s", subnet), f'iifname "{iface}" {saddr} {subnet}')
+                for subnet in subnets
+            ]
+        return out
+
+    def serves_dns(self, family: Family) -> bool:
+        return self.dns and any((":" in a) == (family == "v6") for a in self.addresses)
 
 
 @dataclass(frozen=True)
@@ -31,6 +212,21 @@ class Rule:
     match: tuple[str, ...]
     action: tuple[str, ...]
     position: Literal["append", "insert"] = "append"
+    # nftables statement for the same rule; ``""`` means the rule has no
+    # nft form and forces the iptables backend.  Conversely an empty
+    # ``action`` marks an nft-only rule the iptables backends skip.
+    nft: str = ""
+    # The set this rule matches; ``match`` then carries the ipset form
+    # (``-m set --match-set <ipset_name> dst``) and ``nft`` ``@<name>``.
+    address_set: AddressSet | None = None
+    # Named counter the rule feeds (``counter name`` in nft, a
+    # ``whydpi:<name>`` comment under iptables); see Netfilter.counters.
+    counter: str = ""
+
+    @property
+    def nft_only(self) -> bool:
+        # A rule without a target is fine under iptables if it only counts.
+        return not self.action and not self.counter
 
     def _binary(self) -> str:
         name = "iptables" if self.family == "v4" else "ip6tables"
@@ -51,10 +247,38 @@ class Rule:
     def del_argv(self) -> list[str]:
         return self._argv("-D")
 
+    def expanded(self, elements: Iterable[str] | None = None) -> list["Rule"]:
+        """One plain ``-d <cidr>`` rule per set element (no ipset).
 
-def _run(argv: Sequence[str], *, must_succeed: bool = False) -> bool:
+        *elements* defaults to the set's own; rules without a set are
+        returned unchanged.
+        """
+        aset = self.address_set
+        if aset is None:
+            return [self]
+        marker = ("-m", "set", "--match-set", aset.ipset_name, "dst")
+        at = next(
+            i for i in range(len(self.match))
+            if self.match[i:i + len(marker)] == marker
+        )
+        return [
+            replace(
+                self,
+                match=self.match[:at] + ("-d", element) + self.match[at + len(marker):],
+                nft="", address_set=None,
+            )
+            for element in (aset.elements if elements is None else elements)
+        ]
+
+
+def _run(
+    argv: Sequence[str], *, must_succeed: bool = False, stdin: str | None = None,
+) -> bool:
     try:
-        result = subprocess.run(list(argv), check=False, capture_output=True)
+        result = subprocess.run(
+            list(argv), check=False, capture_output=True,
+            input=stdin.encode() if stdin is not None else None,
+        )
     except FileNotFoundError as exc:
         if must_succeed:
             raise
@@ -67,28 +291,475 @@ def _run(argv: Sequence[str], *, must_succeed: bool = False) -> bool:
     return result.returncode == 0
 
 
+def _nft_delete(name: str, elements: Sequence[str]) -> str:
+    return f"delete element inet {NFT_TABLE} {name} {{ {', '.join(elements)} }}\n"
+
+
+def _output(argv: Sequence[str]) -> str:
+    """*argv*'s stdout, or ``""`` if it is missing or fails."""
+    try:
+        result = subprocess.run(list(argv), check=False, capture_output=True)
+    except FileNotFoundError:
+        return ""
+    return result.stdout.decode(errors="replace") if result.returncode == 0 else ""
+
+
+def _ordered(rules: Iterable[Rule]) -> list[Rule]:
+    """Chain order: ``insert`` rules first, then ``append`` rules."""
+    rules = list(rules)
+    return (
+        [r for r in rules if r.position == "insert"]
+        + [r for r in rules if r.position != "insert"]
+    )
+
+
+def render_nft(rules: Sequence[Rule]) -> str:
+    """The ``nft -f`` script that (re)creates the whole ``whydpi`` table.
+
+    Starts with the add-then-delete idiom so loading it replaces any
+    previous copy of the table in the same transaction.
+    """
+    sets: dict[str, AddressSet] = {}
+    counters: dict[str, None] = {}
+    chains: dict[tuple[str, str], list[str]] = {}
+    for rule in _ordered(rules):
+        if not rule.nft:
+            raise ValueError(f"rule has no nftables form: {rule}")
+        if rule.address_set is not None:
+            sets[rule.address_set.name] = rule.address_set
+        if rule.counter:
+            counters[rule.counter] = None
+        statements = chains.setdefault((rule.table, rule.chain), [])
+        if rule.nft not in statements:
+            statements.append(rule.nft)
+
+    lines = [
+        f"table inet {NFT_TABLE}",
+        f"delete table inet {NFT_TABLE}",
+        f"table inet {NFT_TABLE} {{",
+    ]
+    for name, aset in sets.items():
+        addr = "ipv4_addr" if aset.family == "v4" else "ipv6_addr"
+        if aset.timeout_s:
+            flags = f"flags timeout; timeout {aset.timeout_s}s;"
+            members = _addresses(aset.elements, aset.family)
+        else:
+            # ``auto-merge`` lets runtime additions overlap existing ranges.
+            flags = "flags interval; auto-merge;"
+            members = _collapse(aset.elements, aset.family)
+        lines += [f"    set {name} {{", f"        type {addr}; {flags}"]
+        if members:
+            lines.append(f"        elements = {{ {', '.join(members)} }}")
+        lines.append("    }")
+    lines += [f"    counter {name} {{ }}" for name in counters]
+    for key, statements in chains.items():
+        try:
+            name, kind, hook, priority = _NFT_CHAINS[key]
+        except KeyError:
+            raise ValueError(f"no nftables chain for {key}") from None
+        lines.append(f"    chain {name} {{")
+        lines.append(f"        type {kind} hook {hook} priority {priority}; policy accept;")
+        lines += [f"        {statement}" for statement in statements]
+        lines.append("    }")
+    lines.append("}")
+    return "\n".join(lines) + "\n"
+
+
+def render_restore(
+    rules: Sequence[Rule],
+    family: Family,
+    *,
+    jumps: Iterable[tuple[str, str]] = (),
+    ipset: bool = True,
+) -> str:
+    """``iptables-restore --noflush`` input for *family*'s rules.
+
+    Declaring ``WHYDPI_<CHAIN>`` creates it or empties a previous copy,
+    so re-applying never duplicates rules.  *jumps* lists the
+    ``(table, chain)`` pairs whose built-in chain still needs its jump
+    to our chain inserted.  Without *ipset*, set rules are expanded to
+    one rule per element.
+    """
+    family_rules = [r for r in rules if r.family == family and not r.nft_only]
+    if not ipset:
+        family_rules = [x for r in family_rules for x in r.expanded()]
+    by_table: dict[str, dict[str, list[Rule]]] = {}
+    for rule in _ordered(family_rules):
+        by_table.setdefault(rule.table, {}).setdefault(rule.chain, []).append(rule)
+    jumps = set(jumps)
+    lines: list[str] = []
+    for table, chains in by_table.items():
+        lines.append(f"*{table}")
+        lines += [f":{CHAIN_PREFIX}{chain} - [0:0]" for chain in chains]
+        for chain, chain_rules in chains.items():
+            for rule in chain_rules:
+                lines.append(" ".join(["-A", f"{CHAIN_PREFIX}{chain}", *rule.match, *rule.action]))
+            if (table, chain) in jumps:
+                lines.append(f"-I {chain} 1 -j {CHAIN_PREFIX}{chain}")
+        lines.append("COMMIT")
+    return "\n".join(lines) + "\n"
+
+
+def render_ipset(rules: Sequence[Rule]) -> str:
+    """``ipset restore`` input (re)creating every set the rules match."""
+    lines: list[str] = []
+    seen: set[str] = set()
+    for rule in rules:
+        aset = rule.address_set
+        if aset is None or aset.name in seen:
+            continue
+        seen.add(aset.name)
+        name = aset.ipset_name
+        timeout = f" timeout {aset.timeout_s}" if aset.timeout_s else ""
+        lines.append(
+            f"create {name} hash:net family {'inet' if aset.family == 'v4' else 'inet6'}"
+            f"{timeout} -exist"
+        )
+        lines.append(f"flush {name}")
+        lines += [
+            f"add {name} {element} -exist"
+            for element in _set_elements(aset.elements, aset.family, aset.timeout_s)
+        ]
+    return "\n".join(lines) + "\n"
+
+
+def _collapse(elements: Iterable[str], family: Family) -> list[str]:
+    """Non-overlapping CIDRs covering *elements* (interval sets reject overlaps)."""
+    nets = []
+    for element in elements:
+        try:
+            net = ipaddress.ip_network(element, strict=False)
+        except ValueError:
+            logger.warning("netfilter: ignoring invalid CIDR %r", element)
+            continue
+        if (net.version == 4) == (family == "v4"):
+            nets.append(net)
+    return [str(net) for net in ipaddress.collapse_addresses(nets)]
+
+
+def _addresses(elements: Iterable[str], family: Family) -> list[str]:
+    """Valid single addresses of *family* among *elements* (timed sets)."""
+    out = []
+    for element in elements:
+        try:
+            addr = ipaddress.ip_address(element)
+        except ValueError:
+            logger.warning("netfilter: ignoring invalid address %r", element)
+            continue
+        if (addr.version == 4) == (family == "v4"):
+            out.append(str(addr))
+    return out
+
+
+def _set_elements(elements: Iterable[str], family: Family, timeout_s: int) -> list[str]:
+    """What a kernel set of *family* may hold; one bad entry fails the batch."""
+    if timeout_s:
+        return _addresses(elements, family)
+    return _collapse(elements, family)
+
+
+def _family_binary(family: Family, suffix: str = "") -> str | None:
+    return shutil.which(("iptables" if family == "v4" else "ip6tables") + suffix)
+
+
 class Netfilter:
-    """Apply / revert a declarative set of rules atomically per-family."""
+    """Apply / revert a declarative set of rules as one batch.
 
-    def __init__(self, rules: Sequence[Rule]):
+    *backend* ``"auto"`` prefers nftables and falls back to
+    ``iptables-restore``; ``"nft"`` / ``"iptables"`` force one.
+    """
+
+    def __init__(self, rules: Sequence[Rule], *, backend: Backend = "auto"):
         self._rules = tuple(rules)
+        self._backend = backend
         self._applied: list[Rule] = []
+        self._applied_via: str | None = None
+        self._use_ipset = False
+        self._lock = threading.Lock()
+        # Live membership of every set, updated by :meth:`update_set`,
+        # and when each member of a timed set expires in the kernel.
+        self._expires: dict[str, dict[str, float]] = {}
+        self._members: dict[str, list[str]] = {
+            r.address_set.name: list(dict.fromkeys(r.address_set.elements))
+            for r in self._rules if r.address_set is not None
+        }
 
     @property
     def rules(self) -> tuple[Rule, ...]:
-        return self._rules
+        """The rules with every set at its current membership."""
+        return tuple(
+            replace(r, address_set=replace(
+                r.address_set, elements=tuple(self._members[r.address_set.name]),
+            )) if r.address_set is not None else r
+            for r in self._rules
+        )
+
+    def set_members(self, name: str) -> tuple[str, ...]:
+        with self._lock:
+            self._expire_locked(name)
+            return tuple(self._members[name])
+
+    @property
+    def timed_sets(self) -> bool:
+        """Whether the applied backend can hold timed (learned) sets."""
+        return self._applied_via == "nft" or (
+            self._applied_via == "iptables" and self._use_ipset
+        )
+
+    def update_set(
+        self, name: str, *, add: Iterable[str] = (), remove: Iterable[str] = (),
+    ) -> None:
+        """Add / remove elements of set *name*, live if already applied.
+
+        nftables and ipset take the change in one call without touching
+        any rule; the per-element fallback inserts or deletes rules.
+        Before :meth:`apply` only the membership is recorded.  Timed sets
+        need a backend with kernel sets (:attr:`timed_sets`).
+        """
+        if name not in self._members:
+            raise KeyError(f"no address set named {name!r}")
+        with self._lock:
+            self._update_set_locked(name, add, remove)
+
+    def _update_set_locked(
+        self, name: str, add: Iterable[str], remove: Iterable[str],
+    ) -> None:
+        self._expire_locked(name)
+        current = self._members[name]
+        added = [e for e in dict.fromkeys(add) if e not in current]
+        removed = [e for e in dict.fromkeys(remove) if e in current]
+        if not added and not removed:
+            return
+        remaining = [e for e in current if e not in removed] + added
+        # Gateway mode matches one set from more than one chain.
+        users = [r for r in self.rules if r.address_set and r.address_set.name == name]
+        rule = users[0]
+        family = rule.family
+        timeout = rule.address_set.timeout_s
+        via = self._applied_via
+        if timeout and via is not None and not self.timed_sets:
+            raise RuntimeError(f"set {name!r} needs nft or ipset for element timeouts")
+        if via == "nft" and timeout:
+            # The kernel may already have expired what we delete, which
+            # fails the whole transaction: deletes go on their own, one
+            # by one if the batch is refused, and never hold up the adds.
+            doomed = _addresses(removed, family)
+            if doomed and not _run(["nft", "-f", "-"], stdin=_nft_delete(name, doomed)):
+                for element in doomed if len(doomed) > 1 else ():
+                    _run(["nft", "-f", "-"], stdin=_nft_delete(name, [element]))
+            members = _addresses(added, family)
+            if members:
+                _run(
+                    ["nft", "-f", "-"], must_succeed=True,
+                    stdin=f"add element inet {NFT_TABLE} {name} {{ {', '.join(members)} }}\n",
+                )
+        elif via == "nft":
+            if removed:
+                # Merged intervals cannot be deleted piecemeal; reload the
+                # set's contents in the same transaction instead.
+                script = f"flush set inet {NFT_TABLE} {name}\n"
+                members = _collapse(remaining, family)
+            else:
+                script = ""
+                members = _collapse(added, family)
+            if members:
+                script += f"add element inet {NFT_TABLE} {name} {{ {', '.join(members)} }}\n"
+            _run(["nft", "-f", "-"], must_succeed=True, stdin=script)
+        elif via == "iptables" and self._use_ipset:
+            ipset_name = rule.address_set.ipset_name
+            lines = [
+                f"del {ipset_name} {e} -exist"
+                for e in _set_elements(removed, family, timeout)
+            ]
+            lines += [
+                f"add {ipset_name} {e} -exist"
+                for e in _set_elements(added, family, timeout)
+            ]
+            if lines:
+                _run(["ipset", "restore"], must_succeed=True, stdin="\n".join(lines) + "\n")
+        elif via in ("iptables", "legacy"):
+            for user in users:
+                if via == "iptables":
+                    user = replace(user, chain=f"{CHAIN_PREFIX}{user.chain}")
+                for plain in user.expanded(removed):
+                    while _run(plain.del_argv()):
+                        pass
+                for plain in user.expanded(added):
+                    _run(plain.add_argv(), must_succeed=True)
+        self._members[name] = remaining
+        if timeout:
+            stamps = self._expires.setdefault(name, {})
+            for element in removed:
+                stamps.pop(element, None)
+            deadline = time.monotonic() + timeout
+            for element in added:
+                stamps[element] = deadline
+
+    def _expire_locked(self, name: str) -> None:
+        stamps = self._expires.get(name)
+        if not stamps:
+            return
+        now = time.monotonic()
+        gone = {e for e, deadline in stamps.items() if deadline <= now}
+        if gone:
+            self._members[name] = [e for e in self._members[name] if e not in gone]
+            for element in gone:
+                del stamps[element]
+
+    @property
+    def applied_via(self) -> str | None:
+        """``"nft"``, ``"iptables"`` or ``"legacy"`` once applied."""
+        return self._applied_via
+
+    def counters(self) -> dict[str, tuple[int, int]]:
+        """``(packets, bytes)`` per named rule counter, from the kernel.
+
+        The owner counters sit in mangle OUTPUT, ahead of interception,
+        so they count every TCP/443 packet (and byte) an owner sends,
+        not just connections.  Zero for rules that are not loaded.
+        """
+        names = {r.counter for r in self._rules if r.counter}
+        totals = dict.fromkeys(names, (0, 0))
+        if not names:
+            return totals
+        via = self._applied_via
+        if via in (None, "nft") and shutil.which("nft"):
+            text = _output(["nft", "list", "counters", "table", "inet", NFT_TABLE])
+            found = re.findall(r"counter (\S+) \{\s*packets (\d+) bytes (\d+)", text)
+            for name, packets, nbytes in found:
+                if name in totals:
+                    totals[name] = (int(packets), int(nbytes))
+            if found or via == "nft":
+                return totals
+        # iptables: per-rule counters, tagged by comment, summed over
+        # families (and over the expanded copies of a set rule).
+        for family in self._families():
+            text = _output([_family_binary(family, "-save") or "iptables-save", "-c"])
+            for packets, nbytes, name in re.findall(
+                r'^\[(\d+):(\d+)\] .*--comment "?whydpi:([^"\s]+)', text, re.M,
+            ):
+                if name in totals:
+                    p, b = totals[name]
+                    totals[name] = (p + int(packets), b + int(nbytes))
+        return totals
 
     def flush_matching(self) -> None:
-        """Remove any prior copies of our rules before applying fresh ones."""
-        for rule in self._rules:
+        """Remove any prior per-rule copies (legacy backend)."""
+        for rule in self._expanded_rules():
             while _run(rule.del_argv()):
                 pass
 
     def apply(self) -> None:
+        if self._backend in ("auto", "nft") and self._nft_capable():
+            try:
+                self._apply_nft()
+                return
+            except (subprocess.CalledProcessError, FileNotFoundError) as exc:
+                if self._backend == "nft":
+                    raise
+                logger.warning("nft apply failed (%s); falling back to iptables",
+                               _stderr(exc))
+        elif self._backend == "nft":
+            raise RuntimeError("nft backend requested but nft is unavailable")
+        if all(_family_binary(f, "-restore") for f in self._families()):
+            self._apply_restore()
+        else:
+            self._apply_legacy()
+
+    def cleanup(self) -> None:
+        via = self._applied_via
+        if via in (None, "nft") and shutil.which("nft"):
+            _run(["nft", "delete", "table", "inet", NFT_TABLE])
+        if via in (None, "iptables"):
+            self._cleanup_restore()
+        if via == "legacy" or (via is None and not all(
+            _family_binary(f, "-restore") for f in self._families()
+        )):
+            for rule in reversed(self._applied or self._expanded_rules()):
+                while _run(rule.del_argv()):
+                    pass
+        if via in (None, "iptables") and shutil.which("ipset"):
+            for name in self._members:
+                _run(["ipset", "destroy", f"whydpi-{name}"])
+        self._applied = []
+        self._applied_via = None
+        self._expires.clear()
+
+    # Backends -----------------------------------------------------------
+
+    def _families(self) -> list[Family]:
+        return sorted({r.family for r in self._rules})
+
+    def _expanded_rules(self) -> list[Rule]:
+        return [x for r in self._xt_rules() for x in r.expanded()]
+
+    def _xt_rules(self) -> list[Rule]:
+        """The rules the iptables backends can express."""
+        return [r for r in self.rules if not r.nft_only]
+
+    def _warn_nft_only(self) -> None:
+        skipped = [r for r in self._rules if r.nft_only]
+        if skipped:
+            logger.warning(
+                "netfilter: %d nftables-only rule(s) skipped on the iptables "
+                "backend (%s)", len(skipped),
+                ", ".join(sorted({f"{r.table}/{r.chain}" for r in skipped})),
+            )
+
+    def _nft_capable(self) -> bool:
+        return shutil.which("nft") is not None and all(
+            r.nft and (r.table, r.chain) in _NFT_CHAINS for r in self._rules
+        )
+
+    def _apply_nft(self) -> None:
+        _run(["nft", "-f", "-"], must_succeed=True, stdin=render_nft(self.rules))
+        self._applied = list(self.rules)
+        self._applied_via = "nft"
+        logger.debug("netfilter: %d rules loaded as nft table %s",
+                     len(self._rules), NFT_TABLE)
+
+    def _apply_restore(self) -> None:
+        self._warn_nft_only()
+        rules = self._xt_rules()
+        self._use_ipset = shutil.which("ipset") is not None
+        if self._use_ipset and any(r.address_set is not None for r in rules):
+            _run(["ipset", "restore"], must_succeed=True, stdin=render_ipset(rules))
+        applied: list[Family] = []
+        try:
+            for family in self._families():
+                binary = _family_binary(family)
+                pairs = {(r.table, r.chain) for r in rules if r.family == family}
+                missing = [
+                    (table, chain) for table, chain in sorted(pairs)
+                    if not _run([binary or "iptables", "-t", table, "-C", chain,
+                                 "-j", f"{CHAIN_PREFIX}{chain}"])
+                ]
+                _run(
+                    [_family_binary(family, "-restore") or "iptables-restore", "--noflush"],
+                    must_succeed=True,
+                    stdin=render_restore(
+                        rules, family, jumps=missing, ipset=self._use_ipset,
+                    ),
+                )
+                applied.append(family)
+        except Exception:
+            for family in applied:
+                self._cleanup_restore_family(family)
+            raise
+        self._applied = list(rules)
+        self._applied_via = "iptables"
+        logger.debug("netfilter: %d rules loaded via iptables-restore", len(self._rules))
+
+    def _apply_legacy(self) -> None:
+        self._warn_nft_only()
         self.flush_matching()
         applied: list[Rule] = []
+        # Each ``-I`` lands at the head of its chain, so inserts go in
+        # reverse to end up in :func:`_ordered` order.
+        ordered = _ordered(self._expanded_rules())
+        inserts = [r for r in ordered if r.position == "insert"]
         try:
-            for rule in self._rules:
+            for rule in [*reversed(inserts), *ordered[len(inserts):]]:
                 _run(rule.add_argv(), must_succeed=True)
                 applied.append(rule)
         except Exception:
@@ -97,20 +768,62 @@ class Netfilter:
                 _run(rule.del_argv())
             raise
         self._applied = applied
+        self._applied_via = "legacy"
 
-    def cleanup(self) -> None:
-        for rule in reversed(self._applied or list(self._rules)):
-            while _run(rule.del_argv()):
+    def _cleanup_restore(self) -> None:
+        for family in self._families():
+            self._cleanup_restore_family(family)
+
+    def _cleanup_restore_family(self, family: Family) -> None:
+        binary = _family_binary(family)
+        restore = _family_binary(family, "-restore")
+        if binary is None or restore is None:
+            return
+        pairs = sorted({(r.table, r.chain) for r in self._xt_rules() if r.family == family})
+        for table, chain in pairs:
+            while _run([binary, "-t", table, "-D", chain, "-j", f"{CHAIN_PREFIX}{chain}"]):
                 pass
-        self._applied = []
+        # Declaring the chain guarantees it exists, so the delete that
+        # follows cannot fail the batch.
+        lines: list[str] = []
+        for table in dict.fromkeys(table for table, _ in pairs):
+            chains = [chain for t, chain in pairs if t == table]
+            lines.append(f"*{table}")
+            lines += [f":{CHAIN_PREFIX}{chain} - [0:0]" for chain in chains]
+            lines += [f"-X {CHAIN_PREFIX}{chain}" for chain in chains]
+            lines.append("COMMIT")
+        if lines:
+            _run([restore, "--noflush"], stdin="\n".join(lines) + "\n")
+
+
+def _stderr(exc: Exception) -> str:
+    stderr = getattr(exc, "stderr", None)
+    if isinstance(stderr, bytes) and stderr.strip():
+        return stderr.decode(errors="replace").strip()
+    return str(exc)
 
 
 # ---------------------------------------------------------------------------
 # Rule builders (policy-agnostic)
 # ---------------------------------------------------------------------------
 
-def tls_redirect(*, port: int, mark: int, family: Family) -> Rule:
-    return Rule(
+def _nfproto(family: Family) -> str:
+    return "meta nfproto " + ("ipv4" if family == "v4" else "ipv6")
+
+
+def _daddr(family: Family) -> str:
+    return "ip daddr" if family == "v4" else "ip6 daddr"
+
+
+def _owned(rule: Rule, owner: Owner | None) -> Rule:
+    """*rule* narrowed to *owner*'s sockets."""
+    if owner is None:
+        return rule
+    return replace(rule, match=(*owner.match, *rule.match), nft=f"{owner.nft} {rule.nft}")
+
+
+def tls_redirect(*, port: int, mark: int, family: Family, owner: Owner | None = None) -> Rule:
+    return _owned(Rule(
         family=family,
         table="nat",
         chain="OUTPUT",
@@ -119,17 +832,287 @@ def tls_redirect(*, port: int, mark: int, family: Family) -> Rule:
             "-m", "mark", "!", "--mark", str(mark),
         ),
         action=("-j", "REDIRECT", "--to-port", str(port)),
+        nft=f"{_nfproto(family)} tcp dport 443 meta mark != {mark} redirect to :{port}",
+    ), owner)
+
+
+def tls_tproxy_mark(
+    *, mark: int, proxy_mark: int, family: Family, owner: Owner | None = None,
+) -> Rule:
+    """TPROXY mode, step 1: mark local TCP/443 for the ``lo`` detour.
+
+    Policy routing (:class:`whydpi.system.policy_route.PolicyRoute`)
+    sends *mark*-ed packets to a ``local`` route, so they re-enter
+    through PREROUTING where :func:`tls_tproxy` can take them.
+    """
+    return _owned(Rule(
+        family=family,
+        table="mangle",
+        chain="OUTPUT",
+        match=(
+            "-p", "tcp", "--dport", "443",
+            "-m", "mark", "!", "--mark", str(proxy_mark),
+        ),
+        action=("-j", "MARK", "--set-mark", str(mark)),
+        nft=(
+            f"{_nfproto(family)} tcp dport 443 meta mark != {proxy_mark} "
+            f"meta mark set {mark}"
+        ),
+    ), owner)
+
+
+def owner_bypass(owner: Owner, family: Family, *, table: str = "nat") -> Rule:
+    """Send *owner*'s TCP/443 straight out."""
+    return Rule(
+        family=family,
+        table=table,
+        chain="OUTPUT",
+        match=(*owner.match, "-p", "tcp", "--dport", "443"),
+        action=("-j", "RETURN"),
+        position="insert",
+        nft=f"{owner.nft} {_nfproto(family)} tcp dport 443 return",
     )
 
 
-def tls_bypass(cidr: str, family: Family) -> Rule:
+def _owner_counter(
+    family: Family, marks: Sequence[int], name: str,
+    match: tuple[str, ...], nft: str,
+) -> Rule:
+    unmarked = tuple(x for mark in marks for x in ("-m", "mark", "!", "--mark", str(mark)))
+    nft_marks = ", ".join(str(mark) for mark in marks)
+    return Rule(
+        family=family,
+        table="mangle",
+        chain="OUTPUT",
+        match=(*match, "-p", "tcp", "--dport", "443", *unmarked, *_comment(name)),
+        action=(),
+        position="insert",
+        nft=(
+            f"{nft} {_nfproto(family)} tcp dport 443 meta mark != {{ {nft_marks} }} "
+            f"counter name {name}"
+        ),
+        counter=name,
+    )
+
+
+def owner_count(owner: Owner, family: Family, marks: Sequence[int]) -> Rule:
+    """Count every TCP/443 packet *owner* sends; no verdict.
+
+    It sits at the top of mangle OUTPUT, before NAT and before any
+    rule that marks or queues the packet, so the counter holds real
+    traffic whatever the interception mode.  Packets carrying one of
+    *marks* — the proxy's or the shaper's own — are not counted.
+    """
+    return _owner_counter(family, marks, owner.counter, owner.match, owner.nft)
+
+
+def owner_other(owners: Sequence[Owner], family: Family, marks: Sequence[int]) -> Rule:
+    """Include mode: count the TCP/443 none of *owners* sent."""
+    return _owner_counter(
+        family, marks, "owner_other",
+        tuple(x for owner in owners for x in owner.not_match),
+        " ".join(owner.nft_not for owner in owners),
+    )
+
+
+def tls_tproxy(
+    *, port: int, mark: int, family: Family, interfaces: Sequence[str] = ("lo",),
+) -> list[Rule]:
+    """TPROXY mode, step 2: hand marked TCP/443 to the proxy unmodified.
+
+    The proxy listens with ``IP_TRANSPARENT``; the original destination
+    is the accepted socket's own address, and nothing is NAT-ed.
+    """
+    on_ip = "127.0.0.1" if family == "v4" else "::1"
+    nft_ip = "ip" if family == "v4" else "ip6"
+    nft_on = on_ip if family == "v4" else f"[{on_ip}]"
+    return [
+        Rule(
+            family=family,
+            table="mangle",
+            chain="PREROUTING",
+            match=("-i", iface, "-p", "tcp", "--dport", "443", "-m", "mark", "--mark", str(mark)),
+            action=(
+                "-j", "TPROXY", "--on-ip", on_ip, "--on-port", str(port),
+                "--tproxy-mark", str(mark),
+            ),
+            nft=(
+                f'{_nfproto(family)} iifname "{iface}" tcp dport 443 meta mark {mark} '
+                f"tproxy {nft_ip} to {nft_on}:{port}"
+            ),
+        )
+        for iface in interfaces
+    ]
+
+
+def _queue(num: int) -> tuple[tuple[str, ...], str]:
+    return ("-j", "NFQUEUE", "--queue-num", str(num), "--queue-bypass"), f"queue num {num} bypass"
+
+
+def nfqueue_hello(
+    *, queue: int, mark: int, proxy_mark: int, family: Family, owner: Owner | None = None,
+) -> Rule:
+    """NFQUEUE mode: queue the first data segments of each TCP/443 flow.
+
+    ``connbytes`` limits this to a flow's first packets and the length
+    floor skips bare ACKs, so in practice only the ClientHello (and its
+    retransmissions) reach the shaper.  Packets it sent itself carry
+    *mark* or ``mark + 1``; flows it rewrites are queued by
+    :func:`nfqueue_flow` instead.  ``bypass`` accepts when nothing
+    listens on the queue.
+    """
+    rewrite = mark + 1
+    action, verdict = _queue(queue)
+    unmarked = tuple(
+        x for m in (proxy_mark, mark, rewrite) for x in ("-m", "mark", "!", "--mark", str(m))
+    )
+    return _owned(Rule(
+        family=family,
+        table="mangle",
+        chain="OUTPUT",
+        match=(
+            "-p", "tcp", "--dport", "443", "--tcp-flags", "SYN,RST", "NONE",
+            "-m", "connbytes", "--connbytes", "2:8",
+            "--connbytes-dir", "original", "--connbytes-mode", "packets",
+            "-m", "length", "--length", "100:65535",
+            *unmarked,
+            "-m", "connmark", "!", "--mark", str(rewrite),
+        ),
+        action=action,
+        nft=(
+            f"{_nfproto(family)} tcp dport 443 tcp flags & (syn | rst) == 0 "
+            f"ct original packets 2-8 meta length >= 100 "
+            f"meta mark != {{ {proxy_mark}, {mark}, {rewrite} }} ct mark != {rewrite} {verdict}"
+        ),
+    ), owner)
+
+
+def nfqueue_flow(*, queue: int, mark: int, family: Family) -> list[Rule]:
+    """NFQUEUE mode: follow the flows the shaper touched.
+
+    The shaper marks what it sends with *mark* (``mark + 1`` when the
+    flow needs sequence rewriting); filter OUTPUT copies that to the
+    connection.  Then replies of a *mark* flow are queued until the
+    first few have been seen, and every packet of a ``mark + 1`` flow
+    in both directions — except the shaper's own.
+    """
+    rewrite = mark + 1
+    action, verdict = _queue(queue)
+    tags = [
+        Rule(
+            family=family,
+            table="filter",
+            chain="OUTPUT",
+            match=("-p", "tcp", "--dport", "443", "-m", "mark", "--mark", str(m)),
+            action=("-j", "CONNMARK", "--set-mark", str(m)),
+            nft=f"{_nfproto(family)} tcp dport 443 meta mark {m} ct mark set {m}",
+        )
+        for m in (mark, rewrite)
+    ]
+    return [
+        *tags,
+        Rule(
+            family=family,
+            table="mangle",
+            chain="OUTPUT",
+            match=(
+                "-p", "tcp", "--dport", "443", "-m", "connmark", "--mark", str(rewrite),
+                "-m", "mark", "!", "--mark", str(rewrite),
+            ),
+            action=action,
+            nft=(
+                f"{_nfproto(family)} tcp dport 443 ct mark {rewrite} "
+                f"meta mark != {rewrite} {verdict}"
+            ),
+        ),
+        Rule(
+            family=family,
+            table="mangle",
+            chain="PREROUTING",
+            match=("-p", "tcp", "--sport", "443", "-m", "connmark", "--mark", str(rewrite)),
+            action=action,
+            nft=f"{_nfproto(family)} tcp sport 443 ct mark {rewrite} {verdict}",
+        ),
+        Rule(
+            family=family,
+            table="mangle",
+            chain="PREROUTING",
+            match=(
+                "-p", "tcp", "--sport", "443", "-m", "connmark", "--mark", str(mark),
+                "-m", "connbytes", "--connbytes", "1:8",
+                "--connbytes-dir", "reply", "--connbytes-mode", "packets",
+            ),
+            action=action,
+            nft=(
+                f"{_nfproto(family)} tcp sport 443 ct mark {mark} "
+                f"ct reply packets 1-8 {verdict}"
+            ),
+        ),
+    ]
+
+
+def gateway_tls_redirect(
+    *, port: int, family: Family, lan: tuple[tuple[str, ...], str],
+) -> Rule:
+    """REDIRECT forwarded LAN TCP/443 to the proxy (gateway mode).
+
+    The proxy must listen on the router's address on that interface;
+    traffic to the router itself is left alone.
+    """
+    match, nft_match = lan
     return Rule(
         family=family,
         table="nat",
+        chain="PREROUTING",
+        match=(*match, "-p", "tcp", "--dport", "443",
+               "-m", "addrtype", "!", "--dst-type", "LOCAL"),
+        action=("-j", "REDIRECT", "--to-port", str(port)),
+        nft=f"{nft_match} tcp dport 443 fib daddr type != local redirect to :{port}",
+    )
+
+
+def gateway_tls_tproxy(
+    *, port: int, mark: int, family: Family, lan: tuple[tuple[str, ...], str],
+) -> Rule:
+    """TPROXY forwarded LAN TCP/443 to the proxy (gateway mode).
+
+    Unlike :func:`tls_tproxy` nothing has marked these packets yet, so
+    the rule matches the LAN source instead and sets the mark itself.
+    """
+    match, nft_match = lan
+    on_ip = "127.0.0.1" if family == "v4" else "::1"
+    nft_ip = "ip" if family == "v4" else "ip6"
+    nft_on = on_ip if family == "v4" else f"[{on_ip}]"
+    return Rule(
+        family=family,
+        table="mangle",
+        chain="PREROUTING",
+        match=(*match, "-p", "tcp", "--dport", "443",
+               "-m", "addrtype", "!", "--dst-type", "LOCAL"),
+        action=(
+            "-j", "TPROXY", "--on-ip", on_ip, "--on-port", str(port),
+            "--tproxy-mark", str(mark),
+        ),
+        nft=(
+            f"{nft_match} tcp dport 443 fib daddr type != local "
+            f"tproxy {nft_ip} to {nft_on}:{port} meta mark set {mark} accept"
+        ),
+    )
+
+
+def tls_bypass(cidrs: Iterable[str], family: Family, *, table: str = "nat") -> Rule:
+    """One rule exempting every CIDR in the ``bypass_<family>`` set."""
+    aset = AddressSet(name=f"bypass_{family}", family=family, elements=tuple(cidrs))
+    return Rule(
+        family=family,
+        table=table,
         chain="OUTPUT",
-        match=("-p", "tcp", "-d", cidr, "--dport", "443"),
+        match=("-p", "tcp", "-m", "set", "--match-set", aset.ipset_name, "dst",
+               "--dport", "443"),
         action=("-j", "RETURN"),
         position="insert",
+        nft=f"{_daddr(family)} @{aset.name} tcp dport 443 return",
+        address_set=aset,
     )
 
 
@@ -147,6 +1130,7 @@ def dns_redirect(*, stub_address: str, stub_port: int, family: Family) -> Rule:
         match=("-p", "udp", "--dport", "53",
                "!", "-d", stub_address),
         action=("-j", "DNAT", "--to-destination", f"{stub_address}:{stub_port}"),
+        nft=_nft_dnat(family, "udp", f"!= {stub_address}", stub_address, stub_port),
     )
 
 
@@ -158,9 +1142,38 @@ def dns_redirect_tcp(*, stub_address: str, stub_port: int, family: Family) -> Ru
         match=("-p", "tcp", "--dport", "53",
                "!", "-d", stub_address),
         action=("-j", "DNAT", "--to-destination", f"{stub_address}:{stub_port}"),
+        nft=_nft_dnat(family, "tcp", f"!= {stub_address}", stub_address, stub_port),
     )
 
 
+def gateway_dns_redirect(
+    *, stub_port: int, family: Family, lan: tuple[tuple[str, ...], str],
+    proto: Literal["udp", "tcp"],
+) -> Rule:
+    """Send LAN clients' DNS, to any server, to the stub (gateway mode).
+
+    REDIRECT lands on the router's address on the incoming interface,
+    where the stub must be bound.
+    """
+    match, nft_match = lan
+    return Rule(
+        family=family,
+        table="nat",
+        chain="PREROUTING",
+        match=(*match, "-p", proto, "--dport", "53"),
+        action=("-j", "REDIRECT", "--to-port", str(stub_port)),
+        nft=f"{nft_match} {proto} dport 53 redirect to :{stub_port}",
+    )
+
+
+def _nft_dnat(
+    family: Family, proto: str, daddr: str, to_addr: str, to_port: int, *, dport: int = 53,
+) -> str:
+    target = f"{to_addr}:{to_port}" if family == "v4" else f"[{to_addr}]:{to_port}"
+    ip = "ip" if family == "v4" else "ip6"
+    return f"{_daddr(family)} {daddr} {proto} dport {dport} dnat {ip} to {target}"
+
+
 def dns_altport_rule(*, server: str, src_port: int, dst_port: int, family: Family,
                      proto: Literal["udp", "tcp"]) -> Rule:
     return Rule(
@@ -169,18 +1182,79 @@ def dns_altport_rule(*, server: str, src_port: int, dst_port: int, family: Famil
         chain="OUTPUT",
         match=("-p", proto, "-d", server, "--dport", str(src_port)),
         action=("-j", "DNAT", "--to-destination", f"{server}:{dst_port}"),
+        nft=_nft_dnat(family, proto, server, server, dst_port, dport=src_port),
     )
 
 
-def quic_block(family: Family) -> Rule:
+def quic_block(family: Family, *, lan: tuple[tuple[str, ...], str] | None = None) -> Rule:
+    """Reject UDP/443 — local, or forwarded from a *lan* source."""
     reject = "icmp-port-unreachable" if family == "v4" else "icmp6-port-unreachable"
+    nft_reject = "icmp type port-unreachable" if family == "v4" else "icmpv6 type port-unreachable"
+    match, nft_match = lan if lan is not None else ((), _nfproto(family))
     return Rule(
         family=family,
         table="filter",
-        chain="OUTPUT",
-        match=("-p", "udp", "--dport", "443"),
+        chain="FORWARD" if lan is not None else "OUTPUT",
+        match=(*match, "-p", "udp", "--dport", "443"),
         action=("-j", "REJECT", "--reject-with", reject),
         position="insert",
+        nft=f"{nft_match} udp dport 443 reject with {nft_reject}",
+    )
+
+
+def quic_allow(family: Family, timeout_s: int) -> Rule:
+    """Let QUIC through to the addresses known to need no shaping.
+
+    Must precede :func:`quic_block` in the chain.
+    """
+    aset = AddressSet(name=f"quic_allow_{family}", family=family, timeout_s=timeout_s)
+    return Rule(
+        family=family,
+        table="filter",
+        chain="OUTPUT",
+        match=("-p", "udp", "-m", "set", "--match-set", aset.ipset_name, "dst",
+               "--dport", "443"),
+        action=("-j", "RETURN"),
+        position="insert",
+        nft=f"{_daddr(family)} @{aset.name} udp dport 443 return",
+        address_set=aset,
+    )
+
+
+def notrack_upstream(family: Family, mark: int) -> list[Rule]:
+    """Keep the proxy's own ``mark``-ed upstream flows out of conntrack.
+
+    Outbound packets carry the socket mark; replies are matched by the
+    mark of the local socket they belong to (nft ``socket mark``), which
+    iptables cannot express in the raw table — so both are nft-only.
+    Untracked replies show ``ct state untracked``: a host firewall that
+    only accepts ``established`` input must accept those too.
+    """
+    return [
+        Rule(
+            family=family, table="raw", chain="OUTPUT", match=(), action=(),
+            nft=f"{_nfproto(family)} meta mark {mark} notrack",
+        ),
+        Rule(
+            family=family, table="raw", chain="PREROUTING", match=(), action=(),
+            nft=f"{_nfproto(family)} meta l4proto tcp socket mark {mark} notrack",
+        ),
+    ]
+
+
+def learned_bypass(family: Family, timeout_s: int, *, table: str = "nat") -> Rule:
+    """Exempt the addresses the proxy learned need no shaping."""
+    aset = AddressSet(name=f"learned_{family}", family=family, timeout_s=timeout_s)
+    return Rule(
+        family=family,
+        table=table,
+        chain="OUTPUT",
+        match=("-p", "tcp", "-m", "set", "--match-set", aset.ipset_name, "dst",
+               "--dport", "443"),
+        action=("-j", "RETURN"),
+        position="insert",
+        nft=f"{_daddr(family)} @{aset.name} tcp dport 443 return",
+        address_set=aset,
     )
 
 
@@ -195,26 +1269,111 @@ def compose_rules(
     dns_stub_address: str | None,
     dns_stub_port: int,
     dns_altport: tuple[str, int, int] | None,
+    learned_bypass_s: int = 0,
+    quic_allow_s: int = 0,
+    notrack_mark: int = 0,
+    tproxy_mark: int = 0,
+    gateway: Gateway | None = None,
+    owners: OwnerPolicy | None = None,
+    shaper_mark: int = 0,
+    nfqueue_num: int = 200,
 ) -> list[Rule]:
-    """Produce the complete rule set for the active configuration."""
+    """Produce the complete rule set for the active configuration.
+
+    A non-zero *tproxy_mark* intercepts TCP/443 with TPROXY (mangle
+    table plus policy routing) instead of ``nat`` REDIRECT.  A
+    *gateway* extends interception to traffic forwarded from the LAN;
+    *owners* narrows the local interception by socket owner.  A
+    non-zero *shaper_mark* hands ClientHellos to the NFQUEUE shaper
+    (:mod:`whydpi.system.nfq_shaper`) on queue *nfqueue_num* instead of
+    proxying whole connections.
+    """
     rules: list[Rule] = []
+    families: tuple[Family, ...] = ("v4", "v6") if ipv6_enabled else ("v4",)
+    # Exemptions live in whichever table intercepts.
+    intercept = "mangle" if tproxy_mark or shaper_mark else "nat"
 
     # QUIC must come before TLS redirect so UDP 443 never races an outbound
     # session.  Using insert positions them at the top of their chains.
+    # With ``quic_allow_s`` the addresses in the timed ``quic_allow`` sets
+    # (see :class:`whydpi.core.quic.QuicPolicy`) keep HTTP/3.
     if block_quic:
-        rules.append(quic_block("v4"))
-        if ipv6_enabled:
-            rules.append(quic_block("v6"))
+        for family in families:
+            if quic_allow_s > 0:
+                rules.append(quic_allow(family, quic_allow_s))
+            rules.append(quic_block(family))
+            if gateway is not None:
+                if quic_allow_s > 0:
+                    rules.append(replace(quic_allow(family, quic_allow_s), chain="FORWARD"))
+                rules += [quic_block(family, lan=lan) for lan in gateway.matches(family)]
 
-    for cidr in bypass_v4:
-        rules.append(tls_bypass(cidr, "v4"))
+    # Always present, even empty, so CIDRs can be added at runtime.
+    rules.append(tls_bypass(bypass_v4, "v4", table=intercept))
     if ipv6_enabled:
-        for cidr in bypass_v6:
-            rules.append(tls_bypass(cidr, "v6"))
+        rules.append(tls_bypass(bypass_v6, "v6", table=intercept))
+    if notrack_mark:
+        rules += notrack_upstream("v4", notrack_mark)
+        if ipv6_enabled:
+            rules += notrack_upstream("v6", notrack_mark)
 
-    rules.append(tls_redirect(port=tls_port, mark=tls_mark, family="v4"))
-    if ipv6_enabled:
-        rules.append(tls_redirect(port=tls_port, mark=tls_mark, family="v6"))
+    if learned_bypass_s > 0:
+        rules.append(learned_bypass("v4", learned_bypass_s, table=intercept))
+        if ipv6_enabled:
+            rules.append(learned_bypass("v6", learned_bypass_s, table=intercept))
+
+    owned = owners.owners() if owners is not None else []
+    include = bool(owned) and owners is not None and owners.mode == "include"
+    # Counted before anything marks them; the shaper's own packets are not.
+    counted = (tls_mark, shaper_mark, shaper_mark + 1) if shaper_mark else (tls_mark,)
+    for family in families:
+        rules += [owner_count(o, family, counted) for o in owned]
+        if include:
+            rules.append(owner_other(owned, family, counted))
+        if owned and not include:
+            rules += [owner_bypass(o, family, table=intercept) for o in owned]
+        # Include mode: one interception rule per listed owner.
+        for owner in owned if include else [None]:
+            if shaper_mark:
+                rules.append(nfqueue_hello(
+                    queue=nfqueue_num, mark=shaper_mark, proxy_mark=tls_mark,
+                    family=family, owner=owner,
+                ))
+            elif tproxy_mark:
+                rules.append(tls_tproxy_mark(
+                    mark=tproxy_mark, proxy_mark=tls_mark, family=family, owner=owner,
+                ))
+            else:
+                rules.append(tls_redirect(
+                    port=tls_port, mark=tls_mark, family=family, owner=owner,
+                ))
+        if shaper_mark:
+            rules += nfqueue_flow(queue=nfqueue_num, mark=shaper_mark, family=family)
+        elif tproxy_mark:
+            rules += tls_tproxy(port=tls_port, mark=tproxy_mark, family=family)
+
+    if gateway is not None:
+        # The same sets exempt forwarded traffic; their rules are simply
+        # repeated in PREROUTING.
+        rules += [
+            replace(r, chain="PREROUTING") for r in list(rules)
+            if r.address_set is not None and r.table == intercept
+        ]
+        lan_port = gateway.port or tls_port
+        for family in families:
+            for lan in gateway.matches(family):
+                if tproxy_mark:
+                    rules.append(gateway_tls_tproxy(
+                        port=lan_port, mark=tproxy_mark, family=family, lan=lan,
+                    ))
+                else:
+                    rules.append(gateway_tls_redirect(port=lan_port, family=family, lan=lan))
+                if dns_stub_address and gateway.serves_dns(family):
+                    rules += [
+                        gateway_dns_redirect(
+                            stub_port=dns_stub_port, family=family, lan=lan, proto=proto,
+                        )
+                        for proto in ("udp", "tcp")
+                    ]
 
     if dns_stub_address:
         rules.append(dns_redirect(
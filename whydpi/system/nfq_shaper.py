@@ -0,0 +1,538 @@
+# Copyright (c) 2025 whyDPI Contributors
+# SPDX-License-Identifier: MIT
+
+"""Linux packet-layer ClientHello shaper on NFQUEUE.
+
+The transparent proxy relays every byte of every intercepted
+connection through Python.  This shaper is the Linux twin of the
+Windows :class:`whydpi.system.windivert.PacketShaper` instead: only the
+ClientHello segment and a few reply packets leave the kernel, and the
+rest of the connection never does.
+
+The rules (:func:`whydpi.system.netfilter.nfqueue_rules`) queue:
+
+* outbound TCP/443 data segments among a flow's first few packets
+  (``connbytes``) — in practice the ClientHello;
+* inbound packets of a tagged flow, until the first few replies have
+  been seen, to learn whether the strategy worked;
+* every packet of a flow shaped with ``record:*``, which grows the
+  client's byte stream by 5 bytes and so needs sequence rewriting for
+  its whole life (:mod:`whydpi.system.seqadj`, shared with Windows).
+
+A shaped ClientHello is dropped and its fragments are sent in its
+place through a raw socket, marked with ``shaper_mark`` (``+1`` for
+``record:*`` flows).  A later netfilter rule copies that mark to the
+connection, which is what the inbound and rewrite rules match on.
+``tcp:*`` flows therefore stop being queued after the handshake, and
+untouched or no-SNI hellos are never queued past their first segment.
+
+A ClientHello larger than one segment (a post-quantum key share pushes
+Chrome's past 1460 bytes) is held back segment by segment until its
+first record is complete, then shaped as a whole; fragments are cut to
+the size of the segments it arrived in.  A gap, a retransmission or a
+tail that never comes (:data:`_REASSEMBLY_S`) releases the held
+segments unchanged.
+
+Kernel-side sequence adjustment (``nf_ct_seqadj``) is only offered to
+NAT helpers, so the ``record:*`` offset is applied here, after
+conntrack has seen the client's own numbers.  Conntrack would then
+find the server acknowledging bytes it never saw and mark the replies
+INVALID, so the shaper turns on ``nf_conntrack_tcp_be_liberal`` while
+it runs and restores the previous value on stop.
+"""
+
+from __future__ import annotations
+
+import logging
+import socket
+import threading
+import time
+from dataclasses import dataclass, replace
+from pathlib import Path
+from typing import Callable, Iterable
+
+from ..core.cache import StrategyCache
+from ..core.discovery import discover_parallel, order_candidates
+from ..core.strategy import Strategy, build_plan
+from ..net.tls_parser import (
+    build_minimal_client_hello, looks_like_client_hello, parse_client_hello,
+)
+from ..settings import passthrough_contains
+from . import tcp_packet
+from .nfqueue import ACCEPT, DROP, NfQueue, Verdict
+from .seqadj import ConnKey, SeqRewrites, record_delta
+from .tcp_packet import FIN, PSH, RST, TcpPacket
+
+
+logger = logging.getLogger(__name__)
+
+_SO_MARK = getattr(socket, "SO_MARK", 36)
+_LIBERAL = Path("/proc/sys/net/netfilter/nf_conntrack_tcp_be_liberal")
+
+# Same lifetimes as the Windows shaper: how long a shaped hello waits
+# for its verdict, and how long one discovery probe per SNI holds off
+# the next.
+_STATE_TTL_S = 8.0
+_DISCOVERY_TTL_S = 20.0
+# A held hello segment waits this long for the next one; more than
+# ``_MAX_HELLO_SEGMENTS`` is not a hello we reassemble.
+_REASSEMBLY_S = 0.2
+_MAX_HELLO_SEGMENTS = 6
+
+
+@dataclass
+class _Flow:
+    sni: str
+    strategy: Strategy
+    seq: int                        # the hello's sequence number
+    packets: tuple[bytes, ...]      # what was sent in its place
+    mark: int
+    created_at: float
+    length: int = 0                 # the hello's bytes in the client's stream
+
+
+@dataclass
+class _Partial:
+    segments: tuple[TcpPacket, ...]  # held (dropped) so far, in order
+    created_at: float
+
+
+class NfqShaper:
+    """Shape outbound ClientHellos queued by the NFQUEUE rules."""
+
+    def __init__(
+        self,
+        *,
+        queue_num: int,
+        shaper_mark: int,
+        proxy_mark: int,
+        default_strategy: Strategy,
+        fallbacks: Iterable[Strategy],
+        cache: StrategyCache,
+        probe_timeout_s: float = 3.0,
+        success_min_bytes: int = 6,
+        passthrough_sni: tuple[str, ...] = (),
+        decoy_sni: str = "www.example.com",
+        on_relayed: Callable[[str, str, bool], None] | None = None,
+        send: Callable[[bytes, TcpPacket, int], None] | None = None,
+    ) -> None:
+        self._queue_num = int(queue_num)
+        self._mark = int(shaper_mark)
+        self._proxy_mark = int(proxy_mark)
+        self._default = default_strategy
+        self._fallbacks = tuple(fallbacks)
+        self._cache = cache
+        self._probe_timeout_s = float(probe_timeout_s)
+        self._success_min_bytes = int(success_min_bytes)
+        self._passthrough = tuple(passthrough_sni)
+        self._on_relayed = on_relayed
+        self._send = send or self._send_raw
+        self._decoy_payload = build_minimal_client_hello(
+            decoy_sni.strip().strip(".").lower() or "www.example.com",
+        )
+
+        self._queue: NfQueue | None = None
+        self._thread: threading.Thread | None = None
+        self._sockets: dict[tuple[int, int], socket.socket] = {}
+        self._liberal_was: str | None = None
+
+        self._flows: dict[ConnKey, _Flow] = {}
+        self._partials: dict[ConnKey, _Partial] = {}
+        self._flows_lock = threading.Lock()
+        self._rewrites = SeqRewrites()
+        self._discovery_inflight: dict[str, float] = {}
+        self._discovery_lock = threading.Lock()
+        self.shaped = 0
+        self.passed = 0
+        # Multi-segment hellos: shaped after reassembly (also counted in
+        # ``shaped``), and released unshaped.
+        self.reassembled = 0
+        self.abandoned = 0
+        self._reassembly_seen = False
+
+    # ------------------------------------------------------------------ lifecycle
+
+    def start(self) -> None:
+        queue = NfQueue(self._queue_num, self.handle)
+        queue.open()
+        self._queue = queue
+        try:
+            self._liberal_was = _LIBERAL.read_text().strip()
+            if self._liberal_was != "1":
+                _LIBERAL.write_text("1")
+        except OSError as exc:
+            self._liberal_was = None
+            logger.warning("cannot enable nf_conntrack_tcp_be_liberal (%s); "
+                           "record:* flows may stall", exc)
+        self._thread = threading.Thread(
+            target=queue.run, name="whydpi-nfqueue", daemon=True,
+        )
+        self._thread.start()
+        logger.info("NFQUEUE shaper on queue %d (marks %d/%d)",
+                    self._queue_num, self._mark, self._mark + 1)
+
+    def stop(self) -> None:
+        if self._queue is not None:
+            self._queue.stop()
+        if self._thread is not None:
+            self._thread.join(timeout=2.0)
+            self._thread = None
+        if self._queue is not None:
+            self._queue.close()
+            self._queue = None
+        if self._liberal_was not in (None, "1"):
+            try:
+                _LIBERAL.write_text(self._liberal_was)
+            except OSError as exc:
+                logger.debug("restoring nf_conntrack_tcp_be_liberal: %s", exc)
+        self._liberal_was = None
+        for sock in self._sockets.values():
+            sock.close()
+        self._sockets.clear()
+        logger.info("NFQUEUE shaper stopped: shaped=%d (reassembled=%d) passed=%d "
+                    "multi-segment unshaped=%d", self.shaped, self.reassembled,
+                    self.passed, self.abandoned)
+
+    # ------------------------------------------------------------------ verdicts
+
+    def handle(self, raw: bytes, _mark: int = 0) -> Verdict:
+        """The verdict for one queued datagram."""
+        packet = tcp_packet.parse(raw)
+        if packet is None:
+            return ACCEPT
+        if self._partials:
+            self._expire_partials()
+        if packet.dst_port == 443:
+            return self._outbound(packet)
+        return self._inbound(packet)
+
+    def _outbound(self, packet: TcpPacket) -> Verdict:
+        key = ConnKey(packet.src, packet.src_port, packet.dst, packet.dst_port)
+        payload = packet.payload
+        with self._flows_lock:
+            flow = self._flows.get(key)
+            partial = self._partials.get(key)
+        if partial is not None and payload:
+            return self._reassemble(packet, key, partial)
+        if (
+            flow is not None and flow.packets and payload
+            and (packet.seq - flow.seq) & 0xFFFFFFFF < max(flow.length, 1)
+        ):
+            # The kernel retransmits (part of) the hello it believes it
+            # sent; repeat what actually went out instead.
+            for out in flow.packets:
+                self._send(out, packet, flow.mark)
+            return DROP
+
+        rewrite = self._rewrites.get(key)
+        if rewrite is not None:
+            if packet.flags & (FIN | RST):
+                self._rewrites.drop(key)
+            return Verdict(payload=packet.rebuild(seq=rewrite.seq(packet.seq)))
+
+        if not payload or not looks_like_client_hello(payload):
+            return ACCEPT
+        return self._shape(packet, key, payload)
+
+    def _shape(
+        self,
+        packet: TcpPacket,
+        key: ConnKey,
+        payload: bytes,
+        held: tuple[TcpPacket, ...] = (),
+    ) -> Verdict:
+        """Shape the hello in *payload*, which ends with *packet*.
+
+        *held* are the earlier segments of a multi-segment hello, already
+        dropped; every path that does not shape sends them on unchanged.
+        """
+        # Sequence numbers and decoys start from the hello's first segment.
+        first = held[0] if held else packet
+        complete = 5 + int.from_bytes(payload[3:5], "big") <= len(payload)
+        view = parse_client_hello(payload)
+        sni = (view.sni or "").lower()
+        if not complete and not sni:
+            return self._hold(packet, key, held)
+        if not sni or passthrough_contains(self._passthrough, sni):
+            self._release(held)
+            self.passed += 1
+            return ACCEPT
+
+        strategy = self._select_strategy(sni)
+        if self._cache.get(sni) is None:
+            self._maybe_kick_discovery(sni, packet.dst, packet.dst_port)
+
+        if strategy.layer == "decoy":
+            self._send_decoy(first, ttl=int(strategy.offset_value or 5))
+            self._release(held)
+            self._track(key, sni, strategy, first, (), self._mark)
+            return Verdict(mark=self._mark)
+        if not complete:
+            if strategy.layer != "passthrough":
+                # Reframing a partial record would corrupt it.
+                return self._hold(packet, key, held)
+            self._release(held)
+            self._track(key, sni, strategy, first, (), self._mark)
+            self.passed += 1
+            return Verdict(mark=self._mark)
+
+        plan = build_plan(payload, view, strategy)
+        fragments = [f for f in plan.fragments if f]
+        delta = record_delta(strategy)
+        if len(fragments) < 2 or sum(map(len, fragments)) != len(payload) + delta:
+            # Nothing to split (passthrough) or a plan we cannot map
+            # onto the stream: forward as is, still watch the reply.
+            self._release(held)
+            self._track(key, sni, strategy, first, (), self._mark)
+            self.passed += 1
+            return Verdict(mark=self._mark)
+
+        if held:
+            # Rebuilt from the first segment; no fragment may outgrow
+            # the segments the kernel sized for this path.
+            first = replace(first, flags=packet.flags)
+            size = max(len(p.payload) for p in (*held, packet))
+            fragments = [f[i:i + size] for f in fragments for i in range(0, len(f), size)]
+        mark = self._mark + 1 if delta else self._mark
+        packets = _segments(first, fragments)
+        try:
+            for out in packets:
+                self._send(out, packet, mark)
+        except OSError as exc:
+            logger.debug("raw send failed (%s); passthrough sni=%s", exc, sni)
+            self._release(held)
+            self.passed += 1
+            return Verdict(mark=self._mark)
+        self._rewrites.register(key, delta)
+        self._track(key, sni, strategy, first, packets, mark, length=len(payload))
+        self.shaped += 1
+        if held:
+            self.reassembled += 1
+        logger.debug("shaped sni=%s strategy=%s frags=%d delta=%d segments=%d",
+                     sni, strategy.label(), len(packets), delta, len(held) + 1)
+        return DROP
+
+    # ------------------------------------------------------------------ reassembly
+
+    def _hold(self, packet: TcpPacket, key: ConnKey, held: tuple[TcpPacket, ...]) -> Verdict:
+        if len(held) + 1 >= _MAX_HELLO_SEGMENTS:
+            self._abandon(held, "too many segments")
+            return Verdict(mark=self._mark)
+        if not self._reassembly_seen:
+            self._reassembly_seen = True
+            logger.info("multi-segment ClientHello seen (e.g. a post-quantum key share); "
+                        "reassembling such hellos before shaping")
+        with self._flows_lock:
+            self._partials[key] = _Partial(
+                segments=(*held, packet), created_at=time.monotonic(),
+            )
+        return DROP
+
+    def _reassemble(self, packet: TcpPacket, key: ConnKey, partial: _Partial) -> Verdict:
+        with self._flows_lock:
+            if self._partials.pop(key, None) is not partial:
+                return Verdict(mark=self._mark)  # released meanwhile
+        last = partial.segments[-1]
+        if packet.seq != (last.seq + len(last.payload)) & 0xFFFFFFFF:
+            # A retransmission or a gap: what we hold goes out as is.
+            self._abandon(partial.segments, "out-of-order segment")
+            return Verdict(mark=self._mark)
+        payload = b"".join(p.payload for p in (*partial.segments, packet))
+        return self._shape(packet, key, payload, held=partial.segments)
+
+    def _expire_partials(self) -> None:
+        cutoff = time.monotonic() - _REASSEMBLY_S
+        with self._flows_lock:
+            stale = [k for k, p in self._partials.items() if p.created_at < cutoff]
+            expired = [self._partials.pop(k) for k in stale]
+        for partial in expired:
+            self._abandon(partial.segments, "rest of the hello never queued")
+
+    def _abandon(self, held: tuple[TcpPacket, ...], why: str) -> None:
+        self._release(held)
+        self.abandoned += 1
+        logger.debug("multi-segment ClientHello to %s sent unshaped: %s",
+                     held[0].dst if held else "?", why)
+
+    def _release(self, held: tuple[TcpPacket, ...]) -> None:
+        """Send dropped segments on unchanged, marked past the queue."""
+        for segment in held:
+            try:
+                self._send(segment.raw, segment, self._mark)
+            except OSError as exc:
+                logger.debug("raw send failed (%s); the kernel will retransmit", exc)
+
+    def _inbound(self, packet: TcpPacket) -> Verdict:
+        key = ConnKey(packet.dst, packet.dst_port, packet.src, packet.src_port)
+        self._observe(key, packet)
+        rewrite = self._rewrites.get(key)
+        if packet.flags & (FIN | RST):
+            self._rewrites.drop(key)
+        if rewrite is None:
+            return ACCEPT
+        return Verdict(payload=packet.rebuild(ack=rewrite.ack(packet.ack)))
+
+    # ------------------------------------------------------------------ learning
+
+    def _observe(self, key: ConnKey, packet: TcpPacket) -> None:
+        with self._flows_lock:
+            flow = self._flows.get(key)
+        if flow is None:
+            return
+        payload = packet.payload
+        label = flow.strategy.label()
+        if packet.flags & RST or (payload and payload[0] not in (0x15, 0x16)):
+            ok = False
+        elif len(payload) >= 2 and payload[0] == 0x16 and payload[1] == 0x03:
+            ok = True
+        else:
+            return  # bare ACK, or an alert we cannot attribute
+        with self._flows_lock:
+            self._flows.pop(key, None)
+        if ok:
+            self._cache.record_success(flow.sni, label)
+            logger.debug("strategy ok sni=%s strategy=%s", flow.sni, label)
+        else:
+            self._cache.record_failure(flow.sni, label)
+            logger.debug("strategy failed sni=%s strategy=%s", flow.sni, label)
+            self._maybe_kick_discovery(flow.sni, key.server_ip, key.server_port)
+        if self._on_relayed is not None:
+            try:
+                self._on_relayed(
+                    key.server_ip, flow.sni, ok and flow.strategy.layer == "passthrough",
+                )
+            except Exception as exc:  # noqa: BLE001
+                logger.debug("relay hook failed for %s: %s", key.server_ip, exc)
+
+    def _select_strategy(self, sni: str) -> Strategy:
+        entry = self._cache.get(sni)
+        if entry is not None:
+            try:
+                return Strategy.parse(entry.strategy)
+            except ValueError:
+                pass
+        return self._default
+
+    def _track(
+        self,
+        key: ConnKey,
+        sni: str,
+        strategy: Strategy,
+        packet: TcpPacket,
+        packets: tuple[bytes, ...],
+        mark: int,
+        *,
+        length: int = 0,
+    ) -> None:
+        now = time.monotonic()
+        with self._flows_lock:
+            self._flows[key] = _Flow(
+                sni=sni, strategy=strategy, seq=packet.seq, packets=packets,
+                mark=mark, created_at=now, length=length,
+            )
+            if len(self._flows) >= 256:
+                cutoff = now - _STATE_TTL_S
+                for stale in [k for k, v in self._flows.items() if v.created_at < cutoff]:
+                    self._flows.pop(stale, None)
+
+    # ------------------------------------------------------------------ discovery
+
+    def _maybe_kick_discovery(self, sni: str, dest_ip: str, dest_port: int) -> None:
+        if not self._fallbacks:
+            return
+        now = time.monotonic()
+        with self._discovery_lock:
+            if self._discovery_inflight.get(sni, 0.0) > now:
+                return
+            self._discovery_inflight[sni] = now + _DISCOVERY_TTL_S
+        threading.Thread(
+            target=self._run_discovery, args=(sni, dest_ip, dest_port),
+            name=f"whydpi-discover-{sni[:32]}", daemon=True,
+        ).start()
+
+    def _run_discovery(self, sni: str, dest_ip: str, dest_port: int) -> None:
+        try:
+            hello = build_minimal_client_hello(sni)
+            # Probe sockets carry the proxy mark, so the queue skips
+            # them and they fragment their own hello.  Decoys need
+            # per-segment TTL control a socket does not give: as on
+            # Windows, the first one is seeded when nothing else wins
+            # and live traffic then tries it.
+            ordered = order_candidates(None, self._default, self._fallbacks)
+            candidates = tuple(s for s in ordered if s.layer != "decoy")
+            decoys = tuple(s for s in ordered if s.layer == "decoy")
+            if not candidates:
+                if decoys:
+                    self._cache.record_success(sni, decoys[0].label())
+                return
+            result = discover_parallel(
+                dest_ip=dest_ip,
+                dest_port=dest_port,
+                hello_bytes=hello,
+                hello_view=parse_client_hello(hello),
+                candidates=candidates,
+                proxy_mark=self._proxy_mark,
+                timeout_s=self._probe_timeout_s,
+                success_min_bytes=self._success_min_bytes,
+                accept_alert=False,
+            )
+            if result.upstream is not None:
+                try:
+                    result.upstream.close()
+                except OSError:
+                    pass
+            attempts = ",".join(f"{lbl}:{reason}" for lbl, reason in result.attempts)
+            if result.strategy is None:
+                if decoys:
+                    self._cache.record_success(sni, decoys[0].label())
+                    logger.warning("active discovery sni=%s: no socket winner (attempts=%s); "
+                                   "seeded %s", sni, attempts, decoys[0].label())
+                else:
+                    logger.warning("active discovery sni=%s: NO STRATEGY  attempts=%s",
+                                   sni, attempts)
+                return
+            self._cache.record_success(sni, result.strategy.label())
+            logger.info("active discovery sni=%s: %s  attempts=%s",
+                        sni, result.strategy.label(), attempts)
+        except Exception:  # noqa: BLE001
+            logger.exception("active discovery sni=%s crashed", sni)
+        finally:
+            with self._discovery_lock:
+                self._discovery_inflight.pop(sni, None)
+
+    # ------------------------------------------------------------------ injection
+
+    def _send_decoy(self, packet: TcpPacket, *, ttl: int) -> None:
+        decoy = packet.rebuild(
+            payload=self._decoy_payload, flags=packet.flags | PSH,
+            ttl=max(1, min(int(ttl), 32)),
+        )
+        try:
+            self._send(decoy, packet, self._mark)
+        except OSError as exc:
+            logger.debug("decoy send failed: %s", exc)
+
+    def _send_raw(self, datagram: bytes, packet: TcpPacket, mark: int) -> None:
+        family = socket.AF_INET if packet.version == 4 else socket.AF_INET6
+        sock = self._sockets.get((family, mark))
+        if sock is None:
+            sock = socket.socket(family, socket.SOCK_RAW, socket.IPPROTO_RAW)
+            sock.setsockopt(socket.SOL_SOCKET, _SO_MARK, mark)
+            self._sockets[(family, mark)] = sock
+        sock.sendto(datagram, (packet.dst, 0))
+
+
+def _segments(packet: TcpPacket, fragments: list[bytes]) -> tuple[bytes, ...]:
+    """*fragments* as consecutive segments starting at the hello's seq.
+
+    ACK, window and options are kept; PSH only stays on the last one.
+    """
+    cursor = packet.seq
+    out = []
+    for i, fragment in enumerate(fragments):
+        flags = packet.flags & ~PSH
+        if i == len(fragments) - 1:
+            flags |= packet.flags & PSH
+        out.append(packet.rebuild(payload=fragment, seq=cursor, flags=flags))
+        cursor = (cursor + len(fragment)) & 0xFFFFFFFF
+    return tuple(out)
@@ -0,0 +1,216 @@
+# Copyright (c) 2025 whyDPI Contributors
+# SPDX-License-Identifier: MIT
+
+"""Minimal ctypes binding for libnetfilter_queue.
+
+Only what the packet shaper (:mod:`whydpi.system.nfq_shaper`) needs:
+bind one queue in copy-packet mode, read the netlink socket, and hand
+each packet to a callback whose :class:`Verdict` is sent back — with
+an optional replacement payload and packet mark.
+
+The library is loaded on first use, so importing this module never
+fails; :meth:`NfQueue.open` raises ``RuntimeError`` when
+``libnetfilter_queue.so`` is not installed.
+"""
+
+from __future__ import annotations
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import socket
+import threading
+from dataclasses import dataclass
+from typing import Callable
+
+
+logger = logging.getLogger(__name__)
+
+
+NF_DROP = 0
+NF_ACCEPT = 1
+
+_COPY_PACKET = 2
+_F_FAIL_OPEN = 0x01
+# Loopback carries up to 64 KiB segments; leave room for the netlink
+# and nfqueue attribute headers around them.
+_RECV_SIZE = 0x20000
+
+_lib: ctypes.CDLL | None = None
+_lib_lock = threading.Lock()
+
+_Callback = ctypes.CFUNCTYPE(
+    ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p,
+)
+
+
+class _PacketHeader(ctypes.Structure):
+    _pack_ = 1
+    _fields_ = [
+        ("packet_id", ctypes.c_uint32),     # network byte order
+        ("hw_protocol", ctypes.c_uint16),
+        ("hook", ctypes.c_uint8),
+    ]
+
+
+@dataclass(frozen=True)
+class Verdict:
+    accept: bool = True
+    # Replacement packet (whole IP datagram); ``None`` keeps the original.
+    payload: bytes | None = None
+    # New packet mark; ``None`` keeps the current one.
+    mark: int | None = None
+
+
+ACCEPT = Verdict()
+DROP = Verdict(accept=False)
+
+
+def _load() -> ctypes.CDLL:
+    global _lib
+    with _lib_lock:
+        if _lib is not None:
+            return _lib
+        path = ctypes.util.find_library("netfilter_queue")
+        if path is None:
+            raise RuntimeError("libnetfilter_queue not found (install libnetfilter-queue1)")
+        lib = ctypes.CDLL(path, use_errno=True)
+        vp, c_int, u16, u32 = ctypes.c_void_p, ctypes.c_int, ctypes.c_uint16, ctypes.c_uint32
+        for name, restype, argtypes in (
+            ("nfq_open", vp, []),
+            ("nfq_close", c_int, [vp]),
+            ("nfq_unbind_pf", c_int, [vp, u16]),
+            ("nfq_bind_pf", c_int, [vp, u16]),
+            ("nfq_create_queue", vp, [vp, u16, _Callback, vp]),
+            ("nfq_destroy_queue", c_int, [vp]),
+            ("nfq_set_mode", c_int, [vp, ctypes.c_uint8, u32]),
+            ("nfq_set_queue_maxlen", c_int, [vp, u32]),
+            ("nfq_set_queue_flags", c_int, [vp, u32, u32]),
+            ("nfq_fd", c_int, [vp]),
+            ("nfq_handle_packet", c_int, [vp, ctypes.c_char_p, c_int]),
+            ("nfq_get_msg_packet_hdr", ctypes.POINTER(_PacketHeader), [vp]),
+            ("nfq_get_nfmark", u32, [vp]),
+            ("nfq_get_payload", c_int, [vp, ctypes.POINTER(ctypes.POINTER(ctypes.c_char))]),
+            ("nfq_set_verdict", c_int, [vp, u32, u32, u32, ctypes.c_char_p]),
+            ("nfq_set_verdict2", c_int, [vp, u32, u32, u32, u32, ctypes.c_char_p]),
+        ):
+            fn = getattr(lib, name)
+            fn.restype = restype
+            fn.argtypes = argtypes
+        _lib = lib
+        return lib
+
+
+class NfQueue:
+    """One NFQUEUE queue, served by :meth:`run` until :meth:`stop`.
+
+    *handler* receives the queued IP datagram and its mark and returns
+    the :class:`Verdict`.  The queue is created fail-open: packets the
+    kernel cannot queue (reader too slow) are accepted, not dropped.
+    """
+
+    def __init__(
+        self,
+        num: int,
+        handler: Callable[[bytes, int], Verdict],
+        *,
+        maxlen: int = 4096,
+    ) -> None:
+        self._num = int(num)
+        self._handler = handler
+        self._maxlen = int(maxlen)
+        self._handle: int | None = None
+        self._queue: int | None = None
+        self._fd = -1
+        self._running = False
+        # ctypes only keeps the C trampoline alive while we hold it.
+        self._callback = _Callback(self._on_packet)
+
+    def open(self) -> None:
+        lib = _load()
+        handle = lib.nfq_open()
+        if not handle:
+            raise OSError(ctypes.get_errno(), "nfq_open failed (needs CAP_NET_ADMIN)")
+        try:
+            for pf in (socket.AF_INET, socket.AF_INET6):
+                # Pre-3.8 kernels need an explicit bind per family;
+                # newer ones ignore these calls.
+                lib.nfq_unbind_pf(handle, pf)
+                lib.nfq_bind_pf(handle, pf)
+            queue = lib.nfq_create_queue(handle, self._num, self._callback, None)
+            if not queue:
+                raise OSError(
+                    ctypes.get_errno(),
+                    f"nfq_create_queue({self._num}) failed (queue already bound?)",
+                )
+            if lib.nfq_set_mode(queue, _COPY_PACKET, 0xFFFF) < 0:
+                lib.nfq_destroy_queue(queue)
+                raise OSError(ctypes.get_errno(), "nfq_set_mode failed")
+            lib.nfq_set_queue_maxlen(queue, self._maxlen)
+            if lib.nfq_set_queue_flags(queue, _F_FAIL_OPEN, _F_FAIL_OPEN) < 0:
+                logger.debug("nfqueue %d: kernel lacks fail-open", self._num)
+        except Exception:
+            lib.nfq_close(handle)
+            raise
+        self._handle, self._queue = handle, queue
+        self._fd = lib.nfq_fd(handle)
+
+    def run(self) -> None:
+        """Serve packets until :meth:`stop`; :meth:`open` must have run."""
+        lib = _load()
+        self._running = True
+        while self._running:
+            try:
+                ready, _, _ = select.select([self._fd], [], [], 0.5)
+                if not ready:
+                    continue
+                data = os.read(self._fd, _RECV_SIZE)
+            except OSError as exc:
+                if not self._running:
+                    break
+                if exc.errno == errno.ENOBUFS:
+                    # The socket overran; fail-open already let those
+                    # packets through, nothing to replay.
+                    logger.debug("nfqueue %d: receive buffer overrun", self._num)
+                    continue
+                logger.warning("nfqueue %d: read failed: %s", self._num, exc)
+                break
+            lib.nfq_handle_packet(self._handle, data, len(data))
+
+    def stop(self) -> None:
+        self._running = False
+
+    def close(self) -> None:
+        self._running = False
+        if self._handle is None:
+            return
+        lib = _load()
+        if self._queue is not None:
+            lib.nfq_destroy_queue(self._queue)
+        lib.nfq_close(self._handle)
+        self._handle = self._queue = None
+        self._fd = -1
+
+    def _on_packet(self, queue, _msg, nfad, _data) -> int:
+        lib = _load()
+        header = lib.nfq_get_msg_packet_hdr(nfad)
+        if not header:
+            return 0
+        packet_id = socket.ntohl(header.contents.packet_id)
+        buf = ctypes.POINTER(ctypes.c_char)()
+        length = lib.nfq_get_payload(nfad, ctypes.byref(buf))
+        raw = ctypes.string_at(buf, length) if length > 0 else b""
+        try:
+            verdict = self._handler(raw, lib.nfq_get_nfmark(nfad))
+        except Exception:  # noqa: BLE001
+            logger.exception("nfqueue %d: handler crashed; accepting packet", self._num)
+            verdict = ACCEPT
+        code = NF_ACCEPT if verdict.accept else NF_DROP
+        body = verdict.payload if verdict.accept else None
+        size = len(body) if body is not None else 0
+        if verdict.mark is not None:
+            return lib.nfq_set_verdict2(queue, packet_id, code, verdict.mark, size, body)
+        return lib.nfq_set_verdict(queue, packet_id, code, size, body)
@@ -0,0 +1,79 @@
+# Copyright (c) 2025 whyDPI Contributors
+# SPDX-License-Identifier: MIT
+
+"""Policy routing for TPROXY interception.
+
+TPROXY only acts in PREROUTING, so locally generated TCP/443 is marked
+in mangle OUTPUT (:func:`whydpi.system.netfilter.tls_tproxy_mark`) and
+routed back in through ``lo`` by a dedicated table that holds a single
+``local`` default route::
+
+    ip rule add fwmark <mark> lookup <table>
+    ip route add local default dev lo table <table>
+
+(and the ``ip -6`` twins).  :meth:`PolicyRoute.apply` is idempotent —
+it deletes any copy left by a crashed run first — and
+:meth:`PolicyRoute.cleanup` removes exactly what it added.
+"""
+
+from __future__ import annotations
+
+import logging
+import shutil
+import subprocess
+from typing import Sequence
+
+
+logger = logging.getLogger(__name__)
+
+
+def _ip(argv: Sequence[str], *, must_succeed: bool = False) -> bool:
+    binary = shutil.which("ip") or "ip"
+    try:
+        result = subprocess.run([binary, *argv], check=False, capture_output=True)
+    except FileNotFoundError:
+        if must_succeed:
+            raise
+        return False
+    if must_succeed and result.returncode != 0:
+        raise subprocess.CalledProcessError(
+            result.returncode, [binary, *argv], result.stdout, result.stderr,
+        )
+    return result.returncode == 0
+
+
+class PolicyRoute:
+    def __init__(self, *, mark: int, table: int, ipv6_enabled: bool = True) -> None:
+        self._mark = mark
+        self._table = table
+        self._families = ("-4", "-6") if ipv6_enabled else ("-4",)
+        self._applied = False
+
+    def commands(self, family: str) -> tuple[list[str], list[str]]:
+        """The ``ip rule`` and ``ip route`` argument vectors for *family*."""
+        return (
+            [family, "rule", "add", "fwmark", str(self._mark), "lookup", str(self._table)],
+            [family, "route", "add", "local", "default", "dev", "lo",
+             "table", str(self._table)],
+        )
+
+    def apply(self) -> None:
+        self.cleanup()
+        try:
+            for family in self._families:
+                for argv in self.commands(family):
+                    _ip(argv, must_succeed=True)
+        except (OSError, subprocess.CalledProcessError):
+            self.cleanup()
+            raise
+        self._applied = True
+        logger.debug("policy routing: fwmark %d -> table %d (local via lo)",
+                     self._mark, self._table)
+
+    def cleanup(self) -> None:
+        for family in self._families:
+            rule, route = self.commands(family)
+            while _ip([*rule[:2], "del", *rule[3:]]):
+                pass
+            _ip([*route[:2], "del", *route[3:]])
+        self._applied = False
@@ -0,0 +1,133 @@
+# Copyright (c) 2025 whyDPI Contributors
+# SPDX-License-Identifier: MIT
+
+"""TCP sequence offsets for packet-layer ``record:*`` shaping.
+
+Reframing a ClientHello as two TLS records adds a 5-byte record header
+to the client's byte stream.  A userspace proxy owns both sockets and
+never notices; a packet-layer shaper — WinDivert on Windows
+(:mod:`whydpi.system.windivert`), NFQUEUE on Linux
+(:mod:`whydpi.system.nfq_shaper`) — must instead, for the rest of the
+connection, bump every client→server ``seq`` by the growth and shrink
+every server→client ``ack`` by the same amount.  Client and server
+each see a consistent sequence space; only the injection window
+carries the extra header.
+
+:class:`SeqRewrites` is that per-connection table, shared by both
+shapers so they agree on keys, expiry and arithmetic.
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+from dataclasses import dataclass
+
+from ..core.strategy import Strategy
+
+
+# How long to keep a per-connection TCP seq-rewrite entry if we never
+# observe a FIN/RST (the connection ended uncleanly or we missed the
+# teardown).  10 s is well beyond any TLS handshake + short request
+# round-trip while being short enough that a recycled ephemeral port
+# can't realistically collide with a stale entry from a prior
+# connection.  Long-lived WebSocket / HTTP/2 streams refresh the entry
+# implicitly every time we rewrite a packet on it, so they survive well
+# past this window.
+REWRITE_TTL_S = 10.0
+
+_MAX_ENTRIES = 4096
+
+
+@dataclass
+class ConnKey:
+    """Canonicalised 4-tuple keyed as (client, server)."""
+    client_ip: str
+    client_port: int
+    server_ip: str
+    server_port: int
+
+    def __hash__(self) -> int:  # noqa: D401
+        return hash((self.client_ip, self.client_port, self.server_ip, self.server_port))
+
+
+@dataclass
+class SeqRewrite:
+    """Per-connection TCP sequence-number offset.
+
+    ``delta`` is the number of bytes the shaper injected into the C->S
+    stream on top of what the client's TCP stack believes it sent.  For
+    ``record:*`` splits this is exactly 5 (a second TLS record header);
+    for ``tcp:*``/``chunked:*`` splits it is 0.  While ``delta != 0``
+    we must rewrite every packet belonging to this 4-tuple:
+
+    * client -> server:  seq_num += delta
+    * server -> client:  ack_num -= delta
+
+    State is kept until we see a FIN/RST in either direction or until
+    the connection has been idle for ``REWRITE_TTL_S``.
+    """
+    delta: int
+    created_at: float
+
+    def seq(self, seq: int) -> int:
+        """The on-wire sequence number for a client segment at *seq*."""
+        return (seq + self.delta) & 0xFFFFFFFF
+
+    def ack(self, ack: int) -> int:
+        """The acknowledgement the client should see for server *ack*."""
+        return (ack - self.delta) & 0xFFFFFFFF
+
+
+def record_delta(strategy: Strategy) -> int:
+    """Bytes a strategy adds to the C->S byte stream.
+
+    Only ``record:*`` variants grow the stream — by exactly 5 bytes
+    (one extra TLS record header).  Everything else leaves the byte
+    count unchanged.
+    """
+    return 5 if strategy.layer == "record" else 0
+
+
+class SeqRewrites:
+    """Thread-safe ``ConnKey -> SeqRewrite`` table with idle expiry."""
+
+    def __init__(self, *, ttl_s: float = REWRITE_TTL_S) -> None:
+        self._ttl = ttl_s
+        self._entries: dict[ConnKey, SeqRewrite] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def register(self, key: ConnKey, delta: int) -> None:
+        if delta == 0:
+            return
+        with self._lock:
+            self._entries[key] = SeqRewrite(delta=delta, created_at=time.monotonic())
+            # Cheap incremental eviction of truly stale entries.
+            if len(self._entries) > _MAX_ENTRIES:
+                cutoff = time.monotonic() - self._ttl
+                dead = [k for k, v in self._entries.items() if v.created_at < cutoff]
+                for k in dead:
+                    self._entries.pop(k, None)
+
+    def drop(self, key: ConnKey) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def get(self, key: ConnKey) -> SeqRewrite | None:
+        with self._lock:
+            state = self._entries.get(key)
+            if state is None:
+                return None
+            now = time.monotonic()
+            # Entries idle for longer than the TTL are dropped here;
+            # otherwise we refresh the timestamp so an actively-used
+            # long-lived connection (WebSocket, gRPC stream, …) keeps
+            # its rewrite state for as long as packets flow on it.
+            if now - state.created_at > self._ttl:
+                self._entries.pop(key, None)
+                return None
+            state.created_at = now
+            return state
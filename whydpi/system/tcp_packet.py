@@ -0,0 +1,125 @@
+# Copyright (c) 2025 whyDPI Contributors
+# SPDX-License-Identifier: MIT
+
+"""Raw IPv4 / IPv6 + TCP packets, as NFQUEUE hands them over.
+
+Just enough to read a queued segment's 4-tuple, flags, sequence
+numbers and payload, and to build a copy with another payload, ``seq``,
+``ack``, flags or TTL — lengths and checksums recomputed.  IPv6 extension
+headers are not walked: such packets parse as ``None`` and the caller
+passes them through untouched.
+"""
+
+from __future__ import annotations
+
+import ipaddress
+import struct
+from dataclasses import dataclass
+
+
+FIN = 0x01
+SYN = 0x02
+RST = 0x04
+PSH = 0x08
+ACK = 0x10
+
+_TCP = 6
+
+
+@dataclass(frozen=True)
+class TcpPacket:
+    raw: bytes
+    version: int
+    ip_len: int         # IP header length
+    src: str
+    dst: str
+    src_port: int
+    dst_port: int
+    seq: int
+    ack: int
+    flags: int
+    tcp_len: int        # TCP header length, options included
+
+    @property
+    def family(self) -> str:
+        return "v4" if self.version == 4 else "v6"
+
+    @property
+    def payload(self) -> bytes:
+        return self.raw[self.ip_len + self.tcp_len:]
+
+    def rebuild(
+        self,
+        *,
+        payload: bytes | None = None,
+        seq: int | None = None,
+        ack: int | None = None,
+        flags: int | None = None,
+        ttl: int | None = None,
+    ) -> bytes:
+        """The packet with the given fields replaced, checksums fixed."""
+        ip = bytearray(self.raw[:self.ip_len])
+        tcp = bytearray(self.raw[self.ip_len:self.ip_len + self.tcp_len])
+        body = self.payload if payload is None else payload
+        struct.pack_into(
+            "!II", tcp, 4,
+            self.seq if seq is None else seq & 0xFFFFFFFF,
+            self.ack if ack is None else ack & 0xFFFFFFFF,
+        )
+        if flags is not None:
+            tcp[13] = flags & 0xFF
+        if ttl is not None:
+            ip[8 if self.version == 4 else 7] = ttl & 0xFF
+        tcp[16:18] = b"\x00\x00"
+        segment_len = len(tcp) + len(body)
+        if self.version == 4:
+            struct.pack_into("!H", ip, 2, self.ip_len + segment_len)
+            ip[10:12] = b"\x00\x00"
+            struct.pack_into("!H", ip, 10, _checksum(bytes(ip)))
+            pseudo = bytes(ip[12:20]) + struct.pack("!BBH", 0, _TCP, segment_len)
+        else:
+            struct.pack_into("!H", ip, 4, segment_len)
+            pseudo = bytes(ip[8:40]) + struct.pack("!I3xB", segment_len, _TCP)
+        struct.pack_into("!H", tcp, 16, _checksum(pseudo + bytes(tcp) + body))
+        return bytes(ip) + bytes(tcp) + body
+
+
+def parse(raw: bytes) -> TcpPacket | None:
+    """Decode *raw* as IP + TCP, or ``None`` if it is anything else."""
+    if len(raw) < 20:
+        return None
+    version = raw[0] >> 4
+    if version == 4:
+        ip_len = (raw[0] & 0x0F) * 4
+        if ip_len < 20 or raw[9] != _TCP:
+            return None
+        src = str(ipaddress.IPv4Address(raw[12:16]))
+        dst = str(ipaddress.IPv4Address(raw[16:20]))
+    elif version == 6:
+        ip_len = 40
+        if len(raw) < ip_len or raw[6] != _TCP:
+            return None
+        src = str(ipaddress.IPv6Address(raw[8:24]))
+        dst = str(ipaddress.IPv6Address(raw[24:40]))
+    else:
+        return None
+    if len(raw) < ip_len + 20:
+        return None
+    src_port, dst_port, seq, ack, offset, flags = struct.unpack_from("!HHIIBB", raw, ip_len)
+    tcp_len = (offset >> 4) * 4
+    if tcp_len < 20 or len(raw) < ip_len + tcp_len:
+        return None
+    return TcpPacket(
+        raw=bytes(raw), version=version, ip_len=ip_len, src=src, dst=dst,
+        src_port=src_port, dst_port=dst_port, seq=seq, ack=ack, flags=flags,
+        tcp_len=tcp_len,
+    )
+
+
+def _checksum(data: bytes) -> int:
+    if len(data) % 2:
+        data += b"\x00"
+    total = sum(struct.unpack(f"!{len(data) // 2}H", data))
+    while total >> 16:
+        total = (total & 0xFFFF) + (total >> 16)
+    return ~total & 0xFFFF
@@ -34,6 +34,8 @@ and, while the connection lives, bump every subsequent client→server
 segment's ``seq_num`` by +5 and shrink every server→client ``ack_num``
 by -5 on the wire.  Client and server each see a consistent sequence
 space; only the injection window carries the extra record header.
+The offset table lives in :mod:`whydpi.system.seqadj`, shared with the
+Linux NFQUEUE shaper.
 
 This matters because many stateless DPI middleboxes reassemble a
 single TLS record split across TCP segments before extracting the
@@ -61,7 +63,7 @@ import struct as _struct
 import threading
 import time
 from dataclasses import dataclass
-from typing import Iterable
+from typing import Callable, Iterable
 
 from ..core.cache import StrategyCache
 from ..core.discovery import discover_parallel, order_candidates
@@ -71,13 +73,16 @@ from ..net.tls_parser import (
     looks_like_client_hello,
     parse_client_hello,
 )
+from ._trace import trace, trace_enabled
+from .seqadj import ConnKey as _ConnKey
+from .seqadj import SeqRewrite, SeqRewrites
+from .seqadj import record_delta as _record_delta
 
 # Default decoy SNI used when the shaper is instantiated without an
 # explicit value (RFC 2606 reserved name).  The real runtime path
 # always passes ``decoy_sni`` through from ``settings.tls.decoy_sni``,
 # so this fallback only matters for unit tests / notebooks.
 _DEFAULT_DECOY_SNI = "www.example.com"
-from ._trace import trace, trace_enabled
 
 logger = logging.getLogger(__name__)
 
@@ -95,28 +100,6 @@ _STATE_TTL_S = 8.0
 # arrives the probe is either done or lost.
 _DISCOVERY_TTL_S = 20.0
 
-# How long to keep a per-connection TCP seq-rewrite entry if we never
-# observe a FIN/RST (the connection ended uncleanly or we missed the
-# teardown).  10 s is well beyond any TLS handshake + short request
-# round-trip while being short enough that a recycled ephemeral port
-# can't realistically collide with a stale entry from a prior
-# connection.  Long-lived WebSocket / HTTP/2 streams refresh the entry
-# implicitly every time we rewrite a packet on it, so they survive well
-# past this window.
-_REWRITE_TTL_S = 10.0
-
-
-@dataclass
-class _ConnKey:
-    """Canonicalised 4-tuple keyed as (client, server)."""
-    client_ip: str
-    client_port: int
-    server_ip: str
-    server_port: int
-
-    def __hash__(self) -> int:  # noqa: D401
-        return hash((self.client_ip, self.client_port, self.server_ip, self.server_port))
-
 
 @dataclass
 class _ConnState:
@@ -125,49 +108,19 @@ class _ConnState:
     created_at: float
 
 
-@dataclass
-class _SeqRewrite:
-    """Per-connection TCP sequence-number offset.
-
-    ``delta`` is the number of bytes the shaper injected into the C->S
-    stream on top of what the client's TCP stack believes it sent.  For
-    ``record:*`` splits this is exactly 5 (a second TLS record header);
-    for ``tcp:*``/``chunked:*`` splits it is 0.  While ``delta != 0``
-    we must rewrite every packet belonging to this 4-tuple:
-
-    * client -> server:  seq_num += delta
-    * server -> client:  ack_num -= delta
-
-    State is kept until we see a FIN/RST in either direction or until
-    the connection has been idle for ``_REWRITE_TTL_S``.
-    """
-    delta: int
-    created_at: float
-
-
 def _remap_for_packet_layer(strategy: Strategy) -> Strategy:
     """Historical no-op kept for API compatibility and unit tests.
 
     Prior versions demoted ``record:*`` to ``tcp:*`` here.  We no longer
     need that because the shaper itself now compensates for the 5-byte
     record-reframing growth with on-the-fly TCP sequence rewriting
-    (see :class:`_SeqRewrite`).  Returning the strategy unchanged means
+    (see :class:`whydpi.system.seqadj.SeqRewrite`).  Returning the strategy unchanged means
     ``record:2`` on Windows produces the exact same on-wire byte pattern
     it does on Linux.
     """
     return strategy
 
 
-def _record_delta(strategy: Strategy) -> int:
-    """Bytes a strategy adds to the C->S byte stream.
-
-    Only ``record:*`` variants grow the stream — by exactly 5 bytes
-    (one extra TLS record header).  Everything else leaves the byte
-    count unchanged.
-    """
-    return 5 if strategy.layer == "record" else 0
-
-
 class PacketShaper:
     """Intercepts outbound TLS ClientHellos and re-injects them as
     fragmented TCP segments; observes inbound replies to grow the cache.
@@ -197,6 +150,7 @@ class PacketShaper:
         probe_timeout_s: float = 3.0,
         success_min_bytes: int = 6,
         decoy_sni: str = _DEFAULT_DECOY_SNI,
+        quic_policy: Callable[[str], bool] | None = None,
     ) -> None:
         self._raw_default = default_strategy
         self._raw_fallbacks = tuple(fallbacks)
@@ -204,6 +158,9 @@ class PacketShaper:
         self._fallbacks = tuple(_remap_for_packet_layer(s) for s in self._raw_fallbacks)
         self._cache = cache
         self._block_quic = bool(block_quic)
+        # Destination IP -> "may keep QUIC" (selective blocking, see
+        # :class:`whydpi.core.quic.QuicPolicy`); ``None`` blocks all.
+        self._quic_policy = quic_policy
         self._probe_timeout_s = float(probe_timeout_s)
         self._success_min_bytes = int(success_min_bytes)
         # Validate and pre-build the decoy ClientHello payload once so
@@ -228,8 +185,7 @@ class PacketShaper:
         # Per-4-tuple TCP sequence-offset state (see class docstring).
         # Keyed by the canonicalised (client, server) pair so both
         # C->S and S->C packets look it up with the same key.
-        self._rewrites: dict[_ConnKey, _SeqRewrite] = {}
-        self._rewrites_lock = threading.Lock()
+        self._rewrites = SeqRewrites()
 
         # SNI -> deadline after which a new discovery probe is allowed
         # again.  Prevents a connection storm from spawning N parallel
@@ -276,7 +232,8 @@ class PacketShaper:
             "packet shaper active (default=%s, fallbacks=%s, quic=%s)",
             self._default.label(),
             ",".join(s.label() for s in self._fallbacks) or "-",
-            "blocked" if self._quic_handle is not None else (
+            ("selective" if self._quic_policy is not None else "blocked")
+            if self._quic_handle is not None else (
                 "allowed" if not self._block_quic else "allowed (failed to block)"
             ),
         )
@@ -325,6 +282,10 @@ class PacketShaper:
         shape.  If either injection fails we fall back to silent drop
         — the prior behaviour — so the shaper never becomes *less*
         reliable than it was.
+
+        With a ``quic_policy``, datagrams to (and replies from) an
+        address it allows are re-injected untouched instead, so sites
+        that need no shaping keep HTTP/3.
         """
         # The pydivert handle was opened and stored on ``self`` by
         # :meth:`start`; we only call ``handle.recv()`` / re-inject, both
@@ -339,6 +300,7 @@ class PacketShaper:
         inject_fail_v6 = 0
         first_rejects_logged = 0
         last_log = time.monotonic()
+        policy = self._quic_policy
         while self._running:
             try:
                 packet = handle.recv()
@@ -346,6 +308,12 @@ class PacketShaper:
                 if self._running:
                     logger.debug("quic recv failed: %s", exc)
                 break
+            if policy is not None and self._quic_allowed(packet, policy):
+                try:
+                    handle.send(packet)
+                except Exception as exc:  # noqa: BLE001
+                    logger.debug("quic pass-through send failed: %s", exc)
+                continue
             injected = False
             is_v6 = False
             try:
@@ -425,6 +393,18 @@ class PacketShaper:
                 inject_fail_v6 = 0
                 last_log = now
 
+    @staticmethod
+    def _quic_allowed(packet, policy: Callable[[str], bool]) -> bool:
+        try:
+            if getattr(packet, "is_outbound", False):
+                remote = getattr(packet, "dst_addr", None)
+            else:
+                remote = getattr(packet, "src_addr", None)
+            return bool(remote) and policy(str(remote))
+        except Exception as exc:  # noqa: BLE001
+            logger.debug("quic policy failed: %s", exc)
+            return False
+
     def _inject_icmp_port_unreachable(self, original) -> bool:
         """Send a synthetic ICMP port-unreachable back to the origin.
 
@@ -559,38 +539,13 @@ class PacketShaper:
         )
 
     def _register_rewrite(self, key: _ConnKey, delta: int) -> None:
-        if delta == 0:
-            return
-        with self._rewrites_lock:
-            self._rewrites[key] = _SeqRewrite(
-                delta=delta, created_at=time.monotonic(),
-            )
-            # Cheap incremental eviction of truly stale entries.
-            if len(self._rewrites) > 4096:
-                cutoff = time.monotonic() - _REWRITE_TTL_S
-                dead = [k for k, v in self._rewrites.items() if v.created_at < cutoff]
-                for k in dead:
-                    self._rewrites.pop(k, None)
+        self._rewrites.register(key, delta)
 
     def _drop_rewrite(self, key: _ConnKey) -> None:
-        with self._rewrites_lock:
-            self._rewrites.pop(key, None)
-
-    def _rewrite_for(self, key: _ConnKey) -> _SeqRewrite | None:
-        with self._rewrites_lock:
-            state = self._rewrites.get(key)
-            if state is None:
-                return None
-            now = time.monotonic()
-            # Entries idle for longer than the TTL are dropped here;
-            # otherwise we refresh the timestamp so an actively-used
-            # long-lived connection (WebSocket, gRPC stream, …) keeps
-            # its rewrite state for as long as packets flow on it.
-            if now - state.created_at > _REWRITE_TTL_S:
-                self._rewrites.pop(key, None)
-                return None
-            state.created_at = now
-            return state
+        self._rewrites.drop(key)
+
+    def _rewrite_for(self, key: _ConnKey) -> SeqRewrite | None:
+        return self._rewrites.get(key)
 
     def _send_with_rewrite_outbound(self, packet) -> None:
         """C->S path for non-CHLO packets.  If this 4-tuple has an
@@ -604,7 +559,7 @@ class PacketShaper:
         state = self._rewrite_for(key)
         if state is not None and state.delta:
             try:
-                packet.tcp.seq_num = (int(packet.tcp.seq_num) + state.delta) & 0xFFFFFFFF
+                packet.tcp.seq_num = state.seq(int(packet.tcp.seq_num))
             except Exception as exc:  # noqa: BLE001
                 logger.debug("seq rewrite (out) failed: %s", exc)
         try:
@@ -627,7 +582,7 @@ class PacketShaper:
         state = self._rewrite_for(key)
         if state is not None and state.delta:
             try:
-                packet.tcp.ack_num = (int(packet.tcp.ack_num) - state.delta) & 0xFFFFFFFF
+                packet.tcp.ack_num = state.ack(int(packet.tcp.ack_num))
             except Exception as exc:  # noqa: BLE001
                 logger.debug("ack rewrite (in) failed: %s", exc)
         try: